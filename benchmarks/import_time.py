@@ -0,0 +1,90 @@
+"""
+Import-time benchmark for src.main.
+
+Runs ``python -X importtime -c "import src.main"`` in fresh interpreters and
+reports the median cumulative import time of src.main together with the
+slowest modules it pulls in. Exits non-zero when the median exceeds the
+budget, so a change that makes startup eagerly import a heavy library again
+fails loudly:
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --runs 9 --budget-ms 250
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from typing import List, Dict, Tuple
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Median cumulative import time of src.main allowed, in milliseconds
+IMPORT_BUDGET_MS = 300
+
+
+def parse_importtime(stderr: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse ``-X importtime`` output.
+
+    Returns:
+        Mapping of module name to (self, cumulative) microseconds
+    """
+    timings = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+    return timings
+
+
+def measure(module: str = 'src.main') -> Dict[str, Tuple[int, int]]:
+    """Import ``module`` in a fresh interpreter and return its import timings."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=REPO_ROOT, capture_output=True, text=True, check=True
+    )
+    return parse_importtime(result.stderr)
+
+
+def run(module: str = 'src.main', runs: int = 5) -> Tuple[float, List[Tuple[str, int]]]:
+    """
+    Benchmark the import of ``module``.
+
+    Returns:
+        Median cumulative import time in milliseconds, and the slowest
+        modules (by self time) of the last run
+    """
+    totals = []
+    timings = {}
+    for _ in range(runs):
+        timings = measure(module)
+        totals.append(timings[module][1] / 1000)
+    slowest = sorted(((name, t[0]) for name, t in timings.items()), key=lambda x: -x[1])
+    return statistics.median(totals), slowest[:10]
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--module', default='src.main')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    median_ms, slowest = run(args.module, args.runs)
+    print(f"{args.module}: median import time {median_ms:.1f} ms over {args.runs} runs "
+          f"(budget {args.budget_ms:.0f} ms)")
+    print("Slowest modules (self time):")
+    for name, self_us in slowest:
+        print(f"  {self_us / 1000:8.1f} ms  {name}")
+
+    if median_ms > args.budget_ms:
+        print(f"FAIL: import time regressed past the {args.budget_ms:.0f} ms budget")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
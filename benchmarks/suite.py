@@ -0,0 +1,333 @@
+"""
+End-to-end benchmark suite against local fakes.
+
+Runs the real listing, selection, captioning and posting code against the
+in-process fakes in ``tests/fakes.py`` (a synthetic GCS bucket, a fake
+Gemini model and a local Graph API server), so results do not depend on the
+network and can be compared from run to run. Latency and errors can be
+injected into every fake call. Reports:
+
+- listing time and memory peak for 1k/100k/1M synthetic blobs
+- time to select from a streamed listing of each bucket
+- posts per minute and p50/p99 latency of every pipeline stage
+- time to load a year of engagement for 50 accounts and plan their week
+- import time of src.main
+
+Results are compared with ``benchmarks/baselines.json``; any metric worse
+than its baseline by more than the tolerance is reported and the command
+exits non-zero:
+
+    python benchmarks/suite.py
+    python benchmarks/suite.py --sizes 1000,100000 --posts 50 --latency 0.02 --error-rate 0.05
+    python benchmarks/suite.py --update-baselines
+
+Baselines depend on the machine; refresh them with ``--update-baselines``
+on the machine that checks for regressions.
+"""
+
+import argparse
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Optional, List, Dict, Any, Callable
+from unittest.mock import patch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import import_time  # noqa: E402
+from tests.fakes import Faults, FakeGenerativeModel, GraphAPIStub, SyntheticBucket  # noqa: E402
+
+BASELINES_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'baselines.json')
+DEFAULT_SIZES = (1_000, 100_000, 1_000_000)
+# Allowed slowdown (or drop in throughput) relative to the baseline
+DEFAULT_TOLERANCE = 0.25
+# Metrics where a bigger number is better; every other metric is a cost
+HIGHER_IS_BETTER = ('posts_per_minute',)
+# Differences below these floors are noise, whatever the ratio
+ABSOLUTE_SLACK = {'_ms': 2.0, '_mb': 1.0}
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of ``values`` (0 < q <= 100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class StageCollector:
+    """Event-log sink that keeps the duration of every stage in memory."""
+
+    def __init__(self):
+        self.durations: Dict[str, List[float]] = {}
+
+    def write(self, event: Dict[str, Any]) -> None:
+        if event.get("event") == "stage":
+            self.durations.setdefault(event["stage"], []).append(event["duration_ms"])
+
+    def summary(self) -> Dict[str, float]:
+        metrics = {}
+        for stage, durations in sorted(self.durations.items()):
+            metrics[f"stage.{stage}.p50_ms"] = round(percentile(durations, 50), 3)
+            metrics[f"stage.{stage}.p99_ms"] = round(percentile(durations, 99), 3)
+        return metrics
+
+
+def _measure_peak(func: Callable[[], Any]) -> float:
+    """Peak memory allocated while ``func`` runs, in MB."""
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def bench_listing(sizes, faults: Optional[Faults] = None) -> Dict[str, float]:
+    """
+    Time a full image listing, and a selection from a streamed listing, per bucket size.
+
+    The memory peak is measured in a separate pass because tracing slows
+    allocation-heavy code down several times.
+    """
+    from src import main
+    from src.history import PostedHistory
+    from src.rotation import SelectionEngine
+
+    metrics = {}
+    with patch.object(main, 'get_config', return_value={}):
+        for size in sizes:
+            manager = main.GoogleCloudStorageManager()
+            manager.bucket = SyntheticBucket(size, folders=max(1, size // 10_000), faults=faults)
+
+            def list_all():
+                return sum(1 for _ in manager.iter_images())
+
+            started = time.perf_counter()
+            count = list_all()
+            metrics[f"list.{size}.ms"] = round((time.perf_counter() - started) * 1000, 1)
+            metrics[f"list.{size}.peak_mb"] = round(_measure_peak(list_all), 2)
+            if count != size:
+                raise RuntimeError(f"Listed {count} of {size} synthetic blobs")
+
+            engine = SelectionEngine(PostedHistory(':memory:'))
+            started = time.perf_counter()
+            engine.select(manager.candidate_source())
+            metrics[f"select.{size}.ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return metrics
+
+
+def bench_pipeline(posts: int, faults: Optional[Faults] = None) -> Dict[str, float]:
+    """
+    Post ``posts`` images one after another through the daemon's job handlers.
+
+    Each post is a select -> caption -> container -> publish job chain run to
+    completion. Selection lists a synthetic bucket, captions come from the
+    fake Gemini model through the caption cache, and posts go to the local
+    Graph API. A failed stage fails its post, since its retry is not due
+    until after the benchmark.
+    """
+    from src import main
+    from src.accounts import Account, AccountContext, AccountDispatcher
+    from src.caption_cache import CachedCaptioner, CaptionCache
+    from src.history import PostedHistory
+    from src.instagram_client import InstagramClient
+    from src.jobs import JobQueue, JobRunner
+    from src.metrics import REGISTRY
+    from src.rotation import SelectionEngine
+
+    config = {"preprocess": {"enabled": False}, "instagram": {"container_timeout": 30}}
+    stub = GraphAPIStub().start()
+    stub.faults = faults
+    collector = StageCollector()
+    previous_log, REGISTRY.event_log = REGISTRY.event_log, collector
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with patch.object(main, 'get_config', return_value=config):
+            manager = main.GoogleCloudStorageManager()
+            manager.bucket = SyntheticBucket(max(1000, posts * 10), folders=4, faults=faults)
+            generator = main.GeminiCaptionGenerator()
+            generator.model = FakeGenerativeModel(faults)
+            captioner = CachedCaptioner(generator, CaptionCache(os.path.join(tmpdir, 'captions.sqlite3')))
+            client = InstagramClient('token', 'bench', base_url=stub.base_url, backoff_factor=0.01)
+            context = AccountContext(Account('bench', 'bench', 'token'),
+                                     SelectionEngine(PostedHistory(':memory:')), lambda: client)
+            queue = JobQueue(':memory:')
+            runner = JobRunner(queue, main.JOB_HANDLERS)
+
+            with patch.object(main, 'get_storage_manager', return_value=manager), \
+                    patch.object(main, 'get_caption_generator', return_value=generator), \
+                    patch.object(main, 'get_cached_captioner', return_value=captioner), \
+                    patch.object(main, 'get_account_dispatcher', return_value=AccountDispatcher([context])), \
+                    patch.object(main, 'get_job_queue', return_value=queue):
+                def run():
+                    for i in range(posts):
+                        queue.enqueue(main.SELECT_JOB, {"account": "bench", "round": f"bench-{i}"})
+                        runner.run_pending()
+                    return context.engine.history.count()
+
+                tracemalloc.start()
+                started = time.perf_counter()
+                try:
+                    succeeded = run()
+                    elapsed = time.perf_counter() - started
+                    peak = tracemalloc.get_traced_memory()[1] / 1e6
+                finally:
+                    tracemalloc.stop()
+    finally:
+        REGISTRY.event_log = previous_log
+        stub.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    metrics = {
+        "pipeline.posts_per_minute": round(succeeded / elapsed * 60, 1),
+        "pipeline.failed_posts": posts - succeeded,
+        "pipeline.peak_mb": round(peak, 2),
+    }
+    metrics.update({f"pipeline.{k}": v for k, v in collector.summary().items()})
+    return metrics
+
+
+def bench_planner(accounts: int = 50, posts_per_day: int = 3) -> Dict[str, float]:
+    """Load a year of engagement history for many accounts, then plan a week for all of them."""
+    import random
+    from src.planner import EngagementStore, PostingPlanner
+
+    rng = random.Random(0)
+    now = time.time()
+    store = EngagementStore(':memory:')
+    store.conn.executemany(
+        "INSERT INTO engagement VALUES (?, ?, ?, ?)",
+        [(f"account-{a}", f"{a}-{n}", now - rng.random() * 365 * 86400, rng.randint(0, 900))
+         for a in range(accounts) for n in range(posts_per_day * 365)])
+    names = [f"account-{a}" for a in range(accounts)]
+    planner = PostingPlanner(store)
+
+    started = time.perf_counter()
+    planner.load()
+    loaded = time.perf_counter()
+    planner.plan(names, start=now, days=7)
+    planned = time.perf_counter()
+    return {
+        "planner.load_ms": round((loaded - started) * 1000, 1),
+        "planner.plan_ms": round((planned - loaded) * 1000, 1),
+    }
+
+
+def bench_import(runs: int = 5) -> Dict[str, float]:
+    median_ms, _ = import_time.run(runs=runs)
+    return {"import.src_main_ms": round(median_ms, 1)}
+
+
+def compare(results: Dict[str, float], baselines: Dict[str, float],
+            tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """
+    Compare results with baselines.
+
+    Returns:
+        A description of every metric that regressed beyond the tolerance
+    """
+    regressions = []
+    for name, value in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None or name.endswith('failed_posts'):
+            continue
+        slack = next((s for suffix, s in ABSOLUTE_SLACK.items() if name.endswith(suffix)), 0.0)
+        if name.endswith(HIGHER_IS_BETTER):
+            limit = baseline * (1 - tolerance)
+            if value < limit:
+                regressions.append(f"{name}: {value} < {limit:.1f} (baseline {baseline})")
+        else:
+            limit = max(baseline * (1 + tolerance), baseline + slack)
+            if value > limit:
+                regressions.append(f"{name}: {value} > {limit:.1f} (baseline {baseline})")
+    return regressions
+
+
+def load_baselines(path: str = BASELINES_PATH) -> Dict[str, float]:
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baselines(results: Dict[str, float], path: str = BASELINES_PATH) -> None:
+    baselines = load_baselines(path)
+    baselines.update(results)
+    with open(path, 'w') as f:
+        json.dump(dict(sorted(baselines.items())), f, indent=2)
+        f.write('\n')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='Comma-separated synthetic bucket sizes to list')
+    parser.add_argument('--posts', type=int, default=100, help='Posts to run through the pipeline')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every fake call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra latency, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability a fake call fails')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', choices=('listing', 'pipeline', 'planner', 'import'), action='append',
+                        help='Run only these scenarios (repeatable)')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed regression relative to the baseline, e.g. 0.25 for 25%%')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--update-baselines', action='store_true',
+                        help='Store these results as the new baselines')
+    args = parser.parse_args(argv)
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+    def faults():
+        if not (args.latency or args.jitter or args.error_rate):
+            return None
+        return Faults(args.latency, args.jitter, args.error_rate, args.seed)
+
+    scenarios = args.only or ['listing', 'pipeline', 'planner', 'import']
+    results: Dict[str, float] = {}
+    if 'listing' in scenarios:
+        results.update(bench_listing([int(s) for s in args.sizes.split(',') if s], faults()))
+    if 'pipeline' in scenarios:
+        results.update(bench_pipeline(args.posts, faults()))
+    if 'planner' in scenarios:
+        results.update(bench_planner())
+    if 'import' in scenarios:
+        results.update(bench_import())
+
+    width = max(len(name) for name in results)
+    for name, value in sorted(results.items()):
+        print(f"{name:<{width}}  {value}")
+
+    if args.update_baselines:
+        if faults():
+            print("Not storing baselines measured with injected faults")
+            return 1
+        save_baselines(results, args.baselines)
+        print(f"\nBaselines written to {args.baselines}")
+        return 0
+
+    if faults():
+        # Injected latency and errors make the numbers incomparable with the baselines
+        return 0
+    regressions = compare(results, load_baselines(args.baselines), args.tolerance)
+    if regressions:
+        print(f"\nREGRESSION: {len(regressions)} metric(s) worse than baseline "
+              f"by more than {args.tolerance:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("\nNo regressions against baselines")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
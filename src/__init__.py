@@ -0,0 +1 @@
+"""Zmaninstaposter: scheduled Instagram posting from Google Cloud Storage with Gemini captions."""
@@ -0,0 +1,174 @@
+"""
+Multi-account registry and per-account posting state.
+
+Accounts are declared in config/config.yaml:
+
+    accounts:
+      - name: gallery
+        user_id: "1784..."
+        access_token_env: GALLERY_ACCESS_TOKEN
+        prefix: paintings/
+        strategy: round_robin_folder
+      - name: prints
+        user_id: "1785..."
+        access_token_env: PRINTS_ACCESS_TOKEN
+        prefix: prints/
+
+Each account gets its own Graph API client (and therefore its own rate-limit
+view), its own posted-history partition and selection engine. Every
+account's posts run as their own jobs, so a failure in one account never
+affects the others.
+"""
+
+import os
+import random
+import logging
+from typing import Optional, List, Dict, Any, Callable, Mapping, NamedTuple, Tuple
+
+from src.manifest import BlobRecord
+from src.rotation import SelectionEngine
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_VALUES = {"YOUR_INSTAGRAM_ACCESS_TOKEN_HERE", "YOUR_INSTAGRAM_USER_ID_HERE"}
+
+
+class Account(NamedTuple):
+    """Static configuration of one Instagram account."""
+    name: str
+    user_id: str
+    access_token: str
+    api_version: str = 'v19.0'
+    prefix: Optional[str] = None
+    strategy: str = 'oldest_unposted'
+    strategy_options: Optional[Dict[str, Any]] = None
+    no_repeat_days: Optional[float] = None
+
+
+def load_accounts(config: Dict[str, Any], environ: Optional[Mapping[str, str]] = None) -> List[Account]:
+    """
+    Build the account registry from configuration.
+
+    Tokens can be given inline (``access_token``) or, preferably, through an
+    environment variable named by ``access_token_env``.
+
+    Args:
+        config: Parsed config.yaml
+        environ: Environment to read ``access_token_env`` from (default os.environ)
+
+    Returns:
+        List of configured accounts (empty if the ``accounts`` section is missing)
+
+    Raises:
+        ValueError: On missing credentials or duplicate account names
+    """
+    environ = os.environ if environ is None else environ
+    accounts = []
+    defaults = config.get('instagram', {})
+    for entry in config.get('accounts', []) or []:
+        name = entry.get('name')
+        token = entry.get('access_token')
+        if entry.get('access_token_env'):
+            token = environ.get(entry['access_token_env'], token)
+        user_id = str(entry.get('user_id') or '')
+
+        if not name:
+            raise ValueError("Every account needs a name")
+        if not token or token in PLACEHOLDER_VALUES:
+            raise ValueError(f"Instagram access token not configured for account '{name}'")
+        if not user_id or user_id in PLACEHOLDER_VALUES:
+            raise ValueError(f"Instagram user ID not configured for account '{name}'")
+        if any(account.name == name for account in accounts):
+            raise ValueError(f"Duplicate account name '{name}'")
+
+        accounts.append(Account(
+            name=name,
+            user_id=user_id,
+            access_token=token,
+            api_version=entry.get('api_version', defaults.get('api_version', 'v19.0')),
+            prefix=entry.get('prefix'),
+            strategy=entry.get('strategy', 'oldest_unposted'),
+            strategy_options=entry.get('strategy_options'),
+            no_repeat_days=entry.get('no_repeat_days'),
+        ))
+    return accounts
+
+
+class PrefixedSource:
+    """Restricts a candidate source to blobs under one prefix."""
+
+    def __init__(self, source, prefix: str):
+        self.source = source
+        self.prefix = prefix
+
+    @property
+    def orders(self) -> Tuple[str, ...]:
+        return getattr(self.source, 'orders', ('name',))
+
+    def iter_records(self, prefix: Optional[str] = None, **kwargs):
+        if prefix and not prefix.startswith(self.prefix):
+            return iter(())
+        return self.source.iter_records(prefix=prefix or self.prefix, **kwargs)
+
+    def sample(self, k: int, rng: Optional[random.Random] = None) -> List[BlobRecord]:
+        # Oversample so filtering by prefix still leaves a useful pool
+        return [r for r in self.source.sample(k * 4, rng) if r.name.startswith(self.prefix)][:k]
+
+    def folders(self) -> List[str]:
+        return [f for f in self.source.folders()
+                if f.startswith(self.prefix) or self.prefix.startswith(f)]
+
+    def folder_of(self, name: str) -> str:
+        return self.source.folder_of(name)
+
+
+class AccountContext:
+    """
+    Per-account runtime state.
+
+    Args:
+        account: Account configuration
+        engine: Selection engine backed by this account's history
+        client_factory: Creates the account's Graph API client on first use
+    """
+
+    def __init__(self, account: Account, engine: SelectionEngine,
+                 client_factory: Callable[[], Any]):
+        self.account = account
+        self.engine = engine
+        self._client_factory = client_factory
+        self._client = None
+
+    @property
+    def name(self) -> str:
+        return self.account.name
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self._client_factory()
+        return self._client
+
+    def source(self, shared_source):
+        """View of the shared candidate source limited to this account's prefix."""
+        if self.account.prefix:
+            return PrefixedSource(shared_source, self.account.prefix)
+        return shared_source
+
+
+class AccountDispatcher:
+    """
+    The accounts to post to, and when to hold their posts back.
+
+    Each account's posts run as select -> caption -> container -> publish
+    jobs (see JOB_HANDLERS in src.main), so the job workers post for
+    several accounts at once and a failing account never holds up the others.
+
+    Args:
+        contexts: Accounts to drive
+        throttle_percent: Defer posts of an account whose Graph API usage is at or above this
+    """
+
+    def __init__(self, contexts: List[AccountContext], throttle_percent: float = 90.0):
+        self.contexts = contexts
+        self.throttle_percent = throttle_percent
@@ -0,0 +1,274 @@
+"""
+Concurrent caption generation for large backfills.
+
+AsyncCaptionBatcher drives a GeminiCaptionGenerator from asyncio with a
+bounded number of in-flight requests, token-bucket limits on requests and
+tokens per minute, and jittered exponential backoff when Gemini answers
+with 429 or a 5xx. When the generator has image thumbnails, several images
+are packed into one request that returns a caption per image. Results are
+streamed as each caption completes.
+"""
+
+import asyncio
+import functools
+import random
+import time
+import logging
+from typing import Optional, List, Dict, Iterable, AsyncIterator, Callable, NamedTuple
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Gemini bills an inline image as a fixed number of input tokens
+TOKENS_PER_IMAGE = 258
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Decide whether a Gemini error is worth retrying.
+
+    google.api_core exceptions expose the HTTP status as ``code``; plain HTTP
+    errors usually carry ``status_code``.
+    """
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    for attr in ('code', 'status_code'):
+        value = getattr(error, attr, None)
+        value = getattr(value, 'value', value)
+        if isinstance(value, int) and value in RETRYABLE_STATUS_CODES:
+            return True
+    return False
+
+
+class TokenBucket:
+    """
+    Asyncio token bucket refilled continuously at ``rate_per_minute``.
+
+    Args:
+        rate_per_minute: Tokens added per minute
+        capacity: Maximum burst size; defaults to one minute's worth
+        clock: Monotonic clock (injectable for tests)
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1) -> None:
+        """Wait until ``amount`` tokens are available and take them."""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class CaptionResult(NamedTuple):
+    """Outcome of one caption request."""
+    image_url: str
+    caption: Optional[str]
+    error: Optional[str]
+    attempts: int
+
+
+class AsyncCaptionBatcher:
+    """
+    Generate captions for many images concurrently.
+
+    Args:
+        generator: GeminiCaptionGenerator with a configured model
+        concurrency: Maximum requests in flight
+        requests_per_minute: Request rate limit; None disables it
+        tokens_per_minute: Token rate limit; None disables it
+        max_retries: Retries per image on retryable errors
+        base_delay: Initial backoff in seconds
+        max_delay: Backoff ceiling in seconds
+    """
+
+    def __init__(self, generator, concurrency: int = 4,
+                 requests_per_minute: Optional[float] = 60,
+                 tokens_per_minute: Optional[float] = None,
+                 max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.generator = generator
+        self.concurrency = max(1, concurrency)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def estimate_tokens(self, contents, images: int = 1) -> int:
+        """
+        Rough token estimate for a request.
+
+        About 4 characters per text token, a fixed cost per inline image, plus
+        the output budget for each caption.
+        """
+        parts = contents if isinstance(contents, list) else [contents]
+        text = sum(len(p) for p in parts if isinstance(p, str))
+        inline = sum(1 for p in parts if isinstance(p, dict))
+        return text // 4 + inline * TOKENS_PER_IMAGE + self.generator.max_tokens * images
+
+    async def _call_model(self, contents, **kwargs) -> str:
+        model = self.generator.model
+        if hasattr(model, 'generate_content_async'):
+            response = await model.generate_content_async(contents, **kwargs)
+        else:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(
+                None, functools.partial(model.generate_content, contents, **kwargs))
+        return response.text.strip()
+
+    async def _request(self, label: str, contents, images: int,
+                       request_bucket: Optional[TokenBucket],
+                       token_bucket: Optional[TokenBucket], **kwargs):
+        """Send one request, retrying retryable errors. Returns (text, error, attempts)."""
+        attempt = 0
+        while True:
+            attempt += 1
+            if request_bucket:
+                await request_bucket.acquire()
+            if token_bucket:
+                await token_bucket.acquire(self.estimate_tokens(contents, images))
+            started = REGISTRY.clock()
+            try:
+                text = await self._call_model(contents, **kwargs)
+                REGISTRY.record_stage('gemini.request', REGISTRY.clock() - started, images=images)
+                return text, None, attempt
+            except Exception as e:
+                REGISTRY.record_stage('gemini.request', REGISTRY.clock() - started, e, images=images)
+                if not is_retryable(e) or attempt > self.max_retries:
+                    logger.error(f"Failed to generate caption for {label}: {e}")
+                    return None, str(e), attempt
+                # Full jitter keeps retries from synchronising across workers
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                logger.warning(f"Retryable Gemini error for {label} ({e}); retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def _caption(self, image_url: str, request_bucket: Optional[TokenBucket],
+                       token_bucket: Optional[TokenBucket]) -> CaptionResult:
+        loop = asyncio.get_running_loop()
+        # Building the contents may fetch and downscale the image
+        contents = await loop.run_in_executor(None, self.generator.build_contents, image_url)
+        caption, error, attempts = await self._request(image_url, contents, 1,
+                                                       request_bucket, token_bucket)
+        return CaptionResult(image_url, caption, error, attempts)
+
+    async def _caption_batch(self, image_urls: List[str], request_bucket: Optional[TokenBucket],
+                             token_bucket: Optional[TokenBucket]) -> List[CaptionResult]:
+        loop = asyncio.get_running_loop()
+        contents = await loop.run_in_executor(None, self.generator.build_batch_contents, image_urls)
+        label = f"a batch of {len(image_urls)} images"
+        text, error, attempts = await self._request(
+            label, contents, len(image_urls), request_bucket, token_bucket,
+            generation_config={"response_mime_type": "application/json"})
+        if text is not None:
+            try:
+                captions = self.generator.parse_batch_response(text, len(image_urls))
+                return [CaptionResult(url, caption, None, attempts)
+                        for url, caption in zip(image_urls, captions)]
+            except ValueError as e:
+                error = str(e)
+        logger.warning(f"Captioning {label} failed ({error}); retrying them one by one")
+        return [await self._caption(url, request_bucket, token_bucket) for url in image_urls]
+
+    async def _caption_group(self, image_urls: List[str], request_bucket: Optional[TokenBucket],
+                             token_bucket: Optional[TokenBucket]) -> List[CaptionResult]:
+        if len(image_urls) == 1:
+            return [await self._caption(image_urls[0], request_bucket, token_bucket)]
+        loop = asyncio.get_running_loop()
+        # Splits the group further if the thumbnails exceed the request size limit
+        batches = await loop.run_in_executor(None, self.generator.plan_batches, image_urls)
+        results = []
+        for batch in batches:
+            if len(batch) == 1:
+                results.append(await self._caption(batch[0], request_bucket, token_bucket))
+            else:
+                results.extend(await self._caption_batch(batch, request_bucket, token_bucket))
+        return results
+
+    def _group_size(self) -> int:
+        if getattr(self.generator, 'thumbnails', None) is None:
+            return 1
+        return max(1, getattr(self.generator, 'images_per_request', 1))
+
+    async def stream(self, image_urls: Iterable[str]) -> AsyncIterator[CaptionResult]:
+        """
+        Caption every image, yielding each result as soon as it completes.
+
+        Args:
+            image_urls: Images to caption
+
+        Yields:
+            CaptionResult per image, in completion order
+        """
+        if not self.generator.model:
+            raise RuntimeError("Gemini AI not configured")
+
+        request_bucket = TokenBucket(self.requests_per_minute) if self.requests_per_minute else None
+        token_bucket = TokenBucket(self.tokens_per_minute) if self.tokens_per_minute else None
+        pending: asyncio.Queue = asyncio.Queue()
+        results: asyncio.Queue = asyncio.Queue()
+        urls = list(dict.fromkeys(image_urls))
+        size = self._group_size()
+        for i in range(0, len(urls), size):
+            pending.put_nowait(urls[i:i + size])
+
+        async def worker() -> None:
+            while True:
+                try:
+                    group = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    group_results = await self._caption_group(group, request_bucket, token_bucket)
+                except Exception as e:
+                    # e.g. a thumbnail that cannot be read; every image still gets a result
+                    logger.error(f"Failed to caption {len(group)} images: {e}")
+                    group_results = [CaptionResult(url, None, str(e), 0) for url in group]
+                for result in group_results:
+                    await results.put(result)
+
+        workers = [asyncio.create_task(worker())
+                   for _ in range(min(self.concurrency, pending.qsize()))]
+        try:
+            for _ in range(len(urls)):
+                yield await results.get()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def generate_captions(self, image_urls: Iterable[str]) -> Dict[str, str]:
+        """
+        Caption every image and return the successful captions.
+
+        Failures are logged and left out of the result.
+
+        Returns:
+            Mapping of image URL to caption
+        """
+        captions = {}
+        failed: List[str] = []
+        async for result in self.stream(image_urls):
+            if result.caption is not None:
+                captions[result.image_url] = result.caption
+            else:
+                failed.append(result.image_url)
+        logger.info(f"Generated {len(captions)} captions ({len(failed)} failed)")
+        return captions
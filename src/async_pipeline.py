@@ -0,0 +1,133 @@
+"""
+Asyncio pipeline of stages connected by bounded queues.
+
+Each item (e.g. one post) passes through the stages in order. Every stage
+has its own workers, so while one post waits for Instagram to process its
+container the next one is already being captioned. The queues between
+stages are bounded: a slow stage makes the earlier ones wait instead of
+piling up work.
+
+Stage functions may be coroutines or plain blocking functions; blocking
+ones run on a thread pool. A stage returns the item handed to the next
+stage, or ``Finished(result)`` to end the item early. An exception ends
+only that item; ``on_error`` turns it into the item's result.
+
+    pipeline = AsyncPipeline([Stage('caption', caption, workers=2),
+                              Stage('post', post, workers=4)])
+    results = pipeline.run_sync(items)
+"""
+
+import asyncio
+import inspect
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Any, Callable, Iterable, NamedTuple
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    """One pipeline stage and the number of items it works on at once."""
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+class Finished(NamedTuple):
+    """Returned by a stage to end an item early with ``result``."""
+    result: Any
+
+
+def default_on_error(item: Any, error: Exception, stage: Stage) -> Any:
+    logger.error(f"Pipeline stage '{stage.name}' failed: {error}")
+    return {"error": str(error), "stage": stage.name}
+
+
+class AsyncPipeline:
+    """
+    Run items through stages concurrently, keeping results in input order.
+
+    Args:
+        stages: Stages in the order items pass through them
+        queue_size: Items waiting between two stages before the earlier
+            stage blocks
+        on_error: ``(item, exception, stage) -> result`` for failed items
+        executor: Thread pool for blocking stages; one sized to the total
+            number of workers is created per run by default
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 2,
+                 on_error: Callable[[Any, Exception, Stage], Any] = default_on_error,
+                 executor: Optional[ThreadPoolExecutor] = None):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage")
+        self.stages = [stage._replace(workers=max(1, stage.workers)) for stage in stages]
+        self.queue_size = max(1, queue_size)
+        self.on_error = on_error
+        self.executor = executor
+
+    async def _call(self, stage: Stage, item: Any, executor: ThreadPoolExecutor) -> Any:
+        if inspect.iscoroutinefunction(stage.func):
+            return await stage.func(item)
+        return await asyncio.get_running_loop().run_in_executor(executor, stage.func, item)
+
+    async def run(self, items: Iterable[Any]) -> List[Any]:
+        """
+        Process every item and wait for all of them.
+
+        Returns:
+            One result per item, in input order: the last stage's return
+            value, a Finished result, or the on_error result
+        """
+        items = list(items)
+        results: List[Any] = [None] * len(items)
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+        executor = self.executor or ThreadPoolExecutor(
+            max_workers=sum(stage.workers for stage in self.stages), thread_name_prefix='pipeline')
+
+        async def feed():
+            for entry in enumerate(items):
+                await queues[0].put(entry)
+            for _ in range(self.stages[0].workers):
+                await queues[0].put(_DONE)
+
+        async def work(k: int):
+            stage = self.stages[k]
+            while True:
+                entry = await queues[k].get()
+                REGISTRY.set('pipeline_queue_depth', queues[k].qsize(), stage=stage.name)
+                if entry is _DONE:
+                    return
+                index, item = entry
+                try:
+                    output = await self._call(stage, item, executor)
+                except Exception as e:
+                    results[index] = self.on_error(item, e, stage)
+                    continue
+                if isinstance(output, Finished):
+                    results[index] = output.result
+                elif k + 1 == len(self.stages):
+                    results[index] = output
+                else:
+                    await queues[k + 1].put((index, output))
+
+        async def run_stage(k: int):
+            await asyncio.gather(*(work(k) for _ in range(self.stages[k].workers)))
+            if k + 1 < len(self.stages):
+                for _ in range(self.stages[k + 1].workers):
+                    await queues[k + 1].put(_DONE)
+
+        try:
+            await asyncio.gather(feed(), *(run_stage(k) for k in range(len(self.stages))))
+        finally:
+            if executor is not self.executor:
+                executor.shutdown(wait=False)
+        return results
+
+    def run_sync(self, items: Iterable[Any]) -> List[Any]:
+        """Run the pipeline from synchronous code."""
+        return asyncio.run(self.run(items))
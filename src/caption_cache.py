@@ -0,0 +1,300 @@
+"""
+Content-addressed caption cache and background caption pre-generation.
+
+Captions are keyed by the image content hash, the prompt template, the model
+name, max_tokens and what the model was shown (URL only or a thumbnail).
+Changing the prompt or the model therefore only misses the entries
+generated with the old settings; those age out through TTL and LRU eviction
+instead of being served stale.
+
+The pre-generator runs in a background thread and fills captions for the
+next images the selection engine will pick, so the posting workflow only
+needs a cache lookup.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional, Dict, Callable
+
+from src.manifest import BlobRecord
+from src.metrics import inc
+
+logger = logging.getLogger(__name__)
+
+
+def caption_cache_key(image_hash: str, prompt_template: str, model_name: str,
+                      max_tokens: int, input_variant: str = '') -> str:
+    """
+    Return the cache key for a caption generated with the given settings.
+
+    ``input_variant`` describes what the model was shown (e.g. the thumbnail
+    size); text-only captions leave it empty.
+    """
+    parts = [image_hash, prompt_template, model_name, str(max_tokens)]
+    if input_variant:
+        parts.append(input_variant)
+    material = '\x1f'.join(parts)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+def image_hash_for(record: BlobRecord) -> str:
+    """Content hash used for caching; falls back to the URL when no md5 is known."""
+    return record.md5_hash or record.public_url
+
+
+class CaptionCache:
+    """
+    On-disk caption cache with TTL and LRU eviction.
+
+    Args:
+        path: SQLite database file
+        ttl: Seconds a caption stays valid; None keeps captions until evicted
+        max_entries: Least recently used entries beyond this count are evicted
+        clock: Callable returning the current epoch time (injectable for tests;
+            defaults to time.time as found when the cache is created)
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None, max_entries: int = 10000,
+                 clock: Optional[Callable[[], float]] = None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock or time.time
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS captions (
+                    key TEXT PRIMARY KEY,
+                    image_hash TEXT NOT NULL,
+                    model_name TEXT NOT NULL,
+                    caption TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_captions_access ON captions (last_access);
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached caption for ``key``, or None on a miss or expiry."""
+        now = self.clock()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT caption, created_at FROM captions WHERE key = ?", (key,)
+            ).fetchone()
+            if row and self.ttl is not None and now - row[1] >= self.ttl:
+                self.conn.execute("DELETE FROM captions WHERE key = ?", (key,))
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE captions SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return row[0]
+
+    def contains(self, key: str) -> bool:
+        """Check for a live entry without touching LRU order or hit counters."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT created_at FROM captions WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None and (self.ttl is None or self.clock() - row[0] < self.ttl)
+
+    def put(self, key: str, caption: str, image_hash: str = '', model_name: str = '') -> None:
+        """Store a caption and evict expired and least recently used entries."""
+        now = self.clock()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO captions "
+                "(key, image_hash, model_name, caption, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, image_hash, model_name, caption, now, now)
+            )
+            self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now: float) -> None:
+        if self.ttl is not None:
+            self.conn.execute("DELETE FROM captions WHERE created_at <= ?", (now - self.ttl,))
+        excess = self.conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM captions WHERE key IN "
+                "(SELECT key FROM captions ORDER BY last_access LIMIT ?)", (excess,)
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses}
+
+
+class CachedCaptioner:
+    """
+    Caption lookup through the cache, generating and storing on a miss.
+
+    Args:
+        generator: GeminiCaptionGenerator (anything with request_caption,
+            prompt_template, model_name and max_tokens)
+        cache: CaptionCache to read and fill
+    """
+
+    def __init__(self, generator, cache: CaptionCache):
+        self.generator = generator
+        self.cache = cache
+
+    def key_for(self, record: BlobRecord) -> str:
+        return caption_cache_key(image_hash_for(record), self.generator.prompt_template,
+                                 self.generator.model_name, self.generator.max_tokens,
+                                 getattr(self.generator, 'input_variant', ''))
+
+    def lookup(self, record: BlobRecord) -> Optional[str]:
+        """Return the cached caption for the image, if any."""
+        caption = self.cache.get(self.key_for(record))
+        inc('caption_cache_requests_total', result='hit' if caption else 'miss')
+        return caption
+
+    def fill(self, record: BlobRecord) -> bool:
+        """
+        Generate and cache a caption for the image if it is missing.
+
+        Returns:
+            True if a new caption was generated
+        """
+        if self.cache.contains(self.key_for(record)):
+            return False
+        self.generate(record)
+        return True
+
+    def generate(self, record: BlobRecord) -> str:
+        """
+        Generate a caption for the image and cache it, replacing any cached one.
+
+        Raises:
+            Exception: Any error raised by the generator; nothing is cached
+        """
+        caption = self.generator.request_caption(record.public_url)
+        self.cache.put(self.key_for(record), caption, image_hash_for(record), self.generator.model_name)
+        return caption
+
+    def fill_many(self, records) -> int:
+        """
+        Generate and cache captions for every image that is missing one.
+
+        Uses the generator's multi-image requests when it has them. Images
+        that fail are logged and skipped.
+
+        Returns:
+            Number of captions generated
+        """
+        missing: Dict[str, tuple] = {}
+        for record in records:
+            key = self.key_for(record)
+            if key not in missing and not self.cache.contains(key):
+                missing[key] = (record.public_url, record)
+        if not missing:
+            return 0
+
+        urls = [url for url, _ in missing.values()]
+        if hasattr(self.generator, 'request_captions'):
+            captions = self.generator.request_captions(urls)
+        else:
+            captions = {}
+            for url in urls:
+                try:
+                    captions[url] = self.generator.request_caption(url)
+                except Exception as e:
+                    logger.error(f"Failed to pre-generate caption for {url}: {e}")
+
+        for key, (url, record) in missing.items():
+            if url in captions:
+                self.cache.put(key, captions[url], image_hash_for(record), self.generator.model_name)
+        return sum(1 for url, _ in missing.values() if url in captions)
+
+
+class CaptionPregenerator:
+    """
+    Background thread that keeps captions ready for upcoming posts.
+
+    Args:
+        captioner: CachedCaptioner used to fill the cache
+        upcoming: Callable returning the next images to be posted
+        interval: Seconds between fill passes
+    """
+
+    def __init__(self, captioner: CachedCaptioner, upcoming: Callable[[], list],
+                 interval: float = 3600):
+        self.captioner = captioner
+        self.upcoming = upcoming
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def fill(self) -> int:
+        """
+        Run one pre-generation pass.
+
+        Returns:
+            Number of captions generated
+        """
+        records = self.upcoming()
+        if self._stop.is_set():
+            return 0
+        try:
+            generated = self.captioner.fill_many(records)
+        except Exception as e:
+            logger.error(f"Failed to pre-generate captions: {e}")
+            return 0
+        if generated:
+            logger.info(f"Pre-generated {generated} captions")
+        return generated
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.fill()
+            except Exception as e:
+                logger.error(f"Caption pre-generation pass failed: {e}")
+            self._stop.wait(self.interval)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='caption-pregenerator', daemon=True)
+        self._thread.start()
+        logger.info("Caption pre-generation started")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
@@ -0,0 +1,526 @@
+"""
+Compact in-memory catalog of the images in a bucket.
+
+A BlobRecord per image costs several hundred bytes and a Blob object far
+more, so holding a library of hundreds of thousands of images as objects
+takes gigabytes. ImageCatalog stores the same fields column by column
+instead, at about 80 bytes per image:
+
+- names, split into an interned directory prefix and a UTF-8 suffix packed
+  into one byte string
+- generation, size and update time in ``array`` columns
+- MD5 hashes as 16 raw bytes
+- content types interned into small integer ids
+- a posted flag per image
+
+Rows are kept in name order. A precomputed permutation gives update-time
+order, so queries such as "unposted, oldest first, in folder X" are a scan
+over integers. ``CatalogEntry`` is a ``__slots__`` view of one row. The
+catalog also serves as a candidate source for the selection engine, like
+BucketManifest.
+
+A catalog is saved as a short JSON header followed by the raw columns.
+``ImageCatalog.load`` maps the file into memory instead of reading it,
+so loading takes the same time whatever the size of the library. Pages are
+only read when touched.
+"""
+
+import base64
+import binascii
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+import logging
+from array import array
+from typing import Optional, List, Dict, Any, Iterator, Iterable, Tuple
+from urllib.parse import quote
+
+from src.manifest import BlobRecord, shard_of
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ZMCATLG1'
+FORMAT_VERSION = 1
+
+FLAG_POSTED = 1
+FLAG_MD5 = 2
+
+# name -> array typecode of every fixed-width column
+COLUMNS = {
+    'offsets': 'Q',     # start of each name suffix in the names column (count + 1 entries)
+    'names': 'B',       # UTF-8 name suffixes, concatenated
+    'prefix_ids': 'I',
+    'generation': 'q',
+    'size': 'q',
+    'updated': 'd',
+    'md5': 'B',         # 16 bytes per row
+    'content_type_ids': 'H',
+    'flags': 'B',
+    'by_updated': 'I',  # row numbers in (updated, name) order
+}
+
+
+def _split_name(name: str) -> Tuple[str, str]:
+    head, sep, tail = name.rpartition('/')
+    return head + sep, tail
+
+
+def _md5_bytes(md5_hash: str) -> Optional[bytes]:
+    """Decode a base64 GCS MD5 hash to its 16 raw bytes, or None if it isn't one."""
+    if len(md5_hash) != 24:
+        return None
+    try:
+        raw = base64.b64decode(md5_hash, validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return raw if len(raw) == 16 else None
+
+
+def _public_url(url_base: str, name: str) -> str:
+    return url_base + quote(name, safe='/~')
+
+
+class CatalogEntry:
+    """Read-only view of one catalog row."""
+
+    __slots__ = ('catalog', 'index')
+
+    def __init__(self, catalog: 'ImageCatalog', index: int):
+        self.catalog = catalog
+        self.index = index
+
+    @property
+    def name(self) -> str:
+        return self.catalog.name_at(self.index)
+
+    @property
+    def folder(self) -> str:
+        return self.catalog.folder_at(self.index)
+
+    @property
+    def generation(self) -> int:
+        return self.catalog._columns['generation'][self.index]
+
+    @property
+    def size(self) -> int:
+        return self.catalog._columns['size'][self.index]
+
+    @property
+    def updated(self) -> float:
+        return self.catalog._columns['updated'][self.index]
+
+    @property
+    def posted(self) -> bool:
+        return bool(self.catalog._columns['flags'][self.index] & FLAG_POSTED)
+
+    def record(self) -> BlobRecord:
+        return self.catalog.record_at(self.index)
+
+    def __repr__(self) -> str:
+        return f"CatalogEntry({self.name!r})"
+
+
+class ImageCatalog:
+    """
+    Columnar, memory-mappable catalog of image blobs.
+
+    Build one with ``from_records`` or ``load``; the constructor takes
+    ready-made columns.
+    """
+
+    def __init__(self, columns: Dict[str, Any], prefixes: List[str], content_types: List[str],
+                 url_base: str = '', url_overrides: Optional[Dict[int, str]] = None,
+                 md5_overrides: Optional[Dict[int, str]] = None, buffer: Optional[mmap.mmap] = None):
+        self._columns = columns
+        self.prefixes = prefixes
+        self.content_types = content_types
+        self.url_base = url_base
+        self._url_overrides = url_overrides or {}
+        self._md5_overrides = md5_overrides or {}
+        # Kept open for as long as the columns point into it
+        self._buffer = buffer
+        self._prefix_shards = [shard_of(prefix + '_') for prefix in prefixes]
+
+    # -- building ----------------------------------------------------------
+
+    @classmethod
+    def from_records(cls, records: Iterable[BlobRecord], posted: Iterable[str] = ()) -> 'ImageCatalog':
+        """
+        Build a catalog from BlobRecords (e.g. a bucket listing or manifest).
+
+        Records are packed into the columns as they arrive, so a listing in
+        name order (as GCS and BucketManifest return it) is never held as
+        objects. Any other order is sorted once the columns are built.
+
+        Args:
+            records: Images to catalog; duplicate names keep the last record
+            posted: Names to flag as posted
+        """
+        prefixes: List[str] = []
+        prefix_ids: Dict[str, int] = {}
+        content_types: List[str] = []
+        content_type_ids: Dict[str, int] = {}
+        columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        packed = bytearray()
+        md5 = bytearray()
+        url_base = ''
+        url_overrides: Dict[int, str] = {}
+        md5_overrides: Dict[int, str] = {}
+        posted = set(posted)
+        last_name = None
+        in_order = True
+
+        for record in records:
+            name = record.name
+            if last_name is not None and name <= last_name:
+                if name == last_name:
+                    # Adjacent duplicate: the later record replaces the last row
+                    index = len(columns['generation']) - 1
+                    del packed[columns['offsets'].pop():]
+                    for column in ('prefix_ids', 'generation', 'size', 'updated',
+                                   'content_type_ids', 'flags'):
+                        columns[column].pop()
+                    del md5[-16:]
+                    url_overrides.pop(index, None)
+                    md5_overrides.pop(index, None)
+                else:
+                    in_order = False
+            last_name = name
+            index = len(columns['generation'])
+            prefix, suffix = _split_name(name)
+            pid = prefix_ids.get(prefix)
+            if pid is None:
+                pid = prefix_ids[prefix] = len(prefixes)
+                prefixes.append(prefix)
+            cid = content_type_ids.get(record.content_type)
+            if cid is None:
+                cid = content_type_ids[record.content_type] = len(content_types)
+                content_types.append(record.content_type)
+
+            columns['offsets'].append(len(packed))
+            packed += suffix.encode('utf-8')
+            columns['prefix_ids'].append(pid)
+            columns['generation'].append(record.generation)
+            columns['size'].append(record.size)
+            columns['updated'].append(record.updated)
+            columns['content_type_ids'].append(cid)
+
+            flags = FLAG_POSTED if name in posted else 0
+            raw = _md5_bytes(record.md5_hash) if record.md5_hash else None
+            if raw is not None:
+                flags |= FLAG_MD5
+                md5 += raw
+            else:
+                md5 += bytes(16)
+                if record.md5_hash:
+                    md5_overrides[index] = record.md5_hash
+            columns['flags'].append(flags)
+
+            # Public URLs are derived from the bucket URL; only odd ones are stored
+            quoted = quote(name, safe='/~')
+            if not url_base and record.public_url.endswith(quoted):
+                url_base = record.public_url[:-len(quoted)]
+            if record.public_url != url_base + quoted:
+                url_overrides[index] = record.public_url
+        columns['offsets'].append(len(packed))
+        columns['names'] = array('B', bytes(packed))
+        columns['md5'] = array('B', bytes(md5))
+        del packed, md5
+        catalog = cls(columns, prefixes, content_types, url_base, url_overrides, md5_overrides)
+        if not in_order:
+            catalog._sort_by_name()
+        updated = catalog._columns['updated']
+        catalog._columns['by_updated'] = array('I', sorted(range(len(catalog)), key=lambda i: (updated[i], i)))
+        return catalog
+
+    def _sort_by_name(self) -> None:
+        """Put freshly built rows in name order, keeping the last of any duplicate names."""
+        latest: Dict[str, int] = {}
+        for index in range(len(self)):
+            latest[self.name_at(index)] = index
+        rows = [latest[name] for name in sorted(latest)]
+        del latest
+        old = self._columns
+        columns = {name: array(typecode) for name, typecode in COLUMNS.items()}
+        packed = bytearray()
+        md5 = bytearray()
+        offsets = old['offsets']
+        for row in rows:
+            columns['offsets'].append(len(packed))
+            packed += bytes(old['names'][offsets[row]:offsets[row + 1]])
+            md5 += bytes(old['md5'][row * 16:row * 16 + 16])
+        columns['offsets'].append(len(packed))
+        columns['names'] = array('B', bytes(packed))
+        columns['md5'] = array('B', bytes(md5))
+        for name in ('prefix_ids', 'generation', 'size', 'updated', 'content_type_ids', 'flags'):
+            columns[name] = array(COLUMNS[name], (old[name][row] for row in rows))
+        position = {row: index for index, row in enumerate(rows)}
+        self._url_overrides = {position[row]: url for row, url in self._url_overrides.items() if row in position}
+        self._md5_overrides = {position[row]: h for row, h in self._md5_overrides.items() if row in position}
+        self._columns = columns
+
+    # -- persistence -------------------------------------------------------
+
+    def save(self, path: str) -> None:
+        """Write the catalog to ``path`` atomically."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        layout = {}
+        offset = 0
+        for name in COLUMNS:
+            nbytes = memoryview(self._columns[name]).nbytes
+            layout[name] = [offset, nbytes]
+            offset += (nbytes + 7) // 8 * 8
+        header = json.dumps({
+            "version": FORMAT_VERSION,
+            "count": len(self),
+            "byteorder": sys.byteorder,
+            "prefixes": self.prefixes,
+            "content_types": self.content_types,
+            "url_base": self.url_base,
+            "url_overrides": self._url_overrides,
+            "md5_overrides": self._md5_overrides,
+            "columns": layout,
+        }).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for name in COLUMNS:
+                data = memoryview(self._columns[name]).cast('B')
+                f.write(data)
+                f.write(bytes(-len(data) % 8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ImageCatalog':
+        """
+        Map a saved catalog into memory.
+
+        The mapping is copy-on-write: flags changed in memory (e.g. by
+        mark_posted) are not written back to the file.
+
+        Raises:
+            ValueError: If the file is not a catalog this version can read
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError(f"{path} is empty")
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an image catalog")
+        header_length, = struct.unpack_from('<Q', buffer, len(MAGIC))
+        start = len(MAGIC) + 8
+        header = json.loads(buffer[start:start + header_length])
+        if header["version"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written by an incompatible version or platform")
+
+        data = memoryview(buffer)[start + header_length:]
+        columns = {}
+        for name, typecode in COLUMNS.items():
+            offset, nbytes = header["columns"][name]
+            columns[name] = data[offset:offset + nbytes].cast(typecode)
+        return cls(columns, header["prefixes"], header["content_types"], header["url_base"],
+                   {int(k): v for k, v in header["url_overrides"].items()},
+                   {int(k): v for k, v in header["md5_overrides"].items()}, buffer=buffer)
+
+    # -- rows --------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self._columns['generation'])
+
+    def __getitem__(self, index: int) -> CatalogEntry:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return CatalogEntry(self, index)
+
+    def name_at(self, index: int) -> str:
+        offsets = self._columns['offsets']
+        suffix = bytes(self._columns['names'][offsets[index]:offsets[index + 1]]).decode('utf-8')
+        return self.prefixes[self._columns['prefix_ids'][index]] + suffix
+
+    def folder_at(self, index: int) -> str:
+        return self._prefix_shards[self._columns['prefix_ids'][index]]
+
+    def md5_at(self, index: int) -> str:
+        if self._columns['flags'][index] & FLAG_MD5:
+            return base64.b64encode(bytes(self._columns['md5'][index * 16:index * 16 + 16])).decode('ascii')
+        return self._md5_overrides.get(index, '')
+
+    def record_at(self, index: int) -> BlobRecord:
+        name = self.name_at(index)
+        columns = self._columns
+        return BlobRecord(
+            name=name,
+            generation=columns['generation'][index],
+            size=columns['size'][index],
+            md5_hash=self.md5_at(index),
+            content_type=self.content_types[columns['content_type_ids'][index]],
+            public_url=self._url_overrides.get(index) or _public_url(self.url_base, name),
+            updated=columns['updated'][index],
+        )
+
+    def index_of(self, name: str) -> Optional[int]:
+        index = self._name_position(name)
+        if index < len(self) and self.name_at(index) == name:
+            return index
+        return None
+
+    def get(self, name: str) -> Optional[BlobRecord]:
+        index = self.index_of(name)
+        return self.record_at(index) if index is not None else None
+
+    def _name_position(self, name: str, right: bool = False) -> int:
+        """First row whose name is >= ``name`` (> with ``right``), by binary search."""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self.name_at(mid)
+            if current < name or (right and current == name):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _updated_position(self, key: tuple) -> int:
+        """First position in update order whose (updated, name) is > ``key``."""
+        by_updated = self._columns['by_updated']
+        updated = self._columns['updated']
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = by_updated[mid]
+            if (updated[row], self.name_at(row)) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # -- posted flags ------------------------------------------------------
+
+    def mark_posted(self, names: Iterable[str], posted: bool = True) -> int:
+        """Set (or clear) the posted flag of the named images; returns how many were found."""
+        flags = self._columns['flags']
+        found = 0
+        for name in names:
+            index = self.index_of(name)
+            if index is None:
+                continue
+            flags[index] = flags[index] | FLAG_POSTED if posted else flags[index] & ~FLAG_POSTED
+            found += 1
+        return found
+
+    def sync_posted(self, history) -> int:
+        """Flag every image in a PostedHistory as posted."""
+        return self.mark_posted(post["blob_name"] for post in history.posted_since())
+
+    # -- queries -----------------------------------------------------------
+
+    def _rows(self, prefix: Optional[str], order_by: str, descending: bool, start: int) -> Iterable[int]:
+        """Row numbers in the requested order, starting at position ``start`` of that order."""
+        if order_by == 'name':
+            first, stop = 0, len(self)
+            if prefix:
+                # Rows are in name order, so a prefix is a contiguous range
+                first = self._name_position(prefix)
+                stop = self._name_position(prefix + '\U0010ffff')
+            rows = range(max(first, start), stop)
+        elif order_by == 'updated':
+            rows = self._columns['by_updated'][start:]
+        else:
+            raise ValueError(f"Cannot order the catalog by '{order_by}'")
+        return reversed(rows) if descending else rows
+
+    def query(self, posted: Optional[bool] = None, folder: Optional[str] = None,
+              prefix: Optional[str] = None, order_by: str = 'name', descending: bool = False,
+              limit: Optional[int] = None) -> List[CatalogEntry]:
+        """
+        Filter and sort the catalog.
+
+        Args:
+            posted: Only posted (True) or unposted (False) images; None for both
+            folder: Only images in this top-level folder (e.g. ``'portraits/'``)
+            prefix: Only images whose name starts with this
+            order_by: ``'name'`` or ``'updated'``
+            descending: Reverse the order
+            limit: Return at most this many entries
+
+        Returns:
+            Matching rows, e.g. ``query(posted=False, folder='x/', order_by='updated')``
+            for the oldest unposted images in folder x/
+        """
+        return [CatalogEntry(self, i) for i in self._filter(posted, folder, prefix, order_by,
+                                                            descending, limit)]
+
+    def count(self, posted: Optional[bool] = None, folder: Optional[str] = None,
+              prefix: Optional[str] = None) -> int:
+        return sum(1 for _ in self._filter(posted, folder, prefix))
+
+    def _filter(self, posted: Optional[bool], folder: Optional[str], prefix: Optional[str],
+                order_by: str = 'name', descending: bool = False, limit: Optional[int] = None,
+                start: int = 0) -> Iterator[int]:
+        if limit is not None and limit <= 0:
+            return
+        flags = self._columns['flags']
+        prefix_ids = self._columns['prefix_ids']
+        # Name order applies the prefix as a row range; other orders check it
+        # on interned prefix ids, decoding names only for prefixes that end
+        # inside a directory name
+        check_prefix = prefix if order_by != 'name' else None
+        allowed = partial = None
+        if folder is not None or check_prefix:
+            allowed, partial = set(), set()
+            for pid, directory in enumerate(self.prefixes):
+                if folder is not None and self._prefix_shards[pid] != folder:
+                    continue
+                if not check_prefix or directory.startswith(check_prefix):
+                    allowed.add(pid)
+                elif check_prefix.startswith(directory):
+                    partial.add(pid)
+        want = None if posted is None else (FLAG_POSTED if posted else 0)
+
+        found = 0
+        for i in self._rows(prefix, order_by, descending, start):
+            if want is not None and flags[i] & FLAG_POSTED != want:
+                continue
+            if allowed is not None:
+                pid = prefix_ids[i]
+                if pid not in allowed and not (pid in partial and self.name_at(i).startswith(check_prefix)):
+                    continue
+            yield i
+            found += 1
+            if limit is not None and found >= limit:
+                return
+
+    # -- candidate source interface (see BucketManifest) -------------------
+
+    orders = ('name', 'updated')
+
+    def folder_of(self, name: str) -> str:
+        return shard_of(name)
+
+    def folders(self) -> List[str]:
+        return sorted({self._prefix_shards[pid] for pid in set(self._columns['prefix_ids'])})
+
+    def iter_records(self, prefix: Optional[str] = None, order_by: str = 'name',
+                     shard: Optional[str] = None, start_after: Optional[tuple] = None,
+                     batch_size: int = 500) -> Iterator[BlobRecord]:
+        start = 0
+        if start_after:
+            if order_by == 'name':
+                start = self._name_position(start_after[-1], right=True)
+            else:
+                start = self._updated_position(tuple(start_after))
+        for i in self._filter(None, shard, prefix, order_by, start=start):
+            yield self.record_at(i)
+
+    def sample(self, k: int, rng: Optional[random.Random] = None) -> List[BlobRecord]:
+        rng = rng or random
+        return [self.record_at(i) for i in rng.sample(range(len(self)), min(k, len(self)))]
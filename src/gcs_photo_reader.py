@@ -1,18 +1,18 @@
-from src.main import GoogleCloudStorageManager
+from src.main import get_storage_manager
 from typing import List
 
 def get_photos_from_gcs() -> List[str]:
     """
     Retrieves a list of photo URLs from Google Cloud Storage.
 
-    This function initializes the GoogleCloudStorageManager and uses it to
-    fetch the list of public URLs for all images in the configured GCS bucket.
+    This function uses the shared GoogleCloudStorageManager, so the storage
+    client is created once per process and reused, to fetch the list of
+    public URLs for all images in the configured GCS bucket.
 
     Returns:
         A list of strings, where each string is a public URL to a photo.
     """
-    storage_manager = GoogleCloudStorageManager()
-    return storage_manager.list_images()
+    return get_storage_manager().list_images()
 
 if __name__ == '__main__':
     # Example of how to use the function
@@ -0,0 +1,179 @@
+"""
+Durable ledger of what has already been posted to Instagram.
+
+Every successful post is recorded with the blob name and the content hash of
+the image, both indexed, so "has this been posted (recently)?" is a single
+index lookup no matter how large the library or the history grows. The
+ledger also stores the small cursors the rotation strategies keep between
+runs.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional, List, Dict, Any, Callable
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ACCOUNT = 'default'
+
+
+class PostedHistory:
+    """
+    SQLite-backed posted-history store.
+
+    Args:
+        path: Database file, or ':memory:' for a throwaway ledger
+        account: Account the ledger entries belong to
+        clock: Callable returning the current epoch time (injectable for tests;
+            defaults to time.time as found when the ledger is created)
+    """
+
+    def __init__(self, path: str, account: str = DEFAULT_ACCOUNT,
+                 clock: Optional[Callable[[], float]] = None):
+        self.path = path
+        self.account = account
+        self.clock = clock or time.time
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS posts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    account TEXT NOT NULL,
+                    blob_name TEXT NOT NULL,
+                    content_hash TEXT,
+                    image_url TEXT,
+                    media_id TEXT,
+                    posted_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_posts_blob ON posts (account, blob_name, posted_at);
+                CREATE INDEX IF NOT EXISTS idx_posts_hash ON posts (account, content_hash, posted_at);
+                CREATE INDEX IF NOT EXISTS idx_posts_time ON posts (account, posted_at);
+                CREATE TABLE IF NOT EXISTS cursors (
+                    account TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT,
+                    PRIMARY KEY (account, key)
+                );
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def record_post(self, blob_name: str, content_hash: Optional[str] = None,
+                    image_url: Optional[str] = None, media_id: Optional[str] = None) -> None:
+        """
+        Record a successful post.
+
+        Args:
+            blob_name: Identity of the posted image (blob name or URL)
+            content_hash: Content hash (e.g. GCS md5) so re-uploads are recognised
+            image_url: Public URL that was posted
+            media_id: Instagram media ID returned by the Graph API
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO posts (account, blob_name, content_hash, image_url, media_id, posted_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.account, blob_name, content_hash or None, image_url, media_id, self.clock())
+            )
+            self.conn.commit()
+        logger.info(f"Recorded post of {blob_name} in history")
+
+    def last_posted_at(self, blob_name: Optional[str] = None,
+                       content_hash: Optional[str] = None) -> Optional[float]:
+        """Return when the blob (or any blob with the same content) was last posted."""
+        latest = None
+        with self._lock:
+            if blob_name:
+                row = self.conn.execute(
+                    "SELECT MAX(posted_at) FROM posts WHERE account = ? AND blob_name = ?",
+                    (self.account, blob_name)
+                ).fetchone()
+                latest = row[0]
+            if content_hash:
+                row = self.conn.execute(
+                    "SELECT MAX(posted_at) FROM posts WHERE account = ? AND content_hash = ?",
+                    (self.account, content_hash)
+                ).fetchone()
+                if row[0] is not None and (latest is None or row[0] > latest):
+                    latest = row[0]
+        return latest
+
+    def is_posted(self, blob_name: Optional[str] = None, content_hash: Optional[str] = None,
+                  within: Optional[float] = None) -> bool:
+        """
+        Check whether an image has been posted.
+
+        Args:
+            blob_name: Identity of the image
+            content_hash: Content hash of the image
+            within: Only count posts from the last ``within`` seconds; None means ever
+
+        Returns:
+            True if the image (by name or content) was posted in the window
+        """
+        posted_at = self.last_posted_at(blob_name, content_hash)
+        if posted_at is None:
+            return False
+        return within is None or self.clock() - posted_at < within
+
+    def recent(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Return the most recent posts, newest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT blob_name, content_hash, image_url, media_id, posted_at FROM posts "
+                "WHERE account = ? ORDER BY posted_at DESC LIMIT ?",
+                (self.account, limit)
+            ).fetchall()
+        keys = ("blob_name", "content_hash", "image_url", "media_id", "posted_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def posted_since(self, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Return every post at or after ``since`` (all posts if None), oldest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT blob_name, content_hash, posted_at FROM posts "
+                "WHERE account = ? AND posted_at >= ? ORDER BY posted_at",
+                (self.account, since if since is not None else float('-inf'))
+            ).fetchall()
+        return [dict(zip(("blob_name", "content_hash", "posted_at"), row)) for row in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM posts WHERE account = ?", (self.account,)
+            ).fetchone()[0]
+
+    def get_cursor(self, key: str) -> Optional[str]:
+        """Read a rotation cursor persisted for this account."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM cursors WHERE account = ? AND key = ?", (self.account, key)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_cursor(self, key: str, value: Optional[str]) -> None:
+        """Persist a rotation cursor for this account."""
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO cursors (account, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(account, key) DO UPDATE SET value = excluded.value",
+                (self.account, key, value)
+            )
+            self.conn.commit()
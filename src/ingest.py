@@ -0,0 +1,304 @@
+"""
+Event-driven ingestion of new bucket uploads.
+
+Instead of waiting for the daily round, new images are picked up within
+seconds of landing in the bucket and handed to a callback (in production:
+enqueue caption and post jobs). Three event sources are available:
+
+``PubSubEventSource``
+    Cloud Storage Pub/Sub notifications (OBJECT_FINALIZE). Nothing is
+    listed at all; each upload arrives as one message.
+``PollingEventSource``
+    Incremental listing keyed on an (updated, name) cursor persisted between
+    runs. With ``ordered_names`` (upload names that sort by upload time, e.g.
+    date-prefixed) each poll lists only names after the cursor, so the cost
+    of a poll does not grow with the bucket. Otherwise every poll lists the
+    watched prefix, so a prefix is required; the whole bucket is never listed
+    on a timer.
+``LocalEventSource``
+    In-process queue, used by tests and by code that uploads images itself.
+
+Events are acknowledged only after the callback has run, so a crash
+redelivers them rather than losing them.
+"""
+
+import json
+import queue
+import threading
+import time
+import logging
+from datetime import datetime
+from typing import Optional, List, Dict, Any, Callable, Iterable, NamedTuple, Tuple
+from urllib.parse import quote
+
+from src.manifest import BlobRecord, is_image_name
+
+logger = logging.getLogger(__name__)
+
+FINALIZE_EVENT = 'OBJECT_FINALIZE'
+
+
+class IngestEvent(NamedTuple):
+    """A new object, with whatever the source needs to acknowledge it."""
+    record: BlobRecord
+    ack_id: Any = None
+
+
+def record_from_resource(resource: Dict[str, Any], bucket_name: Optional[str] = None) -> BlobRecord:
+    """
+    Build a BlobRecord from a GCS object resource, e.g. a Pub/Sub notification payload.
+
+    Args:
+        resource: JSON object resource (name, generation, size, md5Hash, ...)
+        bucket_name: Bucket the object lives in (default: the resource's ``bucket``)
+    """
+    name = resource['name']
+    bucket_name = bucket_name or resource.get('bucket', '')
+    updated = resource.get('updated')
+    return BlobRecord(
+        name=name,
+        generation=int(resource.get('generation') or 0),
+        size=int(resource.get('size') or 0),
+        md5_hash=resource.get('md5Hash') or '',
+        content_type=resource.get('contentType') or '',
+        public_url=f"https://storage.googleapis.com/{bucket_name}/{quote(name, safe='/~')}",
+        updated=datetime.fromisoformat(updated.replace('Z', '+00:00')).timestamp() if updated else 0.0,
+    )
+
+
+class LocalEventSource:
+    """In-process event source: ``publish()`` records, ``poll()`` them back."""
+
+    def __init__(self):
+        self._queue: 'queue.Queue[BlobRecord]' = queue.Queue()
+
+    def publish(self, record: BlobRecord) -> None:
+        self._queue.put(record)
+
+    def poll(self, timeout: float) -> List[IngestEvent]:
+        """Wait up to ``timeout`` seconds for the first event, then drain what is queued."""
+        try:
+            events = [IngestEvent(self._queue.get(timeout=timeout))]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(IngestEvent(self._queue.get_nowait()))
+            except queue.Empty:
+                return events
+
+    def ack(self, events: List[IngestEvent]) -> None:
+        pass
+
+
+class PollingEventSource:
+    """
+    Detects new uploads by listing incrementally from a persisted cursor.
+
+    The cursor is the (updated, name) of the newest object seen. On the very
+    first poll it is set to the newest existing object without emitting
+    anything, so enabling ingestion does not post the whole backlog.
+
+    Args:
+        list_fn: ``(prefix=, start_offset=) -> Iterable[BlobRecord]``, e.g. storage_manager.iter_images
+        cursors: Object with get_cursor/set_cursor (e.g. PostedHistory)
+        prefix: Only watch objects under this prefix, e.g. ``incoming/``
+        interval: Seconds between listings
+        ordered_names: Names sort by upload time, so listing can start at the cursor
+
+    Raises:
+        ValueError: If neither a prefix nor ordered_names is given
+    """
+
+    def __init__(self, list_fn: Callable[..., Iterable[BlobRecord]], cursors,
+                 prefix: Optional[str] = None, interval: float = 15.0, ordered_names: bool = False):
+        if not prefix and not ordered_names:
+            raise ValueError("Polling without a prefix or ordered_names would list the whole bucket "
+                             "every interval; set ingest.prefix or ingest.ordered_names, "
+                             "or use the pubsub source")
+        self.list_fn = list_fn
+        self.cursors = cursors
+        self.prefix = prefix
+        self.interval = interval
+        self.ordered_names = ordered_names
+        self.cursor_key = f"ingest:{prefix or ''}"
+        self._next_poll = 0.0
+
+    def _cursor(self) -> Optional[Tuple[float, str]]:
+        value = self.cursors.get_cursor(self.cursor_key)
+        return tuple(json.loads(value)) if value else None
+
+    def _save_cursor(self, cursor: Tuple[float, str]) -> None:
+        self.cursors.set_cursor(self.cursor_key, json.dumps(list(cursor)))
+
+    def _order(self, cursor: Tuple[float, str]):
+        # With ordered names the name alone says what came later
+        return cursor[1] if self.ordered_names else tuple(cursor)
+
+    def poll(self, timeout: float) -> List[IngestEvent]:
+        """List objects newer than the cursor, waiting up to ``timeout`` for the next listing."""
+        wait = self._next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return []
+        if wait > 0:
+            time.sleep(wait)
+        self._next_poll = time.monotonic() + self.interval
+
+        cursor = self._cursor()
+        options: Dict[str, Any] = {"prefix": self.prefix}
+        if self.ordered_names and cursor:
+            options["start_offset"] = cursor[1]
+        # The listing is streamed; only the newest object, or the new ones, are kept
+        listed = ((r.updated, r.name, r) for r in self.list_fn(**options))
+
+        if cursor is None:
+            newest = max(listed, key=lambda item: self._order(item[:2]), default=None)
+            self._save_cursor(newest[:2] if newest else (time.time(), ''))
+            logger.info(f"Ingestion cursor initialised for prefix '{self.prefix or ''}'")
+            return []
+        after = self._order(cursor)
+        new = sorted((item for item in listed if self._order(item[:2]) > after),
+                     key=lambda item: self._order(item[:2]))
+        return [IngestEvent(r, (updated, name)) for updated, name, r in new]
+
+    def ack(self, events: List[IngestEvent]) -> None:
+        if events:
+            self._save_cursor(max((tuple(e.ack_id) for e in events), key=self._order))
+
+
+class PubSubEventSource:
+    """
+    Receives Cloud Storage notifications from a Pub/Sub subscription.
+
+    Requires ``google-cloud-pubsub`` and a bucket notification configured with
+    ``gsutil notification create -t TOPIC -f json -e OBJECT_FINALIZE gs://BUCKET``.
+
+    Args:
+        subscription: Full subscription path, ``projects/P/subscriptions/S``
+        bucket_name: Bucket used to build public URLs (default: from each message)
+        max_messages: Messages pulled per request
+    """
+
+    def __init__(self, subscription: str, bucket_name: Optional[str] = None, max_messages: int = 100):
+        self.subscription = subscription
+        self.bucket_name = bucket_name
+        self.max_messages = max_messages
+        self._subscriber = None
+
+    @property
+    def subscriber(self):
+        if self._subscriber is None:
+            try:
+                from google.cloud import pubsub_v1
+            except ImportError:
+                raise RuntimeError("google-cloud-pubsub is not installed. "
+                                   "Install with: pip install google-cloud-pubsub")
+            self._subscriber = pubsub_v1.SubscriberClient()
+        return self._subscriber
+
+    def poll(self, timeout: float) -> List[IngestEvent]:
+        """Pull pending notifications; non-finalize events are acknowledged and dropped."""
+        try:
+            response = self.subscriber.pull(
+                request={"subscription": self.subscription, "max_messages": self.max_messages},
+                timeout=timeout
+            )
+        except Exception as e:
+            # A pull that finds nothing before the deadline raises DeadlineExceeded
+            if type(e).__name__ != 'DeadlineExceeded':
+                logger.error(f"Pub/Sub pull failed: {e}")
+            return []
+
+        events, ignored = [], []
+        for received in response.received_messages:
+            message = received.message
+            if message.attributes.get('eventType') != FINALIZE_EVENT:
+                ignored.append(received.ack_id)
+                continue
+            try:
+                record = record_from_resource(json.loads(message.data), self.bucket_name)
+            except (ValueError, KeyError) as e:
+                logger.error(f"Dropping malformed notification {message.message_id}: {e}")
+                ignored.append(received.ack_id)
+                continue
+            events.append(IngestEvent(record, received.ack_id))
+        if ignored:
+            self._acknowledge(ignored)
+        return events
+
+    def _acknowledge(self, ack_ids: List[str]) -> None:
+        self.subscriber.acknowledge(request={"subscription": self.subscription, "ack_ids": ack_ids})
+
+    def ack(self, events: List[IngestEvent]) -> None:
+        if events:
+            self._acknowledge([e.ack_id for e in events])
+
+
+class Ingestor:
+    """
+    Feeds new uploads from an event source to a handler.
+
+    Args:
+        source: LocalEventSource, PollingEventSource or PubSubEventSource
+        handle: Called once per new image record
+        exclude_prefixes: Ignore objects under these prefixes (e.g. derived renditions)
+        poll_timeout: Longest a single poll blocks, which bounds how long stop() takes
+    """
+
+    def __init__(self, source, handle: Callable[[BlobRecord], Any],
+                 exclude_prefixes: Tuple[str, ...] = (), poll_timeout: float = 5.0):
+        self.source = source
+        self.handle = handle
+        self.exclude_prefixes = tuple(exclude_prefixes)
+        self.poll_timeout = poll_timeout
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self, timeout: Optional[float] = None) -> int:
+        """
+        Poll the source once and handle what arrived.
+
+        Returns:
+            Number of records handed to the handler
+        """
+        events = self.source.poll(self.poll_timeout if timeout is None else timeout)
+        if not events:
+            return 0
+        seen = set()
+        handled = 0
+        for event in events:
+            record = event.record
+            key = (record.name, record.generation)
+            if key in seen or not is_image_name(record.name) or record.name.startswith(self.exclude_prefixes):
+                continue
+            seen.add(key)
+            self.handle(record)
+            handled += 1
+        # Only acknowledge once everything was handled, so a failure redelivers
+        self.source.ack(events)
+        if handled:
+            logger.info(f"Ingested {handled} new uploads")
+        return handled
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Ingestion failed: {e}")
+                self._stop.wait(self.poll_timeout)
+
+    def start(self) -> None:
+        """Start ingesting on a background thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ingestor', daemon=True)
+            self._thread.start()
+            logger.info(f"Started ingestion from {type(self.source).__name__}")
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
@@ -0,0 +1,460 @@
+"""
+Reusable Instagram Graph API client.
+
+One InstagramClient holds a pooled keep-alive ``requests.Session`` and the
+account credentials, applies connect/read timeouts to every call and retries
+failures that are safe to retry:
+
+- connection failures before the request was sent are always retried
+- 429 responses are retried (the request was rejected, not processed)
+- read timeouts and 5xx responses are only retried for idempotent calls,
+  so a publish that may have gone through is never sent twice
+
+Graph API usage headers (X-App-Usage, X-Business-Use-Case-Usage) are parsed
+after every call and exposed through ``usage`` so callers can throttle
+themselves before Meta does.
+
+Containers are only published once their status_code is FINISHED. Carousel
+children are created in parallel and their statuses polled in one batched
+request per round.
+"""
+
+import json
+import random
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from src.metrics import REGISTRY
+from src.resilience import OVERLOAD_STATUS_CODES, Endpoint, guarded
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_URL = "https://graph.facebook.com"
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+USAGE_HEADERS = ('X-App-Usage', 'X-Business-Use-Case-Usage', 'X-Ad-Account-Usage')
+PENDING_STATUSES = {"IN_PROGRESS", "UNKNOWN"}
+MIN_CAROUSEL_ITEMS = 2
+MAX_CAROUSEL_ITEMS = 10
+# error_subcode of a publish refused because the account's quota is used up
+PUBLISHING_LIMIT_SUBCODE = 2207042
+
+
+def may_have_been_sent(error: requests.RequestException) -> bool:
+    """
+    Whether a failed request could have reached the server.
+
+    Connection setup failures (refused, DNS, connect timeout) are known not to
+    have been sent; read timeouts and dropped connections are ambiguous.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return False
+    if isinstance(error, requests.ReadTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return not isinstance(reason, NewConnectionError)
+
+
+class InstagramAPIError(Exception):
+    """Error response from the Graph API."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 error: Optional[Dict[str, Any]] = None, maybe_published: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error = error or {}
+        # The publish was accepted but its outcome is unknown
+        self.maybe_published = maybe_published
+
+    @property
+    def code(self) -> Optional[int]:
+        """Graph API error code (e.g. 4/17/32/613 for rate limiting)."""
+        return self.error.get('code')
+
+    @property
+    def publishing_limit_reached(self) -> bool:
+        """Whether the account has used up its Content Publishing API quota."""
+        return self.error.get('error_subcode') == PUBLISHING_LIMIT_SUBCODE
+
+
+class InstagramClient:
+    """
+    Connection-pooled, retrying Graph API client for one Instagram account.
+
+    Args:
+        access_token: Long-lived Instagram access token
+        user_id: Instagram user ID
+        api_version: Graph API version
+        base_url: Graph API root (overridable for local stub servers)
+        pool_size: Keep-alive connections kept per host
+        connect_timeout: Seconds to establish a connection
+        read_timeout: Seconds to wait for a response
+        max_retries: Retries for calls that are safe to retry
+        backoff_factor: Base delay in seconds for exponential backoff
+        resilience: Endpoint guarding every request with a circuit breaker
+            and concurrency limit, usually shared by all accounts
+        session: Session to send requests with, e.g. one that records or
+            replays them (default: a new requests.Session)
+    """
+
+    def __init__(self, access_token: str, user_id: str, api_version: str = 'v19.0',
+                 base_url: str = GRAPH_API_URL, pool_size: int = 10,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0,
+                 max_retries: int = 3, backoff_factor: float = 1.0,
+                 resilience: Optional[Endpoint] = None, session: Optional[requests.Session] = None):
+        self.access_token = access_token
+        self.user_id = user_id
+        self.api_version = api_version
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.resilience = resilience
+        self.usage: Dict[str, Any] = {}
+
+        self.session = session if session is not None else requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _url(self, path: str) -> str:
+        return f"{self.base_url}/{self.api_version}/{path.lstrip('/')}"
+
+    def _record_usage(self, response: requests.Response) -> None:
+        for header in USAGE_HEADERS:
+            value = response.headers.get(header)
+            if not value:
+                continue
+            try:
+                self.usage[header] = json.loads(value)
+            except ValueError:
+                logger.warning(f"Unparseable {header} header: {value}")
+
+    def usage_percent(self) -> float:
+        """
+        Highest utilisation reported by the latest usage headers, in percent.
+
+        Callers should slow down as this approaches 100.
+        """
+        def percents(value):
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    if key in ('call_count', 'total_cputime', 'total_time') and isinstance(item, (int, float)):
+                        yield item
+                    else:
+                        yield from percents(item)
+            elif isinstance(value, list):
+                for item in value:
+                    yield from percents(item)
+
+        return max(percents(self.usage), default=0.0)
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, self.backoff_factor * 2 ** attempt)
+
+    def request(self, method: str, path: str, params: Optional[Dict[str, Any]] = None,
+                data: Optional[Dict[str, Any]] = None,
+                idempotent: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        Call the Graph API and return the decoded JSON body.
+
+        Args:
+            method: HTTP method
+            path: Path below the API version, e.g. '{user_id}/media'
+            params: Query parameters
+            data: Form fields
+            idempotent: Whether repeating the call is harmless; defaults to
+                True for GET and False otherwise
+
+        Returns:
+            Decoded JSON response
+
+        Raises:
+            InstagramAPIError: The API returned an error response
+            requests.RequestException: Network failure after all retries
+            DependencyUnavailable: The Graph API circuit is open or the
+                concurrency limit is reached
+        """
+        if idempotent is None:
+            idempotent = method.upper() == 'GET'
+        params = dict(params or {})
+        data = dict(data) if data is not None else None
+        if data is not None:
+            data.setdefault('access_token', self.access_token)
+        else:
+            params.setdefault('access_token', self.access_token)
+
+        attempt = 0
+        while True:
+            response = None
+            started = REGISTRY.clock()
+            try:
+                with guarded(self.resilience) as guard:
+                    response = self.session.request(method, self._url(path), params=params,
+                                                    data=data, timeout=self.timeout)
+                    if response.status_code in OVERLOAD_STATUS_CODES:
+                        guard.fail(response.status_code)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                REGISTRY.record_stage('instagram.request', REGISTRY.clock() - started, e, method=method)
+                if attempt >= self.max_retries or (may_have_been_sent(e) and not idempotent):
+                    raise
+                logger.warning(f"Graph API {method} {path} failed ({e}); retrying")
+            else:
+                REGISTRY.record_stage('instagram.request', REGISTRY.clock() - started, method=method)
+                REGISTRY.inc('instagram_responses_total', method=method, status=response.status_code)
+                self._record_usage(response)
+                retryable = response.status_code == 429 or (
+                    idempotent and response.status_code in RETRYABLE_STATUS_CODES)
+                if not retryable or attempt >= self.max_retries:
+                    return self._decode(response)
+                logger.warning(f"Graph API {method} {path} returned {response.status_code}; retrying")
+
+            time.sleep(self._backoff(attempt, response))
+            attempt += 1
+
+    def _decode(self, response: requests.Response) -> Dict[str, Any]:
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code != 200 or 'error' in body:
+            error = body.get('error', {}) if isinstance(body, dict) else {}
+            raise InstagramAPIError(error.get('message') or response.text,
+                                    status_code=response.status_code, error=error)
+        return body
+
+    def create_media_container(self, image_url: str, caption: Optional[str] = None,
+                               is_carousel_item: bool = False) -> str:
+        """
+        Create an image media container.
+
+        Retrying is safe: a duplicate container is never published and
+        expires on its own.
+
+        Args:
+            image_url: Public URL of the image
+            caption: Caption text (omitted for carousel children)
+            is_carousel_item: Create the container as a carousel child
+
+        Returns:
+            Container ID
+        """
+        data = {"image_url": image_url}
+        if caption is not None:
+            data["caption"] = caption
+        if is_carousel_item:
+            data["is_carousel_item"] = "true"
+        body = self.request('POST', f"{self.user_id}/media", data=data, idempotent=True)
+        container_id = body.get("id")
+        if not container_id:
+            raise InstagramAPIError(f"No container ID in response: {body}")
+        return container_id
+
+    def create_carousel_container(self, children: List[str], caption: str) -> str:
+        """
+        Create the parent container of a carousel post.
+
+        Args:
+            children: Container IDs of the carousel items, in display order
+            caption: Caption text for the post
+
+        Returns:
+            Container ID
+        """
+        body = self.request('POST', f"{self.user_id}/media",
+                            data={"media_type": "CAROUSEL", "children": ",".join(children),
+                                  "caption": caption},
+                            idempotent=True)
+        container_id = body.get("id")
+        if not container_id:
+            raise InstagramAPIError(f"No container ID in response: {body}")
+        return container_id
+
+    def get_container_statuses(self, container_ids: List[str]) -> Dict[str, str]:
+        """
+        Fetch the status_code of several containers in one request.
+
+        Returns:
+            Mapping of container ID to status (IN_PROGRESS, FINISHED, ERROR, EXPIRED, PUBLISHED)
+        """
+        body = self.request('GET', '', params={"ids": ",".join(container_ids),
+                                               "fields": "status_code"})
+        return {cid: (body.get(cid) or {}).get("status_code", "UNKNOWN") for cid in container_ids}
+
+    def wait_for_containers(self, container_ids: List[str], timeout: float = 300.0,
+                            initial_delay: float = 1.0, max_delay: float = 30.0) -> Dict[str, str]:
+        """
+        Poll containers together until none is IN_PROGRESS.
+
+        The polling interval grows while nothing changes and drops back when
+        some container finishes, so fast uploads are noticed quickly without
+        hammering the API for slow ones.
+
+        Args:
+            container_ids: Containers to wait for
+            timeout: Give up after this many seconds
+            initial_delay: First polling interval in seconds
+            max_delay: Longest polling interval in seconds
+
+        Returns:
+            Final status of every container; still-pending ones are IN_PROGRESS
+        """
+        statuses = {cid: "IN_PROGRESS" for cid in container_ids}
+        deadline = time.monotonic() + timeout
+        delay = initial_delay
+        while True:
+            pending = [cid for cid, status in statuses.items() if status in PENDING_STATUSES]
+            if not pending:
+                return statuses
+            statuses.update(self.get_container_statuses(pending))
+            still_pending = [cid for cid in pending if statuses[cid] in PENDING_STATUSES]
+            if not still_pending:
+                return statuses
+            if time.monotonic() + delay > deadline:
+                logger.warning(f"Timed out waiting for containers: {still_pending}")
+                return statuses
+            time.sleep(delay)
+            if len(still_pending) < len(pending):
+                delay = max(initial_delay, delay / 2)
+            else:
+                delay = min(max_delay, delay * 1.5)
+
+    def publish_container(self, container_id: str) -> str:
+        """
+        Publish a media container. Not retried once the request may have been sent.
+
+        Returns:
+            Media ID of the published post
+
+        Raises:
+            InstagramAPIError: The API refused the publish, or accepted it
+                without returning a media ID (``maybe_published`` is set)
+        """
+        body = self.request('POST', f"{self.user_id}/media_publish",
+                            data={"creation_id": container_id})
+        media_id = body.get("id")
+        if not media_id:
+            raise InstagramAPIError(f"No media ID in response: {body}", maybe_published=True)
+        return media_id
+
+    def recent_media(self, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Fetch the account's latest posts with their like and comment counts.
+
+        Args:
+            limit: Most posts to return
+
+        Returns:
+            Media objects with id, timestamp, like_count and comments_count
+        """
+        body = self.request('GET', f"{self.user_id}/media",
+                            params={"fields": "id,timestamp,like_count,comments_count",
+                                    "limit": limit})
+        return list(body.get("data") or [])[:limit]
+
+    def content_publishing_limit(self) -> Dict[str, Any]:
+        """
+        Fetch how much of its publishing quota the account has used.
+
+        Returns:
+            Dict with quota_usage (publishes in the current window), and
+            quota_total and quota_duration (seconds) when reported
+        """
+        body = self.request('GET', f"{self.user_id}/content_publishing_limit",
+                            params={"fields": "config,quota_usage"})
+        data = (body.get("data") or [{}])[0]
+        config = data.get("config") or {}
+        return {"quota_usage": int(data.get("quota_usage") or 0),
+                "quota_total": config.get("quota_total"),
+                "quota_duration": config.get("quota_duration")}
+
+    def post_carousel(self, image_urls: List[str], caption: str, max_workers: int = 10,
+                      child_retries: int = 2, timeout: float = 300.0,
+                      poll_delay: float = 1.0) -> Dict[str, Any]:
+        """
+        Create, wait for and publish a carousel post.
+
+        Child containers are created in parallel and polled together; a child
+        that fails to create or ends in ERROR/EXPIRED is recreated on its own
+        without redoing the others.
+
+        Args:
+            image_urls: 2 to 10 public image URLs, in display order
+            caption: Caption text for the post
+            max_workers: Parallel child container creations
+            child_retries: Extra attempts per failed child
+            timeout: Seconds to wait for each round of container processing
+            poll_delay: Initial status polling interval
+
+        Returns:
+            Result dictionary with media_id, container_id and child_ids
+
+        Raises:
+            ValueError: If the number of images is outside 2..10
+            InstagramAPIError: If a child or the parent cannot be processed
+        """
+        if not MIN_CAROUSEL_ITEMS <= len(image_urls) <= MAX_CAROUSEL_ITEMS:
+            raise ValueError(f"A carousel needs {MIN_CAROUSEL_ITEMS}-{MAX_CAROUSEL_ITEMS} images, "
+                             f"got {len(image_urls)}")
+
+        children: Dict[int, str] = {}
+        remaining = list(range(len(image_urls)))
+        last_error: Optional[Exception] = None
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(image_urls)),
+                                thread_name_prefix='carousel') as pool:
+            for _ in range(child_retries + 1):
+                futures = {index: pool.submit(self.create_media_container, image_urls[index],
+                                              is_carousel_item=True)
+                           for index in remaining}
+                created = {}
+                for index, future in futures.items():
+                    try:
+                        created[index] = future.result()
+                    except Exception as e:
+                        last_error = e
+                        logger.warning(f"Failed to create carousel item {image_urls[index]}: {e}")
+
+                statuses = self.wait_for_containers(list(created.values()), timeout=timeout,
+                                                    initial_delay=poll_delay) if created else {}
+                remaining = [index for index in remaining if index not in created]
+                for index, container_id in created.items():
+                    if statuses.get(container_id) == "FINISHED":
+                        children[index] = container_id
+                    else:
+                        logger.warning(f"Carousel item {image_urls[index]} ended as "
+                                       f"{statuses.get(container_id)}; retrying")
+                        remaining.append(index)
+                if not remaining:
+                    break
+
+        if remaining:
+            failed = [image_urls[index] for index in sorted(remaining)]
+            raise InstagramAPIError(f"Carousel items failed: {failed} (last error: {last_error})")
+
+        child_ids = [children[index] for index in range(len(image_urls))]
+        container_id = self.create_carousel_container(child_ids, caption)
+        status = self.wait_for_containers([container_id], timeout=timeout,
+                                          initial_delay=poll_delay)[container_id]
+        if status != "FINISHED":
+            raise InstagramAPIError(f"Carousel container {container_id} ended as {status}")
+
+        media_id = self.publish_container(container_id)
+        return {
+            "success": True,
+            "media_id": media_id,
+            "container_id": container_id,
+            "child_ids": child_ids,
+            "image_urls": list(image_urls),
+            "caption": caption
+        }
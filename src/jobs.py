@@ -0,0 +1,404 @@
+"""
+Durable job queue and worker pool.
+
+Jobs live in SQLite, so a crash never loses scheduled work. Each job has a
+``run_at`` time, an optional dedup key (enqueuing the same key twice is a
+no-op, which makes re-planning idempotent) and a lease. A worker takes a job
+by leasing it for ``lease_seconds``. If the worker dies, the lease expires
+and another worker picks the job up again, so every job runs at least once.
+Failed jobs are retried with exponential backoff until ``max_attempts``.
+
+Workers do not poll. Each one sleeps exactly until the next job is due, and
+is woken early when a job is enqueued in the same process.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional, List, Dict, Any, Callable, NamedTuple
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(NamedTuple):
+    """A leased unit of work."""
+    id: int
+    kind: str
+    payload: Dict[str, Any]
+    attempts: int
+    max_attempts: int
+    dedup_key: Optional[str]
+    run_at: float
+
+
+class RetryLater(Exception):
+    """
+    Raised by a handler to run the job again later without using up an attempt.
+
+    Args:
+        delay: Seconds until the job is due again
+        reason: Logged explanation, e.g. "rate limited"
+    """
+
+    def __init__(self, delay: float, reason: str = ''):
+        super().__init__(reason or f"retry in {delay:.0f}s")
+        self.delay = delay
+        self.reason = reason
+
+
+class JobQueue:
+    """
+    SQLite-backed job queue with scheduled times, leases and dedup keys.
+
+    Args:
+        path: SQLite database file (':memory:' for tests)
+        clock: Wall clock (injectable for tests; defaults to time.time as
+            found when the queue is created)
+        base_delay: First retry delay in seconds; doubles per attempt
+        max_delay: Retry delay ceiling in seconds
+    """
+
+    def __init__(self, path: str, clock: Optional[Callable[[], float]] = None,
+                 base_delay: float = 30.0, max_delay: float = 3600.0):
+        self.path = path
+        self.clock = clock or time.time
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._conn = None
+        self._lock = threading.RLock()
+        # Notified whenever jobs change; workers sleep on it
+        self.changed = threading.Condition(self._lock)
+        self.version = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    dedup_key TEXT UNIQUE,
+                    run_at REAL NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    last_error TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (status, run_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_lease ON jobs (status, lease_expires)")
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _notify(self) -> None:
+        self.version += 1
+        self.changed.notify_all()
+
+    def enqueue(self, kind: str, payload: Optional[Dict[str, Any]] = None,
+                run_at: Optional[float] = None, dedup_key: Optional[str] = None,
+                max_attempts: int = 5) -> int:
+        """
+        Add a job; a job with the same dedup key is not added twice.
+
+        Args:
+            kind: Handler name
+            payload: JSON-serialisable job arguments
+            run_at: When the job becomes due (default: now)
+            dedup_key: Unique key; enqueuing an existing key is a no-op
+            max_attempts: Attempts before the job is marked failed
+
+        Returns:
+            ID of the new job, or of the existing job with the same dedup key
+        """
+        now = self.clock()
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO jobs (kind, payload, dedup_key, run_at, status, max_attempts, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload or {}), dedup_key, now if run_at is None else run_at,
+                 PENDING, max_attempts, now, now)
+            )
+            if cursor.rowcount:
+                self._notify()
+                return cursor.lastrowid
+            return self.conn.execute("SELECT id FROM jobs WHERE dedup_key = ?",
+                                     (dedup_key,)).fetchone()[0]
+
+    def lease(self, owner: str, lease_seconds: float = 300,
+              kinds: Optional[List[str]] = None) -> Optional[Job]:
+        """
+        Take the most overdue job, including jobs whose previous lease expired.
+
+        Returns:
+            The leased job, or None if nothing is due
+        """
+        now = self.clock()
+        kind_filter = ''
+        params: List[Any] = [PENDING, now, LEASED, now]
+        if kinds:
+            kind_filter = f" AND kind IN ({','.join('?' * len(kinds))})"
+            params.extend(kinds)
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT id, kind, payload, attempts, max_attempts, dedup_key, run_at FROM jobs "
+                    "WHERE ((status = ? AND run_at <= ?) OR (status = ? AND lease_expires <= ?))"
+                    f"{kind_filter} ORDER BY run_at, id LIMIT 1", params
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_owner = ?, "
+                    "lease_expires = ?, updated_at = ? WHERE id = ?",
+                    (LEASED, owner, now + lease_seconds, now, row[0])
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return Job(row[0], row[1], json.loads(row[2]), row[3] + 1, row[4], row[5], row[6])
+
+    def heartbeat(self, job: Job, lease_seconds: float = 300) -> None:
+        """Extend the lease of a long-running job."""
+        with self._lock:
+            self.conn.execute("UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ?",
+                              (self.clock() + lease_seconds, self.clock(), job.id))
+
+    def complete(self, job: Job, result: Optional[Dict[str, Any]] = None) -> None:
+        """Mark a job done."""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, lease_owner = NULL, lease_expires = NULL, "
+                "updated_at = ? WHERE id = ?",
+                (DONE, json.dumps(result) if result is not None else None, self.clock(), job.id)
+            )
+            self._notify()
+
+    def fail(self, job: Job, error: str) -> Optional[float]:
+        """
+        Record a failed attempt and schedule a retry with exponential backoff.
+
+        Returns:
+            When the job will be retried, or None if it has run out of attempts
+        """
+        now = self.clock()
+        with self._lock:
+            if job.attempts >= job.max_attempts:
+                self.conn.execute(
+                    "UPDATE jobs SET status = ?, last_error = ?, lease_owner = NULL, "
+                    "lease_expires = NULL, updated_at = ? WHERE id = ?",
+                    (FAILED, error, now, job.id)
+                )
+                self._notify()
+                return None
+            retry_at = now + min(self.max_delay, self.base_delay * 2 ** (job.attempts - 1))
+            self._reschedule(job, retry_at, error, refund=False)
+            return retry_at
+
+    def defer(self, job: Job, delay: float, reason: str = '') -> float:
+        """Run a job again after ``delay`` seconds without counting this attempt."""
+        retry_at = self.clock() + delay
+        with self._lock:
+            self._reschedule(job, retry_at, reason or None, refund=True)
+        return retry_at
+
+    def _reschedule(self, job: Job, run_at: float, error: Optional[str], refund: bool) -> None:
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, run_at = ?, last_error = ?, lease_owner = NULL, "
+            "lease_expires = NULL, attempts = attempts - ?, updated_at = ? WHERE id = ?",
+            (PENDING, run_at, error, 1 if refund else 0, self.clock(), job.id)
+        )
+        self._notify()
+
+    def cancel_pending(self, kind: str) -> int:
+        """Delete the pending jobs of one kind, freeing their dedup keys; returns how many."""
+        with self._lock:
+            cursor = self.conn.execute("DELETE FROM jobs WHERE kind = ? AND status = ?", (kind, PENDING))
+            if cursor.rowcount:
+                self._notify()
+            return cursor.rowcount
+
+    def pending_jobs(self, kind: str) -> List[Dict[str, Any]]:
+        """Payload and run_at of the pending jobs of one kind, soonest first."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT payload, run_at FROM jobs WHERE kind = ? AND status = ? ORDER BY run_at, id",
+                (kind, PENDING)
+            ).fetchall()
+        return [{"payload": json.loads(payload), "run_at": run_at} for payload, run_at in rows]
+
+    def next_due_at(self) -> Optional[float]:
+        """Time the next job becomes runnable (pending run_at or expiring lease), if any."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT MIN(t) FROM ("
+                "SELECT MIN(run_at) AS t FROM jobs WHERE status = ? "
+                "UNION ALL SELECT MIN(lease_expires) FROM jobs WHERE status = ?)",
+                (PENDING, LEASED)
+            ).fetchone()
+        return row[0]
+
+    def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """Return a job's full row as a dict (for inspection and tests)."""
+        with self._lock:
+            cursor = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            record = dict(zip([c[0] for c in cursor.description], row))
+        record["payload"] = json.loads(record["payload"])
+        record["result"] = json.loads(record["result"]) if record["result"] else None
+        return record
+
+    def counts(self) -> Dict[str, int]:
+        """Number of jobs per status."""
+        with self._lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+
+class JobRunner:
+    """
+    Worker pool executing jobs from a JobQueue.
+
+    Handlers are called with the leased job. Returning normally completes it
+    (a returned dict is stored as the result). Raising RetryLater defers it,
+    and raising anything else counts as a failed attempt.
+
+    Args:
+        queue: Queue to take jobs from
+        handlers: Mapping of job kind to handler
+        workers: Worker threads started by start()
+        lease_seconds: How long a job stays leased before another worker may retry it
+        max_idle: Upper bound on one sleep, to notice jobs enqueued by other processes
+    """
+
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable[[Job], Optional[Dict[str, Any]]]],
+                 workers: int = 4, lease_seconds: float = 300, max_idle: float = 300):
+        self.queue = queue
+        self.handlers = handlers
+        self.workers = max(1, workers)
+        self.lease_seconds = lease_seconds
+        self.max_idle = max_idle
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def execute(self, job: Job) -> bool:
+        """Run one leased job and record the outcome. Returns True if it completed."""
+        handler = self.handlers.get(job.kind)
+        started = REGISTRY.clock()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler for job kind '{job.kind}'")
+            result = handler(job)
+        except RetryLater as e:
+            self.queue.defer(job, e.delay, e.reason)
+            REGISTRY.inc('jobs_total', kind=job.kind, outcome='deferred')
+            logger.info(f"Job {job.id} ({job.kind}) deferred {e.delay:.0f}s: {e}")
+            return False
+        except Exception as e:
+            REGISTRY.record_stage(f"job.{job.kind}", REGISTRY.clock() - started, e)
+            retry_at = self.queue.fail(job, str(e))
+            REGISTRY.inc('jobs_total', kind=job.kind, outcome='failed' if retry_at is None else 'retried')
+            if retry_at is None:
+                logger.error(f"Job {job.id} ({job.kind}) failed permanently after "
+                             f"{job.attempts} attempts: {e}")
+            else:
+                logger.warning(f"Job {job.id} ({job.kind}) attempt {job.attempts} failed, "
+                               f"retrying in {retry_at - self.queue.clock():.0f}s: {e}")
+            return False
+        REGISTRY.record_stage(f"job.{job.kind}", REGISTRY.clock() - started)
+        self.queue.complete(job, result)
+        REGISTRY.inc('jobs_total', kind=job.kind, outcome='completed')
+        logger.info(f"Job {job.id} ({job.kind}) completed")
+        return True
+
+    def run_once(self) -> bool:
+        """Lease and run one due job. Returns False if nothing was due."""
+        job = self.queue.lease(self.owner, self.lease_seconds, list(self.handlers))
+        if job is None:
+            return False
+        self.execute(job)
+        return True
+
+    def run_pending(self, limit: int = 1000) -> int:
+        """Run due jobs in the calling thread until none are left. Returns the number run."""
+        count = 0
+        while count < limit and self.run_once():
+            count += 1
+        return count
+
+    def seconds_until_due(self) -> float:
+        """How long an idle worker should sleep: until the next due job, at most max_idle."""
+        due = self.queue.next_due_at()
+        if due is None:
+            return self.max_idle
+        return min(self.max_idle, max(0.0, due - self.queue.clock()))
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            version = self.queue.version
+            try:
+                if self.run_once():
+                    continue
+                timeout = self.seconds_until_due()
+            except Exception as e:
+                logger.error(f"Job worker error: {e}")
+                timeout = min(self.max_idle, 5.0)
+            with self.queue.changed:
+                self.queue.changed.wait_for(
+                    lambda: self._stop.is_set() or self.queue.version != version, timeout)
+
+    def start(self) -> None:
+        """Start the worker threads."""
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job workers")
+
+    def run_forever(self) -> None:
+        """Start the workers and block until stop() is called or the process is interrupted."""
+        self.start()
+        self._stop.wait()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Stop the workers after their current job."""
+        self._stop.set()
+        with self.queue.changed:
+            self.queue.changed.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
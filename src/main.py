@@ -1,46 +1,180 @@
-import requests
+"""
+Zmaninstaposter: select an image from Google Cloud Storage, caption it with
+Gemini and post it to Instagram on a schedule.
+
+Importing this module has no side effects. Configuration, logging, the
+storage and Gemini clients and every other shared object are created on
+first use by the ``get_*`` functions below, and the Google client libraries
+are only imported when a client is actually needed. The historical
+module-level names (``config``, ``storage_manager``, ``caption_generator``,
+...) still work and resolve to the same lazily built instances.
+
+Run the scheduler with ``python -m src.main``. Posting rounds are durable
+jobs (see src/jobs.py): each account's select, caption, container and
+publish stages run as separate retriable jobs on a small worker pool.
+"""
+
+import functools
+import json
 import os
-import yaml
-from schedule import every, run_pending
+import sys
+import threading
 import time
+import uuid
 import logging
-from dotenv import load_dotenv
-from typing import Optional, List, Dict, Any
-
-# Import Google Cloud Storage and Gemini AI libraries
-# TODO: Install these packages: pip install google-cloud-storage google-generativeai
-try:
-    from google.cloud import storage
-    from google.oauth2 import service_account
-    import google.generativeai as genai
-    GOOGLE_LIBS_AVAILABLE = True
-except ImportError:
-    print("WARNING: Google Cloud libraries not installed. Install with:")
-    print("pip install google-cloud-storage google-generativeai")
-    GOOGLE_LIBS_AVAILABLE = False
-
-# Load environment variables from .env file
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('zmaninstaposter.log'),
-        logging.StreamHandler()
-    ]
-)
+from datetime import datetime, timedelta
+from urllib.parse import unquote
+from typing import (Optional, List, Dict, Any, Iterator, Union, Callable, Mapping, Set, Collection,
+                    Tuple, TYPE_CHECKING)
+
+from src.manifest import (BucketManifest, BlobRecord, LIST_FIELDS, ROOT_SHARD, is_image_name,
+                          record_from_blob)
+from src.history import DEFAULT_ACCOUNT, PostedHistory
+from src.catalog import ImageCatalog
+from src.rotation import InMemorySource, StreamingSource, SelectionEngine, build_strategy
+from src.caption_cache import CaptionCache, CachedCaptioner, CaptionPregenerator
+from src.accounts import Account, AccountContext, AccountDispatcher
+from src.preprocess import ImagePreprocessor, PIL_AVAILABLE, DERIVED_PREFIX
+from src.mirror import BucketMirror
+from src.thumbnails import ThumbnailCache
+from src.phash import PerceptualHashStore, NearDuplicateFilter, DEFAULT_MAX_DISTANCE
+from src.jobs import Job, JobQueue, JobRunner, RetryLater, PENDING, LEASED
+from src.quota import PublishQuota
+from src.ingest import Ingestor, LocalEventSource, PollingEventSource, PubSubEventSource
+from src.metrics import REGISTRY, EventLog, MetricsServer, inc, timed
+from src.resilience import CLOSED, DependencyUnavailable, Endpoint
+from src.settings import Settings, SettingsError, SettingsStore
+
+if TYPE_CHECKING:
+    # requests and the Graph API client are imported when the first post is made
+    from src.instagram_client import InstagramClient
+    # asyncio is only needed once a posting workflow runs
+    from src.async_pipeline import Stage
+    from src.settings import GeminiSettings
+    # The planner is only loaded when it is enabled
+    from src.planner import PostingPlanner
+    from src.replay import Cassette
+
 logger = logging.getLogger(__name__)
 
-# Load configuration
-try:
-    with open("config/config.yaml", "r") as f:
-        config = yaml.safe_load(f)
-        logger.info("Configuration loaded successfully")
-except FileNotFoundError:
-    logger.error("Configuration file not found. Please create config/config.yaml from the template.")
-    config = {}
+CONFIG_PATH = "config/config.yaml"
+LOG_FILE = 'zmaninstaposter.log'
+
+_singleton_lock = threading.RLock()
+# Every getter made by _singleton, for reset_components()
+_singletons: List[Callable[[], Any]] = []
+
+
+def _singleton(factory: Callable[[], Any]) -> Callable[[], Any]:
+    """
+    Turn a zero-argument factory into a memoized getter.
+    
+    The instance is built on the first call, once even when several threads
+    ask at the same time; ``getter.reset()`` drops it so the next call
+    builds a fresh one.
+    """
+    instance: List[Any] = []
+    
+    @functools.wraps(factory)
+    def getter():
+        if not instance:
+            with _singleton_lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+    
+    getter.reset = instance.clear
+    # The instance if it was built, without building it
+    getter.peek = lambda: instance[0] if instance else None
+    _singletons.append(getter)
+    return getter
+
+
+def configure_logging() -> None:
+    """Log to zmaninstaposter.log and the console. Called by main(), never on import."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(LOG_FILE),
+            logging.StreamHandler()
+        ]
+    )
+
+
+@_singleton
+def get_settings_store() -> SettingsStore:
+    """Return the store holding the current settings from .env and config/config.yaml."""
+    return SettingsStore(CONFIG_PATH)
+
+
+_settings_override: Optional[Settings] = None
+
+
+def get_settings() -> Settings:
+    """
+    Return the current settings snapshot, loading it on first use.
+    
+    Raises:
+        SettingsError: The configuration is invalid
+    """
+    if _settings_override is not None:
+        return _settings_override
+    return get_settings_store().current
+
+
+def use_settings(settings: Optional[Settings]) -> None:
+    """Use ``settings`` instead of the settings files (e.g. for a simulation); None goes back to them."""
+    global _settings_override
+    _settings_override = settings
+
+
+_cassette: Optional['Cassette'] = None
+
+
+def get_cassette() -> Optional['Cassette']:
+    """Return the cassette storage, Gemini and Graph API calls are recorded to or replayed from, if any."""
+    return _cassette
+
+
+def use_cassette(cassette: Optional['Cassette']) -> None:
+    """
+    Record calls to, or replay them from, ``cassette`` (None: talk to the live services).
+    
+    Clients already built are dropped so the next use goes through the cassette.
+    """
+    global _cassette
+    _cassette = cassette
+    reset_components()
+
+
+def get_config() -> Mapping[str, Any]:
+    """
+    Return the current configuration as read-only mappings.
+    
+    This is config/config.yaml with environment overrides applied (an empty
+    mapping if the file is missing), taken from the current settings
+    snapshot, so it reflects reloads.
+    """
+    return get_settings().raw
+
+
+_UNSET = object()
+
+
+def resilience_endpoint(name: str, **defaults) -> Endpoint:
+    """
+    Create the circuit breaker, concurrency limit and retry policy of one dependency.
+    
+    Settings come from the ``resilience.<name>`` config section, falling
+    back to ``defaults``; see Endpoint for the options.
+    """
+    options = {**defaults, **get_config().get('resilience', {}).get(name, {})}
+    return Endpoint(name, **options)
+
+
+_LAST_PAGE = object()
+
 
 class GoogleCloudStorageManager:
     """
@@ -55,62 +189,302 @@ class GoogleCloudStorageManager:
     """
     
     def __init__(self):
-        self.project_id = os.getenv('GOOGLE_CLOUD_PROJECT_ID') or config.get('cloud_storage', {}).get('project_id')
-        self.bucket_name = os.getenv('GOOGLE_CLOUD_STORAGE_BUCKET') or config.get('cloud_storage', {}).get('bucket_name')
-        self.credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS') or config.get('cloud_storage', {}).get('credentials_path')
-        
-        if not GOOGLE_LIBS_AVAILABLE:
-            logger.warning("Google Cloud Storage libraries not available. Using placeholder implementation.")
-            self.client = None
-            self.bucket = None
+        storage_settings = get_settings().storage
+        self.project_id = storage_settings.project_id
+        self.bucket_name = storage_settings.bucket_name
+        self.credentials_path = storage_settings.credentials_path
+        
+        # Folders that never hold postable originals, e.g. preprocessed derivatives
+        self.exclude_prefixes = tuple(get_config().get('cloud_storage', {}).get(
+            'exclude_prefixes', [get_config().get('preprocess', {}).get('derived_prefix', DERIVED_PREFIX)]))
+        
+        # Optional local manifest so we don't re-list the whole bucket every run
+        manifest_path = get_config().get('cloud_storage', {}).get('manifest_path')
+        self.manifest = BucketManifest(
+            manifest_path,
+            refresh_interval=get_config().get('cloud_storage', {}).get('manifest_refresh_interval', 3600),
+            exclude_prefixes=self.exclude_prefixes
+        ) if manifest_path else None
+        
+        # Optional memory-mapped catalog: the whole library in memory at ~80 bytes per image
+        self.catalog_path = get_config().get('cloud_storage', {}).get('catalog_path')
+        self.catalog_max_age = get_config().get('cloud_storage', {}).get('manifest_refresh_interval', 3600)
+        self._catalog: Optional[ImageCatalog] = None
+        self._catalog_mtime: Optional[float] = None
+        
+        # ACL applied by uploads; None for buckets with uniform bucket-level access
+        self.upload_acl = get_config().get('uploads', {}).get('predefined_acl', 'publicRead')
+        
+        # Storage reads are idempotent, so slow ones are hedged
+        self.resilience = resilience_endpoint('storage', hedge=True)
+        
+        # The client is created on first use of .client or .bucket
+        self._client = _UNSET
+        self._bucket = _UNSET
+    
+    def close(self) -> None:
+        """Stop the storage endpoint's hedging threads."""
+        self.resilience.close()
+    
+    def _connect(self) -> None:
+        """Import the storage library and create the client and bucket handle."""
+        self._client = None
+        self._bucket = None
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            # Served from recorded responses; no credentials or network needed
+            self._bucket = cassette.bucket(name=self.bucket_name)
+            return
+        try:
+            from google.cloud import storage
+            from google.oauth2 import service_account
+        except ImportError:
+            logger.warning("Google Cloud Storage libraries not available. Install with: "
+                           "pip install google-cloud-storage. Using placeholder implementation.")
             return
             
         try:
             # Initialize Google Cloud Storage client
             if self.credentials_path and os.path.exists(self.credentials_path):
                 credentials = service_account.Credentials.from_service_account_file(self.credentials_path)
-                self.client = storage.Client(project=self.project_id, credentials=credentials)
+                self._client = storage.Client(project=self.project_id, credentials=credentials)
             else:
                 # Use default application credentials
-                self.client = storage.Client(project=self.project_id)
+                self._client = storage.Client(project=self.project_id)
             
-            self.bucket = self.client.bucket(self.bucket_name) if self.bucket_name else None
+            self._bucket = self._client.bucket(self.bucket_name) if self.bucket_name else None
+            if cassette is not None and self._bucket is not None:
+                self._bucket = cassette.bucket(self._bucket, self.bucket_name)
             logger.info("Google Cloud Storage client initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize Google Cloud Storage client: {e}")
-            self.client = None
-            self.bucket = None
+            self._client = None
+            self._bucket = None
+    
+    @property
+    def client(self):
+        if self._client is _UNSET:
+            with _singleton_lock:
+                if self._client is _UNSET:
+                    self._connect()
+        return self._client
+    
+    @client.setter
+    def client(self, value) -> None:
+        self._client = value
+    
+    @property
+    def bucket(self):
+        if self._bucket is _UNSET:
+            self.client
+        return self._bucket
+    
+    @bucket.setter
+    def bucket(self, value) -> None:
+        self._bucket = value
+        if self._client is _UNSET:
+            self._client = None
     
     def list_images(self) -> List[str]:
         """
         List all image URLs from the Google Cloud Storage bucket.
         
+        When a manifest is configured the listing is served from it and only
+        stale shards of the bucket are re-crawled.
+        
         Returns:
             List of public image URLs
         """
         if not self.bucket:
             logger.warning("Using placeholder images from config")
-            return config.get('images', [
+            return get_config().get('images', [
                 "https://via.placeholder.com/600x600/FF6B6B/FFFFFF?text=Sample+Image+1",
                 "https://via.placeholder.com/600x600/4ECDC4/FFFFFF?text=Sample+Image+2"
             ])
         
+        if self.manifest:
+            try:
+                self.manifest.refresh(self.bucket)
+                image_urls = self.manifest.image_urls()
+                logger.info(f"Found {len(image_urls)} images in manifest")
+                return image_urls
+            except Exception as e:
+                logger.error(f"Failed to refresh image manifest, listing bucket directly: {e}")
+        
         try:
-            blobs = self.bucket.list_blobs()
-            image_urls = []
-            
-            for blob in blobs:
-                # Only include image files
-                if blob.name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-                    # Use the recommended public_url attribute
-                    image_urls.append(blob.public_url)
-            
+            with timed('storage.list'):
+                image_urls = [record.public_url for record in self.iter_images()]
             logger.info(f"Found {len(image_urls)} images in cloud storage")
             return image_urls
             
         except Exception as e:
             logger.error(f"Failed to list images from cloud storage: {e}")
-            return config.get('images', [])
+            return get_config().get('images', [])
+    
+    def iter_images(self, prefix: Optional[str] = None, match_glob: Optional[str] = None,
+                    updated_after: Optional[Union[float, datetime]] = None,
+                    limit: Optional[int] = None, start_offset: Optional[str] = None,
+                    page_size: int = 1000) -> Iterator[BlobRecord]:
+        """
+        Lazily list the images in the bucket, one page at a time.
+        
+        Only the current page is held in memory, and no further pages are
+        requested once the caller stops iterating or ``limit`` is reached.
+        Prefix, glob and start offset are applied server-side. GCS has no
+        server-side filter on modification time, so ``updated_after`` is
+        applied to each page as it arrives.
+        
+        Args:
+            prefix: Only list blobs under this prefix
+            match_glob: GCS glob such as ``**/*.jpg``
+            updated_after: Skip blobs last modified at or before this time
+                (epoch seconds or datetime)
+            limit: Stop after yielding this many records
+            start_offset: Only list blobs whose name is >= this value
+            page_size: Blobs requested per listing page
+        
+        Yields:
+            BlobRecord for each image, in bucket (name) order
+        """
+        if not self.bucket:
+            return
+        if isinstance(updated_after, datetime):
+            updated_after = updated_after.timestamp()
+        
+        options = {"prefix": prefix, "page_size": page_size, "fields": LIST_FIELDS}
+        if match_glob:
+            options["match_glob"] = match_glob
+        if start_offset:
+            options["start_offset"] = start_offset
+        
+        yielded = 0
+        for page in self.pages(self.bucket.list_blobs(**options)):
+            inc('storage_list_pages_total')
+            for blob in page:
+                if not is_image_name(blob.name) or blob.name.startswith(self.exclude_prefixes):
+                    continue
+                record = record_from_blob(blob)
+                if updated_after is not None and record.updated <= updated_after:
+                    continue
+                yield record
+                yielded += 1
+                if limit is not None and yielded >= limit:
+                    return
+    
+    def pages(self, iterator) -> Iterator[Any]:
+        """
+        Iterate the pages of a listing, fetching each through the storage circuit breaker.
+        
+        Pages are not retried here: a listing iterator cannot resume a failed page.
+        """
+        pages = iter(iterator.pages)
+        while True:
+            page = self.resilience.call(lambda: next(pages, _LAST_PAGE), idempotent=False)
+            if page is _LAST_PAGE:
+                return
+            yield page
+    
+    def list_folders(self) -> List[str]:
+        """
+        List the top-level folders holding images, with ROOT_SHARD for the bucket root.
+        
+        Uses one delimiter listing, which returns folder names without their contents.
+        """
+        if not self.bucket:
+            return [ROOT_SHARD]
+        iterator = self.bucket.list_blobs(delimiter='/', fields=LIST_FIELDS)
+        has_root_images = False
+        for page in self.pages(iterator):
+            has_root_images = has_root_images or any(is_image_name(blob.name) for blob in page)
+        folders = sorted(p for p in iterator.prefixes if not p.startswith(self.exclude_prefixes))
+        return ([ROOT_SHARD] if has_root_images else []) + folders
+    
+    def load_catalog(self) -> ImageCatalog:
+        """
+        Return the image catalog, rebuilding it when the saved copy is stale.
+        
+        A saved catalog younger than the refresh interval is memory-mapped,
+        which is near-instant at any library size. Otherwise it is rebuilt
+        from the manifest (or a bucket listing) and saved again. Either way
+        the posted flags are set from the default account's history.
+        
+        Raises:
+            Exception: Errors listing the bucket or writing the catalog file
+        """
+        try:
+            mtime = os.path.getmtime(self.catalog_path)
+        except OSError:
+            mtime = None
+        if mtime is not None and time.time() - mtime < self.catalog_max_age:
+            if self._catalog is None or self._catalog_mtime != mtime:
+                try:
+                    self._catalog, self._catalog_mtime = ImageCatalog.load(self.catalog_path), mtime
+                    self._catalog.sync_posted(get_posted_history())
+                    logger.info(f"Loaded image catalog of {len(self._catalog)} images")
+                except ValueError as e:
+                    logger.warning(f"Rebuilding unreadable image catalog: {e}")
+                    mtime = None
+            if mtime is not None:
+                return self._catalog
+        
+        if self.manifest:
+            self.manifest.refresh(self.bucket)
+            records = self.manifest.iter_records()
+        else:
+            records = self.iter_images()
+        with timed('catalog.build'):
+            catalog = ImageCatalog.from_records(records)
+        catalog.sync_posted(get_posted_history())
+        catalog.save(self.catalog_path)
+        self._catalog, self._catalog_mtime = catalog, os.path.getmtime(self.catalog_path)
+        logger.info(f"Built image catalog of {len(catalog)} images")
+        return catalog
+    
+    def candidate_source(self):
+        """
+        Return a queryable source of candidate images for the selection engine.
+        
+        Returns:
+            The image catalog or the refreshed manifest when configured,
+            otherwise a source that lists the bucket lazily; placeholder
+            images without a bucket
+        """
+        if self.bucket and self.catalog_path:
+            try:
+                return self.load_catalog()
+            except Exception as e:
+                logger.error(f"Failed to load image catalog: {e}")
+        if self.bucket and self.manifest:
+            try:
+                self.manifest.refresh(self.bucket)
+                return self.manifest
+            except Exception as e:
+                logger.error(f"Failed to refresh image manifest, listing bucket directly: {e}")
+        if self.bucket:
+            return StreamingSource(self.iter_images, self.list_folders)
+        return InMemorySource.from_urls(self.list_images())
+    
+    def public_url_if_exists(self, remote_name: str) -> Optional[str]:
+        """
+        Return the public URL of a blob if it exists in the bucket.
+        
+        Args:
+            remote_name: Name of the blob
+            
+        Returns:
+            Public URL, or None if the blob does not exist or storage is unavailable
+        """
+        if not self.bucket:
+            return None
+        
+        try:
+            blob = self.bucket.blob(remote_name)
+            with timed('storage.exists'):
+                exists = self.resilience.call(blob.exists)
+            return blob.public_url if exists else None
+        except Exception as e:
+            logger.error(f"Failed to check for {remote_name}: {e}")
+            return None
     
     def upload_image(self, local_path: str, remote_name: str) -> Optional[str]:
         """
@@ -128,11 +502,13 @@ class GoogleCloudStorageManager:
             return None
         
         try:
-            blob = self.bucket.blob(remote_name)
-            blob.upload_from_filename(local_path)
-            
-            # Make the blob publicly readable
-            blob.make_public()
+            with timed('storage.upload'):
+                blob = self.bucket.blob(remote_name)
+                
+                # The ACL is set by the upload request itself
+                self.resilience.call(
+                    lambda: blob.upload_from_filename(local_path, predefined_acl=self.upload_acl),
+                    idempotent=False)
             
             public_url = blob.public_url
             logger.info(f"Successfully uploaded {local_path} to {public_url}")
@@ -141,6 +517,75 @@ class GoogleCloudStorageManager:
         except Exception as e:
             logger.error(f"Failed to upload image {local_path}: {e}")
             return None
+    
+    def known_hashes(self) -> Set[str]:
+        """Return the MD5 hashes of the images in the bucket, from the manifest when configured."""
+        if self.manifest:
+            self.manifest.refresh(self.bucket)
+            records = self.manifest.iter_records()
+        else:
+            records = self.iter_images()
+        return {record.md5_hash for record in records if record.md5_hash}
+    
+    def bulk_upload(self, paths: List[str], prefix: str = '') -> Dict[str, Any]:
+        """
+        Upload many local images, skipping any whose content is already in the bucket.
+        
+        Settings come from the uploads config section; see BulkUploader.
+        
+        Args:
+            paths: Image files and directories to upload
+            prefix: Prepended to every blob name
+            
+        Returns:
+            Throughput report from BulkUploader.upload_tasks
+        """
+        from src.uploads import BulkUploader, DEFAULT_CHUNK_SIZE
+        upload_config = get_config().get('uploads', {})
+        uploader = BulkUploader(
+            self.bucket,
+            known_hashes=self.known_hashes(),
+            hash_workers=upload_config.get('hash_workers', 4),
+            upload_workers=upload_config.get('workers', 8),
+            chunk_size=upload_config.get('chunk_size', DEFAULT_CHUNK_SIZE),
+            predefined_acl=self.upload_acl,
+            metadata=upload_config.get('metadata'),
+            cache_control=upload_config.get('cache_control'),
+            resilience=self.resilience
+        )
+        return uploader.run(paths, prefix)
+
+
+# Default prompt for Instagram captions; {image_url} is filled in per image
+DEFAULT_CAPTION_PROMPT = """
+                Generate a creative and engaging Instagram caption for this image: {image_url}
+                
+                Requirements:
+                - Keep it under 150 characters
+                - Make it engaging and authentic
+                - Include 2-3 relevant hashtags
+                - Match the mood and content of the image
+                - Be creative but not overly promotional
+                
+                Return only the caption text, no additional formatting.
+                """
+
+DEFAULT_BATCH_CAPTION_PROMPT = """
+                Generate a creative and engaging Instagram caption for each of the {count} images below.
+                
+                Requirements:
+                - Keep each caption under 150 characters
+                - Make it engaging and authentic
+                - Include 2-3 relevant hashtags
+                - Match the mood and content of its image
+                - Be creative but not overly promotional
+                
+                Return a JSON array of exactly {count} strings, one caption per image,
+                in the order the images are given.
+                """
+
+# Posted when Gemini fails; never cached
+FALLBACK_CAPTION = "✨ Beautiful moment captured! 📸 #life #photography"
 
 
 class GeminiCaptionGenerator:
@@ -155,28 +600,221 @@ class GeminiCaptionGenerator:
     """
     
     def __init__(self):
-        self.api_key = os.getenv('GEMINI_API_KEY') or config.get('gemini', {}).get('api_key')
-        self.model_name = config.get('gemini', {}).get('model', 'gemini-1.5-flash')
-        self.max_tokens = config.get('gemini', {}).get('max_tokens', 150)
-        
-        if not GOOGLE_LIBS_AVAILABLE:
-            logger.warning("Gemini AI libraries not available. Using placeholder implementation.")
-            self.model = None
-            return
-            
+        # The Gemini model is created on first use of .model
+        self._model = _UNSET
+        self.api_key = self.model_name = None
+        self.configure(get_settings().gemini)
+        # ThumbnailCache for multimodal prompts; None sends text-only prompts
+        self.thumbnails = None
+        self.resilience = resilience_endpoint('gemini', retries=1)
+    
+    def close(self) -> None:
+        """Stop the Gemini endpoint's hedging threads."""
+        self.resilience.close()
+    
+    def configure(self, settings: 'GeminiSettings') -> None:
+        """Apply (reloaded) Gemini settings; captions already being generated are unaffected."""
+        if (settings.api_key, settings.model) != (self.api_key, self.model_name):
+            # Reconnect with the new key or model on next use
+            self._model = _UNSET
+        self.api_key = settings.api_key
+        self.model_name = settings.model
+        self.max_tokens = settings.max_tokens
+        self.prompt_template = settings.prompt_template or DEFAULT_CAPTION_PROMPT
+        self.batch_prompt_template = settings.batch_prompt_template or DEFAULT_BATCH_CAPTION_PROMPT
+        self.images_per_request = settings.images_per_request
+        self.max_request_bytes = settings.max_request_bytes
+    
+    def _connect(self):
+        """Import the Gemini library and create the model, or return None if unavailable."""
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return cassette.model()
         if not self.api_key or self.api_key == "YOUR_GEMINI_API_KEY_HERE":
             logger.warning("Gemini API key not configured. Using placeholder captions.")
-            self.model = None
-            return
+            return None
+        
+        try:
+            import google.generativeai as genai
+        except ImportError:
+            logger.warning("Gemini AI libraries not available. Install with: "
+                           "pip install google-generativeai. Using placeholder implementation.")
+            return None
         
         try:
             # Configure Gemini AI
             genai.configure(api_key=self.api_key)
-            self.model = genai.GenerativeModel(self.model_name)
+            model = genai.GenerativeModel(self.model_name)
             logger.info("Gemini AI client initialized successfully")
+            return cassette.model(model) if cassette is not None else model
         except Exception as e:
             logger.error(f"Failed to initialize Gemini AI client: {e}")
-            self.model = None
+            return None
+    
+    @property
+    def model(self):
+        if self._model is _UNSET:
+            with _singleton_lock:
+                if self._model is _UNSET:
+                    self._model = self._connect()
+        return self._model
+    
+    @model.setter
+    def model(self, value) -> None:
+        self._model = value
+    
+    def build_prompt(self, image_url: str, custom_prompt: str = None) -> str:
+        """
+        Build the caption prompt for an image.
+        
+        Args:
+            image_url: URL of the image to analyze
+            custom_prompt: Optional custom prompt that replaces the template
+            
+        Returns:
+            Prompt text sent to Gemini
+        """
+        if custom_prompt:
+            return custom_prompt
+        return self.prompt_template.format(image_url=image_url)
+    
+    @property
+    def input_variant(self) -> str:
+        """What the model is shown; part of the caption cache key."""
+        return f"image-{self.thumbnails.variant}" if self.thumbnails else ''
+    
+    def image_part(self, image_url: str) -> Optional[Dict[str, Any]]:
+        """Return the image's thumbnail as an inline content part, or None if unavailable."""
+        if not self.thumbnails:
+            return None
+        try:
+            return self.thumbnails.image_part(image_url)
+        except Exception as e:
+            logger.warning(f"Could not create thumbnail for {image_url}, captioning from URL only: {e}")
+            return None
+    
+    def build_contents(self, image_url: str, custom_prompt: str = None):
+        """
+        Build the request contents for one image.
+        
+        Returns:
+            A [prompt, image part] list when a thumbnail is available,
+            otherwise the text prompt alone
+        """
+        prompt = self.build_prompt(image_url, custom_prompt)
+        part = self.image_part(image_url)
+        return [prompt, part] if part else prompt
+    
+    def plan_batches(self, image_urls: List[str]) -> List[List[str]]:
+        """
+        Pack images into multi-image requests.
+        
+        Each request holds at most images_per_request thumbnails and at most
+        max_request_bytes of inline image data. Images without a thumbnail
+        are left in batches of one and are captioned from their URL.
+        """
+        batches: List[List[str]] = []
+        current: List[str] = []
+        current_bytes = 0
+        for url in image_urls:
+            part = self.image_part(url) if self.images_per_request > 1 else None
+            if part is None:
+                batches.append([url])
+                continue
+            size = len(part["data"])
+            if current and (len(current) >= self.images_per_request
+                            or current_bytes + size > self.max_request_bytes):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(url)
+            current_bytes += size
+        if current:
+            batches.append(current)
+        return batches
+    
+    def build_batch_contents(self, image_urls: List[str]) -> list:
+        """Build the request contents asking for one caption per image."""
+        contents = [self.batch_prompt_template.format(count=len(image_urls))]
+        for i, url in enumerate(image_urls, 1):
+            contents.append(f"Image {i}:")
+            contents.append(self.thumbnails.image_part(url))
+        return contents
+    
+    @staticmethod
+    def parse_batch_response(text: str, count: int) -> List[str]:
+        """
+        Parse the JSON array of captions returned for a multi-image request.
+        
+        Raises:
+            ValueError: If the response is not a JSON array of ``count`` captions
+        """
+        text = text.strip()
+        if text.startswith('```'):
+            text = text.strip('`').partition('\n')[2]
+        captions = json.loads(text)
+        if not isinstance(captions, list) or len(captions) != count:
+            raise ValueError(f"Expected a JSON array of {count} captions")
+        captions = [c.get('caption') if isinstance(c, dict) else c for c in captions]
+        if not all(isinstance(c, str) and c.strip() for c in captions):
+            raise ValueError("Batch response contains an empty caption")
+        return [c.strip() for c in captions]
+    
+    def request_caption(self, image_url: str, custom_prompt: str = None) -> str:
+        """
+        Ask Gemini for a caption without any placeholder fallback.
+        
+        Used where a failure must not be mistaken for a real caption,
+        e.g. when filling the caption cache.
+        
+        Raises:
+            RuntimeError: If Gemini is not configured
+            Exception: Any error raised by the Gemini client
+        """
+        if not self.model:
+            raise RuntimeError("Gemini AI not configured")
+        
+        contents = self.build_contents(image_url, custom_prompt)
+        with timed('gemini.caption'):
+            response = self.resilience.call(lambda: self.model.generate_content(contents))
+            return response.text.strip()
+    
+    def request_captions(self, image_urls: List[str]) -> Dict[str, str]:
+        """
+        Caption several images, packing them into multi-image requests.
+        
+        A batch whose response can't be parsed is retried one image at a
+        time. Images that still fail are logged and left out.
+        
+        Returns:
+            Mapping of image URL to caption
+        
+        Raises:
+            RuntimeError: If Gemini is not configured
+        """
+        if not self.model:
+            raise RuntimeError("Gemini AI not configured")
+        
+        captions = {}
+        for batch in self.plan_batches(list(dict.fromkeys(image_urls))):
+            if len(batch) > 1:
+                try:
+                    contents = self.build_batch_contents(batch)
+                    with timed('gemini.caption_batch'):
+                        response = self.resilience.call(lambda: self.model.generate_content(
+                            contents,
+                            generation_config={"response_mime_type": "application/json"}
+                        ))
+                        captions.update(zip(batch, self.parse_batch_response(response.text, len(batch))))
+                    continue
+                except Exception as e:
+                    logger.warning(f"Batch caption request for {len(batch)} images failed, "
+                                   f"captioning them one by one: {e}")
+            for url in batch:
+                try:
+                    captions[url] = self.request_caption(url)
+                except Exception as e:
+                    logger.error(f"Failed to generate caption for {url}: {e}")
+        return captions
     
     def generate_caption(self, image_url: str, custom_prompt: str = None) -> str:
         """
@@ -202,72 +840,340 @@ class GeminiCaptionGenerator:
             return caption
         
         try:
-            # Default prompt for Instagram captions
-            if not custom_prompt:
-                prompt = f"""
-                Generate a creative and engaging Instagram caption for this image: {image_url}
-                
-                Requirements:
-                - Keep it under 150 characters
-                - Make it engaging and authentic
-                - Include 2-3 relevant hashtags
-                - Match the mood and content of the image
-                - Be creative but not overly promotional
-                
-                Return only the caption text, no additional formatting.
-                """
-            else:
-                prompt = custom_prompt
-            
-            # For now, use text-only generation
-            # TODO: Implement multimodal image analysis when image input is supported
-            response = self.model.generate_content(prompt)
-            caption = response.text.strip()
+            caption = self.request_caption(image_url, custom_prompt)
             
             logger.info(f"Generated caption: {caption}")
             return caption
             
+        except DependencyUnavailable as e:
+            # Better to skip this post than to post a placeholder caption
+            logger.warning(f"Gemini unavailable, not captioning {image_url}: {e}")
+            return ""
         except Exception as e:
             logger.error(f"Failed to generate caption with Gemini AI: {e}")
             return "✨ Sharing a beautiful moment! 📸 #photography #life #moments"
+    
+    def generate_captions(self, image_urls: List[str], **options) -> Dict[str, str]:
+        """
+        Generate captions for many images concurrently (e.g. archive backfills).
+        
+        Requests are rate limited and retried with backoff on 429/5xx; see
+        AsyncCaptionBatcher for the available options. Defaults come from
+        the gemini.batch config section.
+        
+        Args:
+            image_urls: URLs of the images to caption
+            **options: Overrides for AsyncCaptionBatcher (concurrency,
+                requests_per_minute, tokens_per_minute, max_retries, ...)
+            
+        Returns:
+            Mapping of image URL to caption for every image that succeeded
+        """
+        batch_options = dict(get_config().get('gemini', {}).get('batch', {}))
+        batch_options.update(options)
+        import asyncio
+        from src.async_captions import AsyncCaptionBatcher
+        batcher = AsyncCaptionBatcher(self, **batch_options)
+        return asyncio.run(batcher.generate_captions(image_urls))
 
 
-# Initialize cloud storage and caption generator
-storage_manager = GoogleCloudStorageManager()
-caption_generator = GeminiCaptionGenerator()
+@_singleton
+def get_storage_manager() -> GoogleCloudStorageManager:
+    """Return the shared Cloud Storage manager; its client connects on first use."""
+    return GoogleCloudStorageManager()
 
 
-def select_image() -> str:
-    """
-    Select the next image to post from cloud storage.
-    
-    TODO: Implement intelligent image selection logic:
-    - Track previously posted images
-    - Implement rotation strategies
-    - Consider posting schedules and themes
-    
-    Returns:
-        URL of selected image
-    """
-    try:
-        available_images = storage_manager.list_images()
-        
-        if not available_images:
-            logger.error("No images available for posting")
-            return ""
-        
-        # Simple selection: return first image
-        # TODO: Implement more sophisticated selection logic
-        selected_image = available_images[0]
-        logger.info(f"Selected image: {selected_image}")
-        return selected_image
-        
-    except Exception as e:
-        logger.error(f"Error selecting image: {e}")
-        return ""
+@_singleton
+def get_thumbnail_cache() -> Optional[ThumbnailCache]:
+    """Return the on-disk thumbnail cache, or None without Pillow."""
+    if not PIL_AVAILABLE:
+        return None
+    thumbnail_config = get_config().get('gemini', {}).get('thumbnails', {})
+    return ThumbnailCache(
+        read_image_bytes,
+        thumbnail_config.get('path', 'data/thumbnails'),
+        max_side=thumbnail_config.get('max_side', 768),
+        quality=thumbnail_config.get('quality', 80),
+        max_bytes=thumbnail_config.get('max_kb', 512) * 1024,
+        resolve=bucket_record_for_url,
+        max_cache_bytes=thumbnail_config.get('max_cache_mb', 1024) * 1024 * 1024,
+        max_age=thumbnail_config.get('max_age_days', 30) * 86400
+    )
 
 
-def generate_caption(image_url: str) -> str:
+@_singleton
+def get_caption_generator() -> GeminiCaptionGenerator:
+    """Return the shared caption generator, with image thumbnails when Pillow is available."""
+    generator = GeminiCaptionGenerator()
+    # Thumbnails let Gemini see each image instead of only its URL
+    if get_config().get('gemini', {}).get('thumbnails', {}).get('enabled', True):
+        generator.thumbnails = get_thumbnail_cache()
+    return generator
+
+
+@_singleton
+def get_blob_mirror() -> Optional[BucketMirror]:
+    """Return the local bucket mirror downloads are served from, or None if not configured."""
+    mirror_config = get_config().get('mirror', {})
+    bucket = get_storage_manager().bucket
+    if not bucket or not mirror_config.get('path'):
+        return None
+    return BucketMirror(
+        bucket,
+        mirror_config['path'],
+        max_workers=mirror_config.get('max_workers', 8),
+        chunk_size=mirror_config.get('chunk_size_mb', 8) * 1024 * 1024,
+        ranged_threshold=mirror_config.get('ranged_threshold_mb', 32) * 1024 * 1024
+    )
+
+
+def download_image_from_bucket(blob_name: str, local_path: str,
+                               record: Optional[BlobRecord] = None) -> bool:
+    """
+    Download an image from the configured Google Cloud Storage bucket.
+
+    Args:
+        blob_name: Name of the blob (file) in the bucket
+        local_path: Local path to save the downloaded image
+        record: Listing record of the blob; the download is then of exactly
+            that generation, never an older copy in the mirror
+
+    Returns:
+        True if download succeeds, False otherwise
+    """
+    storage_manager = get_storage_manager()
+    if not storage_manager.bucket:
+        logger.error("Google Cloud Storage not properly configured")
+        return False
+
+    blob_mirror = get_blob_mirror()
+    if blob_mirror:
+        # Served from the local mirror; only blobs not yet cached hit GCS
+        if blob_mirror.copy_to(blob_name, local_path, record):
+            logger.info(f"Copied {blob_name} from mirror to {local_path}")
+            return True
+        return False
+
+    try:
+        with timed('storage.download'):
+            generation = record.generation if record is not None else None
+            blob = storage_manager.bucket.blob(blob_name, generation=generation or None)
+            # Retried, but not hedged: two downloads would write the same file
+            storage_manager.resilience.call(lambda: blob.download_to_filename(local_path), hedge=False)
+        logger.info(f"Downloaded {blob_name} to {local_path}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to download {blob_name}: {e}")
+        return False
+
+
+def bucket_record_for_url(image_url: str) -> Optional[BlobRecord]:
+    """
+    Look up the current record of an image in the configured bucket.
+    
+    Only the blob's metadata is fetched.
+    
+    Returns:
+        The record, or None if the URL is not of a blob in the bucket
+    """
+    storage_manager = get_storage_manager()
+    bucket_url = f"https://storage.googleapis.com/{storage_manager.bucket.name}/"
+    if not image_url.startswith(bucket_url):
+        return None
+    blob = storage_manager.bucket.get_blob(unquote(image_url[len(bucket_url):]))
+    return record_from_blob(blob) if blob is not None else None
+
+
+def read_image_bytes(image_url: str, record: Optional[BlobRecord] = None) -> bytes:
+    """
+    Return the encoded bytes of an image.
+    
+    Images in the configured bucket are read through the local mirror when
+    one is configured, at their current generation; anything else is
+    fetched over HTTP.
+    
+    Args:
+        image_url: Public URL of the image
+        record: Listing record of the image, if known; saves looking up
+            its current generation
+    
+    Raises:
+        Exception: If the image cannot be fetched
+    """
+    blob_mirror = get_blob_mirror()
+    if blob_mirror:
+        bucket_url = f"https://storage.googleapis.com/{get_storage_manager().bucket.name}/"
+        if record is None:
+            # An overwritten blob must not be served from an older copy
+            record = bucket_record_for_url(image_url)
+        if record is not None and image_url.startswith(bucket_url):
+            path = blob_mirror.fetch_record(record)
+            if path:
+                with open(path, 'rb') as f:
+                    return f.read()
+    import requests
+    
+    def fetch() -> bytes:
+        response = requests.get(image_url, timeout=30)
+        response.raise_for_status()
+        return response.content
+    
+    cassette = get_cassette()
+    if cassette is not None:
+        fetch = functools.partial(cassette.fetch, image_url, fetch)
+    with timed('http.fetch_image'):
+        return get_storage_manager().resilience.call(fetch)
+
+
+def repeat_window_seconds(days: Optional[float]) -> Optional[float]:
+    """Convert a no_repeat_days setting to seconds; None means never repeat."""
+    return days * 86400 if days else None
+
+
+@_singleton
+def get_posted_history() -> PostedHistory:
+    """Return the posted-history ledger of the default account."""
+    return PostedHistory(get_config().get('history', {}).get('path', 'data/history.sqlite3'))
+
+
+@_singleton
+def get_perceptual_hashes() -> Optional[PerceptualHashStore]:
+    """Return the perceptual hash store, or None without Pillow."""
+    thumbnails = get_thumbnail_cache()
+    if thumbnails is None:
+        return None
+    hash_config = get_config().get('near_duplicates', {})
+    return PerceptualHashStore(
+        hash_config.get('path', 'data/phash.sqlite3'),
+        lambda record: thumbnails.get(record.public_url, record),
+        algorithm=hash_config.get('algorithm', 'phash'),
+        max_workers=hash_config.get('max_workers', 8)
+    )
+
+
+def near_duplicate_filter(history: PostedHistory,
+                          repeat_days: Optional[float] = None) -> Optional[NearDuplicateFilter]:
+    """
+    Build the look-alike filter for one account's history, if enabled.
+    
+    Look-alikes are blocked for ``near_duplicates.window_days``, defaulting
+    to the account's no-repeat window.
+    """
+    hash_config = get_config().get('near_duplicates', {})
+    if not hash_config.get('enabled', False):
+        return None
+    store = get_perceptual_hashes()
+    if store is None:
+        logger.warning("Near-duplicate detection needs Pillow; disabled")
+        return None
+    return NearDuplicateFilter(
+        store, history,
+        max_distance=hash_config.get('max_distance', DEFAULT_MAX_DISTANCE),
+        window=repeat_window_seconds(hash_config.get('window_days', repeat_days))
+    )
+
+
+@_singleton
+def get_selection_engine() -> SelectionEngine:
+    """Return the rotation engine used for image selection."""
+    history_config = get_config().get('history', {})
+    return SelectionEngine(
+        get_posted_history(),
+        build_strategy(history_config.get('strategy', 'oldest_unposted'), history_config),
+        no_repeat_window=repeat_window_seconds(history_config.get('no_repeat_days')),
+        near_duplicates=near_duplicate_filter(get_posted_history(), history_config.get('no_repeat_days'))
+    )
+
+
+@_singleton
+def get_caption_cache() -> CaptionCache:
+    """Return the on-disk caption cache."""
+    caption_config = get_config().get('caption_cache', {})
+    caption_ttl_days = caption_config.get('ttl_days', 30)
+    return CaptionCache(
+        caption_config.get('path', 'data/captions.sqlite3'),
+        ttl=caption_ttl_days * 86400 if caption_ttl_days else None,
+        max_entries=caption_config.get('max_entries', 10000)
+    )
+
+
+@_singleton
+def get_cached_captioner() -> CachedCaptioner:
+    """Return the caption lookup that goes through the caption cache."""
+    return CachedCaptioner(get_caption_generator(), get_caption_cache())
+
+
+@_singleton
+def get_caption_pregenerator() -> CaptionPregenerator:
+    """Return the background thread that fills captions for upcoming posts."""
+    caption_config = get_config().get('caption_cache', {})
+    return CaptionPregenerator(
+        get_cached_captioner(),
+        lambda: get_selection_engine().peek(get_storage_manager().candidate_source(),
+                                            caption_config.get('lookahead', 5)),
+        interval=caption_config.get('refresh_interval', 3600)
+    )
+
+
+@_singleton
+def get_image_preprocessor() -> ImagePreprocessor:
+    """Return the preprocessor that makes cached Instagram-ready derivatives."""
+    preprocess_config = get_config().get('preprocess', {})
+    storage_manager = get_storage_manager()
+    return ImagePreprocessor(
+        lambda record, local_path: download_image_from_bucket(record.name, local_path, record),
+        storage_manager.upload_image,
+        preprocess_config.get('index_path', 'data/derived.sqlite3'),
+        target_width=preprocess_config.get('target_width', 1080),
+        quality=preprocess_config.get('quality', 85),
+        derived_prefix=preprocess_config.get('derived_prefix', DERIVED_PREFIX),
+        max_workers=preprocess_config.get('max_workers'),
+        exists=storage_manager.public_url_if_exists
+    )
+
+
+def select_record(source=None) -> Optional[BlobRecord]:
+    """
+    Select the next image to post using the configured rotation strategy.
+    
+    Images already in the posted history (by blob name or content hash)
+    are skipped until the no-repeat window has passed.
+    
+    Args:
+        source: Candidate source to select from; defaults to the storage manager's
+        
+    Returns:
+        BlobRecord of the selected image, or None if nothing is eligible
+    """
+    try:
+        if source is None:
+            source = get_storage_manager().candidate_source()
+        record = get_selection_engine().select(source)
+        
+        if not record:
+            logger.error("No images available for posting")
+            return None
+        
+        logger.info(f"Selected image: {record.public_url}")
+        return record
+        
+    except Exception as e:
+        logger.error(f"Error selecting image: {e}")
+        return None
+
+
+def select_image() -> str:
+    """
+    Select the next image to post from cloud storage.
+    
+    Returns:
+        URL of selected image
+    """
+    record = select_record()
+    return record.public_url if record else ""
+
+
+def generate_caption(image_url: str) -> str:
     """
     Generate a caption for the given image URL.
     
@@ -278,13 +1184,340 @@ def generate_caption(image_url: str) -> str:
         Generated caption text
     """
     try:
-        caption = caption_generator.generate_caption(image_url)
+        caption = get_caption_generator().generate_caption(image_url)
         logger.info(f"Generated caption for {image_url}: {caption}")
         return caption
         
     except Exception as e:
         logger.error(f"Error generating caption: {e}")
-        return "✨ Beautiful moment captured! 📸 #life #photography"
+        return FALLBACK_CAPTION
+
+def instagram_url_for(record: BlobRecord) -> str:
+    """
+    Return the URL Instagram should fetch for a selected image.
+    
+    Bucket originals are replaced by their resized, recompressed derivative
+    when preprocessing is enabled; on any failure the original URL is used.
+    
+    Args:
+        record: Selected image
+        
+    Returns:
+        Public image URL
+    """
+    if not get_config().get('preprocess', {}).get('enabled', True) or not PIL_AVAILABLE:
+        return record.public_url
+    if not get_storage_manager().bucket or not record.generation:
+        # Placeholder images from config are not bucket blobs
+        return record.public_url
+    
+    try:
+        url = get_image_preprocessor().prepare(record)
+        if url:
+            logger.info(f"Using preprocessed image {url} for {record.name}")
+            return url
+    except Exception as e:
+        logger.error(f"Failed to preprocess {record.name}: {e}")
+    return record.public_url
+
+
+def caption_for_record(record: BlobRecord) -> str:
+    """
+    Return the caption for a selected image.
+    
+    Pre-generated captions are served from the cache; on a miss the caption
+    is generated live and cached, so a retry of the post reuses it.
+    
+    Args:
+        record: Selected image
+        
+    Returns:
+        Caption text
+    """
+    captioner = None
+    try:
+        captioner = get_cached_captioner()
+        caption = captioner.lookup(record)
+        if caption:
+            logger.info(f"Using pre-generated caption for {record.public_url}: {caption}")
+            return caption
+    except Exception as e:
+        logger.error(f"Caption cache lookup failed: {e}")
+    
+    if captioner is None or not captioner.generator.model:
+        # Placeholder captions are not worth caching
+        return generate_caption(record.public_url)
+    try:
+        caption = captioner.generate(record)
+        logger.info(f"Generated caption for {record.public_url}: {caption}")
+        return caption
+    except DependencyUnavailable as e:
+        # Better to skip this post than to post a placeholder caption
+        logger.warning(f"Gemini unavailable, not captioning {record.public_url}: {e}")
+        return ""
+    except Exception as e:
+        logger.error(f"Error generating caption: {e}")
+        return FALLBACK_CAPTION
+
+
+_instagram_client: Optional['InstagramClient'] = None
+
+
+def get_instagram_client() -> 'InstagramClient':
+    """
+    Return the shared Instagram client, creating it on first use.
+    
+    Credentials are read once; the client keeps a pooled keep-alive session.
+    
+    Raises:
+        ValueError: If the access token or user ID is not configured
+    """
+    global _instagram_client
+    if _instagram_client is None:
+        from src.instagram_client import InstagramClient
+        instagram_settings = get_settings().instagram
+        access_token = instagram_settings.access_token
+        user_id = instagram_settings.user_id
+        
+        if not access_token or access_token == "YOUR_INSTAGRAM_ACCESS_TOKEN_HERE":
+            raise ValueError("Instagram access token not configured")
+        
+        if not user_id or user_id == "YOUR_INSTAGRAM_USER_ID_HERE":
+            raise ValueError("Instagram user ID not configured")
+        
+        _instagram_client = InstagramClient(
+            access_token,
+            user_id,
+            api_version=instagram_settings.api_version,
+            **instagram_client_options()
+        )
+    return _instagram_client
+
+
+def instagram_client_options() -> Dict[str, Any]:
+    """Connection pool, timeout and retry settings shared by every Instagram client."""
+    instagram_settings = get_settings().instagram
+    return {
+        "pool_size": instagram_settings.pool_size,
+        "connect_timeout": instagram_settings.connect_timeout,
+        "read_timeout": instagram_settings.read_timeout,
+        "max_retries": instagram_settings.max_retries,
+        "resilience": get_instagram_endpoint(),
+        # Recording or replaying: requests go through the cassette
+        "session": get_cassette().session() if get_cassette() is not None else None,
+    }
+
+
+@_singleton
+def get_instagram_endpoint() -> Endpoint:
+    """Return the circuit breaker and concurrency limit shared by every account's Graph API calls."""
+    # InstagramClient retries each request itself
+    return resilience_endpoint('instagram', retries=0)
+
+
+@_singleton
+def get_publish_quota() -> Optional[PublishQuota]:
+    """Return the per-account publishing quota, or None unless ``quota.enabled``."""
+    quota_config = get_config().get('quota', {})
+    if not quota_config.get('enabled', False):
+        return None
+    quota = PublishQuota(quota_config.get('path', 'data/quota.sqlite3'),
+                         limit=quota_config.get('limit', 50),
+                         window=quota_config.get('window_hours', 24) * 3600,
+                         sync_interval=quota_config.get('sync_interval', 900))
+    REGISTRY.gauge_callback('publish_quota_used',
+                            lambda: [({"account": account}, used)
+                                     for account, used in quota.usage_by_account().items()],
+                            'Publishes counted against each account\'s quota')
+    return quota
+
+
+def admit_post(account: str, client: 'InstagramClient', key: str) -> float:
+    """
+    Reserve a publishing slot for a post before its container is created.
+    
+    The account's usage is refreshed from the Graph API when the last sync
+    is older than ``quota.sync_interval``.
+    
+    Args:
+        account: Account the post goes to
+        client: Graph API client of the account
+        key: Identity of the post, unique per account
+        
+    Returns:
+        0 when the post may go ahead, else seconds until a slot frees up
+    """
+    quota = get_publish_quota()
+    if quota is None:
+        return 0.0
+    quota.sync(account, client)
+    return quota.admit(account, key).retry_after
+
+
+def settle_post(account: str, key: str, media_id: Optional[str] = None,
+                error: Optional[Exception] = None) -> None:
+    """
+    Count a published post against the quota, or give its slot back after ``error``.
+    
+    A publish accepted without a media ID may have gone out, so it keeps its slot.
+    """
+    quota = get_publish_quota()
+    if quota is None:
+        return
+    if media_id is not None or getattr(error, 'maybe_published', False):
+        quota.record_publish(account, key, media_id)
+        return
+    if getattr(error, 'publishing_limit_reached', False):
+        quota.exhausted(account)
+    quota.release(account, key)
+
+
+def quota_deferral(account: str, wait: float) -> Dict[str, Any]:
+    """Result of a post deferred because the account's publishing quota is used up."""
+    logger.warning(f"[{account}] Publishing quota used up, deferring this post by {wait:.0f}s")
+    return {"error": f"Publishing quota used up; next slot in {wait:.0f}s", "deferred": True,
+            "retry_after": wait}
+
+
+class PostingError(RuntimeError):
+    """A posting stage failed; the message is the error reported for the post."""
+
+
+def create_container(client: 'InstagramClient', image_url: str, caption: str) -> str:
+    """
+    Create a media container and wait until Instagram has processed it.
+    
+    Returns:
+        ID of the FINISHED container
+        
+    Raises:
+        PostingError: If the container is refused or does not finish
+    """
+    from src.instagram_client import InstagramAPIError
+    
+    try:
+        with timed('instagram.create_container'):
+            container_id = client.create_media_container(image_url, caption)
+    except InstagramAPIError as e:
+        raise PostingError(f"Media container creation failed: {e}")
+    with timed('instagram.wait_container'):
+        status = client.wait_for_containers(
+            [container_id],
+            timeout=get_config().get('instagram', {}).get('container_timeout', 300)
+        )[container_id]
+    if status != "FINISHED":
+        raise PostingError(f"Media container {container_id} not ready: {status}")
+    return container_id
+
+
+# The four stages of a post, shared by the job handlers and the async
+# pipeline. Each raises PostingError when the post fails and RetryLater when
+# it should be tried again later.
+
+def select_post(context: AccountContext, source, skip: Collection[str] = ()) -> BlobRecord:
+    """
+    Stage 1: select the image an account posts next.
+    
+    Args:
+        context: Account to post for
+        source: The account's view of the candidate source
+        skip: Names already picked for other posts that are not published yet
+    """
+    with timed('select', account=context.name):
+        if skip:
+            candidates = context.engine.peek(source, len(skip) + 1)
+            record = next((c for c in candidates if c.name not in skip), None)
+        else:
+            record = context.engine.select(source)
+    if not record:
+        raise PostingError("No image selected")
+    logger.info(f"[{context.name}] Selected image: {record.public_url}")
+    return record
+
+
+def caption_post(record: BlobRecord, account: str = DEFAULT_ACCOUNT) -> str:
+    """Stage 2: caption the selected image (cache lookup when pre-generated)."""
+    with timed('caption', account=account):
+        caption = caption_for_record(record)
+    if not caption:
+        breaker = get_caption_generator().resilience.breaker
+        if breaker.state != CLOSED:
+            raise RetryLater(max(1.0, breaker.retry_after()), "Gemini unavailable")
+        raise PostingError("Caption generation failed")
+    return caption
+
+
+def prepare_post(context: AccountContext, record: BlobRecord, caption: str, key: str,
+                 throttle_percent: float) -> Tuple[str, str]:
+    """
+    Stage 3: create the media container of the image and wait until it is processed.
+    
+    Accounts whose Graph API usage is at ``throttle_percent``, or whose
+    publishing quota is used up, are told to retry later. The quota slot is
+    reserved under ``key`` and released if the container fails; otherwise
+    publish_post() settles it.
+    
+    Returns:
+        The container ID and the image URL it was created from
+    """
+    client = context.client
+    usage = client.usage_percent() if hasattr(client, 'usage_percent') else 0.0
+    if usage >= throttle_percent:
+        logger.warning(f"[{context.name}] Graph API usage at {usage:.0f}%, holding this post back")
+        raise RetryLater(get_config().get('jobs', {}).get('throttle_delay', 3600),
+                         f"Graph API usage at {usage:.0f}%")
+    wait = admit_post(context.name, client, key)
+    if wait:
+        raise RetryLater(wait, "Publishing quota used up")
+    
+    try:
+        with timed('prepare_image', account=context.name):
+            image_url = instagram_url_for(record)
+        container_id = create_container(client, image_url, caption)
+    except Exception as e:
+        settle_post(context.name, key, error=e)
+        raise
+    logger.info(f"[{context.name}] Media container {container_id} ready")
+    return container_id, image_url
+
+
+def publish_post(context: AccountContext, record: BlobRecord, container_id: str, key: str,
+                 source) -> str:
+    """
+    Stage 4: publish the container and record the post.
+    
+    Instagram publishes a container at most once, so retrying this stage
+    after an ambiguous failure cannot create a duplicate post. A publish
+    refused because the account's quota is used up is to be retried; the
+    container stays publishable for 24 hours.
+    
+    Returns:
+        Media ID of the published post
+    """
+    from src.instagram_client import InstagramAPIError
+    
+    media_id = None
+    try:
+        with timed('instagram.publish'):
+            media_id = context.client.publish_container(container_id)
+    except InstagramAPIError as e:
+        settle_post(context.name, key, error=e)
+        if e.publishing_limit_reached:
+            quota = get_publish_quota()
+            delay = (quota.retry_after(context.name) if quota is not None
+                     else get_config().get('jobs', {}).get('throttle_delay', 3600))
+            raise RetryLater(delay, "Publishing quota used up")
+        inc('posts_total', account=context.name, outcome='error')
+        raise PostingError(f"Post publishing failed: {e}")
+    except Exception as e:
+        settle_post(context.name, key, error=e)
+        raise
+    settle_post(context.name, key, media_id=media_id)
+    inc('posts_total', account=context.name, outcome='success')
+    context.engine.mark_posted(record, source, media_id=media_id)
+    logger.info(f"[{context.name}] Successfully published post: {media_id}")
+    return media_id
+
 
 def post_to_instagram(image_url: str, caption: str) -> Dict[str, Any]:
     """
@@ -304,109 +1537,321 @@ def post_to_instagram(image_url: str, caption: str) -> Dict[str, Any]:
     Returns:
         API response dictionary
     """
-    # Get credentials from environment or config
-    access_token = os.getenv('INSTAGRAM_ACCESS_TOKEN') or config.get('instagram', {}).get('access_token')
-    user_id = os.getenv('INSTAGRAM_USER_ID') or config.get('instagram', {}).get('user_id')
-    api_version = config.get('instagram', {}).get('api_version', 'v19.0')
+    try:
+        client = get_instagram_client()
+    except ValueError as e:
+        logger.error(str(e))
+        return {"error": str(e)}
     
-    if not access_token or access_token == "YOUR_INSTAGRAM_ACCESS_TOKEN_HERE":
-        logger.error("Instagram access token not configured")
-        return {"error": "Instagram access token not configured"}
+    return publish_image(client, image_url, caption)
+
+
+def publish_image(client: 'InstagramClient', image_url: str, caption: str,
+                  account: str = DEFAULT_ACCOUNT) -> Dict[str, Any]:
+    """
+    Create and publish a single-image post with the given client.
     
-    if not user_id or user_id == "YOUR_INSTAGRAM_USER_ID_HERE":
-        logger.error("Instagram user ID not configured")
-        return {"error": "Instagram user ID not configured"}
+    Nothing is created while the account's publishing quota is used up; the
+    result is then marked ``deferred`` with the seconds to wait. The slot
+    taken in the quota is given back unless the post was published.
     
-    try:
-        # Step 1: Create media container
-        logger.info(f"Creating media container for image: {image_url}")
-        media_resp = requests.post(
-            f"https://graph.facebook.com/{api_version}/{user_id}/media",
-            data={
-                "image_url": image_url,
-                "caption": caption,
-                "access_token": access_token
-            }
-        )
-        
-        if media_resp.status_code != 200:
-            logger.error(f"Failed to create media container: {media_resp.text}")
-            return {"error": f"Media container creation failed: {media_resp.text}"}
-        
-        media_data = media_resp.json()
-        container_id = media_data.get("id")
+    Args:
+        client: Graph API client of the account to post to
+        image_url: Public URL of the image to post
+        caption: Caption text for the post
+        account: Name of the account, for its publishing quota
         
-        if not container_id:
-            logger.error(f"No container ID in response: {media_data}")
-            return {"error": "No container ID received"}
+    Returns:
+        API response dictionary
+    """
+    import requests
+    from src.instagram_client import InstagramAPIError
+    
+    key = uuid.uuid4().hex
+    media_id = refusal = None
+    try:
+        wait = admit_post(account, client, key)
+        if wait:
+            return quota_deferral(account, wait)
         
-        logger.info(f"Media container created with ID: {container_id}")
+        # Steps 1 and 2: create the media container and wait until Instagram has processed it
+        logger.info(f"Creating media container for image: {image_url}")
+        try:
+            container_id = create_container(client, image_url, caption)
+        except PostingError as e:
+            logger.error(str(e))
+            return {"error": str(e)}
         
-        # Step 2: Publish the post
+        # Step 3: Publish the post
         logger.info(f"Publishing media container: {container_id}")
-        publish_resp = requests.post(
-            f"https://graph.facebook.com/{api_version}/{user_id}/media_publish",
-            data={
-                "creation_id": container_id,
-                "access_token": access_token
-            }
-        )
-        
-        if publish_resp.status_code != 200:
-            logger.error(f"Failed to publish post: {publish_resp.text}")
-            return {"error": f"Post publishing failed: {publish_resp.text}"}
+        try:
+            with timed('instagram.publish'):
+                media_id = client.publish_container(container_id)
+        except InstagramAPIError as e:
+            logger.error(f"Failed to publish post: {e}")
+            refusal = e
+            return {"error": f"Post publishing failed: {e}"}
         
-        publish_data = publish_resp.json()
-        logger.info(f"Successfully published post: {publish_data}")
+        logger.info(f"Successfully published post: {media_id} (API usage {client.usage_percent():.0f}%)")
         
         return {
             "success": True,
-            "media_id": publish_data.get("id"),
+            "media_id": media_id,
             "container_id": container_id,
             "image_url": image_url,
-            "caption": caption
+            "caption": caption,
+            "usage": client.usage
         }
         
     except requests.RequestException as e:
         logger.error(f"Network error posting to Instagram: {e}")
         return {"error": f"Network error: {str(e)}"}
+    except DependencyUnavailable as e:
+        logger.error(f"Instagram unavailable, not posting: {e}")
+        return {"error": f"Instagram unavailable: {e}"}
     except Exception as e:
         logger.error(f"Unexpected error posting to Instagram: {e}")
         return {"error": f"Unexpected error: {str(e)}"}
+    finally:
+        settle_post(account, key, media_id=media_id, error=refusal)
+
+
+def post_carousel_to_instagram(image_urls: List[str], caption: str) -> Dict[str, Any]:
+    """
+    Post a carousel of 2-10 images with one caption.
+    
+    Child containers are created in parallel and polled together until
+    they are FINISHED; failed children are retried individually before the
+    carousel is published. A carousel counts as one post against the
+    publishing quota and is deferred like any other while it is used up.
+    
+    Args:
+        image_urls: Public URLs of the images, in display order
+        caption: Caption text for the post
+        
+    Returns:
+        API response dictionary
+    """
+    import requests
+    from src.instagram_client import InstagramAPIError
+    
+    try:
+        client = get_instagram_client()
+    except ValueError as e:
+        logger.error(str(e))
+        return {"error": str(e)}
+    
+    key = uuid.uuid4().hex
+    media_id = refusal = None
+    try:
+        wait = admit_post(DEFAULT_ACCOUNT, client, key)
+        if wait:
+            return quota_deferral(DEFAULT_ACCOUNT, wait)
+        logger.info(f"Creating carousel of {len(image_urls)} images")
+        result = client.post_carousel(
+            image_urls,
+            caption,
+            timeout=get_config().get('instagram', {}).get('container_timeout', 300)
+        )
+        media_id = result['media_id']
+        logger.info(f"Successfully published carousel: {media_id}")
+        return result
+        
+    except (ValueError, InstagramAPIError) as e:
+        logger.error(f"Failed to post carousel: {e}")
+        refusal = e
+        return {"error": f"Carousel posting failed: {e}"}
+    except requests.RequestException as e:
+        logger.error(f"Network error posting carousel to Instagram: {e}")
+        return {"error": f"Network error: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Unexpected error posting carousel to Instagram: {e}")
+        return {"error": f"Unexpected error: {str(e)}"}
+    finally:
+        settle_post(DEFAULT_ACCOUNT, key, media_id=media_id, error=refusal)
+
+
+_account_dispatcher: Optional[AccountDispatcher] = None
+
+
+def build_account_contexts() -> List[AccountContext]:
+    """
+    Create the runtime context of every account to post to.
+    
+    Without an ``accounts`` config section this is a single default account
+    using the INSTAGRAM_* credentials and the shared history and engine.
+    
+    Raises:
+        ValueError: If an account is misconfigured
+    """
+    accounts = get_settings().accounts
+    if not accounts:
+        default = Account('default', '', '')
+        return [AccountContext(default, get_selection_engine(), get_instagram_client)]
+    
+    history_config = get_config().get('history', {})
+    history_path = history_config.get('path', 'data/history.sqlite3')
+    contexts = []
+    for account in accounts:
+        repeat_days = account.no_repeat_days or history_config.get('no_repeat_days')
+        history = PostedHistory(history_path, account=account.name)
+        engine = SelectionEngine(
+            history,
+            build_strategy(account.strategy, account.strategy_options),
+            no_repeat_window=repeat_window_seconds(repeat_days),
+            near_duplicates=near_duplicate_filter(history, repeat_days)
+        )
+        
+        def client_factory(account=account):
+            from src.instagram_client import InstagramClient
+            return InstagramClient(account.access_token, account.user_id,
+                                   api_version=account.api_version, **instagram_client_options())
+        
+        contexts.append(AccountContext(account, engine, client_factory))
+    return contexts
+
+
+def get_account_dispatcher() -> AccountDispatcher:
+    """Return the shared multi-account dispatcher, creating it on first use."""
+    global _account_dispatcher
+    if _account_dispatcher is None:
+        dispatcher_config = get_config().get('dispatcher', {})
+        _account_dispatcher = AccountDispatcher(
+            build_account_contexts(),
+            throttle_percent=dispatcher_config.get('throttle_percent', 90)
+        )
+    return _account_dispatcher
+
+
+def posting_stages(dispatcher: AccountDispatcher) -> List['Stage']:
+    """
+    Build the stages of the async posting pipeline.
+    
+    Items are dicts holding the account ``context`` and its candidate
+    ``source``; each stage adds its output (record, caption, container) for
+    the next one. Images picked earlier in the same run are skipped, since
+    they are only recorded as posted once published.
+    
+    Args:
+        dispatcher: Supplies the Graph API throttle threshold
+        
+    Returns:
+        Select, caption, container and publish stages
+    """
+    from src.async_pipeline import Stage
+    
+    pipeline_config = get_config().get('pipeline', {})
+    claimed: Dict[str, set] = {}
+    select_lock = threading.Lock()
+    
+    def select(post: Dict[str, Any]):
+        context = post["context"]
+        with select_lock:
+            taken = claimed.setdefault(context.name, set())
+            record = select_post(context, post["source"], skip=taken)
+            taken.add(record.name)
+        return {**post, "record": record}
+    
+    def caption(post: Dict[str, Any]):
+        return {**post, "caption": caption_post(post["record"], post["context"].name)}
+    
+    def container(post: Dict[str, Any]):
+        key = uuid.uuid4().hex
+        container_id, image_url = prepare_post(post["context"], post["record"], post["caption"], key,
+                                               dispatcher.throttle_percent)
+        return {**post, "container_id": container_id, "image_url": image_url, "quota_key": key}
+    
+    def publish(post: Dict[str, Any]):
+        media_id = publish_post(post["context"], post["record"], post["container_id"], post["quota_key"],
+                                post["source"])
+        return {"success": True, "media_id": media_id, "container_id": post["container_id"],
+                "image_url": post["image_url"], "caption": post["caption"]}
+    
+    return [
+        Stage('select', select, 1),
+        Stage('caption', caption, pipeline_config.get('caption_workers', 2)),
+        Stage('container', container, pipeline_config.get('container_workers', 4)),
+        Stage('publish', publish, pipeline_config.get('publish_workers', 2)),
+    ]
+
+
+async def workflow_async(posts_per_account: Optional[int] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Post for every configured account with the stages of different posts overlapping.
+    
+    Selection, captioning, container processing and publishing run as
+    separate stages joined by bounded queues, so one post is captioned while
+    Instagram processes the previous post's container.
+    
+    Args:
+        posts_per_account: Posts to make for each account; defaults to
+            ``pipeline.posts_per_account`` (1)
+        
+    Returns:
+        Mapping of account name to the result dict of each of its posts
+    """
+    from src.async_pipeline import AsyncPipeline
+    
+    pipeline_config = get_config().get('pipeline', {})
+    if posts_per_account is None:
+        posts_per_account = pipeline_config.get('posts_per_account', 1)
+    dispatcher = get_account_dispatcher()
+    source = get_storage_manager().candidate_source()
+    
+    def on_error(post, error, stage):
+        name = post["context"].name
+        if isinstance(error, RetryLater):
+            # A batch is not retried; the post is reported as deferred
+            logger.warning(f"[{name}] Deferring this post: {error}")
+            return {"error": str(error), "deferred": True, "retry_after": error.delay}
+        if isinstance(error, PostingError):
+            logger.error(f"[{name}] {error}")
+            return {"error": str(error)}
+        if isinstance(error, ValueError):
+            # Configuration problems, e.g. missing credentials
+            logger.error(f"[{name}] {error}")
+            return {"error": str(error)}
+        logger.error(f"[{name}] Posting stage '{stage.name}' failed: {error}")
+        return {"error": f"Unexpected error: {error}"}
+    
+    # Interleave accounts so one slow account doesn't hold up the others
+    posts = [{"context": context, "source": context.source(source)}
+             for _ in range(posts_per_account) for context in dispatcher.contexts]
+    pipeline = AsyncPipeline(posting_stages(dispatcher),
+                             queue_size=pipeline_config.get('queue_size', 2), on_error=on_error)
+    results = await pipeline.run(posts)
+    
+    by_account: Dict[str, List[Dict[str, Any]]] = {context.name: [] for context in dispatcher.contexts}
+    for post, result in zip(posts, results):
+        by_account[post["context"].name].append(result)
+    return by_account
 
 
 def workflow() -> None:
     """
     Main workflow function that orchestrates the entire posting process.
     
-    This function:
+    For every configured account (concurrently), this function:
     1. Selects an image from cloud storage
     2. Generates a caption using Gemini AI
     3. Posts to Instagram using Graph API
     4. Handles errors and logging
+    
+    Synchronous wrapper around workflow_async().
     """
+    import asyncio
+    
     logger.info("Starting Instagram posting workflow")
     
     try:
-        # Step 1: Select image
-        image_url = select_image()
-        if not image_url:
-            logger.error("No image selected, aborting workflow")
-            return
-        
-        # Step 2: Generate caption
-        caption = generate_caption(image_url)
-        if not caption:
-            logger.error("Failed to generate caption, aborting workflow")
-            return
+        results = asyncio.run(workflow_async())
         
-        # Step 3: Post to Instagram
-        result = post_to_instagram(image_url, caption)
-        
-        if result.get("success"):
-            logger.info(f"Successfully completed workflow - Posted: {result}")
-        else:
-            logger.error(f"Workflow failed - Error: {result.get('error', 'Unknown error')}")
+        for name, account_results in results.items():
+            for result in account_results:
+                if result.get("success"):
+                    logger.info(f"[{name}] Successfully completed workflow - Posted: {result}")
+                else:
+                    logger.error(f"[{name}] Workflow failed - Error: {result.get('error', 'Unknown error')}")
             
     except Exception as e:
         logger.error(f"Unexpected error in workflow: {e}")
@@ -424,16 +1869,16 @@ def test_configuration() -> bool:
     issues = []
     
     # Check Google Cloud Storage configuration
-    if not storage_manager.bucket:
+    if not get_storage_manager().bucket:
         issues.append("Google Cloud Storage not properly configured")
     
     # Check Gemini AI configuration
-    if not caption_generator.model:
+    if not get_caption_generator().model:
         issues.append("Gemini AI not properly configured")
     
     # Check Instagram API configuration
-    access_token = os.getenv('INSTAGRAM_ACCESS_TOKEN') or config.get('instagram', {}).get('access_token')
-    user_id = os.getenv('INSTAGRAM_USER_ID') or config.get('instagram', {}).get('user_id')
+    access_token = get_settings().instagram.access_token
+    user_id = get_settings().instagram.user_id
     
     if not access_token or access_token == "YOUR_INSTAGRAM_ACCESS_TOKEN_HERE":
         issues.append("Instagram access token not configured")
@@ -451,58 +1896,483 @@ def test_configuration() -> bool:
         logger.info("Configuration looks good!")
         return True
 
-# Scheduling configuration
-schedule_time = config.get('schedule', {}).get('time', '09:00')
-every().day.at(schedule_time).do(workflow)
+def schedule_time() -> str:
+    """Time of day (HH:MM) of the daily post."""
+    return get_settings().schedule_time
 
-if __name__ == "__main__":
+
+def next_round_at(now: Optional[float] = None, at: Optional[str] = None) -> float:
+    """
+    Return the next local time of day ``at`` (HH:MM) strictly after ``now``.
+    
+    Args:
+        now: Reference timestamp (default: current time)
+        at: Time of day (default: schedule_time())
+    """
+    now = time.time() if now is None else now
+    hour, minute = (int(part) for part in (at or schedule_time()).split(':'))
+    current = datetime.fromtimestamp(now)
+    due = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due.timestamp() <= now:
+        due = (current + timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return due.timestamp()
+
+
+ROUND_JOB = 'post_round'
+SELECT_JOB = 'select'
+CAPTION_JOB = 'caption'
+CONTAINER_JOB = 'container'
+PUBLISH_JOB = 'publish'
+INGEST_JOB = 'ingest'
+
+
+@_singleton
+def get_job_queue() -> JobQueue:
+    jobs_config = get_config().get('jobs', {})
+    queue = JobQueue(jobs_config.get('path', 'data/jobs.sqlite3'),
+                     base_delay=jobs_config.get('retry_delay', 60),
+                     max_delay=jobs_config.get('max_retry_delay', 3600))
+    REGISTRY.gauge_callback('job_queue_depth',
+                            lambda: [({"status": status}, count) for status, count in queue.counts().items()],
+                            'Jobs in the queue by status')
+    return queue
+
+
+def schedule_round(queue: Optional[JobQueue] = None, now: Optional[float] = None) -> int:
+    """
+    Make sure the next daily posting round is queued.
+    
+    The round is keyed by its date, so calling this repeatedly (e.g. on
+    every start) never queues the same day twice.
+    
+    Returns:
+        ID of the round job
+    """
+    queue = queue or get_job_queue()
+    run_at = next_round_at(queue.clock() if now is None else now)
+    while True:
+        round_key = datetime.fromtimestamp(run_at).strftime('%Y-%m-%d')
+        job_id = queue.enqueue(ROUND_JOB, {"round": round_key}, run_at=run_at,
+                               dedup_key=f"{ROUND_JOB}:{round_key}")
+        if queue.get(job_id)["status"] in (PENDING, LEASED):
+            return job_id
+        # That day's round already ran (the schedule moved later in the day)
+        run_at = next_round_at(run_at + 86400 - 1)
+
+
+def reschedule_round(queue: Optional[JobQueue] = None, now: Optional[float] = None) -> int:
+    """Move the queued posting round to the current schedule time."""
+    queue = queue or get_job_queue()
+    queue.cancel_pending(ROUND_JOB)
+    return schedule_round(queue, now)
+
+
+def apply_settings(old: Settings, new: Settings) -> None:
+    """
+    Bring the running components up to date with reloaded settings.
+    
+    Components are updated in place or dropped so they are rebuilt on next
+    use; jobs already running keep the objects they hold. Changes to the
+    sections of long-lived services (the bucket, job queue, ingestion and
+    metrics endpoint) are logged as needing a restart.
+    """
+    global _instagram_client, _account_dispatcher
+    changed = new.changed_sections(old)
+    # Shared components built from each section, dropped when it changes
+    dependents = {
+        'history': [get_posted_history, get_selection_engine],
+        'near_duplicates': [get_perceptual_hashes, get_selection_engine],
+        'gemini': [get_thumbnail_cache, get_perceptual_hashes, get_selection_engine],
+        'caption_cache': [get_caption_cache, get_cached_captioner, get_caption_pregenerator],
+        'mirror': [get_blob_mirror],
+        'quota': [get_publish_quota],
+        'planner': [get_posting_planner],
+        'schedule': [get_posting_planner],
+        'resilience': [get_instagram_endpoint],
+    }
+    getters = {getter for section in changed for getter in dependents.get(section, [])}
+    if getters & {get_posted_history, get_selection_engine, get_cached_captioner}:
+        # The caption pre-generator holds the captioner and peeks with the selection engine
+        getters.add(get_caption_pregenerator)
+    pregenerator = get_caption_pregenerator.peek()
+    restart_pregenerator = get_caption_pregenerator in getters and pregenerator is not None \
+        and pregenerator.running
+    if restart_pregenerator:
+        pregenerator.stop(timeout=5)
+    dropped = [getter.peek() for getter in getters]
+    for getter in getters:
+        getter.reset()
+    for instance in dropped:
+        close = getattr(instance, 'close', None)
+        if callable(close):
+            close()
+
+    generator = get_caption_generator.peek()
+    if generator is not None and 'gemini' in changed:
+        generator.configure(new.gemini)
+        thumbnails_enabled = get_config().get('gemini', {}).get('thumbnails', {}).get('enabled', True)
+        generator.thumbnails = get_thumbnail_cache() if thumbnails_enabled else None
+    if 'resilience' in changed:
+        replaced = []
+        if generator is not None:
+            replaced.append(generator.resilience)
+            generator.resilience = resilience_endpoint('gemini', retries=1)
+        if get_storage_manager.peek() is not None:
+            replaced.append(get_storage_manager.peek().resilience)
+            get_storage_manager.peek().resilience = resilience_endpoint('storage', hedge=True)
+        for endpoint in replaced:
+            endpoint.close()
+    if changed & {'instagram', 'accounts', 'dispatcher', 'history', 'near_duplicates', 'gemini',
+                  'resilience'}:
+        # Account contexts hold clients and selection engines
+        _instagram_client = None
+        _account_dispatcher = None
+    if restart_pregenerator:
+        get_caption_pregenerator().start()
+    restart = sorted(changed & {'cloud_storage', 'jobs', 'ingest', 'metrics'})
+    if restart:
+        logger.warning(f"Changes to {', '.join(restart)} take effect after a restart")
+    if 'schedule' in changed and get_job_queue.peek() is not None:
+        reschedule_round()
+        logger.info(f"Daily posts now scheduled at {schedule_time()}")
+
+
+def reset_components() -> None:
+    """Close and drop every shared component except the settings store; each is rebuilt on next use."""
+    global _instagram_client, _account_dispatcher
+    instances = [getter.peek() for getter in _singletons if getter is not get_settings_store]
+    for getter in _singletons:
+        if getter is not get_settings_store:
+            getter.reset()
+    instances.append(_instagram_client)
+    _instagram_client = None
+    _account_dispatcher = None
+    for instance in instances:
+        close = getattr(instance, 'close', None)
+        if callable(close):
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"Failed to close {type(instance).__name__}: {e}")
+
+
+def _stage_key(kind: str, job: Job) -> str:
+    return f"{kind}:{job.payload['account']}:{job.payload['round']}"
+
+
+def _account_context(name: str) -> AccountContext:
+    for context in get_account_dispatcher().contexts:
+        if context.name == name:
+            return context
+    raise LookupError(f"Unknown account '{name}'")
+
+
+def _enqueue_next(job: Job, kind: str, **payload) -> Dict[str, Any]:
+    """Queue the next stage of an account's posting round, carrying the payload forward."""
+    payload = {**job.payload, **payload}
+    job_id = get_job_queue().enqueue(kind, payload, dedup_key=_stage_key(kind, job),
+                                     max_attempts=job.max_attempts)
+    return {"next": kind, "job_id": job_id}
+
+
+@_singleton
+def get_posting_planner() -> Optional['PostingPlanner']:
+    """Return the posting-time planner, or None unless ``planner.enabled``."""
+    planner_config = get_config().get('planner', {})
+    if not planner_config.get('enabled', False):
+        return None
+    from src.planner import EngagementStore, PostingPlanner
+    return PostingPlanner(
+        EngagementStore(planner_config.get('path', 'data/engagement.sqlite3')),
+        half_life_days=planner_config.get('half_life_days', 60),
+        posts_per_day=planner_config.get('posts_per_day', 1),
+        min_gap_hours=planner_config.get('min_gap_hours', 3),
+        publishing_limit=planner_config.get('publishing_limit', 50),
+        max_posts_per_hour=planner_config.get('max_posts_per_hour'),
+        default_time=schedule_time()
+    )
+
+
+def sync_engagement(planner: 'PostingPlanner', contexts: List[AccountContext]) -> int:
+    """
+    Pull like and comment counts of recent posts into the planner.
+    
+    Accounts whose Graph API call fails keep their stored engagement.
+    
+    Returns:
+        Number of posts that were new or changed
+    """
+    from src.planner import engagement_from_media
+    limit = get_config().get('planner', {}).get('sync_limit', 50)
+    changed = 0
+    for context in contexts:
+        try:
+            media = context.client.recent_media(limit)
+        except Exception as e:
+            logger.warning(f"[{context.name}] Could not fetch engagement: {e}")
+            continue
+        changed += planner.record(context.name, engagement_from_media(media))
+    return changed
+
+
+def plan_round(queue: JobQueue, planner: 'PostingPlanner', round_key: str) -> List[Dict[str, Any]]:
+    """
+    Queue one select job per planned post for the next 24 hours.
+    
+    Each job runs at its planned time and is keyed by account and hour, so
+    overlapping plans never queue the same slot twice. Posts still queued
+    by an earlier plan count like posts already made.
+    """
+    contexts = get_account_dispatcher().contexts
+    sync_engagement(planner, contexts)
+    now = queue.clock()
+    recent = {context.name: [post["posted_at"] for post in context.engine.history.posted_since(now - 86400)]
+              for context in contexts}
+    for job in queue.pending_jobs(SELECT_JOB):
+        recent.setdefault(job["payload"]["account"], []).append(job["run_at"])
+    max_attempts = get_config().get('jobs', {}).get('max_attempts', 5)
+    planned = []
+    for post in planner.plan([context.name for context in contexts], start=now, days=1, recent=recent):
+        queue.enqueue(SELECT_JOB, {"account": post.account, "round": post.key}, run_at=post.at,
+                      max_attempts=max_attempts, dedup_key=f"{SELECT_JOB}:{post.account}:{post.key}")
+        planned.append({"account": post.account, "at": post.key})
+    logger.info(f"Round {round_key}: planned {len(planned)} posts")
+    return planned
+
+
+def run_round_job(job: Job) -> Dict[str, Any]:
+    """
+    Fan a posting round out into select jobs, and queue the next round.
+    
+    Without the planner every account posts right away; with it, each
+    account's posts are queued at the best hours of the next 24 hours.
+    """
+    queue = get_job_queue()
+    planner = get_posting_planner()
+    if planner is not None:
+        planned = plan_round(queue, planner, job.payload["round"])
+        schedule_round(queue)
+        return {"planned": planned}
+    max_attempts = get_config().get('jobs', {}).get('max_attempts', 5)
+    accounts = []
+    for context in get_account_dispatcher().contexts:
+        payload = {"account": context.name, "round": job.payload["round"]}
+        queue.enqueue(SELECT_JOB, payload, max_attempts=max_attempts,
+                      dedup_key=f"{SELECT_JOB}:{context.name}:{job.payload['round']}")
+        accounts.append(context.name)
+    schedule_round(queue)
+    return {"accounts": accounts}
+
+
+def run_select_job(job: Job) -> Dict[str, Any]:
+    """Stage 1: select the image for one account."""
+    context = _account_context(job.payload["account"])
+    record = select_post(context, context.source(get_storage_manager().candidate_source()))
+    return _enqueue_next(job, CAPTION_JOB, record=record._asdict())
+
+
+def run_caption_job(job: Job) -> Dict[str, Any]:
+    """Stage 2: caption the selected image."""
+    caption = caption_post(BlobRecord(**job.payload["record"]), job.payload.get("account", DEFAULT_ACCOUNT))
+    return _enqueue_next(job, CONTAINER_JOB, caption=caption)
+
+
+def run_container_job(job: Job) -> Dict[str, Any]:
+    """Stage 3: create the media container; its quota slot is held under the round."""
+    context = _account_context(job.payload["account"])
+    container_id, image_url = prepare_post(context, BlobRecord(**job.payload["record"]),
+                                           job.payload["caption"], job.payload["round"],
+                                           get_account_dispatcher().throttle_percent)
+    return _enqueue_next(job, PUBLISH_JOB, container_id=container_id, image_url=image_url)
+
+
+def run_publish_job(job: Job) -> Dict[str, Any]:
+    """Stage 4: publish the container and record the post."""
+    context = _account_context(job.payload["account"])
+    media_id = publish_post(context, BlobRecord(**job.payload["record"]), job.payload["container_id"],
+                            job.payload["round"],
+                            context.source(get_storage_manager().candidate_source()))
+    return {"success": True, "media_id": media_id, "image_url": job.payload["image_url"]}
+
+
+def enqueue_upload(record: BlobRecord) -> int:
+    """Queue a newly uploaded image for captioning and posting."""
+    return get_job_queue().enqueue(INGEST_JOB, {"record": record._asdict()},
+                                   dedup_key=f"{INGEST_JOB}:{record.name}#{record.generation}")
+
+
+def run_ingest_job(job: Job) -> Dict[str, Any]:
+    """
+    Start the caption/container/publish chain for a new upload.
+    
+    The upload goes to every account whose prefix covers it and that has not
+    posted the same image (by name or content hash) already.
+    """
+    record = BlobRecord(**job.payload["record"])
+    queue = get_job_queue()
+    max_attempts = get_config().get('jobs', {}).get('max_attempts', 5)
+    upload_key = f"upload:{record.name}#{record.generation}"
+    accounts = []
+    for context in get_account_dispatcher().contexts:
+        prefix = context.account.prefix
+        if (prefix and not record.name.startswith(prefix)) or not context.engine.is_eligible(record):
+            continue
+        payload = {"account": context.name, "round": upload_key, "record": record._asdict()}
+        queue.enqueue(CAPTION_JOB, payload, max_attempts=max_attempts,
+                      dedup_key=f"{CAPTION_JOB}:{context.name}:{upload_key}")
+        accounts.append(context.name)
+    if not accounts:
+        logger.info(f"No account to post new upload {record.name} to")
+    return {"accounts": accounts}
+
+
+def _defer_when_unavailable(handler: Callable[[Job], Dict[str, Any]]) -> Callable[[Job], Dict[str, Any]]:
+    """Defer a job instead of using up an attempt while a dependency sheds calls."""
+    @functools.wraps(handler)
+    def wrapper(job: Job) -> Dict[str, Any]:
+        try:
+            return handler(job)
+        except DependencyUnavailable as e:
+            raise RetryLater(max(1.0, e.retry_after), str(e))
+    return wrapper
+
+
+JOB_HANDLERS = {kind: _defer_when_unavailable(handler) for kind, handler in {
+    ROUND_JOB: run_round_job,
+    INGEST_JOB: run_ingest_job,
+    SELECT_JOB: run_select_job,
+    CAPTION_JOB: run_caption_job,
+    CONTAINER_JOB: run_container_job,
+    PUBLISH_JOB: run_publish_job,
+}.items()}
+
+
+@_singleton
+def get_job_runner() -> JobRunner:
+    jobs_config = get_config().get('jobs', {})
+    return JobRunner(get_job_queue(), JOB_HANDLERS,
+                     workers=jobs_config.get('workers', 4),
+                     lease_seconds=jobs_config.get('lease_seconds', 900))
+
+
+@_singleton
+def get_metrics_server() -> Optional[MetricsServer]:
+    """Start the /metrics endpoint and JSON event log when ``metrics.enabled`` is set."""
+    metrics_config = get_config().get('metrics', {})
+    if not metrics_config.get('enabled', False):
+        return None
+    if metrics_config.get('event_log'):
+        REGISTRY.event_log = EventLog(metrics_config['event_log'])
+    return MetricsServer(REGISTRY, metrics_config.get('host', '127.0.0.1'),
+                         metrics_config.get('port', 9464)).start()
+
+
+@_singleton
+def get_upload_events():
+    """
+    Return the configured new-upload event source (``ingest.source``).
+    
+    Defaults to Pub/Sub when a subscription is configured, polling otherwise.
+    """
+    ingest_config = get_config().get('ingest', {})
+    kind = ingest_config.get('source', 'pubsub' if ingest_config.get('subscription') else 'poll')
+    if kind == 'pubsub':
+        return PubSubEventSource(ingest_config['subscription'],
+                                 bucket_name=get_storage_manager().bucket_name,
+                                 max_messages=ingest_config.get('max_messages', 100))
+    if kind == 'local':
+        return LocalEventSource()
+    return PollingEventSource(get_storage_manager().iter_images, get_posted_history(),
+                              prefix=ingest_config.get('prefix'),
+                              interval=ingest_config.get('interval', 15),
+                              ordered_names=ingest_config.get('ordered_names', False))
+
+
+@_singleton
+def get_ingestor() -> Ingestor:
+    return Ingestor(get_upload_events(), enqueue_upload,
+                    exclude_prefixes=get_storage_manager().exclude_prefixes)
+
+
+def main() -> None:
+    """Configure logging, check the configuration and run the job workers."""
+    configure_logging()
     logger.info("Starting Zmaninstaposter application")
     
+    try:
+        settings_store = get_settings_store()
+        settings_store.current
+    except SettingsError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    
     # Test configuration on startup
     if not test_configuration():
         logger.error("Configuration test failed. Please fix configuration issues before running.")
         logger.info("See .env.example and config/config.yaml for required settings")
-        exit(1)
+        sys.exit(1)
+    
+    caption_config = get_config().get('caption_cache', {})
+    if get_caption_generator().model and caption_config.get('lookahead', 5) > 0:
+        get_caption_pregenerator().start()
+    get_metrics_server()
+    
+    schedule_round()
+    logger.info(f"Scheduling daily posts at {schedule_time()}")
+    if get_config().get('ingest', {}).get('enabled', False):
+        get_ingestor().start()
     
-    logger.info(f"Scheduling daily posts at {schedule_time}")
+    # Pick up edits to .env and config.yaml without a restart
+    settings_store.subscribe(apply_settings)
+    reload_interval = get_config().get('settings', {}).get('reload_interval', 5)
+    if reload_interval:
+        settings_store.watch(reload_interval)
     logger.info("Application is running. Press Ctrl+C to stop.")
     
+    runner = get_job_runner()
     try:
-        while True:
-            run_pending()
-            time.sleep(60)
+        runner.run_forever()
     except KeyboardInterrupt:
         logger.info("Application stopped by user")
     except Exception as e:
         logger.error(f"Application error: {e}")
-        exit(1)
+        sys.exit(1)
+    finally:
+        if get_config().get('ingest', {}).get('enabled', False):
+            get_ingestor().stop(timeout=5)
+        settings_store.stop(timeout=5)
+        runner.stop(timeout=5)
 
-def download_image_from_bucket(blob_name: str, local_path: str) -> bool:
-    """
-    Download an image from the configured Google Cloud Storage bucket.
 
-    Args:
-        blob_name: Name of the blob (file) in the bucket
-        local_path: Local path to save the downloaded image
+# Module attributes that used to be created at import time; now built on first access
+_LAZY_ATTRIBUTES = {
+    'config': get_config,
+    'storage_manager': get_storage_manager,
+    'caption_generator': get_caption_generator,
+    'blob_mirror': get_blob_mirror,
+    'posted_history': get_posted_history,
+    'selection_engine': get_selection_engine,
+    'caption_cache': get_caption_cache,
+    'cached_captioner': get_cached_captioner,
+    'caption_pregenerator': get_caption_pregenerator,
+    'image_preprocessor': get_image_preprocessor,
+    'perceptual_hashes': get_perceptual_hashes,
+    'job_queue': get_job_queue,
+}
 
-    Returns:
-        True if download succeeds, False otherwise
-    """
-    if not storage_manager.bucket:
-        logger.error("Google Cloud Storage not properly configured")
-        return False
 
-    try:
-        blob = storage_manager.bucket.blob(blob_name)
-        blob.download_to_filename(local_path)
-        logger.info(f"Downloaded {blob_name} to {local_path}")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to download {blob_name}: {e}")
-        return False
+def __getattr__(name: str) -> Any:
+    factory = _LAZY_ATTRIBUTES.get(name)
+    if factory is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return factory()
+
+
+if __name__ == "__main__":
+    main()
 
 # Example usage (uncomment to use):
-# blobs = storage_manager.bucket.list_blobs()
+# blobs = get_storage_manager().bucket.list_blobs()
 # for blob in blobs:
 #     print(blob.name)
-#     # download_image_from_bucket(blob.name, f"./downloads/{blob.name}")
\ No newline at end of file
+#     # download_image_from_bucket(blob.name, f"./downloads/{blob.name}")
@@ -0,0 +1,385 @@
+"""
+Persistent manifest of the images stored in the Google Cloud Storage bucket.
+
+Listing a bucket with hundreds of thousands of objects takes minutes and
+burns list-operation quota, so the manifest keeps a local SQLite copy of the
+metadata we need (name, generation, size, md5, content type, public URL).
+
+The bucket is split into shards by top-level "folder" prefix. Each shard is
+crawled page by page and the page token is saved after every page, so an
+interrupted crawl resumes where it stopped. Only shards older than
+``refresh_interval`` are re-crawled, and only rows whose generation changed
+are rewritten.
+"""
+
+import os
+import random
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional, List, Dict, Any, Iterator, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Only request the fields the manifest stores to keep list responses small
+LIST_FIELDS = 'items(name,generation,size,md5Hash,contentType,updated),nextPageToken,prefixes'
+
+# Shard key for objects that live at the top level of the bucket
+ROOT_SHARD = ''
+
+
+class BlobRecord(NamedTuple):
+    """Lightweight, immutable description of an image blob."""
+    name: str
+    generation: int
+    size: int
+    md5_hash: str
+    content_type: str
+    public_url: str
+    updated: float
+
+
+def is_image_name(name: str) -> bool:
+    """Return True if the blob name has a supported image extension."""
+    return name.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def record_from_blob(blob) -> BlobRecord:
+    """
+    Build a BlobRecord from a google.cloud.storage Blob (or a compatible fake).
+
+    Args:
+        blob: Blob returned by ``bucket.list_blobs()``
+
+    Returns:
+        BlobRecord with the manifest fields
+    """
+    updated = getattr(blob, 'updated', None)
+    return BlobRecord(
+        name=blob.name,
+        generation=int(blob.generation or 0),
+        size=int(blob.size or 0),
+        md5_hash=blob.md5_hash or '',
+        content_type=blob.content_type or '',
+        public_url=blob.public_url,
+        updated=updated.timestamp() if updated is not None else 0.0,
+    )
+
+
+def shard_of(name: str) -> str:
+    """Return the shard (top-level folder prefix) a blob name belongs to."""
+    head, sep, _ = name.partition('/')
+    return head + sep if sep else ROOT_SHARD
+
+
+class BucketManifest:
+    """
+    SQLite-backed index of the image blobs in a bucket.
+
+    The database is opened lazily on first use and is safe to share between
+    threads.
+    """
+
+    orders = ('name', 'updated')
+
+    def __init__(self, path: str, refresh_interval: float = 3600, page_size: int = 1000,
+                 exclude_prefixes: Tuple[str, ...] = ()):
+        self.path = path
+        self.exclude_prefixes = tuple(exclude_prefixes)
+        self.refresh_interval = refresh_interval
+        self.page_size = page_size
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._create_schema()
+        return self._conn
+
+    def _create_schema(self) -> None:
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                name TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                generation INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                md5_hash TEXT NOT NULL,
+                content_type TEXT NOT NULL,
+                public_url TEXT NOT NULL,
+                updated REAL NOT NULL,
+                seen_epoch INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_blobs_shard ON blobs (shard, seen_epoch);
+            CREATE INDEX IF NOT EXISTS idx_blobs_updated ON blobs (updated, name);
+            CREATE INDEX IF NOT EXISTS idx_blobs_shard_updated ON blobs (shard, updated, name);
+            CREATE INDEX IF NOT EXISTS idx_blobs_md5 ON blobs (md5_hash);
+            CREATE TABLE IF NOT EXISTS shards (
+                prefix TEXT PRIMARY KEY,
+                crawl_epoch INTEGER NOT NULL DEFAULT 0,
+                page_token TEXT,
+                completed_at REAL
+            );
+        """)
+        self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # ------------------------------------------------------------------
+    # Refreshing
+    # ------------------------------------------------------------------
+
+    def refresh(self, bucket, force: bool = False) -> Dict[str, int]:
+        """
+        Bring the manifest up to date with the bucket.
+
+        Shards that were crawled within ``refresh_interval`` are skipped unless
+        ``force`` is set. Shards with a pending page token resume from it.
+
+        Args:
+            bucket: google.cloud.storage Bucket (or a compatible fake)
+            force: Re-crawl every shard regardless of age
+
+        Returns:
+            Counters for the refresh: shards crawled, pages, upserted and removed rows
+        """
+        stats = {"shards": 0, "pages": 0, "upserted": 0, "removed": 0}
+        now = time.time()
+
+        for prefix in self._discover_shards(bucket):
+            state = self._shard_state(prefix)
+            resuming = state["page_token"] is not None
+            fresh = state["completed_at"] is not None and now - state["completed_at"] < self.refresh_interval
+            if fresh and not resuming and not force:
+                continue
+
+            shard_stats = self._crawl_shard(bucket, prefix, state)
+            stats["shards"] += 1
+            for key in ("pages", "upserted", "removed"):
+                stats[key] += shard_stats[key]
+
+        if stats["shards"]:
+            logger.info(f"Manifest refresh: {stats}")
+        return stats
+
+    def _discover_shards(self, bucket) -> List[str]:
+        """List the top-level prefixes of the bucket; one cheap delimiter listing."""
+        iterator = bucket.list_blobs(delimiter='/', fields='nextPageToken,prefixes')
+        for _ in iterator.pages:
+            pass
+        prefixes = sorted(p for p in iterator.prefixes if not p.startswith(self.exclude_prefixes))
+
+        # Drop shards whose prefix disappeared from the bucket entirely
+        with self._lock:
+            known = [row[0] for row in self.conn.execute("SELECT prefix FROM shards")]
+            for prefix in set(known) - set(prefixes) - {ROOT_SHARD}:
+                self.conn.execute("DELETE FROM blobs WHERE shard = ?", (prefix,))
+                self.conn.execute("DELETE FROM shards WHERE prefix = ?", (prefix,))
+            self.conn.commit()
+
+        return [ROOT_SHARD] + prefixes
+
+    def _shard_state(self, prefix: str) -> Dict[str, Any]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT crawl_epoch, page_token, completed_at FROM shards WHERE prefix = ?",
+                (prefix,)
+            ).fetchone()
+            if row is None:
+                self.conn.execute("INSERT INTO shards (prefix) VALUES (?)", (prefix,))
+                self.conn.commit()
+                return {"crawl_epoch": 0, "page_token": None, "completed_at": None}
+        return {"crawl_epoch": row[0], "page_token": row[1], "completed_at": row[2]}
+
+    def _crawl_shard(self, bucket, prefix: str, state: Dict[str, Any]) -> Dict[str, int]:
+        stats = {"pages": 0, "upserted": 0, "removed": 0}
+        page_token = state["page_token"]
+        epoch = state["crawl_epoch"] if page_token else state["crawl_epoch"] + 1
+
+        if prefix == ROOT_SHARD:
+            # Only objects directly under the bucket root; folders are their own shards
+            iterator = bucket.list_blobs(delimiter='/', page_token=page_token,
+                                         page_size=self.page_size, fields=LIST_FIELDS)
+        else:
+            iterator = bucket.list_blobs(prefix=prefix, page_token=page_token,
+                                         page_size=self.page_size, fields=LIST_FIELDS)
+
+        for page in iterator.pages:
+            records = [record_from_blob(blob) for blob in page
+                       if is_image_name(blob.name) and not blob.name.startswith(self.exclude_prefixes)]
+            with self._lock:
+                stats["upserted"] += self._upsert(prefix, records, epoch)
+                self.conn.execute(
+                    "UPDATE shards SET crawl_epoch = ?, page_token = ? WHERE prefix = ?",
+                    (epoch, iterator.next_page_token, prefix)
+                )
+                self.conn.commit()
+            stats["pages"] += 1
+
+        with self._lock:
+            cursor = self.conn.execute(
+                "DELETE FROM blobs WHERE shard = ? AND seen_epoch < ?", (prefix, epoch)
+            )
+            stats["removed"] = cursor.rowcount
+            self.conn.execute(
+                "UPDATE shards SET crawl_epoch = ?, page_token = NULL, completed_at = ? WHERE prefix = ?",
+                (epoch, time.time(), prefix)
+            )
+            self.conn.commit()
+        return stats
+
+    def _upsert(self, prefix: str, records: List[BlobRecord], epoch: int) -> int:
+        """Write changed records and mark every listed record as seen. Caller holds the lock."""
+        if not records:
+            return 0
+        placeholders = ','.join('?' * len(records))
+        known = dict(self.conn.execute(
+            f"SELECT name, generation FROM blobs WHERE name IN ({placeholders})",
+            [r.name for r in records]
+        ))
+        changed = [r for r in records if known.get(r.name) != r.generation]
+        unchanged = [r.name for r in records if known.get(r.name) == r.generation]
+
+        self.conn.executemany(
+            """
+            INSERT INTO blobs (name, shard, generation, size, md5_hash, content_type,
+                               public_url, updated, seen_epoch)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                generation = excluded.generation, size = excluded.size,
+                md5_hash = excluded.md5_hash, content_type = excluded.content_type,
+                public_url = excluded.public_url, updated = excluded.updated,
+                seen_epoch = excluded.seen_epoch
+            """,
+            [(r.name, prefix, r.generation, r.size, r.md5_hash, r.content_type,
+              r.public_url, r.updated, epoch) for r in changed]
+        )
+        if unchanged:
+            self.conn.execute(
+                f"UPDATE blobs SET seen_epoch = ? WHERE name IN ({','.join('?' * len(unchanged))})",
+                [epoch] + unchanged
+            )
+        return len(changed)
+
+    # ------------------------------------------------------------------
+    # Queries
+    # ------------------------------------------------------------------
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def get(self, name: str) -> Optional[BlobRecord]:
+        """Look up a single record by blob name."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT name, generation, size, md5_hash, content_type, public_url, updated "
+                "FROM blobs WHERE name = ?", (name,)
+            ).fetchone()
+        return BlobRecord(*row) if row else None
+
+    def iter_records(self, prefix: Optional[str] = None, order_by: str = 'name',
+                     shard: Optional[str] = None, start_after: Optional[Tuple[Any, str]] = None,
+                     batch_size: int = 500) -> Iterator[BlobRecord]:
+        """
+        Lazily iterate over manifest records.
+
+        Rows are fetched in keyset-paginated batches so callers that stop early
+        only pay for the rows they consumed.
+
+        Args:
+            prefix: Only yield blobs whose name starts with this prefix
+            order_by: 'name' or 'updated'
+            shard: Only yield blobs from this shard (top-level folder)
+            start_after: Resume after this ``(order_by value, name)`` key
+            batch_size: Number of rows fetched per query
+
+        Yields:
+            BlobRecord for each matching image
+        """
+        if order_by not in ('name', 'updated'):
+            raise ValueError(f"Unsupported order_by: {order_by}")
+
+        columns = "name, generation, size, md5_hash, content_type, public_url, updated"
+        conditions = []
+        base_params: List[Any] = []
+        if prefix:
+            conditions.append("name >= ? AND name < ?")
+            base_params += [prefix, prefix + '\uffff']
+        if shard is not None:
+            conditions.append("shard = ?")
+            base_params.append(shard)
+
+        last_key = tuple(start_after) if start_after else None
+        while True:
+            where = list(conditions)
+            params = list(base_params)
+            if last_key is not None:
+                where.append(f"({order_by}, name) > (?, ?)")
+                params += list(last_key)
+            query = f"SELECT {columns} FROM blobs"
+            if where:
+                query += " WHERE " + " AND ".join(where)
+            query += f" ORDER BY {order_by}, name LIMIT ?"
+            params.append(batch_size)
+
+            with self._lock:
+                rows = self.conn.execute(query, params).fetchall()
+            for row in rows:
+                yield BlobRecord(*row)
+            if len(rows) < batch_size:
+                return
+            last = BlobRecord(*rows[-1])
+            last_key = (getattr(last, order_by), last.name)
+
+    def sample(self, k: int, rng: Optional[random.Random] = None) -> List[BlobRecord]:
+        """
+        Return up to ``k`` distinct records picked uniformly at random by rowid.
+
+        Each pick is a single index seek, so sampling cost does not depend on
+        the size of the manifest.
+        """
+        rng = rng or random
+        with self._lock:
+            low, high = self.conn.execute("SELECT MIN(rowid), MAX(rowid) FROM blobs").fetchone()
+            if low is None:
+                return []
+            picked: Dict[str, BlobRecord] = {}
+            for _ in range(k):
+                row = self.conn.execute(
+                    "SELECT name, generation, size, md5_hash, content_type, public_url, updated "
+                    "FROM blobs WHERE rowid >= ? ORDER BY rowid LIMIT 1",
+                    (rng.randint(low, high),)
+                ).fetchone()
+                if row:
+                    picked[row[0]] = BlobRecord(*row)
+        return list(picked.values())
+
+    def folders(self) -> List[str]:
+        """Return the shard prefixes (top-level folders) that hold images."""
+        with self._lock:
+            return [row[0] for row in self.conn.execute(
+                "SELECT prefix FROM shards WHERE EXISTS "
+                "(SELECT 1 FROM blobs WHERE blobs.shard = shards.prefix) ORDER BY prefix"
+            )]
+
+    def folder_of(self, name: str) -> str:
+        return shard_of(name)
+
+    def image_urls(self) -> List[str]:
+        """Return the public URLs of every image in the manifest, ordered by name."""
+        with self._lock:
+            return [row[0] for row in self.conn.execute("SELECT public_url FROM blobs ORDER BY name")]
+
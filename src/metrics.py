@@ -0,0 +1,344 @@
+"""
+In-process metrics and structured event log.
+
+Stages and external calls are wrapped in ``timed()``:
+
+    with timed('gemini.caption'):
+        ...
+
+which records a latency histogram, an outcome counter and, on failure, an
+error counter by exception type. It also writes one JSON line per call to the
+event log when one is configured. Counters (cache hits, bytes downloaded),
+gauges (queue depth, computed when scraped) and histograms are all kept in
+one registry and served in the Prometheus text format on a local
+``/metrics`` endpoint:
+
+    metrics:
+      enabled: true
+      host: 127.0.0.1
+      port: 9464
+      event_log: data/events.jsonl
+
+Recording a sample is a dict update under a lock; nothing is exported
+unless the endpoint is scraped.
+"""
+
+import json
+import os
+import threading
+import time
+import logging
+from bisect import bisect_left
+from typing import Optional, List, Dict, Any, Callable, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'zmaninstaposter'
+# Seconds; covers cache hits through multi-minute container processing
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class EventLog:
+    """
+    Appends one JSON object per line to a file.
+
+    Args:
+        path: File to append to; its directory is created on first write
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, event: Dict[str, Any]) -> None:
+        line = json.dumps(event, default=str, ensure_ascii=False)
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class _Timer:
+    """Context manager and decorator returned by MetricsRegistry.timed()."""
+
+    def __init__(self, registry: 'MetricsRegistry', stage: str, labels: Dict[str, Any]):
+        self.registry = registry
+        self.stage = stage
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self) -> '_Timer':
+        self.started = self.registry.clock()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.registry.record_stage(self.stage, self.registry.clock() - self.started, exc, **self.labels)
+        return False
+
+    def __call__(self, func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            with _Timer(self.registry, self.stage, self.labels):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.__wrapped__ = func
+        return wrapper
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms keyed by name and labels.
+
+    Args:
+        prefix: Prepended to every exported metric name
+        buckets: Upper bounds of the latency histogram buckets, in seconds
+        clock: Monotonic clock used by timed()
+    """
+
+    def __init__(self, prefix: str = PREFIX, buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                 clock: Callable[[], float] = time.perf_counter):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.clock = clock
+        self.event_log: Optional[EventLog] = None
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._gauge_callbacks: Dict[str, Callable[[], Iterable[Tuple[Dict[str, Any], float]]]] = {}
+        # (name, labels) -> [per-bucket counts..., +Inf count], sum
+        self._histograms: Dict[Tuple[str, Labels], List[Any]] = {}
+        self.describe('stage_seconds', 'histogram', 'Duration of pipeline stages and external calls')
+        self.describe('stage_total', 'counter', 'Completed stages and external calls by outcome')
+        self.describe('stage_errors_total', 'counter', 'Failed stages and external calls by error type')
+
+    def describe(self, name: str, kind: str, help_text: str) -> None:
+        """Set the TYPE and HELP lines of a metric."""
+        self._help[name] = (kind, help_text)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def inc(self, name: str, amount: float = 1.0, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = value
+
+    def gauge_callback(self, name: str, callback: Callable[[], Iterable[Tuple[Dict[str, Any], float]]],
+                       help_text: str = '') -> None:
+        """Register a gauge computed at scrape time; the callback yields (labels, value) pairs."""
+        self._gauge_callbacks[name] = callback
+        self.describe(name, 'gauge', help_text)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels(labels))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter or gauge (0 if never recorded)."""
+        key = (name, _labels(labels))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0.0))
+
+    def histogram(self, name: str, **labels) -> Dict[str, Any]:
+        """Snapshot of one histogram: ``count``, ``sum`` and cumulative ``buckets``."""
+        with self._lock:
+            entry = self._histograms.get((name, _labels(labels)))
+            counts, total = (list(entry[0]), entry[1]) if entry else ([0] * (len(self.buckets) + 1), 0.0)
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {"count": running, "sum": total, "buckets": cumulative}
+
+    def timed(self, stage: str, **labels) -> _Timer:
+        """Time a block or function as ``stage``; usable as ``with`` or as a decorator."""
+        return _Timer(self, stage, labels)
+
+    def record_stage(self, stage: str, seconds: float, error: Optional[BaseException] = None,
+                     **labels) -> None:
+        """Record one completed stage, as timed() does."""
+        outcome = 'ok' if error is None else 'error'
+        self.observe('stage_seconds', seconds, stage=stage, **labels)
+        self.inc('stage_total', stage=stage, outcome=outcome, **labels)
+        event = {"event": "stage", "stage": stage, "duration_ms": round(seconds * 1000, 3),
+                 "outcome": outcome, **labels}
+        if error is not None:
+            self.inc('stage_errors_total', stage=stage, error=type(error).__name__, **labels)
+            event.update(error=type(error).__name__, message=str(error)[:500])
+        self.event(**event)
+
+    def event(self, **fields) -> None:
+        """Write a structured event to the event log, if one is configured."""
+        if self.event_log is None:
+            return
+        try:
+            self.event_log.write({"ts": round(time.time(), 3), **fields})
+        except Exception as e:
+            logger.error(f"Failed to write event: {e}")
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {k: (list(v[0]), v[1]) for k, v in self._histograms.items()}
+        for name, callback in list(self._gauge_callbacks.items()):
+            try:
+                for labels, value in callback():
+                    gauges[(name, _labels(labels))] = value
+            except Exception as e:
+                logger.error(f"Failed to collect gauge {name}: {e}")
+
+        families: Dict[str, List[str]] = {}
+        for (name, labels), value in sorted(counters.items()):
+            families.setdefault(name, []).append(
+                f"{self.prefix}_{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), value in sorted(gauges.items()):
+            families.setdefault(name, []).append(
+                f"{self.prefix}_{name}{_format_labels(labels)} {_format_value(value)}")
+        for (name, labels), (counts, total) in sorted(histograms.items()):
+            lines = families.setdefault(name, [])
+            running = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                running += count
+                bucket_labels = labels + (('le', _format_value(bound)),)
+                lines.append(f"{self.prefix}_{name}_bucket{_format_labels(bucket_labels)} {running}")
+            lines.append(f"{self.prefix}_{name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.prefix}_{name}_count{_format_labels(labels)} {running}")
+
+        output = []
+        for name, lines in families.items():
+            kind, help_text = self._help.get(name, ('untyped', ''))
+            if help_text:
+                output.append(f"# HELP {self.prefix}_{name} {help_text}")
+            output.append(f"# TYPE {self.prefix}_{name} {kind}")
+            output.extend(lines)
+        return '\n'.join(output) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+def timed(stage: str, **labels) -> _Timer:
+    """Time a block or function in the default registry."""
+    return REGISTRY.timed(stage, **labels)
+
+
+def inc(name: str, amount: float = 1.0, **labels) -> None:
+    """Increment a counter in the default registry."""
+    REGISTRY.inc(name, amount, **labels)
+
+
+class MetricsServer:
+    """
+    Serves ``/metrics`` (Prometheus text format) and ``/healthz`` on a daemon thread.
+
+    Args:
+        registry: Registry to expose
+        host: Interface to bind; keep it local unless a scraper needs remote access
+        port: TCP port (0 picks a free one)
+    """
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = '127.0.0.1', port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> 'MetricsServer':
+        # http.server is only imported when the endpoint is enabled
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body = registry.render().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                    status = 200
+                elif self.path == '/healthz':
+                    body, content_type, status = b'ok\n', 'text/plain', 200
+                else:
+                    body, content_type, status = b'not found\n', 'text/plain', 404
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on {self.url}/metrics")
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and free the port, so a rebuilt server can bind it again."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    close = stop
@@ -0,0 +1,355 @@
+"""
+Local content-addressed mirror of the image bucket.
+
+Captioning and preprocessing both need the original bytes of an image. The
+mirror downloads them once into a local cache directory:
+
+    <cache_dir>/objects/ab/ab12...ef   one file per distinct content (md5)
+    <cache_dir>/partial/               in-progress downloads
+    <cache_dir>/index.sqlite3          blob name -> generation, content hash
+
+Blobs are downloaded concurrently on a thread pool. Large blobs are fetched
+in ranged chunks pinned to their generation and appended to a ``.part`` file,
+so an interrupted download resumes where it stopped. Every download is
+verified against the md5 (or, for composite objects, the crc32c) reported by
+GCS before it is moved into the store, and blobs whose generation has not
+changed since the last mirror are skipped without a request.
+
+Run a bulk mirror with ``python -m src.mirror [prefix]``.
+"""
+
+import base64
+import hashlib
+import importlib.util
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from typing import Optional, List, Dict, Any, Iterable, Iterator
+
+from src.manifest import BlobRecord, record_from_blob
+from src.metrics import inc, timed
+
+# google_crc32c is imported when a download starts, keeping it out of startup
+CRC32C_AVAILABLE = importlib.util.find_spec('google_crc32c') is not None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 8 * 1024 * 1024
+RANGED_THRESHOLD = 32 * 1024 * 1024
+
+
+class IntegrityError(Exception):
+    """Downloaded bytes do not match the checksum reported by GCS."""
+
+
+class _Digests:
+    """Running md5 and crc32c over a download."""
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.crc32c = None
+        if CRC32C_AVAILABLE:
+            import google_crc32c
+            self.crc32c = google_crc32c.Checksum()
+
+    def update(self, data: bytes) -> None:
+        self.md5.update(data)
+        if self.crc32c is not None:
+            self.crc32c.update(data)
+
+    def verify(self, name: str, md5_hash: Optional[str], crc32c: Optional[str]) -> None:
+        if md5_hash:
+            actual = base64.b64encode(self.md5.digest()).decode('ascii')
+            if actual != md5_hash:
+                raise IntegrityError(f"md5 mismatch for {name}: expected {md5_hash}, got {actual}")
+        elif crc32c and self.crc32c is not None:
+            actual = base64.b64encode(self.crc32c.digest()).decode('ascii')
+            if actual != crc32c:
+                raise IntegrityError(f"crc32c mismatch for {name}: expected {crc32c}, got {actual}")
+        else:
+            logger.warning(f"No checksum available to verify {name}")
+
+
+class BucketMirror:
+    """
+    Mirrors bucket images into a local content-addressed cache.
+
+    Args:
+        bucket: google.cloud.storage Bucket (or a compatible fake)
+        cache_dir: Directory holding the objects, partial downloads and index
+        max_workers: Concurrent downloads
+        chunk_size: Bytes per ranged request for large blobs
+        ranged_threshold: Blobs at least this large are downloaded in chunks
+    """
+
+    def __init__(self, bucket, cache_dir: str, max_workers: int = 8,
+                 chunk_size: int = CHUNK_SIZE, ranged_threshold: int = RANGED_THRESHOLD):
+        self.bucket = bucket
+        self.cache_dir = cache_dir
+        self.max_workers = max(1, max_workers)
+        self.chunk_size = chunk_size
+        self.ranged_threshold = ranged_threshold
+        self._conn = None
+        self._lock = threading.RLock()
+        # Partial path -> [lock, holders]; one download per blob generation at a time
+        self._downloads: Dict[str, list] = {}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite3'),
+                                         check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS mirrored (
+                    name TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mirrored_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_mirrored_hash ON mirrored (content_hash)")
+            self._conn.commit()
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def object_path(self, content_hash: str) -> str:
+        return os.path.join(self.cache_dir, 'objects', content_hash[:2], content_hash)
+
+    def _partial_path(self, record: BlobRecord) -> str:
+        key = hashlib.sha1(record.name.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, 'partial', f"{key}-{record.generation}.part")
+
+    @contextmanager
+    def _download_lock(self, partial: str) -> Iterator[None]:
+        with self._lock:
+            entry = self._downloads.setdefault(partial, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._downloads[partial]
+
+    def _indexed(self, name: str) -> Optional[tuple]:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT generation, content_hash FROM mirrored WHERE name = ?", (name,)
+            ).fetchone()
+
+    def _remember(self, record: BlobRecord, content_hash: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mirrored (name, generation, content_hash, size, mirrored_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (record.name, record.generation, content_hash, record.size, time.time())
+            )
+            self.conn.commit()
+
+    def path_for(self, name: str) -> Optional[str]:
+        """Return the local path of a mirrored blob, or None if it is not cached."""
+        row = self._indexed(name)
+        if row:
+            path = self.object_path(row[1])
+            if os.path.exists(path):
+                return path
+        return None
+
+    def fetch(self, name: str) -> Optional[str]:
+        """
+        Return the local path of one blob, downloading it if it is not cached.
+
+        Cached blobs are served without contacting GCS, so a blob overwritten
+        since it was cached is served stale until mirror() runs. Callers that
+        know the blob's record should use fetch_record() instead.
+        """
+        path = self.path_for(name)
+        if path:
+            return path
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            logger.error(f"Blob {name} not found in bucket")
+            return None
+        return self.fetch_record(record_from_blob(blob), blob)
+
+    def fetch_record(self, record: BlobRecord, blob=None) -> Optional[str]:
+        """
+        Make sure one blob is mirrored at its current generation.
+
+        Concurrent calls for the same generation wait for one download
+        instead of appending to the same partial file.
+
+        Returns:
+            Local path of the verified content, or None if the download failed
+        """
+        with self._download_lock(self._partial_path(record)):
+            return self._fetch_record(record, blob)
+
+    def _fetch_record(self, record: BlobRecord, blob=None) -> Optional[str]:
+        row = self._indexed(record.name)
+        if row and row[0] == record.generation:
+            path = self.object_path(row[1])
+            if os.path.exists(path):
+                return path
+
+        # Another blob with the same bytes may already be in the store
+        if record.md5_hash:
+            content_hash = base64.b64decode(record.md5_hash).hex()
+            if os.path.exists(self.object_path(content_hash)):
+                self._remember(record, content_hash)
+                return self.object_path(content_hash)
+
+        try:
+            with timed('mirror.download'):
+                path = self._download(record, blob)
+            inc('mirror_bytes_total', record.size)
+            return path
+        except Exception as e:
+            logger.error(f"Failed to mirror {record.name}: {e}")
+            return None
+
+    def _download(self, record: BlobRecord, blob=None) -> str:
+        crc32c = None
+        if not record.md5_hash:
+            # Composite objects carry only a crc32c, which listings don't return
+            blob = blob or self.bucket.get_blob(record.name)
+            crc32c = getattr(blob, 'crc32c', None) if blob is not None else None
+        # Pin the generation so a resumed download can't mix two versions
+        pinned = self.bucket.blob(record.name, generation=record.generation or None)
+
+        partial = self._partial_path(record)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        digests = _Digests()
+        offset = 0
+        if os.path.exists(partial):
+            with open(partial, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    digests.update(chunk)
+                    offset += len(chunk)
+            if offset > record.size:
+                os.remove(partial)
+                digests, offset = _Digests(), 0
+            elif offset:
+                logger.info(f"Resuming {record.name} at byte {offset}/{record.size}")
+
+        with open(partial, 'ab') as f:
+            if record.size < self.ranged_threshold and offset == 0:
+                data = pinned.download_as_bytes()
+                digests.update(data)
+                f.write(data)
+            else:
+                while offset < record.size:
+                    end = min(offset + self.chunk_size, record.size) - 1
+                    # Integrity is checked over the whole object below
+                    data = pinned.download_as_bytes(start=offset, end=end, checksum=None)
+                    if not data:
+                        raise IOError(f"Empty range {offset}-{end} for {record.name}")
+                    digests.update(data)
+                    f.write(data)
+                    f.flush()
+                    offset += len(data)
+
+        try:
+            digests.verify(record.name, record.md5_hash, crc32c)
+        except IntegrityError:
+            os.remove(partial)
+            raise
+
+        content_hash = digests.md5.hexdigest()
+        target = self.object_path(content_hash)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(partial, target)
+        self._remember(record, content_hash)
+        return target
+
+    def mirror(self, records: Iterable[BlobRecord]) -> Dict[str, Any]:
+        """
+        Mirror many blobs concurrently.
+
+        The records are consumed lazily with a bounded number of downloads in
+        flight, so a streamed bucket listing never has to fit in memory.
+
+        Args:
+            records: Blobs to mirror, e.g. storage_manager.iter_images()
+
+        Returns:
+            Stats dict with ``downloaded``, ``skipped``, ``failed`` and ``bytes``
+        """
+        stats = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+
+        def work(record: BlobRecord) -> str:
+            row = self._indexed(record.name)
+            if row and row[0] == record.generation and os.path.exists(self.object_path(row[1])):
+                return "skipped"
+            return "downloaded" if self.fetch_record(record) else "failed"
+
+        def settle(future, record: BlobRecord) -> None:
+            outcome = future.result()
+            stats[outcome] += 1
+            if outcome == "downloaded":
+                stats["bytes"] += record.size
+
+        in_flight: Dict[Any, BlobRecord] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='mirror') as pool:
+            for record in records:
+                if len(in_flight) >= self.max_workers * 2:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        settle(future, in_flight.pop(future))
+                in_flight[pool.submit(work, record)] = record
+            for future in list(in_flight):
+                settle(future, in_flight.pop(future))
+
+        logger.info(f"Mirror complete: {stats['downloaded']} downloaded, {stats['skipped']} unchanged, "
+                    f"{stats['failed']} failed ({stats['bytes']} bytes)")
+        return stats
+
+    def copy_to(self, name: str, local_path: str, record: Optional[BlobRecord] = None) -> bool:
+        """
+        Copy a blob out of the mirror, downloading it first if needed.
+
+        With the blob's ``record``, the copy is of that generation even if an
+        older one is cached.
+        """
+        path = self.fetch_record(record) if record is not None else self.fetch(name)
+        if not path:
+            return False
+        directory = os.path.dirname(local_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        shutil.copyfile(path, local_path)
+        return True
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Mirror the configured bucket: ``python -m src.mirror [prefix]``."""
+    argv = sys.argv[1:] if argv is None else argv
+    from src.main import configure_logging, get_storage_manager, get_blob_mirror
+    configure_logging()
+    blob_mirror = get_blob_mirror()
+    if blob_mirror is None:
+        logger.error("Mirror not configured: set mirror.path and a Cloud Storage bucket")
+        return 1
+    stats = blob_mirror.mirror(get_storage_manager().iter_images(prefix=argv[0] if argv else None))
+    print(f"Downloaded {stats['downloaded']}, unchanged {stats['skipped']}, "
+          f"failed {stats['failed']} ({stats['bytes']} bytes)")
+    return 1 if stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
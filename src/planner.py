@@ -0,0 +1,454 @@
+"""
+Posting-time optimizer.
+
+The engagement of past posts (likes plus comments) is kept in SQLite. It is
+pulled from the Graph API or imported from a CSV/JSON file, and folded into
+one hour-of-week model per account: 168 buckets of time-decayed sums of
+log engagement. Adding or updating a post costs O(1), so the models follow
+new data incrementally, and a year of history for many accounts loads in a
+fraction of a second.
+
+A bucket's score is its decayed mean engagement, blended with the
+neighbouring hours and pulled toward the account's overall mean. A rarely
+used hour neither wins nor loses on one lucky post.
+
+PostingPlanner turns the scores into a rolling plan. For each account and
+each 24 hours of the plan it picks the best hours, at least
+``min_gap_hours`` apart, up to ``posts_per_day``. It never plans more than
+the publishing limit in any 24 hours, and ``max_posts_per_hour`` spreads
+accounts apart. Without data the configured schedule time wins. Scores are
+cached per model and recomputed only for accounts with new data.
+
+    planner = PostingPlanner(EngagementStore('data/engagement.sqlite3'))
+    planner.record('gallery', [EngagementRecord('1789', posted_at, 240)])
+    for post in planner.plan(['gallery', 'prints'], start=time.time(), days=1):
+        ...
+
+``python -m src.planner import FILE`` loads engagement exported elsewhere;
+``python -m src.planner plan [--days N]`` prints the plan.
+"""
+
+import argparse
+import csv
+import json
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+import logging
+from datetime import datetime
+from typing import Optional, List, Dict, Any, Iterable, Iterator, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+HOURS_PER_WEEK = 168
+# Instagram's limit on API-published posts per account in a moving 24 hours
+DEFAULT_PUBLISHING_LIMIT = 50
+DAY = 86400.0
+
+
+class EngagementRecord(NamedTuple):
+    """Engagement of one published post."""
+    media_id: str
+    posted_at: float
+    engagement: float
+
+
+class PlannedPost(NamedTuple):
+    """One slot of the posting plan."""
+    account: str
+    at: float
+    score: float
+
+    @property
+    def key(self) -> str:
+        """Identifier of the slot in local time, e.g. ``2024-05-01T18``."""
+        return datetime.fromtimestamp(self.at).strftime('%Y-%m-%dT%H')
+
+
+def hour_of_week(timestamp: float) -> int:
+    """Local hour of the week, 0 (Monday 00:00) to 167."""
+    moment = datetime.fromtimestamp(timestamp)
+    return moment.weekday() * 24 + moment.hour
+
+
+def parse_time(value: Any) -> float:
+    """Epoch seconds from a number or an ISO 8601 string (Graph API timestamps included)."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if len(text) > 5 and text[-5] in '+-' and text[-3] != ':':
+        # Graph API style offset, e.g. 2024-05-01T18:00:00+0000
+        text = f"{text[:-2]}:{text[-2:]}"
+    return datetime.fromisoformat(text.replace('Z', '+00:00')).timestamp()
+
+
+class HourOfWeekModel:
+    """
+    Time-decayed engagement per hour of the week for one account.
+
+    Args:
+        half_life: Seconds after which a post counts half as much
+        prior_posts: Strength, in posts, of the pull toward the account's mean
+    """
+
+    def __init__(self, half_life: float = 60 * DAY, prior_posts: float = 3.0):
+        self.half_life = half_life
+        self.prior_posts = prior_posts
+        self.weights = [0.0] * HOURS_PER_WEEK
+        self.values = [0.0] * HOURS_PER_WEEK
+        self.posts = 0
+        self.version = 0
+        self._reference: Optional[float] = None
+        self._scores: Optional[List[float]] = None
+
+    def _weight(self, posted_at: float) -> float:
+        if self._reference is None:
+            self._reference = posted_at
+        exponent = (posted_at - self._reference) / self.half_life
+        if exponent > 500:
+            # Rebase before weights overflow; scaling every bucket alike changes no score
+            scale = 2.0 ** -exponent
+            self.weights = [w * scale for w in self.weights]
+            self.values = [v * scale for v in self.values]
+            self._reference, exponent = posted_at, 0.0
+        return 2.0 ** exponent
+
+    def add(self, posted_at: float, engagement: float, sign: int = 1) -> None:
+        """Add a post, or take one back out with ``sign=-1``."""
+        weight = self._weight(posted_at) * sign
+        hour = hour_of_week(posted_at)
+        self.weights[hour] += weight
+        self.values[hour] += weight * math.log1p(max(0.0, engagement))
+        self.posts += sign
+        self.version += 1
+        self._scores = None
+
+    def scores(self) -> List[float]:
+        """Expected log engagement for each hour of the week (all equal without data)."""
+        if self._scores is not None:
+            return self._scores
+        total_weight = sum(self.weights)
+        if self.posts <= 0 or total_weight <= 0:
+            self._scores = [0.0] * HOURS_PER_WEEK
+            return self._scores
+        mean = sum(self.values) / total_weight
+        prior = self.prior_posts * total_weight / self.posts
+        weights, values = self.weights, self.values
+        scores = []
+        for hour in range(HOURS_PER_WEEK):
+            before, after = hour - 1, (hour + 1) % HOURS_PER_WEEK
+            weight = max(0.0, 0.5 * weights[hour] + 0.25 * (weights[before] + weights[after]))
+            value = 0.5 * values[hour] + 0.25 * (values[before] + values[after])
+            scores.append((value + prior * mean) / (weight + prior))
+        self._scores = scores
+        return scores
+
+
+class EngagementStore:
+    """
+    SQLite table of post engagement per account.
+
+    Args:
+        path: Database file, or ':memory:'
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS engagement (
+                    account TEXT NOT NULL,
+                    media_id TEXT NOT NULL,
+                    posted_at REAL NOT NULL,
+                    engagement REAL NOT NULL,
+                    PRIMARY KEY (account, media_id)
+                );
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def upsert(self, account: str, records: Iterable[EngagementRecord]
+               ) -> List[Tuple[Optional[EngagementRecord], EngagementRecord]]:
+        """
+        Store records, replacing earlier values for the same media.
+
+        Returns:
+            ``(previous, new)`` for every record that is new or changed;
+            ``previous`` is None for new records
+        """
+        changes = []
+        with self._lock:
+            for record in records:
+                row = self.conn.execute(
+                    "SELECT posted_at, engagement FROM engagement WHERE account = ? AND media_id = ?",
+                    (account, record.media_id)
+                ).fetchone()
+                if row is not None and tuple(row) == (record.posted_at, record.engagement):
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO engagement (account, media_id, posted_at, engagement) "
+                    "VALUES (?, ?, ?, ?)",
+                    (account, record.media_id, record.posted_at, record.engagement)
+                )
+                previous = EngagementRecord(record.media_id, *row) if row is not None else None
+                changes.append((previous, record))
+            self.conn.commit()
+        return changes
+
+    def iter_records(self) -> Iterator[Tuple[str, EngagementRecord]]:
+        """Yield ``(account, record)`` for every stored post."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT account, media_id, posted_at, engagement FROM engagement"
+            ).fetchall()
+        for account, media_id, posted_at, engagement in rows:
+            yield account, EngagementRecord(media_id, posted_at, engagement)
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM engagement").fetchone()[0]
+
+
+def read_engagement_file(path: str) -> Dict[str, List[EngagementRecord]]:
+    """
+    Read exported engagement, grouped by account.
+
+    CSV files need a header; JSON files hold a list of objects. Each row has
+    ``account``, ``media_id`` (or ``id``) and ``posted_at`` (or
+    ``timestamp``), plus either ``engagement`` or ``likes``/``like_count``
+    and ``comments``/``comments_count``.
+
+    Raises:
+        ValueError: A row lacks a field or has an unreadable value
+    """
+    with open(path, newline='') as f:
+        rows = json.load(f) if path.lower().endswith('.json') else list(csv.DictReader(f))
+    by_account: Dict[str, List[EngagementRecord]] = {}
+    for number, row in enumerate(rows, 1):
+        try:
+            if row.get('engagement') not in (None, ''):
+                engagement = float(row['engagement'])
+            else:
+                engagement = (float(row.get('likes', row.get('like_count')) or 0)
+                              + float(row.get('comments', row.get('comments_count')) or 0))
+            record = EngagementRecord(str(row.get('media_id') or row['id']),
+                                      parse_time(row.get('posted_at') or row['timestamp']), engagement)
+            by_account.setdefault(str(row.get('account') or 'default'), []).append(record)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"{path}: row {number}: {e!r}")
+    return by_account
+
+
+class PostingPlanner:
+    """
+    Plans posting times across accounts from their hour-of-week models.
+
+    Args:
+        store: Engagement storage
+        half_life_days: Days after which a post's engagement counts half
+        prior_posts: Posts' worth of pull toward each account's mean
+        posts_per_day: Posts planned per account and day
+        min_gap_hours: Least hours between two posts of one account
+        publishing_limit: Most posts of one account in any 24 hours
+        max_posts_per_hour: Most posts across all accounts in one hour
+        default_time: HH:MM preferred while an account has no data
+    """
+
+    def __init__(self, store: EngagementStore, half_life_days: float = 60, prior_posts: float = 3,
+                 posts_per_day: int = 1, min_gap_hours: float = 3,
+                 publishing_limit: int = DEFAULT_PUBLISHING_LIMIT,
+                 max_posts_per_hour: Optional[int] = None, default_time: str = '09:00'):
+        self.store = store
+        self.half_life = half_life_days * DAY
+        self.prior_posts = prior_posts
+        self.publishing_limit = publishing_limit
+        self.posts_per_day = max(0, min(posts_per_day, publishing_limit))
+        self.min_gap = min_gap_hours * 3600
+        self.max_posts_per_hour = max_posts_per_hour
+        self.default_hour = int(default_time.split(':')[0])
+        self.models: Dict[str, HourOfWeekModel] = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def close(self) -> None:
+        self.store.close()
+
+    def _model(self, account: str) -> HourOfWeekModel:
+        model = self.models.get(account)
+        if model is None:
+            model = self.models[account] = HourOfWeekModel(self.half_life, self.prior_posts)
+        return model
+
+    def load(self) -> None:
+        """Build the models from the store (once; later changes arrive through record())."""
+        with self._lock:
+            if self._loaded:
+                return
+            started = time.perf_counter()
+            rows = 0
+            for account, record in self.store.iter_records():
+                self._model(account).add(record.posted_at, record.engagement)
+                rows += 1
+            self._loaded = True
+        logger.info(f"Loaded engagement of {rows} posts for {len(self.models)} accounts "
+                    f"in {time.perf_counter() - started:.3f}s")
+
+    def record(self, account: str, records: Iterable[EngagementRecord]) -> int:
+        """
+        Store new or updated engagement and update the account's model.
+
+        Returns:
+            Number of records that were new or changed
+        """
+        with self._lock:
+            self.load()
+            changes = self.store.upsert(account, records)
+            model = self._model(account)
+            for previous, record in changes:
+                if previous is not None:
+                    model.add(previous.posted_at, previous.engagement, sign=-1)
+                model.add(record.posted_at, record.engagement)
+        return len(changes)
+
+    def import_file(self, path: str) -> int:
+        """Import engagement from a CSV or JSON file; see read_engagement_file."""
+        return sum(self.record(account, records)
+                   for account, records in read_engagement_file(path).items())
+
+    def hour_scores(self, account: str) -> List[float]:
+        """Score of each hour of the week for one account."""
+        with self._lock:
+            self.load()
+            return list(self._model(account).scores())
+
+    def _preference(self, hour: int) -> int:
+        """Hours from the configured time of day; breaks ties, e.g. without data."""
+        distance = abs(hour - self.default_hour)
+        return min(distance, 24 - distance)
+
+    def plan(self, accounts: Iterable[str], start: float, days: int = 1,
+             recent: Optional[Dict[str, List[float]]] = None) -> List[PlannedPost]:
+        """
+        Plan the posts of every account from ``start`` for ``days`` days.
+
+        Each 24 hours from ``start`` gets up to ``posts_per_day`` posts per
+        account, so a plan made every day at the same time never doubles up.
+
+        Args:
+            accounts: Accounts to plan for
+            start: Only plan whole hours at or after this time (epoch seconds)
+            days: Length of the plan
+            recent: Per account, times of posts already made or queued; they
+                count toward the gap and publishing limits
+
+        Returns:
+            Planned posts in time order
+        """
+        accounts = list(accounts)
+        first = datetime.fromtimestamp(start).replace(minute=0, second=0, microsecond=0).timestamp()
+        if first < start:
+            first += 3600
+        hours = []
+        at = first
+        while at < start + days * DAY:
+            hours.append((int((at - start) // DAY), at, hour_of_week(at)))
+            at += 3600
+
+        candidates = []
+        with self._lock:
+            self.load()
+            for account in accounts:
+                scores = self._model(account).scores()
+                ranked = sorted(hours, key=lambda slot: (slot[0], -round(scores[slot[2]], 9),
+                                                         self._preference(slot[2] % 24)))
+                rank, window = 0, None
+                for day, at, hour in ranked:
+                    rank = rank + 1 if day == window else 0
+                    window = day
+                    candidates.append((day, rank, account, at, scores[hour]))
+
+        # Window by window, every account's best hour before anyone's second best
+        candidates.sort()
+        times = {account: sorted((recent or {}).get(account, ())) for account in accounts}
+        per_day: Dict[Tuple[str, int], int] = {}
+        per_hour: Dict[float, int] = {}
+        planned = []
+        for day, _, account, at, score in candidates:
+            if per_day.get((account, day), 0) >= self.posts_per_day:
+                continue
+            if self.max_posts_per_hour is not None and per_hour.get(at, 0) >= self.max_posts_per_hour:
+                continue
+            taken = times[account]
+            if any(abs(at - other) < self.min_gap for other in taken):
+                continue
+            if sum(1 for other in taken if abs(at - other) < DAY) >= self.publishing_limit:
+                continue
+            taken.append(at)
+            per_day[(account, day)] = per_day.get((account, day), 0) + 1
+            per_hour[at] = per_hour.get(at, 0) + 1
+            planned.append(PlannedPost(account, at, score))
+        planned.sort(key=lambda post: (post.at, post.account))
+        return planned
+
+
+def engagement_from_media(media: Iterable[Dict[str, Any]]) -> List[EngagementRecord]:
+    """Engagement records from Graph API media objects (``id``, ``timestamp``, counts)."""
+    records = []
+    for item in media:
+        if not item.get('id') or not item.get('timestamp'):
+            continue
+        engagement = float(item.get('like_count') or 0) + float(item.get('comments_count') or 0)
+        records.append(EngagementRecord(str(item['id']), parse_time(item['timestamp']), engagement))
+    return records
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Import engagement or print the plan: ``python -m src.planner {import FILE | plan}``."""
+    parser = argparse.ArgumentParser(description="Plan posting times from engagement history")
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_command = commands.add_parser('import', help="Import engagement from CSV or JSON")
+    import_command.add_argument('file')
+    plan_command = commands.add_parser('plan', help="Print the posting plan")
+    plan_command.add_argument('--days', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    from src.main import configure_logging, get_posting_planner, get_account_dispatcher
+    configure_logging()
+    planner = get_posting_planner()
+    if planner is None:
+        logger.error("Posting planner not enabled: set planner.enabled in config/config.yaml")
+        return 1
+    if args.command == 'import':
+        print(f"Imported {planner.import_file(args.file)} new or changed posts")
+        return 0
+    accounts = [context.name for context in get_account_dispatcher().contexts]
+    for post in planner.plan(accounts, start=time.time(), days=args.days):
+        print(f"{datetime.fromtimestamp(post.at):%a %Y-%m-%d %H:%M}  {post.account}  "
+              f"(expected engagement {math.expm1(post.score):.0f})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
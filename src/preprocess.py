@@ -0,0 +1,307 @@
+"""
+Image preprocessing for Instagram.
+
+Archive scans are often 40 MB TIFF/PNG files that Instagram fetches slowly or
+rejects. Before posting, each original is downloaded, auto-oriented from its
+EXIF data, center-cropped into Instagram's supported aspect ratios
+(4:5 portrait to 1.91:1 landscape), downscaled to 1080px wide and re-encoded
+as an optimized progressive JPEG.
+
+The derived JPEG is uploaded under a key built from the original's content
+hash and the processing settings, and recorded in a local index, so every
+original is processed only once. Batches run the CPU-heavy transform on a
+process pool while downloads and uploads run on threads.
+"""
+
+import base64
+import hashlib
+import importlib.util
+import io
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, List, Dict, Callable, Tuple
+
+from src.manifest import BlobRecord
+
+# Pillow is imported where images are decoded, keeping it out of startup
+PIL_AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+logger = logging.getLogger(__name__)
+
+TARGET_WIDTH = 1080
+JPEG_QUALITY = 85
+MIN_ASPECT = 4 / 5
+MAX_ASPECT = 1.91
+DERIVED_PREFIX = 'derived/'
+
+
+def fit_aspect_box(width: int, height: int, min_aspect: float = MIN_ASPECT,
+                   max_aspect: float = MAX_ASPECT) -> Tuple[int, int, int, int]:
+    """
+    Return the centered crop box that brings an image into the allowed aspect range.
+
+    Images already inside the range are returned uncropped.
+    """
+    aspect = width / height
+    if aspect < min_aspect:
+        new_height = round(width / min_aspect)
+        top = (height - new_height) // 2
+        return 0, top, width, top + new_height
+    if aspect > max_aspect:
+        new_width = round(height * max_aspect)
+        left = (width - new_width) // 2
+        return left, 0, left + new_width, height
+    return 0, 0, width, height
+
+
+def prepare_image_bytes(data: bytes, target_width: int = TARGET_WIDTH,
+                        quality: int = JPEG_QUALITY) -> bytes:
+    """
+    Turn an original image into an Instagram-ready JPEG.
+
+    Args:
+        data: Encoded original image (any format Pillow can read)
+        target_width: Maximum output width; smaller images are not upscaled
+        quality: JPEG quality
+
+    Returns:
+        Encoded JPEG bytes
+    """
+    if not PIL_AVAILABLE:
+        raise RuntimeError("Pillow is not installed. Install with: pip install Pillow")
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+            # Flatten transparency onto white; JPEG has no alpha channel
+            rgba = image.convert('RGBA')
+            background = Image.new('RGB', rgba.size, (255, 255, 255))
+            background.paste(rgba, mask=rgba.split()[-1])
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        image = image.crop(fit_aspect_box(*image.size))
+        if image.width > target_width:
+            height = round(image.height * target_width / image.width)
+            image = image.resize((target_width, height), Image.LANCZOS)
+
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+
+def _process_file(source_path: str, target_path: str, target_width: int, quality: int) -> int:
+    """Process pool entry point: transform one file on disk. Returns the output size."""
+    with open(source_path, 'rb') as f:
+        data = prepare_image_bytes(f.read(), target_width, quality)
+    with open(target_path, 'wb') as f:
+        f.write(data)
+    return len(data)
+
+
+def content_hash_of(record: BlobRecord, local_path: Optional[str] = None) -> str:
+    """
+    Hex content hash of an original: the GCS md5 when known, else the file's md5.
+    """
+    if record.md5_hash:
+        try:
+            return base64.b64decode(record.md5_hash).hex()
+        except ValueError:
+            pass
+    if local_path:
+        digest = hashlib.md5()
+        with open(local_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    raise ValueError(f"No content hash available for {record.name}")
+
+
+class ImagePreprocessor:
+    """
+    Produces and caches Instagram-ready derivatives of bucket images.
+
+    Args:
+        download: ``(record, local_path) -> bool`` fetching exactly the
+            record's generation, whose md5 names the derivative
+        upload: ``(local_path, remote_name) -> Optional[str]``, e.g. storage_manager.upload_image
+        index_path: SQLite file recording which derivatives already exist
+        target_width: Output width in pixels
+        quality: JPEG quality
+        derived_prefix: Bucket prefix the derivatives are uploaded under
+        max_workers: Processes used for batch transforms (default: CPU count)
+        exists: Optional ``(remote_name) -> Optional[str]`` returning the public
+            URL of a derivative that already exists in the bucket
+    """
+
+    def __init__(self, download: Callable[[str, str], bool],
+                 upload: Callable[[str, str], Optional[str]], index_path: str,
+                 target_width: int = TARGET_WIDTH, quality: int = JPEG_QUALITY,
+                 derived_prefix: str = DERIVED_PREFIX, max_workers: Optional[int] = None,
+                 exists: Optional[Callable[[str], Optional[str]]] = None):
+        self.download = download
+        self.upload = upload
+        self.index_path = index_path
+        self.target_width = target_width
+        self.quality = quality
+        self.derived_prefix = derived_prefix
+        self.max_workers = max_workers
+        self.exists = exists
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def variant(self) -> str:
+        return f"w{self.target_width}-q{self.quality}"
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.index_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS derived (
+                    content_hash TEXT NOT NULL,
+                    variant TEXT NOT NULL,
+                    remote_name TEXT NOT NULL,
+                    public_url TEXT NOT NULL,
+                    size INTEGER,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (content_hash, variant)
+                )
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def derived_name(self, content_hash: str) -> str:
+        return f"{self.derived_prefix}{content_hash}-{self.variant}.jpg"
+
+    def cached_url(self, content_hash: str) -> Optional[str]:
+        """Return the public URL of an existing derivative, if any."""
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT public_url FROM derived WHERE content_hash = ? AND variant = ?",
+                (content_hash, self.variant)
+            ).fetchone()
+        if row:
+            return row[0]
+        if self.exists:
+            url = self.exists(self.derived_name(content_hash))
+            if url:
+                self._remember(content_hash, url, None)
+                return url
+        return None
+
+    def _remember(self, content_hash: str, public_url: str, size: Optional[int]) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO derived "
+                "(content_hash, variant, remote_name, public_url, size, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (content_hash, self.variant, self.derived_name(content_hash), public_url,
+                 size, time.time())
+            )
+            self.conn.commit()
+
+    def prepare(self, record: BlobRecord) -> Optional[str]:
+        """
+        Return the URL of the Instagram-ready version of one image.
+
+        Returns:
+            Public URL of the derivative, or None if processing failed
+        """
+        return self.prepare_batch([record], processes=False).get(record.name)
+
+    def prepare_batch(self, records: List[BlobRecord], processes: bool = True) -> Dict[str, str]:
+        """
+        Prepare many images; cached derivatives are reused without downloading.
+
+        Args:
+            records: Originals to prepare
+            processes: Run transforms on a process pool (False runs them inline)
+
+        Returns:
+            Mapping of original blob name to derivative URL for every success
+        """
+        results: Dict[str, str] = {}
+        todo = []
+        for record in records:
+            url = self.cached_url(content_hash_of(record)) if record.md5_hash else None
+            if url:
+                results[record.name] = url
+            else:
+                todo.append(record)
+        if not todo:
+            return results
+
+        with tempfile.TemporaryDirectory(prefix='zmaninstaposter-') as workdir:
+            jobs = {}
+            io_workers = min(8, len(todo))
+            with ThreadPoolExecutor(max_workers=io_workers) as pool:
+                paths = {r.name: os.path.join(workdir, f"original-{i}") for i, r in enumerate(todo)}
+                downloaded = pool.map(lambda r: (r, self.download(r, paths[r.name])), todo)
+                for record, ok in downloaded:
+                    if not ok:
+                        logger.error(f"Failed to download {record.name} for preprocessing")
+                        continue
+                    content_hash = content_hash_of(record, paths[record.name])
+                    url = self.cached_url(content_hash)
+                    if url:
+                        results[record.name] = url
+                    else:
+                        jobs[record.name] = (content_hash, paths[record.name],
+                                             paths[record.name] + '.jpg')
+
+            sizes = self._transform(jobs, processes)
+
+            with ThreadPoolExecutor(max_workers=io_workers) as pool:
+                uploads = {name: pool.submit(self.upload, jobs[name][2],
+                                             self.derived_name(jobs[name][0]))
+                           for name in sizes}
+                for name, future in uploads.items():
+                    url = future.result()
+                    if not url:
+                        logger.error(f"Failed to upload preprocessed image for {name}")
+                        continue
+                    self._remember(jobs[name][0], url, sizes[name])
+                    results[name] = url
+
+        logger.info(f"Prepared {len(results)}/{len(records)} images ({len(jobs)} processed)")
+        return results
+
+    def _transform(self, jobs: Dict[str, tuple], processes: bool) -> Dict[str, int]:
+        sizes = {}
+        if not jobs:
+            return sizes
+        if processes and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=self.max_workers) as pool:
+                futures = {name: pool.submit(_process_file, source, target,
+                                             self.target_width, self.quality)
+                           for name, (_, source, target) in jobs.items()}
+                for name, future in futures.items():
+                    try:
+                        sizes[name] = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to preprocess {name}: {e}")
+        else:
+            for name, (_, source, target) in jobs.items():
+                try:
+                    sizes[name] = _process_file(source, target, self.target_width, self.quality)
+                except Exception as e:
+                    logger.error(f"Failed to preprocess {name}: {e}")
+        return sizes
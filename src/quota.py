@@ -0,0 +1,252 @@
+"""
+Per-account Content Publishing API quota.
+
+Instagram lets an account publish a limited number of posts (50 at the time
+of writing) in any rolling 24 hours. Past that, ``media_publish`` is rejected,
+after the container has already been created and processed. PublishQuota
+counts every account's publishes in a sliding window, so a post is admitted
+before its container is created, or deferred until a slot frees up:
+
+- An admitted post reserves a slot under a key (e.g. its posting round). The
+  slot turns into a publish when the post goes out. It is released if the
+  post fails before publishing.
+- Usage is the slots in the window. If the Graph API's
+  ``content_publishing_limit`` endpoint reported more at the last sync, the
+  report plus the slots taken since counts instead, which also covers posts
+  made by other tools. The limit and window come from the same endpoint.
+- Slots and the last report are kept in SQLite, so a restart does not forget
+  the day's posts.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import logging
+from typing import Optional, Dict, Callable, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 50
+DEFAULT_WINDOW = 86400
+
+
+class Admission(NamedTuple):
+    """Outcome of asking to publish: whether to go ahead, or how long to wait."""
+    admitted: bool
+    used: int
+    limit: int
+    retry_after: float = 0.0
+
+
+class PublishQuota:
+    """
+    SQLite-backed sliding-window publishing quota of every account.
+
+    Args:
+        path: Database file, or ':memory:' for a throwaway quota
+        limit: Publishes allowed per window until the Graph API reports the limit
+        window: Length of the sliding window in seconds, likewise
+        sync_interval: Seconds before the Graph API's report is refreshed
+        clock: Callable returning the current epoch time (injectable for tests;
+            defaults to time.time as found when the quota is created)
+    """
+
+    def __init__(self, path: str, limit: int = DEFAULT_LIMIT, window: float = DEFAULT_WINDOW,
+                 sync_interval: float = 900.0, clock: Optional[Callable[[], float]] = None):
+        self.path = path
+        self.limit = limit
+        self.window = window
+        self.sync_interval = sync_interval
+        self.clock = clock or time.time
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS slots (
+                    account TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    taken_at REAL NOT NULL,
+                    media_id TEXT,
+                    PRIMARY KEY (account, key)
+                );
+                CREATE INDEX IF NOT EXISTS idx_slots_time ON slots (account, taken_at);
+                CREATE TABLE IF NOT EXISTS reports (
+                    account TEXT PRIMARY KEY,
+                    quota_usage INTEGER NOT NULL,
+                    quota_total INTEGER,
+                    quota_duration REAL,
+                    synced_at REAL NOT NULL
+                );
+            """)
+            self._conn.commit()
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _report(self, account: str) -> Tuple[int, float, Optional[int], Optional[float]]:
+        """The account's limit and window, and the last reported usage and its time."""
+        row = self.conn.execute(
+            "SELECT quota_usage, quota_total, quota_duration, synced_at FROM reports WHERE account = ?",
+            (account,)
+        ).fetchone()
+        if row is None:
+            return self.limit, self.window, None, None
+        usage, total, duration, synced_at = row
+        return total or self.limit, duration or self.window, usage, synced_at
+
+    def _usage(self, account: str, now: float) -> Tuple[int, int, float]:
+        """Slots used, the limit, and seconds until usage drops below the limit (0 if it is below)."""
+        limit, window, reported, synced_at = self._report(account)
+        taken = [row[0] for row in self.conn.execute(
+            "SELECT taken_at FROM slots WHERE account = ? AND taken_at > ? ORDER BY taken_at",
+            (account, now - window)
+        )]
+        used, wait = len(taken), 0.0
+        if used >= limit:
+            # Once the slot ``limit`` places from the newest leaves the window
+            wait = taken[used - limit] + window - now
+        if reported is not None and synced_at > now - window:
+            estimate = reported + sum(1 for t in taken if t >= synced_at)
+            if estimate >= limit:
+                # The report does not say when its posts leave the window; ask again
+                wait = max(wait, synced_at + self.sync_interval - now)
+            used = max(used, estimate)
+        return used, limit, max(1.0, wait) if used >= limit else 0.0
+
+    def usage(self, account: str) -> int:
+        """Publishes counted against the account in the current window."""
+        with self._lock:
+            return self._usage(account, self.clock())[0]
+
+    def retry_after(self, account: str) -> float:
+        """Seconds until the account can publish again (0 if it can now)."""
+        with self._lock:
+            return self._usage(account, self.clock())[2]
+
+    def admit(self, account: str, key: str) -> Admission:
+        """
+        Reserve a slot for a post, unless the account's quota is used up.
+
+        Asking again with the same key (e.g. when a job is retried) admits
+        it without taking another slot.
+
+        Args:
+            account: Account to publish to
+            key: Identity of the post, unique per account
+
+        Returns:
+            Admission; when not admitted, ``retry_after`` says how long to wait
+        """
+        with self._lock:
+            now = self.clock()
+            self.conn.execute("DELETE FROM slots WHERE account = ? AND taken_at <= ?",
+                              (account, now - max(self.window, self._report(account)[1])))
+            used, limit, wait = self._usage(account, now)
+            held = self.conn.execute("SELECT 1 FROM slots WHERE account = ? AND key = ?",
+                                     (account, key)).fetchone()
+            if held is None and wait == 0:
+                self.conn.execute("INSERT INTO slots (account, key, taken_at) VALUES (?, ?, ?)",
+                                  (account, key, now))
+                used += 1
+            self.conn.commit()
+        if held is None and wait > 0:
+            logger.info(f"[{account}] Publishing quota used up ({used}/{limit}); "
+                        f"next slot in {wait:.0f}s")
+            return Admission(False, used, limit, wait)
+        return Admission(True, used, limit)
+
+    def record_publish(self, account: str, key: str, media_id: Optional[str] = None) -> None:
+        """Count a publish at the current time, in the slot reserved under ``key`` if any."""
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO slots (account, key, taken_at, media_id) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(account, key) DO UPDATE SET taken_at = excluded.taken_at, "
+                "media_id = excluded.media_id",
+                (account, key, self.clock(), media_id)
+            )
+            self.conn.commit()
+
+    def release(self, account: str, key: str) -> None:
+        """Give back a reserved slot whose post will not be published."""
+        with self._lock:
+            self.conn.execute("DELETE FROM slots WHERE account = ? AND key = ? AND media_id IS NULL",
+                              (account, key))
+            self.conn.commit()
+
+    def update(self, account: str, usage: int, limit: Optional[int] = None,
+               window: Optional[float] = None) -> None:
+        """
+        Store the usage the Graph API reports for the account right now.
+
+        Args:
+            account: Account the report is for
+            usage: Publishes the API counts in the current window
+            limit: The account's limit, if reported
+            window: The window in seconds, if reported
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO reports (account, quota_usage, quota_total, quota_duration, synced_at) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(account) DO UPDATE SET "
+                "quota_usage = excluded.quota_usage, quota_total = excluded.quota_total, "
+                "quota_duration = excluded.quota_duration, synced_at = excluded.synced_at",
+                (account, usage, limit, window, self.clock())
+            )
+            self.conn.commit()
+
+    def exhausted(self, account: str) -> None:
+        """Note that the Graph API refused a publish because the quota is used up."""
+        with self._lock:
+            limit, window = self._report(account)[:2]
+        self.update(account, limit, limit, window)
+        logger.warning(f"[{account}] Graph API reports the publishing quota used up")
+
+    def needs_sync(self, account: str) -> bool:
+        with self._lock:
+            synced_at = self._report(account)[3]
+        return synced_at is None or self.clock() - synced_at >= self.sync_interval
+
+    def sync(self, account: str, client, force: bool = False) -> bool:
+        """
+        Refresh the account's usage and limit from the Graph API when due.
+
+        A failed call keeps the last report.
+
+        Args:
+            account: Account to sync
+            client: InstagramClient of the account
+            force: Sync even if the last report is recent
+
+        Returns:
+            True if a new report was stored
+        """
+        if not force and not self.needs_sync(account):
+            return False
+        try:
+            report = client.content_publishing_limit()
+        except Exception as e:
+            logger.warning(f"[{account}] Could not fetch the publishing quota: {e}")
+            return False
+        self.update(account, report["quota_usage"], report.get("quota_total"), report.get("quota_duration"))
+        return True
+
+    def usage_by_account(self) -> Dict[str, int]:
+        """Current usage of every account with slots or a report."""
+        with self._lock:
+            accounts = [row[0] for row in self.conn.execute(
+                "SELECT account FROM slots UNION SELECT account FROM reports"
+            )]
+            now = self.clock()
+            return {account: self._usage(account, now)[0] for account in accounts}
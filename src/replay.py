@@ -0,0 +1,782 @@
+"""
+Record and replay of Cloud Storage, Gemini and Graph API calls.
+
+A Cassette sits between the app and the three services. While recording,
+every call goes to the live service, and the request and response are
+appended to a JSON-lines cassette file. No access tokens are written, but
+listings, downloaded image bytes and captions are. While replaying, the same
+calls are answered from the file without credentials or network:
+
+- A request recorded exactly as made gets its recorded responses in order.
+  The last one repeats, so a container polled IN_PROGRESS then FINISHED
+  behaves the same every time.
+- Any other request gets the responses recorded for the same route (e.g.
+  ``POST /v19.0/<user>/media`` or a one-image Gemini call), in turn. A new
+  image selected on a later simulated day is therefore still captioned and
+  posted. With ``strict`` such a request raises CassetteMiss instead.
+
+Each service is intercepted where the app talks to it:
+
+- the storage bucket and blob handles
+- Gemini's ``generate_content``
+- the Graph API client's HTTP session
+
+Everything above those points runs for real. Every response keeps its
+recorded latency. On replay it can advance a VirtualClock instead of being
+slept, so a month of daily rounds runs in seconds:
+
+    python -m src.replay record cassettes/day.jsonl --round
+    python -m src.replay replay cassettes/day.jsonl
+    python -m src.replay simulate cassettes/day.jsonl --days 30
+
+Replays and simulations start from empty state files (history, jobs,
+caches) in a temporary directory, so they never touch the real ones. The local
+mirror is bypassed because its ranged downloads are not recorded.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import logging
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Callable, Iterator, Mapping, Tuple
+from urllib.parse import quote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+RECORD = 'record'
+REPLAY = 'replay'
+DAY = 86400
+
+# Request fields that must never reach a cassette file
+SECRET_FIELDS = ('access_token',)
+# ``field=value`` in URLs quoted by error messages, headers and paging links
+_SECRET_IN_TEXT = re.compile(r'\b(%s)=[^&\s"\'\\]+' % '|'.join(map(re.escape, SECRET_FIELDS)))
+BLOB_FIELDS = ('name', 'generation', 'size', 'md5_hash', 'crc32c', 'content_type', 'public_url', 'metadata')
+
+
+class CassetteMiss(LookupError):
+    """A replayed request has no recorded response."""
+
+
+class ReplayedError(RuntimeError):
+    """An error recorded from a live call, raised again on replay."""
+
+    def __init__(self, message: str, error_type: str = '', code: Optional[int] = None):
+        super().__init__(message)
+        self.error_type = error_type
+        self.code = code
+
+
+def redact(text: str) -> str:
+    """``text`` with the value of every secret query parameter replaced."""
+    return _SECRET_IN_TEXT.sub(r'\1=REDACTED', text)
+
+
+def canonical(value: Any) -> Any:
+    """JSON-compatible form of a request, with bytes replaced by their digest."""
+    if isinstance(value, (bytes, bytearray)):
+        return {"sha256": hashlib.sha256(value).hexdigest()}
+    if isinstance(value, Mapping):
+        return {str(key): canonical(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return repr(value)
+
+
+def encode_bytes(data: bytes) -> Dict[str, str]:
+    return {"base64": base64.b64encode(data).decode('ascii')}
+
+
+def decode_bytes(value: Dict[str, str]) -> bytes:
+    return base64.b64decode(value["base64"])
+
+
+class VirtualClock:
+    """
+    Simulated time: sleeping advances it instantly.
+
+    Args:
+        start: Initial epoch time (default: now)
+    """
+
+    def __init__(self, start: Optional[float] = None):
+        self.now = time.time() if start is None else start
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        if seconds > 0:
+            with self._lock:
+                self.now += seconds
+
+    def advance_to(self, when: float) -> None:
+        with self._lock:
+            self.now = max(self.now, when)
+
+    @contextlib.contextmanager
+    def installed(self, monotonic: bool = False) -> Iterator['VirtualClock']:
+        """
+        Stand in for ``time.time`` and ``time.sleep`` (and ``time.monotonic`` if asked).
+
+        Leave ``monotonic`` off while asyncio runs: its event loop keeps time
+        with time.monotonic and would wait forever for virtual time to pass.
+        """
+        saved = time.time, time.sleep, time.monotonic
+        time.time, time.sleep = self.time, self.sleep
+        if monotonic:
+            time.monotonic = self.time
+        try:
+            yield self
+        finally:
+            time.time, time.sleep, time.monotonic = saved
+
+
+class Cassette:
+    """
+    Recorded service calls, read from or written to a JSON-lines file.
+
+    Args:
+        path: Cassette file
+        mode: RECORD (overwrites the file) or REPLAY
+        strict: Replay only requests recorded exactly as made
+        clock: Replayed latencies advance this clock (default: no delay)
+    """
+
+    def __init__(self, path: str, mode: str = REPLAY, strict: bool = False,
+                 clock: Optional[VirtualClock] = None):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"Unknown cassette mode '{mode}'")
+        self.path = path
+        self.mode = mode
+        self.strict = strict
+        self.clock = clock
+        self._by_key: Dict[str, List[Dict[str, Any]]] = {}
+        self._by_route: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursors: Dict[str, int] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if mode == RECORD:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(path, 'w')
+        else:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        self._index(json.loads(line))
+            logger.info(f"Loaded {sum(len(v) for v in self._by_key.values())} recorded calls from {path}")
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == REPLAY
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    @staticmethod
+    def _key(service: str, request: Mapping[str, Any]) -> str:
+        return f"{service} {json.dumps(canonical(request), sort_keys=True)}"
+
+    def _index(self, interaction: Dict[str, Any]) -> None:
+        self._by_key.setdefault(self._key(interaction["service"], interaction["request"]), []).append(interaction)
+        if interaction.get("route"):
+            self._by_route.setdefault(f"{interaction['service']} {interaction['route']}", []).append(interaction)
+
+    def _count(self, service: str, outcome: str) -> None:
+        counts = self._stats.setdefault(service, {})
+        counts[outcome] = counts.get(outcome, 0) + 1
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Calls per service: recorded, or replayed exactly, by route (fallback) or missed."""
+        with self._lock:
+            return {service: dict(counts) for service, counts in self._stats.items()}
+
+    def record(self, service: str, route: Optional[str], request: Mapping[str, Any],
+               response: Any = None, error: Optional[BaseException] = None, latency: float = 0.0) -> None:
+        """Append one call to the cassette file, with secrets in URLs redacted."""
+        interaction = {"service": service, "route": route, "request": canonical(request),
+                       "latency": round(latency, 4)}
+        if error is not None:
+            code = getattr(error, 'code', None)
+            interaction["error"] = {"type": type(error).__name__, "message": str(error),
+                                    "code": code if isinstance(code, int) else None}
+        else:
+            interaction["response"] = response
+        # Error messages and responses can quote a request URL with its token
+        line = redact(json.dumps(interaction))
+        with self._lock:
+            self._count(service, 'recorded')
+            if self._file is not None:
+                self._file.write(line + '\n')
+                self._file.flush()
+
+    def play(self, service: str, route: Optional[str], request: Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        The next recorded interaction for a request.
+
+        Raises:
+            CassetteMiss: Nothing recorded for the request (or its route, unless strict)
+        """
+        key = self._key(service, request)
+        with self._lock:
+            recorded = self._by_key.get(key)
+            if recorded:
+                position = self._cursors.get(key, 0)
+                self._cursors[key] = position + 1
+                self._count(service, 'exact')
+                interaction = recorded[min(position, len(recorded) - 1)]
+            else:
+                route_key = f"{service} {route}"
+                recorded = None if self.strict or not route else self._by_route.get(route_key)
+                if not recorded:
+                    self._count(service, 'missed')
+                    raise CassetteMiss(f"No recorded {service} response for {key[:300]}")
+                position = self._cursors.get(route_key, 0)
+                self._cursors[route_key] = position + 1
+                self._count(service, 'fallback')
+                interaction = recorded[position % len(recorded)]
+        if self.clock is not None:
+            self.clock.sleep(interaction.get("latency", 0.0))
+        return interaction
+
+    def call(self, service: str, route: Optional[str], request: Mapping[str, Any], func: Callable[[], Any],
+             encode: Callable[[Any], Any] = lambda value: value,
+             decode: Callable[[Any], Any] = lambda value: value) -> Any:
+        """
+        Make a live call and record it, or replay it.
+
+        Args:
+            service: 'storage', 'gemini' or 'instagram'
+            route: Coarse request identity used when no exact match was
+                recorded; None to replay exact matches only
+            request: What identifies the call; bytes are stored as digests
+            func: Makes the live call
+            encode: Turns the live result into JSON for the cassette
+            decode: Turns the recorded JSON back into a result
+
+        Raises:
+            ReplayedError: The recorded call failed
+            CassetteMiss: Nothing recorded for a replayed request
+        """
+        if self.replaying:
+            interaction = self.play(service, route, request)
+            if "error" in interaction:
+                error = interaction["error"]
+                raise ReplayedError(error["message"], error["type"], error.get("code"))
+            return decode(interaction["response"])
+        started = time.perf_counter()
+        try:
+            result = func()
+        except Exception as e:
+            self.record(service, route, request, error=e, latency=time.perf_counter() - started)
+            raise
+        self.record(service, route, request, encode(result), latency=time.perf_counter() - started)
+        return result
+
+    def bucket(self, bucket=None, name: str = '') -> 'CassetteBucket':
+        """Storage bucket whose calls are recorded (``bucket`` is the live one) or replayed."""
+        return CassetteBucket(self, bucket, name or getattr(bucket, 'name', ''))
+
+    def model(self, model=None) -> 'CassetteModel':
+        """Gemini model whose calls are recorded (``model`` is the live one) or replayed."""
+        return CassetteModel(self, model)
+
+    def session(self) -> 'CassetteSession':
+        """HTTP session for the Graph API client."""
+        return CassetteSession(self)
+
+    def fetch(self, url: str, func: Callable[[], bytes]) -> bytes:
+        """Image bytes fetched over HTTP."""
+        return self.call('storage', 'fetch', {"op": "fetch", "url": url}, func,
+                         encode=encode_bytes, decode=decode_bytes)
+
+
+def blob_fields(blob) -> Optional[Dict[str, Any]]:
+    """The fields of a blob the app reads, as JSON."""
+    if blob is None:
+        return None
+    fields = {name: getattr(blob, name, None) for name in BLOB_FIELDS}
+    updated = getattr(blob, 'updated', None)
+    fields["updated"] = updated.timestamp() if updated is not None else None
+    return fields
+
+
+class CassetteBlob:
+    """A blob handle whose calls go through the cassette; attributes come from the live blob or the recording."""
+
+    def __init__(self, bucket: 'CassetteBucket', name: str, blob=None, fields: Optional[Dict[str, Any]] = None):
+        self._bucket = bucket
+        self._cassette = bucket.cassette
+        self._blob = blob
+        self._fields = dict(fields or {})
+        self._fields.setdefault("name", name)
+        self._fields.setdefault("public_url",
+                                f"https://storage.googleapis.com/{bucket.name}/{quote(name, safe='/~')}")
+
+    def __getattr__(self, attribute: str) -> Any:
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        if self._blob is not None:
+            return getattr(self._blob, attribute)
+        if attribute == 'updated':
+            updated = self._fields.get("updated")
+            return datetime.fromtimestamp(updated, timezone.utc) if updated is not None else None
+        if attribute in self._fields or attribute in BLOB_FIELDS:
+            return self._fields.get(attribute)
+        raise AttributeError(attribute)
+
+    def _call(self, op: str, func: Callable[[], Any], route: Optional[str] = None, **encoding) -> Any:
+        request = {"op": op, "bucket": self._bucket.name, "name": self._fields["name"]}
+        return self._cassette.call('storage', route, request, func, **encoding)
+
+    def exists(self, *args, **kwargs) -> bool:
+        return bool(self._call('exists', lambda: self._blob.exists(*args, **kwargs)))
+
+    def reload(self, *args, **kwargs) -> None:
+        def reload():
+            self._blob.reload(*args, **kwargs)
+            return self._blob
+        fields = self._call('reload', reload, encode=blob_fields)
+        if self._blob is None:
+            self._fields.update(fields or {})
+
+    def download_as_bytes(self, *args, **kwargs) -> bytes:
+        return self._call('download', lambda: self._blob.download_as_bytes(*args, **kwargs),
+                          route='download', encode=encode_bytes, decode=decode_bytes)
+
+    def download_to_filename(self, filename: str, *args, **kwargs) -> None:
+        data = self.download_as_bytes(*args, **kwargs)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def upload_from_filename(self, filename: str, *args, **kwargs) -> None:
+        def upload():
+            self._blob.upload_from_filename(filename, *args, **kwargs)
+            return self._blob
+        fields = self._call('upload', upload, route='upload', encode=blob_fields)
+        if self._blob is None:
+            # The recorded fields describe some other upload; keep this blob's name
+            self._fields.update({k: v for k, v in (fields or {}).items() if k not in ("name", "public_url")})
+
+
+class _Listing:
+    """Result of ``list_blobs`` through the cassette: pages, prefixes and the page token."""
+
+    def __init__(self, bucket: 'CassetteBucket', options: Dict[str, Any]):
+        self.bucket = bucket
+        self.options = options
+        self.prefixes = set()
+        self.next_page_token = None
+
+    @property
+    def pages(self) -> Iterator[List[CassetteBlob]]:
+        cassette = self.bucket.cassette
+        live = None if cassette.replaying else self.bucket.live.list_blobs(**self.options)
+        live_pages = iter(live.pages) if live is not None else None
+        options = {k: v for k, v in self.options.items() if v is not None}
+        # Set when a listing from an unrecorded offset is served from the full recorded listing
+        offset = None
+        number = 0
+        while True:
+            request = {"op": "list_blobs", "bucket": self.bucket.name, "page": number, **options}
+
+            def next_page():
+                page = next(live_pages, None)
+                return None if page is None else (list(page), set(live.prefixes), live.next_page_token)
+
+            def encode(page):
+                if page is None:
+                    return None
+                blobs, prefixes, token = page
+                return {"blobs": [blob_fields(blob) for blob in blobs], "prefixes": sorted(prefixes),
+                        "next_page_token": token}
+
+            try:
+                page = cassette.call('storage', None, request, next_page, encode=encode)
+            except CassetteMiss:
+                if number == 0 and options.get("start_offset") and not self.bucket.cassette.strict:
+                    # Resumed listings start where the recording never did; GCS would
+                    # return the same blobs from that name on
+                    offset = options.pop("start_offset")
+                    continue
+                if number == 0:
+                    raise
+                # The recording stopped listing here
+                return
+            if page is None:
+                return
+            if cassette.replaying:
+                blobs = [CassetteBlob(self.bucket, fields["name"], fields=fields) for fields in page["blobs"]
+                         if offset is None or fields["name"] >= offset]
+                prefixes, token = page["prefixes"], page["next_page_token"]
+            else:
+                raw, prefixes, token = page
+                blobs = [CassetteBlob(self.bucket, blob.name, blob=blob) for blob in raw]
+            self.prefixes.update(prefixes)
+            self.next_page_token = token
+            yield blobs
+            number += 1
+            if cassette.replaying and token is None:
+                return
+
+    def __iter__(self) -> Iterator[CassetteBlob]:
+        for page in self.pages:
+            yield from page
+
+
+class CassetteBucket:
+    """
+    Storage bucket recording to or replaying from a cassette.
+
+    Args:
+        cassette: Cassette to use
+        live: The live bucket while recording, None while replaying
+        name: Bucket name
+    """
+
+    def __init__(self, cassette: Cassette, live=None, name: str = ''):
+        self.cassette = cassette
+        self.live = live
+        self.name = name
+
+    def list_blobs(self, **options) -> _Listing:
+        return _Listing(self, options)
+
+    def get_blob(self, name: str, *args, **kwargs) -> Optional[CassetteBlob]:
+        request = {"op": "get_blob", "bucket": self.name, "name": name}
+        result = self.cassette.call('storage', None, request, lambda: self.live.get_blob(name, *args, **kwargs),
+                                    encode=blob_fields)
+        if result is None:
+            return None
+        if self.cassette.replaying:
+            return CassetteBlob(self, name, fields=result)
+        return CassetteBlob(self, name, blob=result)
+
+    def blob(self, name: str, *args, **kwargs) -> CassetteBlob:
+        # Creating a handle makes no request
+        if self.cassette.replaying:
+            return CassetteBlob(self, name)
+        return CassetteBlob(self, name, blob=self.live.blob(name, *args, **kwargs))
+
+
+class _Response:
+    """Replayed Gemini response."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class CassetteModel:
+    """Gemini model recording to or replaying from a cassette."""
+
+    def __init__(self, cassette: Cassette, live=None):
+        self.cassette = cassette
+        self.live = live
+
+    @staticmethod
+    def _request(contents, kwargs) -> Tuple[str, Dict[str, Any]]:
+        parts = contents if isinstance(contents, (list, tuple)) else [contents]
+        images = sum(1 for part in parts if not isinstance(part, str))
+        # A batch response only fits a request with as many images
+        return f"generate_content/{images}", {"contents": contents, **kwargs}
+
+    def generate_content(self, contents, **kwargs):
+        route, request = self._request(contents, kwargs)
+        return self.cassette.call('gemini', route, request,
+                                  lambda: self.live.generate_content(contents, **kwargs),
+                                  encode=lambda response: {"text": response.text},
+                                  decode=lambda response: _Response(response["text"]))
+
+    async def generate_content_async(self, contents, **kwargs):
+        if self.cassette.replaying or not hasattr(self.live, 'generate_content_async'):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, functools.partial(self.generate_content, contents, **kwargs))
+        route, request = self._request(contents, kwargs)
+        started = time.perf_counter()
+        try:
+            response = await self.live.generate_content_async(contents, **kwargs)
+        except Exception as e:
+            self.cassette.record('gemini', route, request, error=e, latency=time.perf_counter() - started)
+            raise
+        self.cassette.record('gemini', route, request, {"text": response.text},
+                             latency=time.perf_counter() - started)
+        return response
+
+
+class CassetteSession:
+    """
+    Stand-in for the Graph API client's ``requests.Session``.
+
+    Access tokens are left out of what is recorded and matched.
+    """
+
+    def __init__(self, cassette: Cassette):
+        self.cassette = cassette
+        self.live = None
+        if not cassette.replaying:
+            import requests
+            self.live = requests.Session()
+
+    def mount(self, prefix: str, adapter) -> None:
+        if self.live is not None:
+            self.live.mount(prefix, adapter)
+
+    def close(self) -> None:
+        if self.live is not None:
+            self.live.close()
+
+    def request(self, method: str, url: str, params: Optional[Dict[str, Any]] = None,
+                data: Optional[Dict[str, Any]] = None, **kwargs):
+        import requests
+
+        path = urlsplit(url).path
+        request = {"method": method, "path": path,
+                   "params": {k: v for k, v in (params or {}).items() if k not in SECRET_FIELDS},
+                   "data": {k: v for k, v in (data or {}).items() if k not in SECRET_FIELDS}}
+
+        def encode(response):
+            return {"status": response.status_code, "headers": dict(response.headers), "body": response.text}
+
+        def decode(recorded):
+            response = requests.Response()
+            response.status_code = recorded["status"]
+            response.headers.update(recorded["headers"])
+            response._content = recorded["body"].encode('utf-8')
+            response.encoding = 'utf-8'
+            response.url = url
+            return response
+
+        try:
+            return self.cassette.call('instagram', f"{method} {path}", request,
+                                      lambda: self.live.request(method, url, params=params, data=data, **kwargs),
+                                      encode=encode, decode=decode)
+        except ReplayedError as e:
+            # Network failures replay as network failures, so retries behave as they did live
+            if e.error_type.endswith('Timeout'):
+                raise requests.Timeout(str(e))
+            if e.error_type.endswith('ConnectionError'):
+                raise requests.ConnectionError(str(e))
+            raise
+
+
+# (section, key) -> file name of the SQLite state each replay gets a fresh copy of
+STATE_PATHS = {
+    ('history', 'path'): 'history.sqlite3',
+    ('jobs', 'path'): 'jobs.sqlite3',
+    ('caption_cache', 'path'): 'captions.sqlite3',
+    ('near_duplicates', 'path'): 'phash.sqlite3',
+    ('preprocess', 'index_path'): 'derived.sqlite3',
+    ('planner', 'path'): 'engagement.sqlite3',
+    ('quota', 'path'): 'quota.sqlite3',
+}
+# Only moved when configured: without them the app lists the bucket directly
+OPTIONAL_STATE_PATHS = {
+    ('cloud_storage', 'manifest_path'): 'manifest.sqlite3',
+    ('cloud_storage', 'catalog_path'): 'catalog.bin',
+}
+
+
+def thaw(value: Any) -> Any:
+    """Mutable copy of a frozen config (see settings.freeze)."""
+    if isinstance(value, Mapping):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+def sandbox_config(config: Mapping[str, Any], directory: str) -> Dict[str, Any]:
+    """The config with every state file moved into ``directory`` and the mirror turned off."""
+    config = thaw(config)
+    for (section, key), name in list(STATE_PATHS.items()) + list(OPTIONAL_STATE_PATHS.items()):
+        values = config.setdefault(section, {})
+        if (section, key) in STATE_PATHS or values.get(key):
+            values[key] = os.path.join(directory, name)
+    thumbnails = config.setdefault('gemini', {}).setdefault('thumbnails', {})
+    thumbnails['path'] = os.path.join(directory, 'thumbnails')
+    config.pop('mirror', None)
+    return config
+
+
+@contextlib.contextmanager
+def sandbox(cassette: Cassette, clock: VirtualClock, monotonic: bool = False) -> Iterator[str]:
+    """
+    Run the app against ``cassette`` on ``clock``, with throwaway state files.
+
+    Yields:
+        The temporary directory holding the state files
+    """
+    from src import main
+    from src.settings import build_settings
+
+    directory = tempfile.mkdtemp(prefix='zmaninstaposter-replay-')
+    # Environment overrides are already part of the current config
+    settings = build_settings(sandbox_config(main.get_settings().raw, directory), {})
+    try:
+        with clock.installed(monotonic=monotonic):
+            main.use_settings(settings)
+            main.use_cassette(cassette)
+            try:
+                yield directory
+            finally:
+                main.use_settings(None)
+                main.use_cassette(None)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def simulate(cassette: Cassette, days: int = 30, start: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Run ``days`` of scheduled posting rounds through the job queue against a cassette.
+
+    Jobs run as soon as they are due; between jobs the virtual clock jumps
+    to the next due time. Replayed latencies advance the clock too, so the
+    simulated timeline matches the recorded service speeds.
+
+    Returns:
+        Posts per account and day, job outcomes, cassette statistics and
+        simulated versus wall-clock time
+    """
+    from src import main
+    from src.jobs import JobRunner
+
+    clock = VirtualClock(start)
+    cassette.clock = clock
+    wall_started = time.perf_counter()
+    with sandbox(cassette, clock, monotonic=True):
+        queue = main.get_job_queue()
+        runner = JobRunner(queue, main.JOB_HANDLERS)
+        started = clock.time()
+        end = started + days * DAY
+        main.schedule_round(queue)
+        jobs_run = 0
+        while True:
+            jobs_run += runner.run_pending()
+            due = queue.next_due_at()
+            if due is None or due >= end:
+                break
+            clock.advance_to(due)
+        clock.advance_to(end)
+        posts: Dict[str, List[float]] = {}
+        for context in main.get_account_dispatcher().contexts:
+            posts[context.name] = [post["posted_at"] for post in context.engine.history.posted_since(started)]
+        job_counts = queue.counts()
+
+    per_day = [0] * days
+    for times in posts.values():
+        for posted_at in times:
+            per_day[min(days - 1, int((posted_at - started) // DAY))] += 1
+    wall = time.perf_counter() - wall_started
+    return {
+        "days": days,
+        "posts": sum(per_day),
+        "posts_by_account": {name: len(times) for name, times in posts.items()},
+        "posts_per_day": per_day,
+        "days_without_posts": sum(1 for count in per_day if count == 0),
+        "jobs_run": jobs_run,
+        "jobs": job_counts,
+        "calls": cassette.stats(),
+        "simulated_seconds": round(end - started, 1),
+        "wall_seconds": round(wall, 3),
+        "speedup": round((end - started) / wall) if wall else None,
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """Human-readable summary of a simulation."""
+    lines = [f"Simulated {report['days']} days in {report['wall_seconds']:.2f}s (x{report['speedup']})",
+             f"Posts: {report['posts']} "
+             f"({', '.join(f'{name}: {count}' for name, count in report['posts_by_account'].items())})",
+             f"Days without posts: {report['days_without_posts']}",
+             f"Jobs: {report['jobs_run']} run; "
+             f"{', '.join(f'{status}: {count}' for status, count in sorted(report['jobs'].items()))}"]
+    for service, counts in sorted(report['calls'].items()):
+        lines.append(f"{service} calls: {', '.join(f'{k}: {v}' for k, v in sorted(counts.items()))}")
+    return '\n'.join(lines)
+
+
+def _run_round() -> None:
+    """Run one posting round through the job queue right away, as the scheduler would."""
+    from src import main
+    from src.jobs import JobRunner
+
+    queue = main.get_job_queue()
+    round_key = datetime.fromtimestamp(queue.clock()).strftime('%Y-%m-%d')
+    queue.enqueue(main.ROUND_JOB, {"round": round_key}, dedup_key=f"{main.ROUND_JOB}:{round_key}")
+    runner = JobRunner(queue, main.JOB_HANDLERS)
+    while runner.run_pending():
+        pass
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Record, replay or simulate: ``python -m src.replay {record|replay|simulate} CASSETTE``."""
+    parser = argparse.ArgumentParser(description="Record, replay and simulate posting runs")
+    commands = parser.add_subparsers(dest='command', required=True)
+    record = commands.add_parser('record', help="Post for real and record every service call")
+    record.add_argument('cassette')
+    record.add_argument('--round', action='store_true',
+                        help="Post through the job queue (what simulate replays) instead of workflow()")
+    replay = commands.add_parser('replay', help="Run workflow() against a recording")
+    replay.add_argument('cassette')
+    replay.add_argument('--strict', action='store_true', help="Fail on requests not recorded exactly")
+    simulation = commands.add_parser('simulate', help="Simulate days of scheduled posting")
+    simulation.add_argument('cassette')
+    simulation.add_argument('--days', type=int, default=30)
+    simulation.add_argument('--start', help="Simulated start, e.g. 2024-06-01T08:00 (default: now)")
+    simulation.add_argument('--strict', action='store_true', help="Fail on requests not recorded exactly")
+    simulation.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    from src import main as app
+    app.configure_logging()
+
+    if args.command == 'record':
+        cassette = Cassette(args.cassette, RECORD)
+        app.use_cassette(cassette)
+        try:
+            _run_round() if args.round else app.workflow()
+        finally:
+            app.use_cassette(None)
+            cassette.close()
+        print(f"Recorded {cassette.stats()} to {args.cassette}")
+        return 0
+
+    cassette = Cassette(args.cassette, REPLAY, strict=args.strict)
+    if args.command == 'replay':
+        clock = VirtualClock()
+        cassette.clock = clock
+        # workflow() runs on asyncio, so monotonic time stays real
+        with sandbox(cassette, clock):
+            app.workflow()
+        print(f"Replayed calls: {cassette.stats()}")
+        return 0
+
+    start = datetime.fromisoformat(args.start).timestamp() if args.start else None
+    report = simulate(cassette, days=args.days, start=start)
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,466 @@
+"""
+Circuit breakers, adaptive concurrency limits and hedged retries for
+calls to external services.
+
+Each dependency (Cloud Storage, Gemini, the Graph API) gets one Endpoint.
+Every call to the dependency goes through the Endpoint, which:
+
+- fails fast with CircuitOpenError while the dependency is failing. The
+  circuit opens after a run of consecutive failures, or when most recent
+  calls have failed. After ``reset_timeout`` a single probe call is let
+  through, and its outcome closes or reopens the circuit.
+- limits the calls in flight with an AIMD limit. The limit grows by about
+  one for each limit's worth of successful calls, and halves on an
+  overload failure (timeouts, connection errors, 429 and 5xx) or when a
+  call is slower than ``latency_target``. A call that cannot get a slot
+  within ``max_wait`` seconds is shed with ConcurrencyLimitExceeded
+  instead of queueing behind a struggling dependency.
+- retries failed idempotent calls with decorrelated jittered backoff, but
+  only while a retry budget (a fraction of recent calls) lasts, so retries
+  cannot multiply the load on a dependency that is already down.
+- hedges slow idempotent calls. When a call has not finished by the
+  endpoint's recent ``hedge_percentile`` latency, a second copy is sent if
+  a concurrency slot is free, and the first response wins.
+
+Errors that say nothing about the dependency's health (404, bad input) pass
+straight through and count as successful calls.
+"""
+
+import random
+import threading
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Optional, Any, Callable, TypeVar
+
+from src.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+OVERLOAD_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class DependencyUnavailable(Exception):
+    """A call was rejected without reaching the dependency."""
+
+    def __init__(self, endpoint: str, message: str, retry_after: float = 0.0):
+        super().__init__(f"{endpoint}: {message}")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(DependencyUnavailable):
+    """The endpoint's circuit is open."""
+
+
+class ConcurrencyLimitExceeded(DependencyUnavailable):
+    """No concurrency slot became free in time; the call was shed."""
+
+
+def status_of(error: BaseException) -> Optional[int]:
+    """HTTP status carried by an exception from requests, google-api-core or the Graph client."""
+    for value in (getattr(error, 'status_code', None), getattr(error, 'code', None),
+                  getattr(getattr(error, 'response', None), 'status_code', None)):
+        value = getattr(value, 'value', value)
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    return None
+
+
+def is_failure(error: BaseException) -> bool:
+    """
+    Whether an error means the dependency is unhealthy or overloaded.
+
+    Timeouts and connection errors (requests' exceptions are OSErrors too),
+    429 and 5xx count; client errors such as 404 or a rejected payload do not.
+    """
+    if isinstance(error, DependencyUnavailable):
+        return False
+    status = status_of(error)
+    if status is not None:
+        return status in OVERLOAD_STATUS_CODES
+    return isinstance(error, (OSError, TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open circuit breaker.
+
+    Args:
+        name: Endpoint name, used in errors, logs and metrics
+        failure_threshold: Consecutive failures that open the circuit
+        failure_rate: Failure ratio over the last ``window`` calls that opens it
+        window: Calls the failure ratio is computed over (and the minimum
+            number of calls before the ratio applies)
+        reset_timeout: Seconds the circuit stays open before a probe call
+        clock: Monotonic clock (injectable for tests)
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, failure_rate: float = 0.5,
+                 window: int = 20, reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        """Seconds until an open circuit lets a probe through."""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - self.clock())
+
+    def allow(self) -> None:
+        """
+        Admit a call or reject it.
+
+        Raises:
+            CircuitOpenError: The circuit is open, or half-open with the probe in flight
+        """
+        with self._lock:
+            if self.state == OPEN:
+                if self.clock() - self._opened_at < self.reset_timeout:
+                    raise CircuitOpenError(self.name, "circuit open", self.retry_after())
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpenError(self.name, "circuit half-open, probe in flight",
+                                           self.reset_timeout)
+                self._probing = True
+
+    def cancel(self) -> None:
+        """Forget an admitted call that was not made, freeing the half-open probe."""
+        with self._lock:
+            self._probing = False
+
+    def record(self, failed: bool) -> None:
+        with self._lock:
+            self._probing = False
+            if self.state == HALF_OPEN:
+                self._transition(OPEN if failed else CLOSED)
+                return
+            self._outcomes.append(failed)
+            self.consecutive_failures = self.consecutive_failures + 1 if failed else 0
+            if self.state == CLOSED and failed and (
+                    self.consecutive_failures >= self.failure_threshold
+                    or (len(self._outcomes) == self._outcomes.maxlen
+                        and sum(self._outcomes) >= self.failure_rate * len(self._outcomes))):
+                self._transition(OPEN)
+
+    def _transition(self, state: str) -> None:
+        if state == OPEN:
+            self._opened_at = self.clock()
+        if state != HALF_OPEN:
+            self._outcomes.clear()
+            self.consecutive_failures = 0
+        log = logger.warning if state == OPEN else logger.info
+        log(f"Circuit for {self.name} {self.state} -> {state}")
+        self.state = state
+        REGISTRY.set('circuit_open', 1 if state == OPEN else 0, endpoint=self.name)
+        REGISTRY.event(event='circuit', endpoint=self.name, state=state)
+
+
+class AdaptiveLimiter:
+    """
+    Additive-increase/multiplicative-decrease limit on calls in flight.
+
+    Args:
+        name: Endpoint name
+        initial: Starting limit
+        min_limit: The limit never drops below this
+        max_limit: The limit never grows above this
+        backoff_ratio: Factor the limit is multiplied by on overload
+        latency_target: Seconds; slower successful calls count as overload
+    """
+
+    def __init__(self, name: str, initial: float = 4, min_limit: float = 1, max_limit: float = 32,
+                 backoff_ratio: float = 0.5, latency_target: Optional[float] = None):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_target = latency_target
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self._available = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """Take a slot, waiting up to ``timeout`` seconds (None waits forever)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._available:
+            while self.in_flight >= int(self.limit):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._available.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, latency: Optional[float] = None, overloaded: bool = False) -> None:
+        """Return a slot and adapt the limit to how the call went."""
+        with self._available:
+            self.in_flight -= 1
+            if overloaded or (latency is not None and self.latency_target is not None
+                              and latency > self.latency_target):
+                self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+            elif latency is not None:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            REGISTRY.set('concurrency_limit', self.limit, endpoint=self.name)
+            self._available.notify_all()
+
+
+class Endpoint:
+    """
+    Resilient access to one external dependency.
+
+    Args:
+        name: Dependency name, e.g. ``gemini``
+        failure_threshold, failure_rate, window, reset_timeout: See CircuitBreaker
+        initial_concurrency, min_concurrency, max_concurrency, latency_target:
+            See AdaptiveLimiter
+        max_wait: Seconds a call waits for a concurrency slot before it is shed
+        retries: Extra attempts for failed idempotent calls
+        retry_budget: Retries allowed per call made, averaged over recent calls
+        base_delay: Smallest backoff between retries, in seconds
+        max_delay: Largest backoff between retries, in seconds
+        hedge: Send a second copy of slow idempotent calls
+        hedge_percentile: Latency percentile after which a call is hedged
+        min_hedge_delay: Never hedge calls faster than this, in seconds
+        clock: Monotonic clock for the breaker (injectable for tests)
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, failure_rate: float = 0.5,
+                 window: int = 20, reset_timeout: float = 30.0,
+                 initial_concurrency: float = 4, min_concurrency: float = 1,
+                 max_concurrency: float = 32, latency_target: Optional[float] = None,
+                 max_wait: Optional[float] = 30.0, retries: int = 2, retry_budget: float = 0.2,
+                 base_delay: float = 0.5, max_delay: float = 10.0, hedge: bool = False,
+                 hedge_percentile: float = 95, min_hedge_delay: float = 0.05,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.breaker = CircuitBreaker(name, failure_threshold, failure_rate, window, reset_timeout, clock)
+        self.limiter = AdaptiveLimiter(name, initial_concurrency, min_concurrency, max_concurrency,
+                                       latency_target=latency_target)
+        self.max_wait = max_wait
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self._retry_tokens = 10.0
+        self._latencies = deque(maxlen=200)
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._closed = False
+
+    def close(self) -> None:
+        """Shut down the hedging threads; calls made afterwards are no longer hedged."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._closed = True
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    # -- single attempts ---------------------------------------------------
+
+    def _admit(self, wait_for_slot: bool = True) -> None:
+        try:
+            self.breaker.allow()
+        except CircuitOpenError:
+            REGISTRY.inc('resilience_rejected_total', endpoint=self.name, reason='circuit_open')
+            raise
+        if not self.limiter.acquire(self.max_wait if wait_for_slot else 0):
+            self.breaker.cancel()
+            REGISTRY.inc('resilience_rejected_total', endpoint=self.name, reason='overloaded')
+            raise ConcurrencyLimitExceeded(self.name, f"{self.limiter.in_flight} calls in flight",
+                                           self.base_delay)
+
+    def _finish(self, started: float, error: Optional[BaseException]) -> None:
+        latency = time.monotonic() - started
+        failed = error is not None and is_failure(error)
+        self.breaker.record(failed)
+        self.limiter.release(None if failed else latency, overloaded=failed)
+        if not failed:
+            with self._lock:
+                self._latencies.append(latency)
+
+    def attempt(self) -> '_Attempt':
+        """
+        Guard one attempt made by the caller, e.g. one HTTP request:
+
+            with endpoint.attempt() as attempt:
+                response = session.get(url)
+                if response.status_code >= 500:
+                    attempt.fail(response.status_code)
+
+        Raises:
+            DependencyUnavailable: The attempt was rejected
+        """
+        return _Attempt(self)
+
+    def _run(self, func: Callable[[], T], wait_for_slot: bool = True) -> T:
+        self._admit(wait_for_slot)
+        started = time.monotonic()
+        try:
+            result = func()
+        except BaseException as e:
+            self._finish(started, e)
+            raise
+        self._finish(started, None)
+        return result
+
+    # -- calls with retries and hedging ------------------------------------
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds after which a call is hedged, or None before enough calls were seen."""
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return max(self.min_hedge_delay, ordered[index])
+
+    def _hedged(self, func: Callable[[], T]) -> T:
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._run(func)
+        executor = self._executor
+        if executor is None:
+            with self._lock:
+                if self._executor is None and not self._closed:
+                    self._executor = ThreadPoolExecutor(max_workers=int(self.limiter.max_limit) * 2,
+                                                        thread_name_prefix=f'hedge-{self.name}')
+                executor = self._executor
+        try:
+            if executor is None:
+                raise RuntimeError("endpoint closed")
+            primary = executor.submit(self._run, func)
+        except RuntimeError:
+            # Closed, e.g. replaced by a settings reload while this call started
+            return self._run(func)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        try:
+            # Only hedge with spare capacity; never wait for a slot
+            hedge = executor.submit(self._run, func, False)
+        except RuntimeError:
+            return primary.result()
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    REGISTRY.inc('resilience_hedges_total', endpoint=self.name,
+                                 winner='hedge' if future is hedge else 'primary')
+                    return future.result()
+            if not pending:
+                # Both failed (or the hedge found no free slot): report the original call's error
+                return primary.result()
+
+    def _backoff(self, previous: float) -> float:
+        # Decorrelated jitter: spreads retries out without synchronising clients
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+
+    def call(self, func: Callable[[], T], idempotent: bool = True,
+             hedge: Optional[bool] = None) -> T:
+        """
+        Call ``func`` through the breaker and limiter, retrying and hedging idempotent calls.
+
+        Args:
+            func: Zero-argument callable making the request
+            idempotent: Whether repeating the call is harmless
+            hedge: Override the endpoint's hedging for this call, e.g. False
+                for a download two copies of which would write the same file
+
+        Returns:
+            Whatever ``func`` returns
+
+        Raises:
+            DependencyUnavailable: The call was rejected without being made
+            Exception: The last error raised by ``func``
+        """
+        with self._lock:
+            self._retry_tokens = min(10.0, self._retry_tokens + self.retry_budget)
+        if hedge is None:
+            hedge = self.hedge
+        delay = self.base_delay
+        attempt = 0
+        while True:
+            try:
+                if idempotent and hedge:
+                    return self._hedged(func)
+                return self._run(func)
+            except DependencyUnavailable:
+                raise
+            except Exception as e:
+                if not idempotent or attempt >= self.retries or not is_failure(e):
+                    raise
+                with self._lock:
+                    if self._retry_tokens < 1:
+                        REGISTRY.inc('resilience_retries_total', endpoint=self.name, outcome='no_budget')
+                        raise
+                    self._retry_tokens -= 1
+                REGISTRY.inc('resilience_retries_total', endpoint=self.name, outcome='retried')
+                delay = self._backoff(delay)
+                logger.warning(f"{self.name} call failed ({e}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+
+class _Attempt:
+    """Context manager returned by Endpoint.attempt()."""
+
+    def __init__(self, endpoint: Endpoint):
+        self.endpoint = endpoint
+        self.failed = False
+        self.started = 0.0
+
+    def fail(self, status: Any = None) -> None:
+        """Count this attempt as a failure of the dependency, e.g. after a 503 response."""
+        self.failed = True
+
+    def __enter__(self) -> '_Attempt':
+        self.endpoint._admit()
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        if exc is None and self.failed:
+            exc = ConnectionError(f"{self.endpoint.name} attempt failed")
+        self.endpoint._finish(self.started, exc)
+        return False
+
+
+class _Unguarded:
+    """Stand-in for _Attempt when there is no endpoint to guard."""
+
+    def fail(self, status: Any = None) -> None:
+        pass
+
+    def __enter__(self) -> '_Unguarded':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+def guarded(endpoint: Optional[Endpoint]) -> Any:
+    """Return ``endpoint.attempt()``, or a context manager doing nothing when ``endpoint`` is None."""
+    return endpoint.attempt() if endpoint is not None else _Unguarded()
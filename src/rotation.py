@@ -0,0 +1,390 @@
+"""
+Image rotation strategies for select_image.
+
+A selection engine combines a candidate source (the bucket manifest, a lazy
+bucket listing when no manifest is configured, or an in-memory list of
+placeholders) with the posted-history ledger and a pluggable strategy:
+
+- ``oldest_unposted``: oldest images first, resuming from a persisted
+  watermark so already-posted images at the head are not rescanned. A lazy
+  bucket listing has no age order, so there it goes through the images in
+  name order instead (with a warning); configure a manifest or catalog for
+  true oldest-first rotation
+- ``weighted_random``: random picks by rowid, weighted by folder
+- ``round_robin_folder``: cycle through top-level folders (themes), taking
+  the oldest unposted image from each in turn
+
+Eligibility is an indexed history lookup by blob name and content hash, so
+the cost of a selection does not grow with the size of the history.
+"""
+
+import bisect
+import itertools
+import json
+import random
+import logging
+from typing import Optional, List, Dict, Any, Iterator, Iterable, Callable
+
+from src.history import PostedHistory
+from src.manifest import BlobRecord, ROOT_SHARD, shard_of
+
+logger = logging.getLogger(__name__)
+
+
+class InMemorySource:
+    """
+    Candidate source over an in-memory list of records.
+
+    Used for placeholder images and buckets without a manifest; it offers the
+    same query surface as BucketManifest.
+    """
+
+    orders = ('name', 'updated')
+
+    def __init__(self, records: Iterable[BlobRecord],
+                 folder_fn: Callable[[str], str] = shard_of):
+        self._records = list(records)
+        self._folder_fn = folder_fn
+        self._by_key = {
+            'name': sorted(self._records, key=lambda r: r.name),
+            'updated': sorted(self._records, key=lambda r: (r.updated, r.name)),
+        }
+        # Keyset values matching BucketManifest.iter_records(start_after=...)
+        self._keys = {
+            'name': [(r.name, r.name) for r in self._by_key['name']],
+            'updated': [(r.updated, r.name) for r in self._by_key['updated']],
+        }
+
+    @classmethod
+    def from_urls(cls, urls: Iterable[str]) -> 'InMemorySource':
+        """Wrap bare image URLs; the URL doubles as the blob identity."""
+        records = [BlobRecord(url, 0, 0, '', '', url, 0.0) for url in urls]
+        return cls(records, folder_fn=lambda _: ROOT_SHARD)
+
+    def folder_of(self, name: str) -> str:
+        return self._folder_fn(name)
+
+    def folders(self) -> List[str]:
+        return sorted({self._folder_fn(r.name) for r in self._records})
+
+    def iter_records(self, prefix: Optional[str] = None, order_by: str = 'name',
+                     shard: Optional[str] = None, start_after: Optional[tuple] = None,
+                     batch_size: int = 500) -> Iterator[BlobRecord]:
+        ordered = self._by_key[order_by]
+        start = 0
+        if start_after:
+            start = bisect.bisect_right(self._keys[order_by], tuple(start_after))
+        for record in ordered[start:]:
+            if prefix and not record.name.startswith(prefix):
+                continue
+            if shard is not None and self._folder_fn(record.name) != shard:
+                continue
+            yield record
+
+    def sample(self, k: int, rng: Optional[random.Random] = None) -> List[BlobRecord]:
+        rng = rng or random
+        return rng.sample(self._records, min(k, len(self._records)))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
+class StreamingSource:
+    """
+    Candidate source that lists the bucket lazily instead of loading it.
+
+    Used for buckets without a manifest. Records arrive page by page in bucket
+    (name) order, so a selection stops listing as soon as it has found an
+    eligible image and memory does not grow with the bucket. There is no age
+    index to seek into, so only name order is offered (see ``orders``).
+
+    Args:
+        list_fn: ``(prefix=..., start_offset=...) -> Iterator[BlobRecord]``,
+            e.g. GoogleCloudStorageManager.iter_images
+        folders_fn: Returns the top-level folders, e.g. list_folders
+        folder_fn: Maps a blob name to its folder
+    """
+
+    orders = ('name',)
+
+    def __init__(self, list_fn: Callable[..., Iterator[BlobRecord]],
+                 folders_fn: Optional[Callable[[], List[str]]] = None,
+                 folder_fn: Callable[[str], str] = shard_of):
+        self._list_fn = list_fn
+        self._folders_fn = folders_fn
+        self._folder_fn = folder_fn
+
+    def folder_of(self, name: str) -> str:
+        return self._folder_fn(name)
+
+    def folders(self) -> List[str]:
+        if self._folders_fn:
+            return self._folders_fn()
+        return sorted({self._folder_fn(r.name) for r in self._list_fn()})
+
+    def iter_records(self, prefix: Optional[str] = None, order_by: str = 'name',
+                     shard: Optional[str] = None, start_after: Optional[tuple] = None,
+                     batch_size: int = 500) -> Iterator[BlobRecord]:
+        if order_by not in self.orders:
+            raise ValueError(f"A bucket listing cannot be ordered by '{order_by}'")
+        offset = start_after[-1] if start_after else None
+        # Folders are prefixes, so a shard filter narrows the listing server-side
+        if shard and (not prefix or shard.startswith(prefix)):
+            prefix = shard
+        for record in self._list_fn(prefix=prefix, start_offset=offset):
+            if offset is not None and record.name <= offset:
+                continue
+            if shard is not None and self._folder_fn(record.name) != shard:
+                continue
+            yield record
+
+    def sample(self, k: int, rng: Optional[random.Random] = None) -> List[BlobRecord]:
+        # Reservoir sampling: one pass over the listing, O(k) memory
+        rng = rng or random
+        reservoir: List[BlobRecord] = []
+        for i, record in enumerate(self._list_fn()):
+            if i < k:
+                reservoir.append(record)
+            else:
+                j = rng.randint(0, i)
+                if j < k:
+                    reservoir[j] = record
+        return reservoir
+
+
+class RotationStrategy:
+    """Base class for selection strategies."""
+
+    name = ''
+
+    def candidates(self, source, engine: 'SelectionEngine') -> Iterator[BlobRecord]:
+        """Yield eligible candidates, best first, without changing any state."""
+        raise NotImplementedError
+
+    def commit(self, record: BlobRecord, source, engine: 'SelectionEngine') -> None:
+        """Advance persisted cursors after ``record`` has been posted."""
+
+
+def _key(record: BlobRecord, order_by: str = 'updated') -> str:
+    return json.dumps([getattr(record, order_by), record.name])
+
+
+def _load_key(value: Optional[str]) -> Optional[tuple]:
+    return tuple(json.loads(value)) if value else None
+
+
+class OldestUnpostedFirst(RotationStrategy):
+    """
+    Post the oldest image that has not been posted, resuming from a watermark.
+
+    Sources that cannot be ordered by age (a lazy bucket listing) are gone
+    through in name order, with a watermark of its own.
+    """
+
+    name = 'oldest_unposted'
+    cursor_key = 'oldest_unposted:watermark'
+
+    def __init__(self):
+        self._warned = False
+
+    def _order(self, source) -> str:
+        if 'updated' in getattr(source, 'orders', ('name',)):
+            return 'updated'
+        if not self._warned:
+            logger.warning(f"Strategy '{self.name}' needs a manifest or catalog to post oldest "
+                           f"images first; going through the bucket in name order instead")
+            self._warned = True
+        return 'name'
+
+    @staticmethod
+    def _cursor(key: str, order_by: str) -> str:
+        return key if order_by == 'updated' else f"{key}:by_name"
+
+    def _scan(self, source, engine, shard: Optional[str], watermark: Optional[tuple],
+              order_by: str = 'updated'):
+        # Scan forward from the watermark, then wrap around to pick up images
+        # that have aged out of the no-repeat window
+        after = source.iter_records(order_by=order_by, shard=shard, start_after=watermark)
+        yield from engine.eligible(after)
+        if watermark:
+            before = itertools.takewhile(
+                lambda r: (getattr(r, order_by), r.name) <= watermark,
+                source.iter_records(order_by=order_by, shard=shard)
+            )
+            yield from engine.eligible(before)
+
+    def candidates(self, source, engine):
+        order_by = self._order(source)
+        watermark = _load_key(engine.history.get_cursor(self._cursor(self.cursor_key, order_by)))
+        return self._scan(source, engine, None, watermark, order_by)
+
+    def commit(self, record, source, engine):
+        order_by = self._order(source)
+        engine.history.set_cursor(self._cursor(self.cursor_key, order_by), _key(record, order_by))
+
+
+class WeightedRandom(RotationStrategy):
+    """
+    Random selection weighted by folder prefix.
+
+    Each round samples ``sample_size`` records by random index seek, discards
+    ineligible ones and draws from the rest by weight. When ``max_rounds``
+    of sampling turn up nothing (most of the library already posted), the
+    rest are scanned in order, so an eligible image is still found.
+    """
+
+    name = 'weighted_random'
+
+    def __init__(self, weights: Optional[Dict[str, float]] = None, default_weight: float = 1.0,
+                 sample_size: int = 16, max_rounds: int = 8, rng: Optional[random.Random] = None):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.sample_size = sample_size
+        self.max_rounds = max_rounds
+        self.rng = rng or random.Random()
+
+    def weight(self, record: BlobRecord) -> float:
+        for prefix, weight in self.weights.items():
+            if record.name.startswith(prefix):
+                return weight
+        return self.default_weight
+
+    def candidates(self, source, engine):
+        seen = set()
+        for _ in range(self.max_rounds):
+            pool = [r for r in source.sample(self.sample_size, self.rng)
+                    if r.name not in seen]
+            seen.update(r.name for r in pool)
+            pool = [r for r in pool if engine.is_eligible(r) and self.weight(r) > 0]
+            while pool:
+                choice = self.rng.choices(pool, weights=[self.weight(r) for r in pool])[0]
+                pool.remove(choice)
+                yield choice
+        rest = (r for r in source.iter_records() if r.name not in seen and self.weight(r) > 0)
+        yield from engine.eligible(rest)
+
+
+class RoundRobinByFolder(OldestUnpostedFirst):
+    """Cycle through top-level folders, posting the oldest unposted image of each."""
+
+    name = 'round_robin_folder'
+    folder_key = 'round_robin:last_folder'
+
+    def candidates(self, source, engine):
+        folders = source.folders()
+        if not folders:
+            return
+        last = engine.history.get_cursor(self.folder_key)
+        start = bisect.bisect_right(folders, last) if last is not None else 0
+        ordered = folders[start:] + folders[:start]
+
+        order_by = self._order(source)
+        streams = []
+        for folder in ordered:
+            watermark = _load_key(engine.history.get_cursor(self._cursor(f'round_robin:{folder}', order_by)))
+            streams.append(self._scan(source, engine, folder, watermark, order_by))
+
+        # Interleave: one candidate per folder per round
+        while streams:
+            for stream in list(streams):
+                record = next(stream, None)
+                if record is None:
+                    streams.remove(stream)
+                else:
+                    yield record
+
+    def commit(self, record, source, engine):
+        folder = source.folder_of(record.name)
+        order_by = self._order(source)
+        engine.history.set_cursor(self.folder_key, folder)
+        engine.history.set_cursor(self._cursor(f'round_robin:{folder}', order_by), _key(record, order_by))
+
+
+STRATEGIES = {
+    OldestUnpostedFirst.name: OldestUnpostedFirst,
+    WeightedRandom.name: WeightedRandom,
+    RoundRobinByFolder.name: RoundRobinByFolder,
+}
+
+
+def build_strategy(name: str, options: Optional[Dict[str, Any]] = None) -> RotationStrategy:
+    """
+    Create a rotation strategy by name.
+
+    Args:
+        name: One of the keys of STRATEGIES
+        options: Strategy options from config (e.g. folder ``weights``)
+
+    Returns:
+        RotationStrategy instance
+    """
+    options = options or {}
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown rotation strategy '{name}'. Choose from: {', '.join(STRATEGIES)}")
+    if name == WeightedRandom.name:
+        return WeightedRandom(weights=options.get('weights'),
+                              sample_size=options.get('sample_size', 16))
+    return STRATEGIES[name]()
+
+
+class SelectionEngine:
+    """
+    Picks the next image to post.
+
+    Args:
+        history: Posted-history ledger
+        strategy: Rotation strategy
+        no_repeat_window: Seconds before an image may be posted again; None never repeats
+        max_scan: Upper bound on records scanned per candidate stream
+        near_duplicates: Optional NearDuplicateFilter rejecting look-alikes of recent posts
+    """
+
+    def __init__(self, history: PostedHistory, strategy: Optional[RotationStrategy] = None,
+                 no_repeat_window: Optional[float] = None, max_scan: int = 10000,
+                 near_duplicates=None):
+        self.history = history
+        self.strategy = strategy or OldestUnpostedFirst()
+        self.no_repeat_window = no_repeat_window
+        self.max_scan = max_scan
+        self.near_duplicates = near_duplicates
+
+    def is_eligible(self, record: BlobRecord) -> bool:
+        if self.history.is_posted(record.name, record.md5_hash or None, within=self.no_repeat_window):
+            return False
+        return self.near_duplicates is None or not self.near_duplicates.is_near_duplicate(record)
+
+    def eligible(self, records: Iterable[BlobRecord]) -> Iterator[BlobRecord]:
+        """Filter a record stream down to eligible records, scanning at most max_scan."""
+        for record in itertools.islice(records, self.max_scan):
+            if self.is_eligible(record):
+                yield record
+
+    def peek(self, source, count: int) -> List[BlobRecord]:
+        """Return the next ``count`` distinct candidates without changing any state."""
+        picked: Dict[str, BlobRecord] = {}
+        hashes = set()
+        for record in self.strategy.candidates(source, self):
+            if record.name in picked or (record.md5_hash and record.md5_hash in hashes):
+                continue
+            picked[record.name] = record
+            if record.md5_hash:
+                hashes.add(record.md5_hash)
+            if len(picked) >= count:
+                break
+        return list(picked.values())
+
+    def select(self, source) -> Optional[BlobRecord]:
+        """Return the next image to post, or None if nothing is eligible."""
+        candidates = self.peek(source, 1)
+        if not candidates:
+            logger.warning(f"No eligible images left for strategy '{self.strategy.name}'")
+            return None
+        return candidates[0]
+
+    def mark_posted(self, record: BlobRecord, source, media_id: Optional[str] = None) -> None:
+        """Record a successful post and advance the strategy's cursors."""
+        self.history.record_post(record.name, record.md5_hash or None,
+                                 image_url=record.public_url, media_id=media_id)
+        self.strategy.commit(record, source, self)
+        if self.near_duplicates is not None:
+            self.near_duplicates.remember(record)
@@ -0,0 +1,373 @@
+"""
+Typed, validated settings with hot reload.
+
+Settings are built from four layers, later layers winning:
+
+1. built-in defaults
+2. config/config.yaml
+3. the .env file
+4. the process environment
+
+Environment variables override single config keys (see ENV_OVERRIDES),
+e.g. GEMINI_API_KEY overrides ``gemini.api_key``. The result is a frozen
+Settings snapshot. It holds the merged config as read-only mappings
+(``raw``) plus typed, validated sections for the values read on hot
+paths, so those need no dict or environment lookups.
+
+SettingsStore holds the current snapshot. ``reload()`` rebuilds it when
+one of the files changed and swaps it in with a single assignment:
+readers see the old or the new snapshot, never a mix, and work that is
+already running keeps the snapshot it started with. Invalid new settings
+are logged and ignored. ``watch()`` polls the files from a background
+thread, and listeners added with ``subscribe()`` hear about every swap.
+"""
+
+import os
+import re
+import threading
+import time
+import logging
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Optional, List, Dict, Any, Callable, Mapping, Set, Tuple
+
+import yaml
+
+from src.accounts import Account, load_accounts
+from src.metrics import inc
+
+logger = logging.getLogger(__name__)
+
+# Environment variable -> (config section, key) it overrides
+ENV_OVERRIDES = {
+    'GOOGLE_CLOUD_PROJECT_ID': ('cloud_storage', 'project_id'),
+    'GOOGLE_CLOUD_STORAGE_BUCKET': ('cloud_storage', 'bucket_name'),
+    'GOOGLE_APPLICATION_CREDENTIALS': ('cloud_storage', 'credentials_path'),
+    'GEMINI_API_KEY': ('gemini', 'api_key'),
+    'INSTAGRAM_ACCESS_TOKEN': ('instagram', 'access_token'),
+    'INSTAGRAM_USER_ID': ('instagram', 'user_id'),
+}
+
+EMPTY: Mapping[str, Any] = MappingProxyType({})
+
+_TIME_OF_DAY = re.compile(r'([01]?\d|2[0-3]):[0-5]\d')
+
+
+class SettingsError(ValueError):
+    """The configuration is invalid; ``problems`` lists every issue found."""
+
+    def __init__(self, problems: List[str]):
+        super().__init__("Invalid settings: " + "; ".join(problems))
+        self.problems = problems
+
+
+def freeze(value: Any) -> Any:
+    """Turn nested dicts and lists into read-only mappings and tuples."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+@dataclass(frozen=True)
+class StorageSettings:
+    project_id: Optional[str] = None
+    bucket_name: Optional[str] = None
+    credentials_path: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class GeminiSettings:
+    api_key: Optional[str] = None
+    model: str = 'gemini-1.5-flash'
+    max_tokens: int = 150
+    # None: use the built-in prompts
+    prompt_template: Optional[str] = None
+    batch_prompt_template: Optional[str] = None
+    images_per_request: int = 4
+    max_request_bytes: int = 4 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class InstagramSettings:
+    access_token: Optional[str] = None
+    user_id: Optional[str] = None
+    api_version: str = 'v19.0'
+    pool_size: int = 10
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    max_retries: int = 3
+
+
+@dataclass(frozen=True)
+class Settings:
+    """One immutable snapshot of the configuration."""
+    raw: Mapping[str, Any] = field(default_factory=lambda: EMPTY)
+    storage: StorageSettings = StorageSettings()
+    gemini: GeminiSettings = GeminiSettings()
+    instagram: InstagramSettings = InstagramSettings()
+    schedule_time: str = '09:00'
+    accounts: Tuple[Account, ...] = ()
+    loaded_at: float = 0.0
+
+    def section(self, name: str) -> Mapping[str, Any]:
+        return self.raw.get(name) or EMPTY
+
+    def changed_sections(self, other: 'Settings') -> Set[str]:
+        """
+        Names of the config sections that differ from ``other``.
+
+        ``accounts`` is also reported when only a token read from the
+        environment (``access_token_env``) changed.
+        """
+        changed = {name for name in set(self.raw) | set(other.raw)
+                   if self.raw.get(name) != other.raw.get(name)}
+        if self.accounts != other.accounts:
+            changed.add('accounts')
+        return changed
+
+
+class _Section:
+    """Reads and checks the values of one config section, collecting problems."""
+
+    def __init__(self, config: Mapping[str, Any], name: str, problems: List[str]):
+        self.name = name
+        self.problems = problems
+        self.values = config.get(name) or {}
+        if not isinstance(self.values, Mapping):
+            problems.append(f"{name}: expected a mapping, got {self.values!r}")
+            self.values = {}
+
+    def text(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        value = self.values.get(key, default)
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, int) and not isinstance(value, bool):
+            # IDs are often written unquoted in YAML
+            return str(value)
+        self.problems.append(f"{self.name}.{key}: expected text, got {value!r}")
+        return default
+
+    def number(self, key: str, default: Any, minimum: float = 0, integer: bool = False) -> Any:
+        value = self.values.get(key, default)
+        kinds = (int,) if integer else (int, float)
+        if isinstance(value, bool) or not isinstance(value, kinds):
+            kind = 'an integer' if integer else 'a number'
+            self.problems.append(f"{self.name}.{key}: expected {kind}, got {value!r}")
+            return default
+        if value < minimum:
+            self.problems.append(f"{self.name}.{key}: must be at least {minimum}, got {value}")
+            return default
+        return value
+
+
+def build_settings(config: Mapping[str, Any], environ: Mapping[str, str]) -> Settings:
+    """
+    Merge environment overrides into the config, validate it and freeze the result.
+
+    Args:
+        config: Parsed config.yaml
+        environ: Environment variables (.env values included)
+
+    Raises:
+        SettingsError: Listing every invalid value
+    """
+    problems: List[str] = []
+    if not isinstance(config, Mapping):
+        raise SettingsError([f"expected a mapping at the top level, got {type(config).__name__}"])
+    merged: Dict[str, Any] = dict(config)
+    for variable, (section, key) in ENV_OVERRIDES.items():
+        if environ.get(variable):
+            values = merged.get(section)
+            merged[section] = {**(values if isinstance(values, Mapping) else {}), key: environ[variable]}
+
+    storage = _Section(merged, 'cloud_storage', problems)
+    gemini = _Section(merged, 'gemini', problems)
+    instagram = _Section(merged, 'instagram', problems)
+    schedule = _Section(merged, 'schedule', problems)
+
+    schedule_time = schedule.text('time', '09:00')
+    if not _TIME_OF_DAY.fullmatch(schedule_time or ''):
+        problems.append(f"schedule.time: expected HH:MM, got {schedule_time!r}")
+        schedule_time = '09:00'
+
+    settings = Settings(
+        raw=freeze(merged),
+        storage=StorageSettings(
+            project_id=storage.text('project_id'),
+            bucket_name=storage.text('bucket_name'),
+            credentials_path=storage.text('credentials_path'),
+        ),
+        gemini=GeminiSettings(
+            api_key=gemini.text('api_key'),
+            model=gemini.text('model', 'gemini-1.5-flash'),
+            max_tokens=gemini.number('max_tokens', 150, minimum=1, integer=True),
+            prompt_template=gemini.text('prompt_template'),
+            batch_prompt_template=gemini.text('batch_prompt_template'),
+            images_per_request=gemini.number('images_per_request', 4, minimum=1, integer=True),
+            max_request_bytes=gemini.number('max_request_bytes', 4 * 1024 * 1024, minimum=1, integer=True),
+        ),
+        instagram=InstagramSettings(
+            access_token=instagram.text('access_token'),
+            user_id=instagram.text('user_id'),
+            api_version=instagram.text('api_version', 'v19.0'),
+            pool_size=instagram.number('pool_size', 10, minimum=1, integer=True),
+            connect_timeout=instagram.number('connect_timeout', 5.0, minimum=0.1),
+            read_timeout=instagram.number('read_timeout', 30.0, minimum=0.1),
+            max_retries=instagram.number('max_retries', 3, integer=True),
+        ),
+        schedule_time=schedule_time,
+        accounts=_accounts(merged, environ, problems),
+        loaded_at=time.time(),
+    )
+    if problems:
+        raise SettingsError(problems)
+    return settings
+
+
+def _accounts(config: Mapping[str, Any], environ: Mapping[str, str],
+              problems: List[str]) -> Tuple[Account, ...]:
+    try:
+        return tuple(load_accounts(config, environ))
+    except (ValueError, TypeError, AttributeError) as e:
+        problems.append(f"accounts: {e}")
+        return ()
+
+
+def read_config_file(path: str) -> Dict[str, Any]:
+    """
+    Parse the YAML config file; a missing file is an empty config.
+
+    Raises:
+        SettingsError: The file is not valid YAML
+    """
+    try:
+        with open(path, "r") as f:
+            return yaml.safe_load(f) or {}
+    except FileNotFoundError:
+        logger.error("Configuration file not found. Please create config/config.yaml from the template.")
+        return {}
+    except yaml.YAMLError as e:
+        raise SettingsError([f"{path}: {e}"])
+
+
+class SettingsStore:
+    """
+    Holds the current Settings and swaps in new ones when the files change.
+
+    Args:
+        config_path: YAML config file
+        env_path: .env file; its values are exported to the process
+            environment, without overriding variables set there already
+    """
+
+    def __init__(self, config_path: str, env_path: str = '.env'):
+        self.config_path = config_path
+        self.env_path = env_path
+        self._settings: Optional[Settings] = None
+        self._stamp: Optional[Tuple] = None
+        self._listeners: List[Callable[[Settings, Settings], None]] = []
+        self._exported: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _file_stamp(self) -> Tuple:
+        stamp = []
+        for path in (self.config_path, self.env_path):
+            try:
+                info = os.stat(path)
+                stamp.append((info.st_mtime_ns, info.st_size))
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _read_env(self) -> Mapping[str, str]:
+        from dotenv import dotenv_values
+        values = dotenv_values(self.env_path)
+        for key, value in values.items():
+            # Variables set before we started win over the .env file
+            if value is not None and (key not in os.environ or key in self._exported):
+                os.environ[key] = value
+                self._exported.add(key)
+        # Keys since removed from the file no longer apply
+        for key in [key for key in self._exported if values.get(key) is None]:
+            os.environ.pop(key, None)
+            self._exported.discard(key)
+        return os.environ
+
+    def _load(self) -> Settings:
+        return build_settings(read_config_file(self.config_path), self._read_env())
+
+    @property
+    def current(self) -> Settings:
+        """
+        The current snapshot, loaded on first use.
+
+        Raises:
+            SettingsError: The first load found invalid settings
+        """
+        settings = self._settings
+        if settings is None:
+            with self._lock:
+                if self._settings is None:
+                    self._stamp = self._file_stamp()
+                    self._settings = self._load()
+                    logger.info("Configuration loaded successfully")
+                settings = self._settings
+        return settings
+
+    def subscribe(self, listener: Callable[[Settings, Settings], None]) -> None:
+        """Call ``listener(old, new)`` after every swap."""
+        self._listeners.append(listener)
+
+    def reload(self, force: bool = False) -> bool:
+        """
+        Rebuild the settings if a file changed (or ``force``) and swap them in.
+
+        Returns:
+            True if new settings were swapped in
+        """
+        with self._lock:
+            stamp = self._file_stamp()
+            if self._settings is not None and stamp == self._stamp and not force:
+                return False
+            # Remember the stamp even if the files are invalid, so they are
+            # only read again once they change
+            self._stamp = stamp
+            try:
+                new = self._load()
+            except SettingsError as e:
+                inc('settings_reloads_total', outcome='invalid')
+                logger.error(f"Keeping the current settings: {e}")
+                return False
+            old, self._settings = self._settings, new
+        inc('settings_reloads_total', outcome='applied')
+        if old is None:
+            return True
+        logger.info(f"Settings reloaded; changed sections: {sorted(new.changed_sections(old)) or 'none'}")
+        for listener in list(self._listeners):
+            try:
+                listener(old, new)
+            except Exception as e:
+                logger.error(f"Failed to apply reloaded settings: {e}")
+        return True
+
+    def watch(self, interval: float = 5.0) -> None:
+        """Check the files for changes every ``interval`` seconds in a daemon thread."""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                self.reload()
+
+        self._thread = threading.Thread(target=run, name='settings-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
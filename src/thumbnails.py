@@ -0,0 +1,219 @@
+"""
+Downscaled JPEG thumbnails for multimodal captioning.
+
+Gemini only needs a small rendition of an image to caption it, so instead of
+uploading the original the caption generator sends a thumbnail whose longest
+side is at most ``max_side`` pixels and whose encoded size stays under
+``max_bytes``. Thumbnails are generated once and cached on disk, keyed by the
+image URL, the version of its content (md5, or generation) and the thumbnail
+settings, so an overwritten blob gets a new thumbnail. Thumbnails unused for
+``max_age`` seconds, then the least recently used beyond ``max_cache_bytes``,
+are pruned.
+"""
+
+import hashlib
+import importlib.util
+import io
+import os
+import tempfile
+import threading
+import time
+import logging
+from typing import Optional, Dict, Any, Callable, List, Tuple
+
+from src.manifest import BlobRecord
+
+from src.metrics import inc, timed
+
+# Pillow is imported where images are decoded, keeping it out of startup
+PIL_AVAILABLE = importlib.util.find_spec('PIL') is not None
+
+logger = logging.getLogger(__name__)
+
+MAX_SIDE = 768
+THUMBNAIL_QUALITY = 80
+# Well under Gemini's 20 MB limit for inline request data, so several fit in one request
+MAX_THUMBNAIL_BYTES = 512 * 1024
+MIME_TYPE = 'image/jpeg'
+MAX_CACHE_BYTES = 1024 * 1024 * 1024
+MAX_AGE = 30 * 86400
+
+
+def make_thumbnail(data: bytes, max_side: int = MAX_SIDE, quality: int = THUMBNAIL_QUALITY,
+                   max_bytes: int = MAX_THUMBNAIL_BYTES) -> bytes:
+    """
+    Downscale an encoded image into a JPEG thumbnail.
+
+    Quality, then size, is reduced until the thumbnail fits in ``max_bytes``.
+
+    Args:
+        data: Encoded original image
+        max_side: Longest side of the thumbnail in pixels
+        quality: Starting JPEG quality
+        max_bytes: Upper bound on the encoded thumbnail
+
+    Returns:
+        Encoded JPEG bytes
+    """
+    if not PIL_AVAILABLE:
+        raise RuntimeError("Pillow is not installed. Install with: pip install Pillow")
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as image:
+        # Decode at reduced scale where the format supports it (JPEG draft mode)
+        image.draft('RGB', (max_side, max_side))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side))
+
+        while True:
+            output = io.BytesIO()
+            image.save(output, 'JPEG', quality=quality, optimize=True)
+            encoded = output.getvalue()
+            if len(encoded) <= max_bytes:
+                return encoded
+            if quality > 50:
+                quality -= 10
+            elif max(image.size) > 64:
+                image = image.resize((max(1, image.width * 3 // 4), max(1, image.height * 3 // 4)))
+            else:
+                return encoded
+
+
+class ThumbnailCache:
+    """
+    Creates and caches thumbnails of images by URL and content version.
+
+    Args:
+        fetch: ``(image_url, record) -> bytes`` returning the original image
+            at the record's generation (record may be None)
+        cache_dir: Directory the thumbnails are stored in
+        max_side: Longest side of a thumbnail in pixels
+        quality: JPEG quality
+        max_bytes: Upper bound on an encoded thumbnail
+        resolve: ``(image_url) -> BlobRecord or None`` looking up the current
+            record of an image when the caller has none; without it such
+            thumbnails are keyed by URL alone
+        max_cache_bytes: Size the cache is pruned back to
+        max_age: Seconds after which an unused thumbnail is pruned
+    """
+
+    def __init__(self, fetch: Callable[[str, Optional[BlobRecord]], bytes], cache_dir: str,
+                 max_side: int = MAX_SIDE, quality: int = THUMBNAIL_QUALITY,
+                 max_bytes: int = MAX_THUMBNAIL_BYTES,
+                 resolve: Optional[Callable[[str], Optional[BlobRecord]]] = None,
+                 max_cache_bytes: int = MAX_CACHE_BYTES, max_age: float = MAX_AGE):
+        self.fetch = fetch
+        self.cache_dir = cache_dir
+        self.max_side = max_side
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.resolve = resolve
+        self.max_cache_bytes = max_cache_bytes
+        self.max_age = max_age
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        # Bytes written since the last prune; None until the first prune
+        self._written: Optional[int] = None
+
+    @property
+    def variant(self) -> str:
+        return f"s{self.max_side}-q{self.quality}"
+
+    def path_for(self, image_url: str, record: Optional[BlobRecord] = None) -> str:
+        key = image_url
+        if record is not None:
+            key += '\0' + (record.md5_hash or f"g{record.generation}")
+        key = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}-{self.variant}.jpg")
+
+    def _lock_for(self, path: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(path, threading.Lock())
+
+    def get(self, image_url: str, record: Optional[BlobRecord] = None) -> bytes:
+        """
+        Return the thumbnail of an image, creating it on first use.
+
+        Args:
+            image_url: URL of the image
+            record: The image's listing record; looked up with ``resolve``
+                when not given
+
+        Raises:
+            Exception: If the original cannot be fetched or decoded
+        """
+        if record is None and self.resolve is not None:
+            record = self.resolve(image_url)
+        path = self.path_for(image_url, record)
+        self._prune_if_due(0)
+        # Concurrent callers for the same image wait for one fetch instead of racing
+        with self._lock_for(path):
+            if os.path.exists(path):
+                inc('thumbnail_cache_requests_total', result='hit')
+                # The modification time records the last use, for pruning
+                os.utime(path)
+                with open(path, 'rb') as f:
+                    return f.read()
+
+            inc('thumbnail_cache_requests_total', result='miss')
+            with timed('thumbnail.create'):
+                thumbnail = make_thumbnail(self.fetch(image_url, record), self.max_side,
+                                           self.quality, self.max_bytes)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(thumbnail)
+            os.replace(tmp_path, path)
+            logger.debug(f"Created {len(thumbnail)} byte thumbnail for {image_url}")
+        self._prune_if_due(len(thumbnail))
+        return thumbnail
+
+    def _prune_if_due(self, written: int) -> None:
+        # Walking the cache is not free: prune on first use, then after every tenth of the limit
+        with self._locks_guard:
+            due = self._written is None or self._written + written > self.max_cache_bytes // 10
+            self._written = 0 if due else self._written + written
+        if due:
+            self.prune()
+
+    def prune(self) -> Dict[str, int]:
+        """
+        Delete thumbnails unused for ``max_age``, then the least recently
+        used ones until the cache fits in ``max_cache_bytes``.
+
+        Thumbnails of overwritten images are never used again, so they age out.
+
+        Returns:
+            Stats dict with ``removed`` and ``bytes`` (the size left)
+        """
+        entries: List[Tuple[float, int, str]] = []
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        cutoff = time.time() - self.max_age
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for used_at, size, path in sorted(entries):
+            if used_at >= cutoff and total <= self.max_cache_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            logger.info(f"Pruned {removed} thumbnails; {total} bytes left in the cache")
+        return {"removed": removed, "bytes": total}
+
+    def image_part(self, image_url: str, record: Optional[BlobRecord] = None) -> Dict[str, Any]:
+        """Return the thumbnail as an inline Gemini content part."""
+        return {"mime_type": MIME_TYPE, "data": self.get(image_url, record)}
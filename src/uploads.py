@@ -0,0 +1,271 @@
+"""
+Bulk upload of local images to the bucket.
+
+Onboarding a folder of thousands of photos runs as a two-stage
+AsyncPipeline:
+
+1. hash: files are MD5-hashed on a thread pool (hashlib releases the GIL
+   while hashing, so files are hashed in parallel). A file whose hash is
+   already in the bucket, or that repeats a file of the batch that was
+   uploaded, is skipped without being uploaded. A file whose content is
+   still being uploaded waits for that upload and goes through again.
+2. upload: the remaining files are uploaded concurrently as resumable
+   uploads in ``chunk_size`` pieces. The ACL, content type and metadata go
+   with the upload itself, with no make_public() round-trip per blob. An
+   ``if_generation_match=0`` precondition never overwrites an existing
+   blob, which also makes an interrupted upload safe to retry.
+
+    uploader = BulkUploader(bucket, known_hashes=storage_manager.known_hashes())
+    report = uploader.run(['photos/'], prefix='2024/')
+
+``python -m src.uploads <path>... [--prefix P]`` uploads to the configured
+bucket and prints the throughput report.
+"""
+
+import argparse
+import base64
+import hashlib
+import mimetypes
+import os
+import sys
+import threading
+import time
+import logging
+from typing import Optional, List, Dict, Any, Iterable, NamedTuple, Set, TYPE_CHECKING
+
+from src.async_pipeline import AsyncPipeline, Finished, Stage
+from src.manifest import is_image_name
+from src.metrics import inc
+from src.resilience import status_of
+
+if TYPE_CHECKING:
+    from src.resilience import Endpoint
+
+logger = logging.getLogger(__name__)
+
+# Resumable upload chunks must be a multiple of 256 KiB
+CHUNK_ALIGNMENT = 256 * 1024
+DEFAULT_CHUNK_SIZE = 32 * CHUNK_ALIGNMENT
+
+UPLOADED = 'uploaded'
+DUPLICATE = 'duplicate'
+EXISTS = 'exists'
+FAILED = 'failed'
+STATUSES = (UPLOADED, DUPLICATE, EXISTS, FAILED)
+
+
+class UploadTask(NamedTuple):
+    """One local file and the blob it becomes."""
+    local_path: str
+    remote_name: str
+    size: int
+    md5_hash: str = ''
+
+
+def file_md5(path: str, block_size: int = 1024 * 1024) -> str:
+    """Base64 MD5 of a file, in the form GCS reports as ``md5Hash``."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode('ascii')
+
+
+def find_images(paths: Iterable[str], prefix: str = '') -> List[UploadTask]:
+    """
+    Collect the image files to upload.
+
+    Files inside a directory keep their path relative to it; a file given
+    directly keeps only its name. Either is appended to ``prefix``.
+    """
+    tasks = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if is_image_name(name):
+                        local_path = os.path.join(root, name)
+                        relative = os.path.relpath(local_path, path).replace(os.sep, '/')
+                        tasks.append(UploadTask(local_path, prefix + relative, os.path.getsize(local_path)))
+        elif os.path.isfile(path) and is_image_name(path):
+            tasks.append(UploadTask(path, prefix + os.path.basename(path), os.path.getsize(path)))
+        else:
+            logger.warning(f"Skipping {path}: not an image file or directory")
+    return tasks
+
+
+def summarize(results: List[Dict[str, Any]], seconds: float) -> Dict[str, Any]:
+    """Count results by status and compute the upload throughput."""
+    report: Dict[str, Any] = {status: 0 for status in STATUSES}
+    for result in results:
+        report[result["status"]] += 1
+    uploaded_bytes = sum(r["bytes"] for r in results if r["status"] == UPLOADED)
+    report.update({
+        "files": len(results),
+        "bytes": uploaded_bytes,
+        "seconds": seconds,
+        "files_per_second": report[UPLOADED] / seconds if seconds > 0 else 0.0,
+        "mb_per_second": uploaded_bytes / (1024 * 1024) / seconds if seconds > 0 else 0.0,
+        "results": results,
+    })
+    return report
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    return (f"Uploaded {report[UPLOADED]} of {report['files']} files "
+            f"({report['bytes'] / (1024 * 1024):.1f} MB) in {report['seconds']:.1f}s: "
+            f"{report['files_per_second']:.1f} files/s, {report['mb_per_second']:.1f} MB/s; "
+            f"{report[DUPLICATE]} duplicates, {report[EXISTS]} names taken, {report[FAILED]} failed")
+
+
+class BulkUploader:
+    """
+    Hash, deduplicate and upload many local images concurrently.
+
+    Args:
+        bucket: Cloud Storage bucket handle
+        known_hashes: Base64 MD5 hashes of the blobs already in the bucket
+        hash_workers: Files hashed at once
+        upload_workers: Uploads in flight at once
+        chunk_size: Bytes sent per resumable upload request (rounded to a
+            multiple of 256 KiB)
+        predefined_acl: ACL applied by the upload, e.g. ``publicRead``;
+            None for buckets with uniform bucket-level access
+        metadata: Custom metadata set on every uploaded blob
+        cache_control: Cache-Control header of the uploaded blobs
+        resilience: Endpoint the uploads go through (breaker and limits)
+    """
+
+    def __init__(self, bucket, known_hashes: Iterable[str] = (), hash_workers: int = 4,
+                 upload_workers: int = 8, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 predefined_acl: Optional[str] = 'publicRead',
+                 metadata: Optional[Dict[str, str]] = None, cache_control: Optional[str] = None,
+                 resilience: Optional['Endpoint'] = None):
+        self.bucket = bucket
+        self.known_hashes = set(known_hashes)
+        self.hash_workers = hash_workers
+        self.upload_workers = upload_workers
+        self.chunk_size = max(1, round(chunk_size / CHUNK_ALIGNMENT)) * CHUNK_ALIGNMENT
+        self.predefined_acl = predefined_acl
+        self.metadata = dict(metadata or {})
+        self.cache_control = cache_control
+        self.resilience = resilience
+        # Hashes of files being uploaded; they only become known once uploaded
+        self._in_flight: Set[str] = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _result(task: UploadTask, status: str, **extra) -> Dict[str, Any]:
+        inc('uploads_total', status=status)
+        return {"path": task.local_path, "name": task.remote_name, "status": status,
+                "bytes": task.size, **extra}
+
+    def hash(self, task: UploadTask) -> Any:
+        """
+        Hash a file; finish it as a duplicate if its content is already known.
+
+        A file with the same content as one being uploaded is finished as
+        the task itself, for upload_tasks to send through again once that
+        upload has succeeded or failed.
+        """
+        if not task.md5_hash:
+            task = task._replace(md5_hash=file_md5(task.local_path))
+        with self._lock:
+            duplicate = task.md5_hash in self.known_hashes
+            waiting = not duplicate and task.md5_hash in self._in_flight
+            if not duplicate and not waiting:
+                self._in_flight.add(task.md5_hash)
+        if duplicate:
+            logger.info(f"Skipping {task.local_path}: same content already in the bucket")
+            return Finished(self._result(task, DUPLICATE))
+        if waiting:
+            return Finished(task)
+        return task
+
+    def upload(self, task: UploadTask) -> Dict[str, Any]:
+        """Upload one file as a new blob, with its ACL and metadata in the same request."""
+        blob = self.bucket.blob(task.remote_name, chunk_size=self.chunk_size)
+        blob.metadata = {**self.metadata, "source-file": os.path.basename(task.local_path)}
+        if self.cache_control:
+            blob.cache_control = self.cache_control
+        content_type = mimetypes.guess_type(task.local_path)[0] or 'application/octet-stream'
+
+        def send() -> None:
+            blob.upload_from_filename(task.local_path, content_type=content_type,
+                                      predefined_acl=self.predefined_acl,
+                                      if_generation_match=0, checksum='md5')
+
+        try:
+            if self.resilience:
+                # Safe to retry thanks to the precondition; never hedged
+                self.resilience.call(send, hedge=False)
+            else:
+                send()
+        except Exception as e:
+            if status_of(e) == 412:
+                logger.warning(f"Not overwriting existing blob {task.remote_name}")
+                return self._result(task, EXISTS)
+            raise
+        else:
+            with self._lock:
+                self.known_hashes.add(task.md5_hash)
+        finally:
+            with self._lock:
+                self._in_flight.discard(task.md5_hash)
+        inc('upload_bytes_total', task.size)
+        return self._result(task, UPLOADED, url=blob.public_url)
+
+    def _failed(self, task: UploadTask, error: Exception, stage: Stage) -> Dict[str, Any]:
+        logger.error(f"Failed to {stage.name} {task.local_path}: {error}")
+        return self._result(task, FAILED, error=str(error))
+
+    def upload_tasks(self, tasks: List[UploadTask]) -> Dict[str, Any]:
+        """
+        Upload prepared tasks.
+
+        Returns:
+            Report with a count per status, uploaded ``bytes``, ``seconds``,
+            ``files_per_second``, ``mb_per_second`` and per-file ``results``
+        """
+        pipeline = AsyncPipeline([Stage('hash', self.hash, self.hash_workers),
+                                  Stage('upload', self.upload, self.upload_workers)],
+                                 queue_size=self.upload_workers * 2, on_error=self._failed)
+        started = time.perf_counter()
+        results = pipeline.run_sync(tasks)
+        # Files held back behind an upload of the same content; every pass
+        # settles at least one upload per content, so this ends
+        waiting = [i for i, result in enumerate(results) if isinstance(result, UploadTask)]
+        while waiting:
+            for i, result in zip(waiting, pipeline.run_sync([results[i] for i in waiting])):
+                results[i] = result
+            waiting = [i for i in waiting if isinstance(results[i], UploadTask)]
+        report = summarize(results, time.perf_counter() - started)
+        logger.info(format_report(report))
+        return report
+
+    def run(self, paths: Iterable[str], prefix: str = '') -> Dict[str, Any]:
+        """Upload the images found under ``paths``; see upload_tasks."""
+        return self.upload_tasks(find_images(paths, prefix))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Upload local images: ``python -m src.uploads <path>... [--prefix P]``."""
+    parser = argparse.ArgumentParser(description="Upload local images to the configured bucket")
+    parser.add_argument('paths', nargs='+', help="Image files or directories")
+    parser.add_argument('--prefix', default='', help="Prepended to every blob name, e.g. 2024/")
+    args = parser.parse_args(argv)
+
+    from src.main import configure_logging, get_storage_manager
+    configure_logging()
+    storage_manager = get_storage_manager()
+    if not storage_manager.bucket:
+        logger.error("Google Cloud Storage not properly configured")
+        return 1
+    report = storage_manager.bulk_upload(args.paths, prefix=args.prefix)
+    print(format_report(report))
+    return 1 if report[FAILED] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,574 @@
+"""
+In-process fakes for the external services used by Zmaninstaposter.
+
+These stand in for ``google.cloud.storage`` clients, buckets and blobs, for
+Gemini's ``GenerativeModel`` and for the Instagram Graph API, so tests and
+benchmarks can exercise listing, paging, downloads, captioning and posting
+without network access. Every fake accepts a ``Faults`` object that injects
+latency and errors.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, List, Dict, Callable, Iterator, Tuple
+from urllib.parse import quote, urlparse, parse_qs
+
+import google_crc32c
+
+
+def glob_to_regex(glob: str) -> 're.Pattern':
+    """Translate a GCS ``matchGlob``: ``*`` stops at '/', ``**`` crosses folders."""
+    parts = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif glob.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif glob[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif glob[i] == '{':
+            end = glob.index('}', i)
+            parts.append('(?:' + '|'.join(re.escape(o) for o in glob[i + 1:end].split(',')) + ')')
+            i = end + 1
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return re.compile(''.join(parts))
+
+
+class Faults:
+    """
+    Latency and error injection shared by the fakes.
+
+    Args:
+        latency: Seconds added to every call
+        jitter: Extra random delay of up to this many seconds
+        error_rate: Probability that a call fails
+        seed: Seed of the random source, so runs are repeatable
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self) -> Tuple[float, bool]:
+        """Decide one call's fate: (delay in seconds, whether it fails)."""
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            fail = self._rng.random() < self.error_rate
+            self.errors += fail
+        return delay, fail
+
+    def hit(self, error: Callable[[], Exception] = lambda: ConnectionError("injected fault")) -> None:
+        """Sleep for the injected latency and raise the injected error, if any."""
+        delay, fail = self.draw()
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise error()
+
+
+class FakeClock:
+    """Settable stand-in for ``time.time``; advance it by changing ``now``."""
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class PreconditionFailed(Exception):
+    """Stand-in for google.api_core.exceptions.PreconditionFailed."""
+    code = 412
+
+
+class FakeBlob:
+    """Minimal stand-in for google.cloud.storage.Blob."""
+
+    def __init__(self, bucket: 'FakeBucket', name: str, data: bytes = b'',
+                 content_type: Optional[str] = None, generation: int = 1,
+                 updated: Optional[datetime] = None):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = content_type
+        self.generation = generation
+        self.updated = updated or datetime.now(timezone.utc)
+        self.data = data
+        self.metadata: Optional[Dict[str, str]] = None
+        self.cache_control: Optional[str] = None
+        self.acl: Optional[str] = None
+        self.chunk_size: Optional[int] = None
+
+    @property
+    def data(self) -> bytes:
+        return self._data
+
+    @data.setter
+    def data(self, value: bytes) -> None:
+        self._data = value
+        self.size = len(value)
+        self.md5_hash = base64.b64encode(hashlib.md5(value).digest()).decode('ascii')
+        self.crc32c = base64.b64encode(google_crc32c.value(value).to_bytes(4, 'big')).decode('ascii')
+
+    def download_as_bytes(self, start: Optional[int] = None, end: Optional[int] = None,
+                          checksum: Optional[str] = 'md5', **kwargs) -> bytes:
+        """Return the blob's bytes; ``end`` is inclusive like the real client."""
+        if self.bucket.faults:
+            self.bucket.faults.hit()
+        current = self.bucket.blobs.get(self.name)
+        if current is None or (self.generation and current.generation != self.generation):
+            raise FileNotFoundError(f"404 No such object: {self.bucket.name}/{self.name}")
+        self.bucket.download_calls.append({"name": self.name, "start": start, "end": end})
+        remaining = self.bucket.interrupt_download.get(self.name)
+        if remaining is not None:
+            if remaining <= 0:
+                del self.bucket.interrupt_download[self.name]
+                raise ConnectionError("simulated connection reset while downloading")
+            self.bucket.interrupt_download[self.name] = remaining - 1
+        data = current.data
+        return data[start or 0:None if end is None else end + 1]
+
+    def download_to_filename(self, filename: str, **kwargs) -> None:
+        with open(filename, 'wb') as f:
+            f.write(self.download_as_bytes())
+
+    def upload_from_filename(self, filename: str, content_type: Optional[str] = None,
+                             predefined_acl: Optional[str] = None,
+                             if_generation_match: Optional[int] = None, **kwargs) -> None:
+        """Store the file's bytes, in ``chunk_size`` requests when set, like a resumable upload."""
+        if self.bucket.faults:
+            self.bucket.faults.hit()
+        with open(filename, 'rb') as f:
+            data = f.read()
+        with self.bucket.lock:
+            current = self.bucket.blobs.get(self.name)
+            if if_generation_match is not None and (current.generation if current else 0) != if_generation_match:
+                raise PreconditionFailed(f"412 Precondition failed: {self.bucket.name}/{self.name}")
+            blob = self.bucket.add_blob(self.name, data, content_type or self.content_type)
+            blob.metadata, blob.cache_control, blob.acl = self.metadata, self.cache_control, predefined_acl
+            requests = -(-len(data) // self.chunk_size) if self.chunk_size else 1
+            self.bucket.upload_calls.append({"name": self.name, "requests": max(1, requests),
+                                             "predefined_acl": predefined_acl,
+                                             "if_generation_match": if_generation_match, **kwargs})
+        self.generation = blob.generation
+
+    @property
+    def public_url(self) -> str:
+        return f"https://storage.googleapis.com/{self.bucket.name}/{quote(self.name)}"
+
+
+class FakeBlobIterator:
+    """Page-aware iterator mirroring google.api_core.page_iterator.HTTPIterator."""
+
+    def __init__(self, items: List[FakeBlob], prefixes: List[str], page_size: int,
+                 page_token: Optional[str], fail_after_pages: Optional[int] = None,
+                 faults: Optional[Faults] = None):
+        self._items = items
+        self._fail_after_pages = fail_after_pages
+        self._faults = faults
+        self._page_size = page_size
+        self._offset = int(page_token) if page_token else 0
+        self.prefixes = set(prefixes)
+        self.next_page_token = page_token
+        self.pages_served = 0
+
+    @property
+    def pages(self):
+        while True:
+            if self._fail_after_pages is not None and self.pages_served >= self._fail_after_pages:
+                raise ConnectionError("simulated connection reset while listing")
+            if self._faults:
+                self._faults.hit()
+            page = self._items[self._offset:self._offset + self._page_size]
+            self._offset += len(page)
+            self.next_page_token = str(self._offset) if self._offset < len(self._items) else None
+            self.pages_served += 1
+            yield page
+            if self.next_page_token is None:
+                return
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class FakeBucket:
+    """In-memory bucket implementing the subset of the Bucket API we use."""
+
+    def __init__(self, name: str = 'fake-bucket', page_size: int = 1000):
+        self.name = name
+        self.default_page_size = page_size
+        self.blobs: Dict[str, FakeBlob] = {}
+        self.list_calls: List[Dict] = []
+        self.iterators: List[FakeBlobIterator] = []
+        self.download_calls: List[Dict] = []
+        # blob name -> successful downloads before the next one fails (one shot)
+        self.interrupt_download: Dict[str, int] = {}
+        # prefix -> pages served before the next listing of that prefix fails (one shot)
+        self.interrupt_listing: Dict[str, int] = {}
+        self.upload_calls: List[Dict] = []
+        self.lock = threading.Lock()
+        # Latency/errors injected into every listing page, download and upload
+        self.faults: Optional[Faults] = None
+
+    def add_blob(self, name: str, data: bytes = b'', content_type: Optional[str] = None,
+                 updated: Optional[datetime] = None) -> FakeBlob:
+        """Create or overwrite a blob, bumping its generation like GCS does."""
+        existing = self.blobs.get(name)
+        generation = existing.generation + 1 if existing else 1
+        blob = FakeBlob(self, name, data, content_type, generation, updated)
+        self.blobs[name] = blob
+        return blob
+
+    def delete_blob(self, name: str) -> None:
+        del self.blobs[name]
+
+    def blob(self, name: str, generation: Optional[int] = None,
+             chunk_size: Optional[int] = None) -> FakeBlob:
+        existing = self.blobs.get(name)
+        if existing is None:
+            handle = FakeBlob(self, name, generation=generation or 0)
+            handle.chunk_size = chunk_size
+            return handle
+        # A handle pinned to one generation, like Bucket.blob(name, generation=...)
+        handle = FakeBlob(self, name, b'', existing.content_type,
+                          generation or existing.generation, existing.updated)
+        handle.data = existing.data
+        handle.chunk_size = chunk_size
+        return handle
+
+    def get_blob(self, name: str) -> Optional[FakeBlob]:
+        return self.blobs.get(name)
+
+    def list_blobs(self, prefix: Optional[str] = None, delimiter: Optional[str] = None,
+                   page_token: Optional[str] = None, page_size: Optional[int] = None,
+                   max_results: Optional[int] = None, fields: Optional[str] = None,
+                   match_glob: Optional[str] = None, start_offset: Optional[str] = None,
+                   **kwargs) -> FakeBlobIterator:
+        self.list_calls.append({"prefix": prefix, "delimiter": delimiter,
+                                "page_token": page_token, "match_glob": match_glob,
+                                "start_offset": start_offset, **kwargs})
+        prefix = prefix or ''
+        pattern = glob_to_regex(match_glob) if match_glob else None
+        items = []
+        prefixes = set()
+        for name in sorted(self.blobs):
+            if not name.startswith(prefix):
+                continue
+            if start_offset and name < start_offset:
+                continue
+            if pattern and not pattern.fullmatch(name):
+                continue
+            rest = name[len(prefix):]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter, 1)[0] + delimiter)
+                continue
+            items.append(self.blobs[name])
+        if max_results is not None:
+            items = items[:max_results]
+        iterator = FakeBlobIterator(items, sorted(prefixes), page_size or self.default_page_size,
+                                    page_token, self.interrupt_listing.pop(prefix, None), self.faults)
+        self.iterators.append(iterator)
+        return iterator
+
+
+class SyntheticBlob:
+    """Listing-only blob generated by SyntheticBucket."""
+
+    __slots__ = ('bucket', 'name', 'generation', 'size', 'md5_hash', 'crc32c', 'content_type', 'updated')
+
+    def __init__(self, bucket: 'SyntheticBucket', name: str, index: int):
+        self.bucket = bucket
+        self.name = name
+        self.generation = index + 1
+        self.size = 200_000 + index % 50_000
+        self.md5_hash = base64.b64encode(index.to_bytes(16, 'big')).decode('ascii')
+        self.crc32c = None
+        self.content_type = 'image/jpeg'
+        self.updated = SyntheticBucket.EPOCH + timedelta(seconds=index)
+
+    @property
+    def public_url(self) -> str:
+        return f"https://storage.googleapis.com/{self.bucket.name}/{quote(self.name)}"
+
+
+class _LazyBlobIterator:
+    def __init__(self, blobs: Iterator[SyntheticBlob], prefixes: List[str], page_size: int,
+                 faults: Optional[Faults]):
+        self._blobs = blobs
+        self._page_size = page_size
+        self._faults = faults
+        self.prefixes = set(prefixes)
+        self.pages_served = 0
+
+    @property
+    def pages(self):
+        while True:
+            if self._faults:
+                self._faults.hit()
+            page = [blob for _, blob in zip(range(self._page_size), self._blobs)]
+            self.pages_served += 1
+            yield page
+            if len(page) < self._page_size:
+                return
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+
+class SyntheticBucket:
+    """
+    Bucket of ``count`` generated images spread over ``folders`` folders.
+
+    Blobs are created while a listing is iterated, so a million-blob bucket
+    costs no memory until it is listed. Names look like
+    ``f003/img00001234.jpg`` and list in name order like GCS.
+    """
+
+    EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def __init__(self, count: int, folders: int = 10, name: str = 'synthetic-bucket',
+                 faults: Optional[Faults] = None):
+        self.count = count
+        self.folders = max(1, folders)
+        self.per_folder = -(-count // self.folders)
+        self.name = name
+        self.faults = faults
+        self.list_calls: List[Dict] = []
+
+    def _folder(self, k: int) -> str:
+        return f"f{k:03d}/"
+
+    def _iter_blobs(self, prefix: str, start_offset: Optional[str]) -> Iterator[SyntheticBlob]:
+        for k in range(self.folders):
+            folder = self._folder(k)
+            if not (folder.startswith(prefix) or prefix.startswith(folder)):
+                continue
+            for j in range(min(self.per_folder, self.count - k * self.per_folder)):
+                name = f"{folder}img{j:08d}.jpg"
+                if name.startswith(prefix) and (not start_offset or name >= start_offset):
+                    yield SyntheticBlob(self, name, k * self.per_folder + j)
+
+    def get_blob(self, name: str) -> Optional[SyntheticBlob]:
+        try:
+            k = int(name[1:4])
+            j = int(name[len(self._folder(k)) + 3:-4])
+        except ValueError:
+            return None
+        index = k * self.per_folder + j
+        return SyntheticBlob(self, name, index) if index < self.count else None
+
+    def list_blobs(self, prefix: Optional[str] = None, delimiter: Optional[str] = None,
+                   page_size: Optional[int] = None, start_offset: Optional[str] = None,
+                   **kwargs) -> _LazyBlobIterator:
+        self.list_calls.append({"prefix": prefix, "delimiter": delimiter, "start_offset": start_offset})
+        if delimiter and not prefix:
+            folders = [self._folder(k) for k in range(self.folders)
+                       if k * self.per_folder < self.count]
+            return _LazyBlobIterator(iter(()), folders, page_size or 1000, self.faults)
+        return _LazyBlobIterator(self._iter_blobs(prefix or '', start_offset), [],
+                                 page_size or 1000, self.faults)
+
+
+class FakeStorageClient:
+    """Stand-in for google.cloud.storage.Client serving one bucket."""
+
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def bucket(self, name: str):
+        return self._bucket
+
+
+class FakeGenerateResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGenerativeModel:
+    """
+    Stand-in for genai.GenerativeModel.
+
+    Single-image (or text) prompts get one caption; multi-image requests with
+    a JSON response type get a JSON array with one caption per image.
+    """
+
+    def __init__(self, faults: Optional[Faults] = None, caption: str = 'A quiet study in light ✨ #art'):
+        self.faults = faults or Faults()
+        self.caption = caption
+        self.requests = 0
+
+    def _answer(self, contents, generation_config) -> FakeGenerateResponse:
+        self.requests += 1
+        images = [p for p in contents if isinstance(p, dict)] if isinstance(contents, list) else []
+        if generation_config and len(images) > 1:
+            return FakeGenerateResponse(json.dumps([f"{self.caption} ({i + 1})" for i in range(len(images))]))
+        return FakeGenerateResponse(self.caption)
+
+    def generate_content(self, contents, generation_config=None, **kwargs) -> FakeGenerateResponse:
+        self.faults.hit(lambda: RuntimeError("503 Service Unavailable (injected)"))
+        return self._answer(contents, generation_config)
+
+    async def generate_content_async(self, contents, generation_config=None, **kwargs):
+        delay, fail = self.faults.draw()
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("503 Service Unavailable (injected)")
+        return self._answer(contents, generation_config)
+
+
+class _GraphAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stub.connections += 1
+
+    def _handle(self):
+        stub = self.server.stub
+        parsed = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        params.update({k: v[0] for k, v in parse_qs(body).items()})
+        stub.requests.append({"method": self.command, "path": parsed.path, "params": params})
+
+        status, payload, headers, delay = stub.respond(self.command, parsed.path, params)
+        if delay:
+            time.sleep(delay)
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class GraphAPIStub:
+    """
+    Local HTTP server imitating the Instagram Graph API.
+
+    By default container creation and publishing succeed. Tests can queue
+    scripted responses per path suffix (e.g. 'media_publish') with
+    ``script()``; queued responses are consumed in order before falling back
+    to the default behaviour. Publishes are counted per user and reported by
+    ``content_publishing_limit``; past ``publishing_limit`` (if set) they are
+    refused the way Instagram refuses them.
+    """
+
+    def __init__(self):
+        self.requests: List[Dict] = []
+        self.connections = 0
+        self.scripts: Dict[str, List[tuple]] = {}
+        self.default_headers: Dict[str, str] = {}
+        # Latency/errors injected into unscripted responses
+        self.faults: Optional[Faults] = None
+        # container id -> status_code sequence returned by successive polls
+        self.statuses: Dict[str, List[str]] = {}
+        # user id -> publishes so far, and the quota enforced on them
+        self.published: Dict[str, int] = {}
+        self.publishing_limit: Optional[int] = None
+        self._counter = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _GraphAPIHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'GraphAPIStub':
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def script(self, suffix: str, status: int = 200, payload: Optional[Dict] = None,
+               headers: Optional[Dict[str, str]] = None, delay: float = 0.0) -> None:
+        """Queue a one-shot response for the next request whose path ends with ``suffix``."""
+        self.scripts.setdefault(suffix, []).append((status, payload or {}, headers or {}, delay))
+
+    def calls(self, suffix: str) -> List[Dict]:
+        return [r for r in self.requests if r["path"].endswith(suffix)]
+
+    def next_id(self, prefix: str) -> str:
+        with self._lock:
+            self._counter += 1
+            return f"{prefix}{self._counter}"
+
+    def container_status(self, container_id: str) -> str:
+        with self._lock:
+            sequence = self.statuses.get(container_id)
+            if not sequence:
+                return "FINISHED"
+            return sequence.pop(0) if len(sequence) > 1 else sequence[0]
+
+    def respond(self, method: str, path: str, params: Dict[str, str]):
+        with self._lock:
+            for suffix, queued in self.scripts.items():
+                if path.endswith(suffix) and queued:
+                    return queued.pop(0)
+        delay = 0.0
+        if self.faults:
+            delay, fail = self.faults.draw()
+            if fail:
+                return 500, {"error": {"message": "injected fault", "code": 2}}, dict(self.default_headers), delay
+        if method == 'GET' and 'ids' in params:
+            payload = {cid: {"id": cid, "status_code": self.container_status(cid)}
+                       for cid in params['ids'].split(',')}
+            return 200, payload, dict(self.default_headers), 0.0
+        if path.endswith('/content_publishing_limit'):
+            user = path.rsplit('/', 2)[-2]
+            payload = {"data": [{"quota_usage": self.published.get(user, 0),
+                                 "config": {"quota_total": self.publishing_limit or 50, "quota_duration": 86400}}]}
+            return 200, payload, dict(self.default_headers), 0.0
+        if path.endswith('/media_publish'):
+            user = path.rsplit('/', 2)[-2]
+            with self._lock:
+                limit = self.publishing_limit
+                if limit is not None and self.published.get(user, 0) >= limit:
+                    error = {"message": "The maximum number of posts that can be published has been reached",
+                             "code": 9, "error_subcode": 2207042}
+                    return 400, {"error": error}, dict(self.default_headers), 0.0
+                self.published[user] = self.published.get(user, 0) + 1
+            return 200, {"id": self.next_id('media-')}, dict(self.default_headers), 0.0
+        if path.endswith('/media'):
+            return 200, {"id": self.next_id('container-')}, dict(self.default_headers), 0.0
+        return 200, {"id": path.rsplit('/', 1)[-1], "status_code": "FINISHED"}, dict(self.default_headers), 0.0
@@ -0,0 +1,148 @@
+import os
+import unittest
+from unittest.mock import patch
+
+from src import main
+from src.accounts import (Account, AccountContext, AccountDispatcher, PrefixedSource,
+                          load_accounts)
+from src.history import PostedHistory
+from src.instagram_client import InstagramClient
+from src.jobs import JobQueue, JobRunner
+from src.manifest import BlobRecord
+from src.rotation import InMemorySource, SelectionEngine
+from tests.fakes import GraphAPIStub
+
+
+def make_record(name, updated=0.0):
+    return BlobRecord(name, 1, 10, f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', updated)
+
+
+class FakeClient:
+    def __init__(self, usage=0.0):
+        self.usage = usage
+
+    def usage_percent(self):
+        return self.usage
+
+
+def make_context(name, client=None, prefix=None):
+    engine = SelectionEngine(PostedHistory(':memory:', account=name))
+    return AccountContext(Account(name, '1', 'token', prefix=prefix), engine,
+                          lambda: client or FakeClient())
+
+
+class TestLoadAccounts(unittest.TestCase):
+    """
+    Test suite for the config-driven account registry.
+    """
+
+    def test_tokens_can_come_from_environment(self):
+        config = {"accounts": [
+            {"name": "gallery", "user_id": 17841, "access_token_env": "GALLERY_TOKEN",
+             "prefix": "paintings/"},
+            {"name": "prints", "user_id": "17842", "access_token": "inline"},
+        ]}
+
+        with patch.dict(os.environ, {"GALLERY_TOKEN": "from-env"}):
+            accounts = load_accounts(config)
+
+        self.assertEqual([a.name for a in accounts], ["gallery", "prints"])
+        self.assertEqual(accounts[0].access_token, "from-env")
+        self.assertEqual(accounts[0].user_id, "17841")
+        self.assertEqual(accounts[0].prefix, "paintings/")
+
+    def test_invalid_accounts_are_rejected(self):
+        with self.assertRaises(ValueError):
+            load_accounts({"accounts": [{"name": "a", "user_id": "1"}]})
+        with self.assertRaises(ValueError):
+            load_accounts({"accounts": [{"name": "a", "user_id": "1", "access_token": "t"},
+                                        {"name": "a", "user_id": "2", "access_token": "t"}]})
+        self.assertEqual(load_accounts({}), [])
+
+    def test_strategy_options_are_not_shared_between_accounts(self):
+        accounts = load_accounts({"accounts": [
+            {"name": "gallery", "user_id": "1", "access_token": "t"},
+            {"name": "prints", "user_id": "2", "access_token": "t",
+             "strategy": "weighted_random", "strategy_options": {"weights": {"a/": 2}}},
+        ]})
+
+        self.assertIsNone(accounts[0].strategy_options)
+        self.assertIsNone(Account('other', '3', 't').strategy_options)
+        self.assertEqual(accounts[1].strategy_options, {"weights": {"a/": 2}})
+
+
+class TestAccountDispatcher(unittest.TestCase):
+    """
+    Test suite for per-account views of the candidate source.
+    """
+
+    def test_prefixed_source_limits_candidates(self):
+        source = InMemorySource([make_record('paintings/a.jpg'), make_record('prints/b.jpg')])
+        prefixed = PrefixedSource(source, 'prints/')
+
+        self.assertEqual([r.name for r in prefixed.iter_records()], ['prints/b.jpg'])
+        self.assertEqual(prefixed.folders(), ['prints/'])
+
+
+class FakeStorageManager:
+    def __init__(self, source):
+        self.source = source
+
+    def candidate_source(self):
+        return self.source
+
+
+class TestAccountPipeline(unittest.TestCase):
+    """
+    End-to-end posting rounds of several accounts against the local Graph API stub.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.addCleanup(self.stub.stop)
+        self.queue = JobQueue(':memory:')
+        self.contexts = []
+        for name, prefix in (('gallery', 'paintings/'), ('prints', 'prints/')):
+            client = InstagramClient('token', name, base_url=self.stub.base_url)
+            self.contexts.append(make_context(name, client=client, prefix=prefix))
+        source = InMemorySource([make_record('paintings/a.jpg', 1), make_record('paintings/b.jpg', 2),
+                                 make_record('prints/c.jpg', 3)])
+        for p in (patch.object(main, 'get_job_queue', return_value=self.queue),
+                  patch.object(main, 'get_account_dispatcher', return_value=AccountDispatcher(self.contexts)),
+                  patch.object(main, 'get_storage_manager', return_value=FakeStorageManager(source)),
+                  patch.object(main, 'caption_for_record', return_value='caption'),
+                  patch.object(main, 'instagram_url_for', side_effect=lambda record: record.public_url),
+                  patch.object(main, 'get_config', return_value={})):
+            p.start()
+            self.addCleanup(p.stop)
+        self.runner = JobRunner(self.queue, main.JOB_HANDLERS)
+
+    def post_round(self, round_key):
+        self.queue.enqueue(main.ROUND_JOB, {"round": round_key})
+        self.runner.run_pending()
+
+    def posted(self, context):
+        return [post["blob_name"] for post in context.engine.history.posted_since(None)]
+
+    def test_each_account_posts_from_its_own_prefix_and_history(self):
+        self.post_round('2024-01-01')
+        self.post_round('2024-01-02')
+
+        self.assertEqual(sorted(self.posted(self.contexts[0])), ['paintings/a.jpg', 'paintings/b.jpg'])
+        self.assertEqual(self.posted(self.contexts[1]), ['prints/c.jpg'])
+        self.assertEqual(len(self.stub.calls('/gallery/media_publish')), 2)
+
+    def test_failing_account_does_not_hold_up_the_others(self):
+        def misconfigured():
+            raise ValueError("Instagram access token not configured")
+        self.contexts[1]._client_factory = misconfigured
+
+        self.post_round('2024-01-01')
+
+        self.assertEqual(self.posted(self.contexts[0]), ['paintings/a.jpg'])
+        self.assertEqual(self.posted(self.contexts[1]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from PIL import Image
+
+from src.async_captions import AsyncCaptionBatcher, TokenBucket, is_retryable
+from src.main import GeminiCaptionGenerator
+from src.manifest import BlobRecord
+from src.thumbnails import ThumbnailCache, make_thumbnail
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class RateLimited(Exception):
+    code = 429
+
+
+class FakeAsyncModel:
+    """Gemini stand-in that sleeps and fails the first call for some images."""
+
+    def __init__(self, delay=0.01, flaky=(), broken=()):
+        self.delay = delay
+        self.flaky = set(flaky)
+        self.broken = set(broken)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    async def generate_content_async(self, prompt):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            url = prompt.rsplit(' ', 1)[-1]
+            if url in self.broken:
+                raise ValueError("prompt blocked")
+            if url in self.flaky:
+                self.flaky.discard(url)
+                raise RateLimited("429 Resource exhausted")
+            return FakeResponse(f" caption for {url} ")
+        finally:
+            self.in_flight -= 1
+
+
+class FakeSyncModel:
+    def generate_content(self, prompt):
+        time.sleep(0.01)
+        return FakeResponse("sync caption")
+
+
+class FakeMultimodalModel:
+    """Gemini stand-in that answers multi-image requests with a JSON array."""
+
+    def __init__(self, malformed=False):
+        self.malformed = malformed
+        self.requests = []
+
+    def generate_content(self, contents, generation_config=None):
+        images = [p for p in contents if isinstance(p, dict)] if isinstance(contents, list) else []
+        self.requests.append({"images": len(images),
+                              "bytes": sum(len(p["data"]) for p in images),
+                              "json": bool(generation_config)})
+        if len(images) > 1:
+            captions = [f"caption {i}" for i in range(len(images))]
+            return FakeResponse(json.dumps(captions[:-1] if self.malformed else captions))
+        return FakeResponse("single caption" if images else "text caption")
+
+
+def make_generator(model):
+    generator = GeminiCaptionGenerator()
+    generator.model = model
+    generator.prompt_template = "Caption {image_url}"
+    return generator
+
+
+def thumbnail_cache(directory, fetched):
+    def fetch(url, record=None):
+        fetched.append(url)
+        color = int(url.rsplit('/', 1)[-1].split('.')[0]) * 20
+        return encode_png(Image.new('RGB', (3000, 2000), (color, 0, 0)))
+    return ThumbnailCache(fetch, directory, max_side=256)
+
+
+def encode_png(image):
+    output = io.BytesIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+class TestAsyncCaptionBatcher(unittest.TestCase):
+    """
+    Test suite for concurrent caption generation.
+    """
+
+    def setUp(self):
+        self.urls = [f"https://example.com/{i}.jpg" for i in range(12)]
+
+    def test_concurrency_is_bounded(self):
+        model = FakeAsyncModel()
+        batcher = AsyncCaptionBatcher(make_generator(model), concurrency=3,
+                                      requests_per_minute=None)
+
+        captions = asyncio.run(batcher.generate_captions(self.urls))
+
+        self.assertEqual(len(captions), 12)
+        self.assertEqual(captions[self.urls[0]], f"caption for {self.urls[0]}")
+        self.assertEqual(model.max_in_flight, 3)
+
+    def test_retryable_errors_are_retried_and_others_reported(self):
+        model = FakeAsyncModel(flaky=self.urls[:4], broken=self.urls[-1:])
+        batcher = AsyncCaptionBatcher(make_generator(model), concurrency=4,
+                                      requests_per_minute=None, base_delay=0.01)
+
+        async def collect():
+            return [result async for result in batcher.stream(self.urls)]
+
+        results = {r.image_url: r for r in asyncio.run(collect())}
+
+        self.assertEqual(results[self.urls[0]].attempts, 2)
+        self.assertIsNotNone(results[self.urls[0]].caption)
+        self.assertIsNone(results[self.urls[-1]].caption)
+        self.assertEqual(results[self.urls[-1]].attempts, 1)
+
+    def test_sync_models_run_in_executor(self):
+        generator = make_generator(FakeSyncModel())
+
+        captions = generator.generate_captions(self.urls[:3], requests_per_minute=None)
+
+        self.assertEqual(set(captions.values()), {"sync caption"})
+
+    def test_unconfigured_generator_raises(self):
+        generator = make_generator(None)
+
+        with self.assertRaises(RuntimeError):
+            generator.generate_captions(self.urls)
+
+
+class TestMultimodalCaptions(unittest.TestCase):
+    """
+    Test suite for thumbnail-based captioning with multi-image requests.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fetched = []
+        self.model = FakeMultimodalModel()
+        self.generator = make_generator(self.model)
+        self.generator.thumbnails = thumbnail_cache(self.tmpdir, self.fetched)
+        self.generator.images_per_request = 4
+        self.urls = [f"https://example.com/{i}.png" for i in range(10)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_images_are_packed_into_batched_requests(self):
+        captions = self.generator.request_captions(self.urls)
+
+        self.assertEqual(len(captions), 10)
+        self.assertEqual([r["images"] for r in self.model.requests], [4, 4, 2])
+        self.assertTrue(all(r["json"] for r in self.model.requests))
+        self.assertEqual(captions[self.urls[5]], "caption 1")
+
+    def test_request_size_limit_splits_batches(self):
+        self.generator.thumbnails.fetch = lambda url, record: encode_png(Image.new('RGB', (3000, 2000)))
+        thumbnail_size = len(self.generator.thumbnails.get(self.urls[0]))
+        self.generator.max_request_bytes = thumbnail_size * 2 + 1
+
+        self.generator.request_captions(self.urls[:4])
+
+        self.assertEqual([r["images"] for r in self.model.requests], [2, 2])
+        self.assertTrue(all(r["bytes"] <= self.generator.max_request_bytes
+                            for r in self.model.requests))
+
+    def test_thumbnails_are_small_and_created_once(self):
+        self.generator.request_captions(self.urls[:4])
+        self.generator.request_captions(self.urls[:4])
+
+        self.assertEqual(self.fetched, self.urls[:4])
+        thumbnail = Image.open(io.BytesIO(self.generator.thumbnails.get(self.urls[0])))
+        self.assertEqual(thumbnail.format, 'JPEG')
+        self.assertEqual(max(thumbnail.size), 256)
+
+    def test_overwritten_image_gets_a_new_thumbnail(self):
+        thumbnails = self.generator.thumbnails
+        url = self.urls[1]
+        record = BlobRecord('1.png', 1, 10, 'md5-old', 'image/png', url, 0.0)
+
+        first = thumbnails.get(url, record)
+        thumbnails.get(url, record)
+        thumbnails.fetch = lambda url, record: encode_png(Image.new('RGB', (3000, 2000), (0, 255, 0)))
+        second = thumbnails.get(url, record._replace(generation=2, md5_hash='md5-new'))
+
+        self.assertEqual(self.fetched, [url])
+        self.assertNotEqual(first, second)
+
+    def test_cache_is_pruned_by_age_then_size(self):
+        thumbnails = self.generator.thumbnails
+        for url in self.urls[:4]:
+            thumbnails.get(url)
+        paths = [thumbnails.path_for(url) for url in self.urls[:4]]
+        now = time.time()
+        for age, path in zip((40 * 86400, 3, 2, 1), paths):
+            os.utime(path, (now - age, now - age))
+        thumbnails.max_cache_bytes = os.path.getsize(paths[2]) + os.path.getsize(paths[3])
+
+        stats = thumbnails.prune()
+
+        self.assertEqual(stats["removed"], 2)
+        self.assertEqual([os.path.exists(p) for p in paths], [False, False, True, True])
+
+    def test_thumbnail_respects_byte_budget(self):
+        noisy = encode_png(Image.effect_noise((2000, 2000), 100))
+
+        thumbnail = make_thumbnail(noisy, max_side=1024, max_bytes=40 * 1024)
+
+        self.assertLessEqual(len(thumbnail), 40 * 1024)
+
+    def test_malformed_batch_falls_back_to_single_requests(self):
+        self.model.malformed = True
+
+        captions = self.generator.request_captions(self.urls[:3])
+
+        self.assertEqual(set(captions.values()), {"single caption"})
+        self.assertEqual([r["images"] for r in self.model.requests], [3, 1, 1, 1])
+
+    def test_async_batcher_packs_images(self):
+        batcher = AsyncCaptionBatcher(self.generator, concurrency=2, requests_per_minute=None)
+
+        captions = asyncio.run(batcher.generate_captions(self.urls))
+
+        self.assertEqual(len(captions), 10)
+        self.assertEqual(sorted(r["images"] for r in self.model.requests), [2, 4, 4])
+
+    def test_failed_group_is_reported_instead_of_hanging(self):
+        batcher = AsyncCaptionBatcher(self.generator, concurrency=2, requests_per_minute=None)
+
+        async def collect():
+            return [result async for result in batcher.stream(self.urls)]
+
+        with patch.object(self.generator, 'build_batch_contents', side_effect=OSError('unreadable')):
+            results = asyncio.run(asyncio.wait_for(collect(), 5))
+
+        self.assertEqual(sorted(r.image_url for r in results), sorted(self.urls))
+        self.assertEqual({(r.caption, r.error) for r in results}, {(None, 'unreadable')})
+
+    def test_unavailable_thumbnail_falls_back_to_url_prompt(self):
+        self.generator.thumbnails.fetch = lambda url, record: b'not an image'
+
+        self.assertEqual(self.generator.request_caption(self.urls[0]), "text caption")
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Test suite for the asyncio token bucket.
+    """
+
+    def test_acquire_waits_for_refill(self):
+        async def run():
+            bucket = TokenBucket(rate_per_minute=600, capacity=2)
+            start = time.monotonic()
+            for _ in range(4):
+                await bucket.acquire()
+            return time.monotonic() - start
+
+        # Two burst tokens, then two more at 10 tokens/second
+        self.assertGreaterEqual(asyncio.run(run()), 0.18)
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(RateLimited()))
+        self.assertTrue(is_retryable(ConnectionError()))
+        self.assertFalse(is_retryable(ValueError()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from src import main
+from src.accounts import Account, AccountContext, AccountDispatcher
+from src.async_pipeline import AsyncPipeline, Finished, Stage
+from src.history import PostedHistory
+from src.instagram_client import InstagramClient
+from src.manifest import BlobRecord
+from src.rotation import InMemorySource, SelectionEngine
+from tests.fakes import GraphAPIStub
+
+
+def make_record(name, updated=0.0):
+    return BlobRecord(name, 1, 10, f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', updated)
+
+
+class FakeStorageManager:
+    def __init__(self, source):
+        self.source = source
+
+    def candidate_source(self):
+        return self.source
+
+
+class TestAsyncPipeline(unittest.TestCase):
+    """
+    Test suite for the bounded-queue stage pipeline.
+    """
+
+    def test_results_keep_input_order_and_stages_overlap(self):
+        def slow(item):
+            time.sleep(0.05)
+            return item * 10
+
+        async def fast(item):
+            await asyncio.sleep(0.01 * (5 - item))
+            return item + 1
+
+        pipeline = AsyncPipeline([Stage('slow', slow, workers=5), Stage('fast', fast, workers=5)])
+        started = time.perf_counter()
+        results = pipeline.run_sync(range(5))
+
+        self.assertEqual(results, [1, 11, 21, 31, 41])
+        # Run one after another, the items would take about 0.4s
+        self.assertLess(time.perf_counter() - started, 0.25)
+
+    def test_finished_and_failed_items_skip_later_stages(self):
+        seen = []
+
+        def check(item):
+            if item == 'bad':
+                raise ValueError('broken')
+            if item == 'done':
+                return Finished('early')
+            return item
+
+        def record(item):
+            seen.append(item)
+            return item.upper()
+
+        results = AsyncPipeline([Stage('check', check), Stage('record', record)]).run_sync(
+            ['a', 'bad', 'done', 'b'])
+
+        self.assertEqual(results, ['A', {"error": "broken", "stage": "check"}, 'early', 'B'])
+        self.assertEqual(seen, ['a', 'b'])
+
+    def test_bounded_queues_limit_work_in_progress(self):
+        release = threading.Event()
+        started = []
+
+        def produce(item):
+            started.append(item)
+            return item
+
+        def consume(item):
+            release.wait(5)
+            return item
+
+        pipeline = AsyncPipeline([Stage('produce', produce), Stage('consume', consume)], queue_size=2)
+
+        async def run():
+            task = asyncio.ensure_future(pipeline.run(range(20)))
+            await asyncio.sleep(0.2)
+            in_progress = len(started)
+            release.set()
+            return in_progress, await task
+
+        in_progress, results = asyncio.run(run())
+
+        # One item in consume, two queued and one waiting to be queued
+        self.assertLessEqual(in_progress, 4)
+        self.assertEqual(results, list(range(20)))
+
+
+class TestAsyncWorkflow(unittest.TestCase):
+    """
+    Test suite for the pipelined posting workflow.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.addCleanup(self.stub.stop)
+        contexts = []
+        for name in ('gallery', 'prints'):
+            client = InstagramClient('token', name, base_url=self.stub.base_url)
+            engine = SelectionEngine(PostedHistory(':memory:', account=name))
+            contexts.append(AccountContext(Account(name, name, 'token', prefix=f'{name}/'), engine,
+                                           lambda client=client: client))
+        self.dispatcher = AccountDispatcher(contexts)
+        source = InMemorySource([make_record('gallery/a.jpg', 1), make_record('gallery/b.jpg', 2),
+                                 make_record('prints/c.jpg', 3)])
+        for p in [
+            patch.object(main, 'get_account_dispatcher', return_value=self.dispatcher),
+            patch.object(main, 'get_storage_manager', return_value=FakeStorageManager(source)),
+            patch.object(main, 'caption_for_record', side_effect=lambda record: f'caption {record.name}'),
+            patch.object(main, 'instagram_url_for', side_effect=lambda record: record.public_url),
+            patch.object(main, 'get_config', return_value={}),
+        ]:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_batch_posts_distinct_images_for_every_account(self):
+        results = asyncio.run(main.workflow_async(posts_per_account=2))
+
+        self.assertEqual([r.get("image_url") for r in results['gallery']],
+                         ['https://example.com/gallery/a.jpg', 'https://example.com/gallery/b.jpg'])
+        self.assertEqual(results['gallery'][1]["caption"], 'caption gallery/b.jpg')
+        self.assertTrue(results['prints'][0]["success"])
+        self.assertEqual(results['prints'][1], {"error": "No image selected"})
+        self.assertEqual(len(self.stub.calls('/gallery/media_publish')), 2)
+        self.assertTrue(self.dispatcher.contexts[0].engine.history.is_posted('gallery/b.jpg'))
+
+    def test_throttled_account_is_skipped(self):
+        self.dispatcher.throttle_percent = 0
+
+        main.workflow()
+
+        self.assertEqual(self.stub.calls('/gallery/media'), [])
+        self.assertFalse(self.dispatcher.contexts[0].engine.history.is_posted('gallery/a.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import asyncio
+import unittest
+
+from benchmarks.suite import bench_pipeline, compare, percentile
+from tests.fakes import Faults, FakeGenerativeModel, SyntheticBucket
+
+
+class TestFakes(unittest.TestCase):
+    """
+    Test suite for the synthetic bucket and fault injection used by the benchmarks.
+    """
+
+    def test_synthetic_bucket_lists_in_name_order(self):
+        bucket = SyntheticBucket(25, folders=3)
+
+        names = [blob.name for blob in bucket.list_blobs(page_size=4)]
+        folders = bucket.list_blobs(delimiter='/')
+        list(folders)
+        resumed = [blob.name for blob in bucket.list_blobs(prefix='f001/', start_offset='f001/img00000005.jpg')]
+
+        self.assertEqual(len(names), 25)
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(sorted(folders.prefixes), ['f000/', 'f001/', 'f002/'])
+        self.assertEqual(resumed, ['f001/img00000005.jpg', 'f001/img00000006.jpg', 'f001/img00000007.jpg',
+                                   'f001/img00000008.jpg'])
+        self.assertEqual(bucket.get_blob('f002/img00000006.jpg').generation, 25)
+        self.assertIsNone(bucket.get_blob('f002/img00000007.jpg'))
+
+    def test_faults_are_repeatable(self):
+        def outcomes():
+            faults = Faults(error_rate=0.3, seed=4)
+            return [faults.draw()[1] for _ in range(100)]
+
+        first = outcomes()
+        self.assertEqual(first, outcomes())
+        self.assertTrue(10 < sum(first) < 50)
+
+    def test_fake_model_fails_when_told_to(self):
+        model = FakeGenerativeModel(Faults(error_rate=1.0))
+
+        with self.assertRaises(RuntimeError):
+            model.generate_content('prompt')
+        with self.assertRaises(RuntimeError):
+            asyncio.run(model.generate_content_async('prompt'))
+
+
+class TestBenchmarkSuite(unittest.TestCase):
+    """
+    Test suite for the benchmark harness and baseline comparison.
+    """
+
+    def test_compare_flags_only_regressions_beyond_tolerance(self):
+        baselines = {"list.1000.ms": 100.0, "pipeline.posts_per_minute": 300.0, "stage.x.p99_ms": 0.1}
+        results = {"list.1000.ms": 140.0, "pipeline.posts_per_minute": 200.0, "stage.x.p99_ms": 1.5,
+                   "new.metric_ms": 5.0}
+
+        regressions = compare(results, baselines, tolerance=0.25)
+
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('list.1000.ms'))
+        self.assertTrue(regressions[1].startswith('pipeline.posts_per_minute'))
+        self.assertEqual(compare(results, baselines, tolerance=0.5), [])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 99), 0.0)
+
+    def test_pipeline_posts_through_the_fakes(self):
+        metrics = bench_pipeline(3)
+
+        self.assertEqual(metrics["pipeline.failed_posts"], 0)
+        self.assertGreater(metrics["pipeline.posts_per_minute"], 0)
+        self.assertIn("pipeline.stage.job.publish.p99_ms", metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import unittest
+from unittest.mock import patch
+
+from src import main
+from src.caption_cache import (CaptionCache, CachedCaptioner, CaptionPregenerator,
+                               caption_cache_key)
+from src.manifest import BlobRecord
+from src.resilience import CircuitOpenError
+from tests.fakes import FakeClock
+
+
+class FakeGenerator:
+    """Stands in for GeminiCaptionGenerator.request_caption."""
+
+    def __init__(self, fail_for=()):
+        self.prompt_template = "Caption {image_url}"
+        self.model_name = 'gemini-1.5-flash'
+        self.max_tokens = 150
+        self.model = 'configured'
+        self.fail_for = set(fail_for)
+        self.calls = []
+
+    def request_caption(self, image_url, custom_prompt=None):
+        self.calls.append(image_url)
+        if image_url in self.fail_for:
+            raise RuntimeError("quota exceeded")
+        return f"caption for {image_url}"
+
+
+def make_record(name, md5=None):
+    return BlobRecord(name, 1, 10, md5 or f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', 0.0)
+
+
+class TestCaptionCache(unittest.TestCase):
+    """
+    Test suite for the content-addressed caption cache.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock(1_000_000.0)
+        self.cache = CaptionCache(':memory:', ttl=100, max_entries=3, clock=self.clock)
+
+    def test_key_changes_with_prompt_model_and_tokens(self):
+        base = caption_cache_key('hash', 'prompt', 'model', 150)
+
+        self.assertEqual(base, caption_cache_key('hash', 'prompt', 'model', 150))
+        self.assertNotEqual(base, caption_cache_key('hash', 'prompt v2', 'model', 150))
+        self.assertNotEqual(base, caption_cache_key('hash', 'prompt', 'model-pro', 150))
+        self.assertNotEqual(base, caption_cache_key('hash', 'prompt', 'model', 200))
+
+    def test_entries_expire_after_ttl(self):
+        self.cache.put('k', 'hello')
+        self.clock.now += 99
+        self.assertEqual(self.cache.get('k'), 'hello')
+
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get('k'))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for key in ('a', 'b', 'c'):
+            self.cache.put(key, key)
+            self.clock.now += 1
+        self.cache.get('a')
+        self.clock.now += 1
+
+        self.cache.put('d', 'd')
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 'a')
+        self.assertEqual(len(self.cache), 3)
+
+
+class TestCaptionPregenerator(unittest.TestCase):
+    """
+    Test suite for background caption pre-generation.
+    """
+
+    def setUp(self):
+        self.cache = CaptionCache(':memory:')
+        self.generator = FakeGenerator(fail_for={'https://example.com/bad.jpg'})
+        self.captioner = CachedCaptioner(self.generator, self.cache)
+        self.upcoming = [make_record('a.jpg'), make_record('bad.jpg'), make_record('b.jpg')]
+        self.pregenerator = CaptionPregenerator(self.captioner, lambda: self.upcoming)
+
+    def test_fill_generates_missing_captions_once(self):
+        self.assertEqual(self.pregenerator.fill(), 2)
+        self.assertEqual(self.pregenerator.fill(), 0)
+
+        self.assertEqual(self.captioner.lookup(self.upcoming[0]),
+                         'caption for https://example.com/a.jpg')
+        self.assertIsNone(self.captioner.lookup(self.upcoming[1]))
+
+    def test_prompt_change_only_invalidates_affected_entries(self):
+        self.pregenerator.fill()
+        self.generator.prompt_template = "New prompt {image_url}"
+
+        self.assertIsNone(self.captioner.lookup(self.upcoming[0]))
+        self.assertEqual(self.pregenerator.fill(), 2)
+
+    def test_same_content_shares_a_caption(self):
+        self.pregenerator.fill()
+        renamed = make_record('renamed.jpg', md5='md5-a.jpg')
+
+        self.assertEqual(self.captioner.lookup(renamed), 'caption for https://example.com/a.jpg')
+
+    def test_live_caption_on_a_miss_is_cached(self):
+        record = make_record('live.jpg')
+
+        with patch.object(main, 'get_cached_captioner', return_value=self.captioner):
+            first = main.caption_for_record(record)
+            retried = main.caption_for_record(record)
+            failed = main.caption_for_record(self.upcoming[1])
+
+        self.assertEqual(first, 'caption for https://example.com/live.jpg')
+        self.assertEqual(retried, first)
+        self.assertEqual(self.generator.calls.count(record.public_url), 1)
+        self.assertEqual(failed, main.FALLBACK_CAPTION)
+        self.assertIsNone(self.captioner.lookup(self.upcoming[1]))
+
+    def test_unavailable_gemini_gives_no_caption_on_a_miss(self):
+        with patch.object(self.generator, 'request_caption', side_effect=CircuitOpenError('gemini', 'open')), \
+                patch.object(main, 'get_cached_captioner', return_value=self.captioner):
+            caption = main.caption_for_record(make_record('live.jpg'))
+
+        # Empty, so the caption job is deferred instead of posting a placeholder
+        self.assertEqual(caption, '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from src import main
+from src.catalog import ImageCatalog
+from src.history import PostedHistory
+from src.manifest import BlobRecord
+from src.rotation import InMemorySource, RoundRobinByFolder, SelectionEngine
+from tests.fakes import FakeBucket
+
+
+def make_record(name, updated, md5_hash=None, size=10):
+    md5_hash = md5_hash or base64.b64encode(hashlib.md5(name.encode()).digest()).decode()
+    return BlobRecord(name, 1, size, md5_hash, 'image/jpeg',
+                      f'https://storage.googleapis.com/bucket/{name.replace(" ", "%20")}', updated)
+
+
+RECORDS = [
+    make_record('portraits/b.jpg', 30),
+    make_record('portraits/a.jpg', 40),
+    make_record('landscapes/2024/x.jpg', 10, md5_hash='md5-not-base64'),
+    make_record('landscapes/y z.jpg', 20),
+    make_record('root.jpg', 5),
+]
+
+
+class TestImageCatalog(unittest.TestCase):
+    """
+    Test suite for the columnar, memory-mapped image catalog.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.catalog = ImageCatalog.from_records(RECORDS, posted=['portraits/b.jpg'])
+
+    def test_records_round_trip(self):
+        self.assertEqual(len(self.catalog), 5)
+        for record in RECORDS:
+            self.assertEqual(self.catalog.get(record.name), record)
+        self.assertIsNone(self.catalog.get('missing.jpg'))
+        self.assertEqual(self.catalog.prefixes.count('portraits/'), 1)
+
+    def test_duplicate_names_keep_the_last_record(self):
+        newer = make_record('portraits/b.jpg', 50, size=99)
+        in_order = sorted(RECORDS, key=lambda r: r.name)
+        index = in_order.index(RECORDS[0]) + 1
+
+        for records in (in_order[:index] + [newer] + in_order[index:], RECORDS + [newer]):
+            catalog = ImageCatalog.from_records(records)
+            self.assertEqual(len(catalog), 5)
+            self.assertEqual([e.name for e in catalog.query()], [r.name for r in in_order])
+            self.assertEqual(catalog.get('portraits/b.jpg'), newer)
+            self.assertEqual(catalog.get('landscapes/2024/x.jpg'), RECORDS[2])
+            self.assertEqual(catalog.query(order_by='updated', descending=True)[0].name, 'portraits/b.jpg')
+
+    def test_query_filters_and_sorts(self):
+        unposted_oldest = self.catalog.query(posted=False, order_by='updated')
+        in_landscapes = self.catalog.query(folder='landscapes/', order_by='updated', descending=True)
+        by_prefix = self.catalog.query(prefix='portraits/', posted=True)
+
+        self.assertEqual([e.name for e in unposted_oldest],
+                         ['root.jpg', 'landscapes/2024/x.jpg', 'landscapes/y z.jpg', 'portraits/a.jpg'])
+        self.assertEqual([e.name for e in in_landscapes], ['landscapes/y z.jpg', 'landscapes/2024/x.jpg'])
+        self.assertEqual([(e.name, e.posted) for e in by_prefix], [('portraits/b.jpg', True)])
+        self.assertEqual(self.catalog.count(posted=False, prefix='landscapes/y'), 1)
+        self.assertEqual([e.name for e in self.catalog.query(prefix='landscapes/y', order_by='updated')],
+                         ['landscapes/y z.jpg'])
+        with self.assertRaises(AttributeError):
+            in_landscapes[0].extra = 1
+
+    def test_saved_catalog_is_memory_mapped(self):
+        path = os.path.join(self.tmpdir, 'catalog.bin')
+        self.catalog.save(path)
+
+        loaded = ImageCatalog.load(path)
+        loaded.mark_posted(['root.jpg'])
+
+        self.assertEqual([loaded.get(r.name) for r in RECORDS], RECORDS)
+        self.assertEqual([e.name for e in loaded.query(posted=True)], ['portraits/b.jpg', 'root.jpg'])
+        # Flags changed in memory are not written back
+        self.assertEqual(len(ImageCatalog.load(path).query(posted=True)), 1)
+
+    def test_selection_matches_in_memory_source(self):
+        for strategy in (None, RoundRobinByFolder()):
+            picks = []
+            for source in (InMemorySource(RECORDS), self.catalog):
+                engine = SelectionEngine(PostedHistory(':memory:'), strategy)
+                names = []
+                for _ in range(len(RECORDS)):
+                    record = engine.select(source)
+                    engine.mark_posted(record, source)
+                    names.append(record.name)
+                picks.append(names)
+            self.assertEqual(picks[0], picks[1])
+
+    def test_storage_manager_reuses_a_fresh_catalog(self):
+        bucket = FakeBucket()
+        bucket.add_blob('gallery/a.jpg', b'a')
+        path = os.path.join(self.tmpdir, 'catalog.bin')
+        config = {"cloud_storage": {"catalog_path": path}}
+        with patch.object(main, 'get_config', return_value=config):
+            manager = main.GoogleCloudStorageManager()
+            manager.bucket = bucket
+            first = manager.candidate_source()
+            bucket.add_blob('gallery/b.jpg', b'b')
+            restarted = main.GoogleCloudStorageManager()
+            restarted.bucket = bucket
+            second = restarted.candidate_source()
+
+        self.assertIsInstance(first, ImageCatalog)
+        self.assertEqual([r.name for r in second.iter_records()], ['gallery/a.jpg'])
+        self.assertEqual(len(bucket.list_calls), 1)
+
+    def test_storage_manager_flags_posted_images_from_history(self):
+        bucket = FakeBucket()
+        bucket.add_blob('gallery/a.jpg', b'a')
+        bucket.add_blob('gallery/b.jpg', b'b')
+        history = PostedHistory(':memory:')
+        history.record_post('gallery/a.jpg')
+        path = os.path.join(self.tmpdir, 'catalog.bin')
+        config = {"cloud_storage": {"catalog_path": path}}
+        with patch.object(main, 'get_config', return_value=config), \
+                patch.object(main, 'get_posted_history', return_value=history):
+            manager = main.GoogleCloudStorageManager()
+            manager.bucket = bucket
+            built = manager.candidate_source()
+            history.record_post('gallery/b.jpg')
+            restarted = main.GoogleCloudStorageManager()
+            restarted.bucket = bucket
+            loaded = restarted.candidate_source()
+
+        self.assertEqual([e.name for e in built.query(posted=True)], ['gallery/a.jpg'])
+        self.assertEqual([e.name for e in loaded.query(posted=True)], ['gallery/a.jpg', 'gallery/b.jpg'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,7 +9,7 @@ class TestGCSPhotoReader(unittest.TestCase):
     Test suite for the GCS photo reader function.
     """
 
-    @patch('src.gcs_photo_reader.GoogleCloudStorageManager')
+    @patch('src.gcs_photo_reader.get_storage_manager')
     def test_get_photos_from_gcs_success(self, mock_gcs_manager):
         """
         Test that get_photos_from_gcs returns a list of photo URLs on success.
@@ -23,7 +23,7 @@ class TestGCSPhotoReader(unittest.TestCase):
             "http://example.com/photo2.png"
         ]
         mock_instance.list_images.return_value = expected_photos
-        # Make the patched class return our mock instance
+        # Make the patched getter return our mock instance
         mock_gcs_manager.return_value = mock_instance
 
         # Act
@@ -36,7 +36,7 @@ class TestGCSPhotoReader(unittest.TestCase):
         # Verify that the list_images method was called once
         mock_instance.list_images.assert_called_once()
 
-    @patch('src.gcs_photo_reader.GoogleCloudStorageManager')
+    @patch('src.gcs_photo_reader.get_storage_manager')
     def test_get_photos_from_gcs_no_images(self, mock_gcs_manager):
         """
         Test that get_photos_from_gcs returns an empty list when no images are found.
@@ -0,0 +1,188 @@
+import json
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from src import main
+from src.accounts import Account, AccountContext, AccountDispatcher
+from src.history import PostedHistory
+from src.ingest import (Ingestor, LocalEventSource, PollingEventSource, PubSubEventSource,
+                        record_from_resource)
+from src.jobs import JobQueue
+from src.main import GoogleCloudStorageManager
+from src.manifest import BlobRecord
+from src.rotation import SelectionEngine
+from tests.fakes import FakeBucket
+
+
+def at(minute):
+    return datetime(2024, 1, 1, 12, minute, tzinfo=timezone.utc)
+
+
+def make_record(name, generation=1):
+    return BlobRecord(name, generation, 10, f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', 0.0)
+
+
+class TestIngestor(unittest.TestCase):
+    """
+    Test suite for feeding new uploads to a handler.
+    """
+
+    def test_local_events_are_filtered_and_deduplicated(self):
+        source = LocalEventSource()
+        handled = []
+        ingestor = Ingestor(source, handled.append, exclude_prefixes=('derived/',))
+        for name in ('incoming/a.jpg', 'incoming/a.jpg', 'incoming/notes.txt', 'derived/a-w1080.jpg'):
+            source.publish(make_record(name))
+
+        self.assertEqual(ingestor.run_once(timeout=0.1), 1)
+        self.assertEqual([r.name for r in handled], ['incoming/a.jpg'])
+        self.assertEqual(ingestor.run_once(timeout=0.01), 0)
+
+    def test_failed_handler_leaves_events_unacknowledged(self):
+        source = LocalEventSource()
+        source.publish(make_record('incoming/a.jpg'))
+        acked = []
+        source.ack = acked.append
+
+        def fail(record):
+            raise RuntimeError('queue unavailable')
+
+        with self.assertRaises(RuntimeError):
+            Ingestor(source, fail).run_once(timeout=0.1)
+        self.assertEqual(acked, [])
+
+
+class TestPollingEventSource(unittest.TestCase):
+    """
+    Test suite for incremental polling from a persisted cursor.
+    """
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.bucket.add_blob('incoming/2024-01-01/a.jpg', b'a', updated=at(1))
+        self.bucket.add_blob('archive/old.jpg', b'old', updated=at(0))
+        self.manager = GoogleCloudStorageManager()
+        self.manager.bucket = self.bucket
+        self.cursors = PostedHistory(':memory:')
+
+    def source(self, **options):
+        return PollingEventSource(self.manager.iter_images, self.cursors, prefix='incoming/',
+                                  interval=0, **options)
+
+    def test_first_poll_sets_the_cursor_without_emitting_the_backlog(self):
+        source = self.source()
+
+        self.assertEqual(source.poll(0), [])
+        self.bucket.add_blob('incoming/2024-01-01/b.jpg', b'b', updated=at(2))
+        events = source.poll(0)
+        source.ack(events)
+
+        self.assertEqual([e.record.name for e in events], ['incoming/2024-01-01/b.jpg'])
+        self.assertEqual(source.poll(0), [])
+        # The cursor survives a restart
+        self.assertEqual(self.source().poll(0), [])
+
+    def test_ordered_names_list_from_the_cursor(self):
+        source = self.source(ordered_names=True)
+        source.poll(0)
+        self.bucket.add_blob('incoming/2024-01-02/c.jpg', b'c', updated=at(3))
+
+        events = source.poll(0)
+
+        self.assertEqual([e.record.name for e in events], ['incoming/2024-01-02/c.jpg'])
+        self.assertEqual(self.bucket.list_calls[-1]["start_offset"], 'incoming/2024-01-01/a.jpg')
+        self.assertEqual(self.bucket.list_calls[-1]["prefix"], 'incoming/')
+
+    def test_ordered_names_do_not_depend_on_update_times(self):
+        source = self.source(ordered_names=True)
+        source.poll(0)
+        # Clock skew: the later upload reports an older update time
+        self.bucket.add_blob('incoming/2024-01-02/d.jpg', b'd', updated=at(0))
+
+        events = source.poll(0)
+        source.ack(events)
+
+        self.assertEqual([e.record.name for e in events], ['incoming/2024-01-02/d.jpg'])
+        self.assertEqual(source.poll(0), [])
+
+    def test_whole_bucket_polling_is_refused(self):
+        with self.assertRaises(ValueError):
+            PollingEventSource(self.manager.iter_images, self.cursors)
+
+
+class FakeSubscriber:
+    def __init__(self, messages):
+        self.messages = messages
+        self.acked = []
+
+    def pull(self, request, timeout):
+        return SimpleNamespace(received_messages=self.messages)
+
+    def acknowledge(self, request):
+        self.acked.extend(request["ack_ids"])
+
+
+def notification(ack_id, event_type, resource):
+    message = SimpleNamespace(attributes={"eventType": event_type}, message_id=ack_id,
+                              data=json.dumps(resource).encode())
+    return SimpleNamespace(ack_id=ack_id, message=message)
+
+
+class TestPubSubEventSource(unittest.TestCase):
+    """
+    Test suite for Cloud Storage Pub/Sub notifications.
+    """
+
+    def test_finalize_notifications_become_records(self):
+        resource = {"bucket": "photos", "name": "incoming/my photo.jpg", "generation": "17",
+                    "size": "2048", "md5Hash": "abc==", "contentType": "image/jpeg",
+                    "updated": "2024-01-01T12:00:00.000Z"}
+        subscriber = FakeSubscriber([notification('1', 'OBJECT_FINALIZE', resource),
+                                     notification('2', 'OBJECT_DELETE', resource)])
+        source = PubSubEventSource('projects/p/subscriptions/s')
+        source._subscriber = subscriber
+
+        events = source.poll(1)
+        self.assertEqual(subscriber.acked, ['2'])
+        source.ack(events)
+
+        self.assertEqual(events[0].record, record_from_resource(resource))
+        self.assertEqual(events[0].record.public_url,
+                         'https://storage.googleapis.com/photos/incoming/my%20photo.jpg')
+        self.assertEqual((events[0].record.generation, events[0].record.updated), (17, at(0).timestamp()))
+        self.assertEqual(subscriber.acked, ['2', '1'])
+
+
+class TestIngestJob(unittest.TestCase):
+    """
+    Test suite for turning a new upload into per-account posting jobs.
+    """
+
+    def test_upload_is_queued_for_accounts_that_cover_it(self):
+        queue = JobQueue(':memory:')
+        contexts = []
+        for name, prefix in (('gallery', 'incoming/'), ('prints', 'prints/'), ('posted', None)):
+            engine = SelectionEngine(PostedHistory(':memory:', account=name))
+            contexts.append(AccountContext(Account(name, name, 'token', prefix=prefix), engine, None))
+        contexts[2].engine.history.record_post('incoming/a.jpg', None)
+        record = make_record('incoming/a.jpg')
+
+        with patch.object(main, 'get_job_queue', return_value=queue), \
+                patch.object(main, 'get_account_dispatcher',
+                             return_value=AccountDispatcher(contexts)), \
+                patch.object(main, 'get_config', return_value={}):
+            job_id = main.enqueue_upload(record)
+            self.assertEqual(main.enqueue_upload(record), job_id)
+            main.JobRunner(queue, {main.INGEST_JOB: main.run_ingest_job}).run_pending()
+
+        self.assertEqual(queue.get(job_id)["result"], {"accounts": ["gallery"]})
+        caption_job = queue.lease('test', kinds=[main.CAPTION_JOB])
+        self.assertEqual(caption_job.payload["record"]["name"], 'incoming/a.jpg')
+        self.assertEqual(caption_job.payload["account"], 'gallery')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import json
+import time
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from src import main
+from src.instagram_client import InstagramClient, InstagramAPIError
+from tests.fakes import GraphAPIStub
+
+
+class TestInstagramClient(unittest.TestCase):
+    """
+    Test suite for the pooled, retrying Graph API client against a local stub.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.client = InstagramClient('token', '1234', base_url=self.stub.base_url,
+                                      read_timeout=0.5, backoff_factor=0.01)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_post_reuses_one_keep_alive_connection(self):
+        for _ in range(3):
+            container_id = self.client.create_media_container('https://example.com/a.jpg', 'hi')
+            self.client.publish_container(container_id)
+
+        self.assertEqual(len(self.stub.requests), 6)
+        self.assertEqual(self.stub.connections, 1)
+        first = self.stub.requests[0]
+        self.assertEqual(first["path"], '/v19.0/1234/media')
+        self.assertEqual(first["params"]["access_token"], 'token')
+
+    def test_idempotent_calls_retry_server_errors(self):
+        self.stub.script('/media', status=503, payload={"error": {"message": "busy"}})
+
+        container_id = self.client.create_media_container('https://example.com/a.jpg', 'hi')
+
+        self.assertTrue(container_id.startswith('container-'))
+        self.assertEqual(len(self.stub.calls('/media')), 2)
+
+    def test_publish_is_not_retried_on_server_error(self):
+        self.stub.script('/media_publish', status=500, payload={"error": {"message": "oops"}})
+
+        with self.assertRaises(InstagramAPIError) as ctx:
+            self.client.publish_container('container-1')
+
+        self.assertEqual(ctx.exception.status_code, 500)
+        self.assertEqual(len(self.stub.calls('/media_publish')), 1)
+
+    def test_publish_without_a_media_id_is_an_error(self):
+        self.stub.script('/media_publish', payload={"status": "ok"})
+
+        with self.assertRaises(InstagramAPIError) as ctx:
+            self.client.publish_container('container-1')
+
+        self.assertTrue(ctx.exception.maybe_published)
+        self.assertEqual(len(self.stub.calls('/media_publish')), 1)
+
+    def test_publish_is_not_retried_after_read_timeout(self):
+        self.stub.script('/media_publish', payload={"id": "late"}, delay=1.0)
+
+        with self.assertRaises(requests.ReadTimeout):
+            self.client.publish_container('container-1')
+
+        self.assertEqual(len(self.stub.calls('/media_publish')), 1)
+
+    def test_rate_limited_publish_is_retried(self):
+        self.stub.script('/media_publish', status=429, payload={"error": {"code": 4}})
+
+        self.assertTrue(self.client.publish_container('container-1').startswith('media-'))
+        self.assertEqual(len(self.stub.calls('/media_publish')), 2)
+
+    def test_connection_refused_is_retried_then_raised(self):
+        self.stub.stop()
+
+        with patch('src.instagram_client.time.sleep') as sleep:
+            with self.assertRaises(requests.ConnectionError):
+                self.client.publish_container('container-1')
+
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_usage_headers_are_exposed(self):
+        self.stub.default_headers['X-App-Usage'] = json.dumps(
+            {"call_count": 42, "total_cputime": 7, "total_time": 12})
+        self.stub.default_headers['X-Business-Use-Case-Usage'] = json.dumps(
+            {"1234": [{"type": "instagram", "call_count": 81, "total_time": 3}]})
+
+        self.client.create_media_container('https://example.com/a.jpg', 'hi')
+
+        self.assertEqual(self.client.usage['X-App-Usage']["call_count"], 42)
+        self.assertEqual(self.client.usage_percent(), 81)
+
+    def test_post_to_instagram_uses_shared_client(self):
+        self.stub.script('/media_publish', status=400,
+                         payload={"error": {"message": "Media not ready", "code": 9007}})
+
+        with patch.object(main, '_instagram_client', self.client):
+            failed = main.post_to_instagram('https://example.com/a.jpg', 'hi')
+            posted = main.post_to_instagram('https://example.com/a.jpg', 'hi')
+
+        self.assertIn("Media not ready", failed["error"])
+        self.assertTrue(posted["success"])
+        self.assertTrue(posted["media_id"].startswith('media-'))
+
+    def test_publish_waits_for_container_to_finish(self):
+        self.stub.statuses['container-1'] = ['IN_PROGRESS', 'IN_PROGRESS', 'FINISHED']
+
+        with patch.object(main, '_instagram_client', self.client), \
+                patch('src.instagram_client.time.sleep'):
+            posted = main.post_to_instagram('https://example.com/a.jpg', 'hi')
+
+        self.assertTrue(posted["success"])
+        methods = [r["method"] for r in self.stub.requests]
+        self.assertEqual(methods, ['POST', 'GET', 'GET', 'GET', 'POST'])
+
+    def test_errored_container_is_not_published(self):
+        self.stub.statuses['container-1'] = ['ERROR']
+
+        with patch.object(main, '_instagram_client', self.client):
+            failed = main.post_to_instagram('https://example.com/a.jpg', 'hi')
+
+        self.assertIn('ERROR', failed["error"])
+        self.assertEqual(self.stub.calls('/media_publish'), [])
+
+
+class TestCarousel(unittest.TestCase):
+    """
+    Test suite for parallel carousel container creation and publishing.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.client = InstagramClient('token', '1234', base_url=self.stub.base_url,
+                                      backoff_factor=0.01)
+        self.urls = [f'https://example.com/{i}.jpg' for i in range(5)]
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_children_are_created_in_parallel_and_polled_together(self):
+        for i in range(5):
+            self.stub.script('/media', payload={"id": f"child-{i}"}, delay=0.2)
+            self.stub.statuses[f'child-{i}'] = ['IN_PROGRESS', 'FINISHED']
+
+        start = time.monotonic()
+        result = self.client.post_carousel(self.urls, 'caption', poll_delay=0.01)
+        elapsed = time.monotonic() - start
+
+        self.assertTrue(result["success"])
+        self.assertEqual(sorted(result["child_ids"]), [f'child-{i}' for i in range(5)])
+        self.assertLess(elapsed, 0.8)
+        polls = [r for r in self.stub.requests if r["method"] == 'GET']
+        self.assertEqual(len(polls[0]["params"]["ids"].split(',')), 5)
+        parent = self.stub.calls('/media')[-1]["params"]
+        self.assertEqual(parent["media_type"], 'CAROUSEL')
+        self.assertEqual(parent["children"], ','.join(result["child_ids"]))
+
+    def test_failed_children_are_retried_individually(self):
+        self.stub.script('/media', status=400, payload={"error": {"message": "bad image"}})
+        self.stub.statuses['container-1'] = ['ERROR']
+
+        result = self.client.post_carousel(self.urls[:3], 'caption', poll_delay=0.01)
+
+        self.assertTrue(result["success"])
+        # 3 children + 1 rejected + 1 errored retry + parent
+        self.assertEqual(len(self.stub.calls('/media')), 6)
+        self.assertNotIn('container-1', result["child_ids"])
+
+    def test_children_that_keep_failing_abort_the_post(self):
+        for _ in range(3):
+            self.stub.script('/media', status=400, payload={"error": {"message": "bad image"}})
+
+        with self.assertRaises(InstagramAPIError):
+            self.client.post_carousel(self.urls[:2], 'caption', child_retries=1, poll_delay=0.01)
+
+        self.assertEqual(self.stub.calls('/media_publish'), [])
+
+    def test_carousel_size_is_validated(self):
+        with self.assertRaises(ValueError):
+            self.client.post_carousel(self.urls[:1], 'caption')
+        with self.assertRaises(ValueError):
+            self.client.post_carousel(self.urls * 3, 'caption')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+from datetime import datetime, timezone
+
+from src.accounts import PrefixedSource
+from src.history import PostedHistory
+from src.main import GoogleCloudStorageManager
+from src.rotation import SelectionEngine, StreamingSource, RoundRobinByFolder
+from tests.fakes import FakeBucket
+
+
+def at(day):
+    return datetime(2024, 1, day, tzinfo=timezone.utc)
+
+
+class TestIterImages(unittest.TestCase):
+    """
+    Test suite for lazily streaming images out of the bucket.
+    """
+
+    def setUp(self):
+        self.bucket = FakeBucket(page_size=2)
+        for i in range(10):
+            self.bucket.add_blob(f'scans/{i:03d}.png', f'scan {i}'.encode(), updated=at(i + 1))
+        self.bucket.add_blob('scans/readme.txt', b'not an image')
+        self.bucket.add_blob('prints/a.jpg', b'print a', updated=at(20))
+        self.bucket.add_blob('derived/abc-w1080-q85.jpg', b'derived')
+        self.manager = GoogleCloudStorageManager()
+        self.manager.bucket = self.bucket
+        self.manager.manifest = None
+
+    def test_stops_listing_once_limit_is_reached(self):
+        records = list(self.manager.iter_images(limit=3, page_size=2))
+
+        self.assertEqual([r.name for r in records], ['prints/a.jpg', 'scans/000.png', 'scans/001.png'])
+        self.assertEqual(self.bucket.iterators[-1].pages_served, 2)
+
+    def test_filters(self):
+        by_prefix = [r.name for r in self.manager.iter_images(prefix='prints/')]
+        by_glob = [r.name for r in self.manager.iter_images(match_glob='**/00[12].png')]
+        recent = [r.name for r in self.manager.iter_images(updated_after=at(9))]
+
+        self.assertEqual(by_prefix, ['prints/a.jpg'])
+        self.assertEqual(self.bucket.list_calls[0]["prefix"], 'prints/')
+        self.assertEqual(self.bucket.list_calls[1]["match_glob"], '**/00[12].png')
+        self.assertEqual(recent, ['prints/a.jpg', 'scans/009.png'])
+
+    def test_excluded_prefixes_are_skipped(self):
+        names = [r.name for r in self.manager.iter_images()]
+
+        self.assertEqual(len(names), 11)
+        self.assertNotIn('derived/abc-w1080-q85.jpg', names)
+        self.assertEqual(self.manager.list_folders(), ['prints/', 'scans/'])
+
+    def test_selection_stops_at_first_eligible_image(self):
+        history = PostedHistory(':memory:')
+        history.record_post('prints/a.jpg', None)
+        engine = SelectionEngine(history)
+        source = self.manager.candidate_source()
+
+        record = engine.select(source)
+
+        self.assertIsInstance(source, StreamingSource)
+        self.assertEqual(record.name, 'scans/000.png')
+        self.assertEqual(self.bucket.iterators[-1].pages_served, 1)
+
+    def test_oldest_unposted_resumes_after_the_last_post_in_name_order(self):
+        engine = SelectionEngine(PostedHistory(':memory:'), max_scan=3)
+        source = self.manager.candidate_source()
+
+        with self.assertLogs('src.rotation', 'WARNING'):
+            posted = []
+            for _ in range(6):
+                record = engine.select(source)
+                engine.mark_posted(record, source)
+                posted.append(record.name)
+
+        self.assertEqual(posted, ['prints/a.jpg'] + [f'scans/{i:03d}.png' for i in range(5)])
+        # Each selection lists from the last post, not from the first name
+        self.assertEqual(self.bucket.list_calls[-1]["start_offset"], 'scans/003.png')
+        with self.assertRaises(ValueError):
+            next(source.iter_records(order_by='updated'))
+
+    def test_prefixed_account_streams_its_prefix_in_name_order(self):
+        engine = SelectionEngine(PostedHistory(':memory:'))
+        source = PrefixedSource(self.manager.candidate_source(), 'scans/')
+
+        with self.assertLogs('src.rotation', 'WARNING'):
+            posted = []
+            for _ in range(2):
+                record = engine.select(source)
+                engine.mark_posted(record, source)
+                posted.append(record.name)
+
+        self.assertEqual(source.orders, ('name',))
+        self.assertEqual(posted, ['scans/000.png', 'scans/001.png'])
+        self.assertEqual(self.bucket.list_calls[-1]["prefix"], 'scans/')
+
+    def test_round_robin_lists_one_folder_at_a_time(self):
+        engine = SelectionEngine(PostedHistory(':memory:'), RoundRobinByFolder())
+        source = self.manager.candidate_source()
+
+        picked = engine.peek(source, 2)
+
+        self.assertEqual([r.name for r in picked], ['prints/a.jpg', 'scans/000.png'])
+        prefixes = [c["prefix"] for c in self.bucket.list_calls if c["delimiter"] is None]
+        self.assertEqual(prefixes, ['prints/', 'scans/'])
+
+
+if __name__ == '__main__':
+    unittest.main()
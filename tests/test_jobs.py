@@ -0,0 +1,226 @@
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from src import main
+from src.accounts import Account, AccountContext, AccountDispatcher
+from src.history import PostedHistory
+from src.instagram_client import InstagramClient
+from src.jobs import JobQueue, JobRunner, RetryLater
+from src.manifest import BlobRecord
+from src.rotation import InMemorySource, SelectionEngine
+from tests.fakes import FakeClock, GraphAPIStub
+
+
+class TestJobQueue(unittest.TestCase):
+    """
+    Test suite for the durable SQLite job queue.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.queue = JobQueue(':memory:', clock=self.clock, base_delay=10, max_delay=25)
+
+    def test_jobs_are_leased_when_due_in_order(self):
+        later = self.queue.enqueue('a', {"n": 1}, run_at=1100)
+        first = self.queue.enqueue('a', {"n": 2})
+
+        job = self.queue.lease('w1')
+
+        self.assertEqual((job.id, job.payload, job.attempts), (first, {"n": 2}, 1))
+        self.assertIsNone(self.queue.lease('w1'))
+        self.assertEqual(self.queue.next_due_at(), 1100)
+        self.clock.now = 1100
+        self.assertEqual(self.queue.lease('w1').id, later)
+
+    def test_dedup_key_enqueues_once(self):
+        first = self.queue.enqueue('a', dedup_key='round:2024-01-01')
+        second = self.queue.enqueue('a', {"other": True}, dedup_key='round:2024-01-01')
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.queue.counts(), {'pending': 1})
+
+    def test_expired_lease_is_retaken(self):
+        job_id = self.queue.enqueue('a')
+        self.queue.lease('w1', lease_seconds=60)
+        self.assertIsNone(self.queue.lease('w2'))
+        self.assertEqual(self.queue.next_due_at(), 1060)
+
+        self.clock.now = 1060
+        job = self.queue.lease('w2')
+
+        self.assertEqual((job.id, job.attempts), (job_id, 2))
+        self.assertEqual(self.queue.get(job_id)["lease_owner"], 'w2')
+
+    def test_failures_back_off_until_attempts_run_out(self):
+        job_id = self.queue.enqueue('a', max_attempts=3)
+
+        retries = []
+        for _ in range(3):
+            self.clock.now = self.queue.next_due_at()
+            retries.append(self.queue.fail(self.queue.lease('w1'), 'boom'))
+
+        self.assertEqual(retries, [1010, 1030, None])
+        self.assertEqual(self.queue.get(job_id)["status"], 'failed')
+        self.assertEqual(self.queue.get(job_id)["last_error"], 'boom')
+        self.assertIsNone(self.queue.next_due_at())
+
+    def test_deferring_does_not_use_an_attempt(self):
+        job_id = self.queue.enqueue('a', max_attempts=1)
+        self.queue.defer(self.queue.lease('w1'), 300, 'throttled')
+
+        self.clock.now = 1300
+        job = self.queue.lease('w1')
+
+        self.assertEqual((job.id, job.attempts), (job_id, 1))
+
+
+class TestJobRunner(unittest.TestCase):
+    """
+    Test suite for executing jobs on the worker pool.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.queue = JobQueue(':memory:', clock=self.clock, base_delay=10)
+
+    def test_handler_outcomes(self):
+        def flaky(job):
+            if job.attempts == 1:
+                raise RuntimeError('transient')
+            return {"ok": job.attempts}
+
+        def throttled(job):
+            raise RetryLater(60, 'busy')
+
+        runner = JobRunner(self.queue, {'flaky': flaky, 'throttled': throttled})
+        flaky_id = self.queue.enqueue('flaky')
+        throttled_id = self.queue.enqueue('throttled')
+
+        self.assertEqual(runner.run_pending(), 2)
+        self.assertEqual(runner.seconds_until_due(), 10)
+        self.clock.now += 10
+        runner.run_pending()
+
+        self.assertEqual(self.queue.get(flaky_id)["result"], {"ok": 2})
+        self.assertEqual(self.queue.get(throttled_id)["run_at"], 1060)
+
+    def test_idle_workers_sleep_until_the_next_job(self):
+        runner = JobRunner(JobQueue(':memory:'), {}, max_idle=300)
+        self.assertEqual(runner.seconds_until_due(), 300)
+
+        runner.queue.enqueue('a', run_at=time.time() + 42)
+
+        self.assertAlmostEqual(runner.seconds_until_due(), 42, delta=1)
+
+    def test_enqueue_wakes_sleeping_workers(self):
+        done = threading.Event()
+        queue = JobQueue(':memory:')
+        runner = JobRunner(queue, {'a': lambda job: done.set()}, workers=2, max_idle=60)
+        runner.start()
+        try:
+            time.sleep(0.05)
+            queue.enqueue('a')
+            self.assertTrue(done.wait(2))
+        finally:
+            runner.stop(timeout=2)
+
+
+def make_record(name, updated=0.0):
+    return BlobRecord(name, 1, 10, f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', updated)
+
+
+class FakeStorageManager:
+    def __init__(self, source):
+        self.source = source
+
+    def candidate_source(self):
+        return self.source
+
+
+class TestPostingJobs(unittest.TestCase):
+    """
+    Test suite for the select/caption/container/publish stage jobs.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.clock = FakeClock(datetime(2024, 1, 1, 9, 0).timestamp())
+        self.queue = JobQueue(':memory:', clock=self.clock, base_delay=10)
+        contexts = []
+        for name in ('gallery', 'prints'):
+            client = InstagramClient('token', name, base_url=self.stub.base_url)
+            engine = SelectionEngine(PostedHistory(':memory:', account=name))
+            contexts.append(AccountContext(Account(name, name, 'token', prefix=f'{name}/'), engine,
+                                           lambda client=client: client))
+        self.dispatcher = AccountDispatcher(contexts)
+        source = InMemorySource([make_record('gallery/a.jpg', 1), make_record('prints/b.jpg', 2)])
+        self.patches = [
+            patch.object(main, 'get_job_queue', return_value=self.queue),
+            patch.object(main, 'get_account_dispatcher', return_value=self.dispatcher),
+            patch.object(main, 'get_storage_manager', return_value=FakeStorageManager(source)),
+            patch.object(main, 'caption_for_record', return_value='caption'),
+            patch.object(main, 'instagram_url_for', side_effect=lambda record: record.public_url),
+            patch.object(main, 'get_config', return_value={"schedule": {"time": "09:00"}}),
+        ]
+        for p in self.patches:
+            p.start()
+        self.runner = JobRunner(self.queue, main.JOB_HANDLERS)
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.stub.stop()
+
+    def test_round_posts_every_account_and_schedules_tomorrow(self):
+        round_id = self.queue.enqueue(main.ROUND_JOB, {"round": "2024-01-01"},
+                                      dedup_key=f"{main.ROUND_JOB}:2024-01-01")
+
+        self.runner.run_pending()
+
+        self.assertEqual(self.queue.get(round_id)["result"], {"accounts": ["gallery", "prints"]})
+        self.assertEqual(len(self.stub.calls('/gallery/media_publish')), 1)
+        self.assertEqual(len(self.stub.calls('/prints/media_publish')), 1)
+        self.assertTrue(self.dispatcher.contexts[0].engine.history.is_posted('gallery/a.jpg'))
+        self.assertEqual(self.queue.counts(), {'done': 9, 'pending': 1})
+        self.assertEqual(self.queue.next_due_at(), datetime(2024, 1, 2, 9, 0).timestamp())
+
+    def test_failed_stage_is_retried_without_repeating_earlier_stages(self):
+        self.stub.script('/gallery/media_publish', status=400,
+                         payload={"error": {"message": "temporarily unavailable", "code": 2}})
+        self.queue.enqueue(main.SELECT_JOB, {"account": "gallery", "round": "2024-01-01"})
+
+        self.runner.run_pending()
+        self.clock.now = self.queue.next_due_at()
+        self.runner.run_pending()
+
+        self.assertEqual(len(self.stub.calls('/gallery/media')), 1)
+        self.assertEqual(len(self.stub.calls('/gallery/media_publish')), 2)
+        self.assertEqual(self.queue.counts(), {'done': 4})
+
+    def test_throttled_account_is_deferred(self):
+        self.dispatcher.throttle_percent = 0
+        job_id = self.queue.enqueue(main.CONTAINER_JOB, {
+            "account": "gallery", "round": "2024-01-01",
+            "record": make_record('gallery/a.jpg')._asdict(), "caption": "caption"})
+
+        self.runner.run_pending()
+
+        job = self.queue.get(job_id)
+        self.assertEqual((job["status"], job["attempts"]), ('pending', 0))
+        self.assertEqual(job["run_at"], self.clock.now + 3600)
+        self.assertEqual(self.stub.calls('/gallery/media'), [])
+
+    def test_next_round_is_today_until_its_time_has_passed(self):
+        morning = datetime(2024, 1, 1, 8, 0).timestamp()
+
+        self.assertEqual(main.next_round_at(morning, '09:00'), datetime(2024, 1, 1, 9, 0).timestamp())
+        self.assertEqual(main.next_round_at(self.clock.now, '09:00'),
+                         datetime(2024, 1, 2, 9, 0).timestamp())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.main import GoogleCloudStorageManager
+from src.manifest import BucketManifest
+from tests.fakes import FakeBucket
+
+
+class TestBucketManifest(unittest.TestCase):
+    """
+    Test suite for the persistent bucket manifest.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest = BucketManifest(os.path.join(self.tmpdir, 'manifest.sqlite3'), page_size=2)
+        self.bucket = FakeBucket(page_size=2)
+        self.bucket.add_blob('root.jpg', b'root')
+        self.bucket.add_blob('notes.txt', b'not an image')
+        for i in range(5):
+            self.bucket.add_blob(f'scans/{i:03d}.png', f'scan {i}'.encode())
+        self.bucket.add_blob('prints/a.jpeg', b'print a')
+
+    def tearDown(self):
+        self.manifest.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cold_start_crawls_every_image(self):
+        stats = self.manifest.refresh(self.bucket)
+
+        self.assertEqual(stats["upserted"], 7)
+        self.assertEqual(self.manifest.count(), 7)
+        record = self.manifest.get('scans/002.png')
+        self.assertEqual(record.size, len(b'scan 2'))
+        self.assertTrue(record.public_url.endswith('/fake-bucket/scans/002.png'))
+        self.assertIsNone(self.manifest.get('notes.txt'))
+
+    def test_fresh_shards_are_not_relisted(self):
+        self.manifest.refresh(self.bucket)
+        self.bucket.list_calls.clear()
+
+        stats = self.manifest.refresh(self.bucket)
+
+        self.assertEqual(stats["shards"], 0)
+        # Only the cheap delimiter listing used to discover shards
+        self.assertEqual(len(self.bucket.list_calls), 1)
+
+    def test_incremental_refresh_only_writes_changes(self):
+        self.manifest.refresh(self.bucket)
+        self.bucket.add_blob('scans/001.png', b'rescanned')
+        self.bucket.delete_blob('prints/a.jpeg')
+        self.bucket.add_blob('scans/new.webp', b'new')
+
+        stats = self.manifest.refresh(self.bucket, force=True)
+
+        self.assertEqual(stats["upserted"], 2)
+        self.assertEqual(stats["removed"], 0)
+        self.assertEqual(self.manifest.get('scans/001.png').generation, 2)
+        self.assertIsNone(self.manifest.get('prints/a.jpeg'))
+        self.assertEqual(self.manifest.count(), 7)
+
+    def test_interrupted_crawl_resumes_from_page_token(self):
+        self.bucket.interrupt_listing['scans/'] = 1
+        with self.assertRaises(ConnectionError):
+            self.manifest.refresh(self.bucket)
+
+        self.manifest.refresh(self.bucket)
+
+        resumed = [c for c in self.bucket.list_calls if c["prefix"] == 'scans/'][-1]
+        self.assertEqual(resumed["page_token"], '2')
+        self.assertEqual(self.manifest.count(), 7)
+
+    def test_iter_records_orders_and_filters(self):
+        self.manifest.refresh(self.bucket)
+
+        names = [r.name for r in self.manifest.iter_records(prefix='scans/', batch_size=2)]
+
+        self.assertEqual(names, [f'scans/{i:03d}.png' for i in range(5)])
+
+    def test_list_images_is_served_from_manifest(self):
+        manager = GoogleCloudStorageManager()
+        manager.bucket = self.bucket
+        manager.manifest = self.manifest
+
+        first = manager.list_images()
+        self.bucket.list_calls.clear()
+        second = manager.list_images()
+
+        self.assertEqual(len(first), 7)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.bucket.list_calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
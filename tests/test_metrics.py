@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+from src import main
+from src.jobs import JobQueue, JobRunner
+from src.metrics import REGISTRY, EventLog, MetricsRegistry, MetricsServer
+from tests.fakes import FakeClock
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    """
+    Test suite for timers, counters, gauges and the Prometheus text format.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.registry = MetricsRegistry(buckets=(0.1, 1.0), clock=self.clock)
+
+    def test_timed_records_latency_outcome_and_error_type(self):
+        with self.registry.timed('gemini.caption'):
+            self.clock.now += 0.05
+        with self.assertRaises(TimeoutError):
+            with self.registry.timed('gemini.caption'):
+                self.clock.now += 2.0
+                raise TimeoutError('deadline')
+
+        histogram = self.registry.histogram('stage_seconds', stage='gemini.caption')
+        self.assertEqual(histogram["count"], 2)
+        self.assertAlmostEqual(histogram["sum"], 2.05)
+        self.assertEqual(histogram["buckets"], [(0.1, 1), (1.0, 1), (float('inf'), 2)])
+        self.assertEqual(self.registry.value('stage_total', stage='gemini.caption', outcome='ok'), 1)
+        self.assertEqual(self.registry.value('stage_errors_total', stage='gemini.caption',
+                                             error='TimeoutError'), 1)
+
+    def test_timed_works_as_a_decorator(self):
+        @self.registry.timed('select', account='gallery')
+        def select():
+            """Pick an image."""
+            return 'a.jpg'
+
+        self.assertEqual(select(), 'a.jpg')
+        self.assertEqual(select.__doc__, 'Pick an image.')
+        self.assertEqual(self.registry.value('stage_total', stage='select', outcome='ok',
+                                             account='gallery'), 1)
+
+    def test_render_prometheus_text(self):
+        self.registry.inc('caption_cache_requests_total', result='hit')
+        self.registry.inc('caption_cache_requests_total', 2, result='miss')
+        self.registry.describe('caption_cache_requests_total', 'counter', 'Caption cache lookups')
+        self.registry.gauge_callback('job_queue_depth', lambda: [({"status": "pending"}, 3)])
+        self.registry.observe('stage_seconds', 0.5, stage='post "x"')
+
+        text = self.registry.render()
+
+        self.assertIn('# HELP zmaninstaposter_caption_cache_requests_total Caption cache lookups\n'
+                      '# TYPE zmaninstaposter_caption_cache_requests_total counter\n'
+                      'zmaninstaposter_caption_cache_requests_total{result="hit"} 1\n'
+                      'zmaninstaposter_caption_cache_requests_total{result="miss"} 2\n', text)
+        self.assertIn('zmaninstaposter_job_queue_depth{status="pending"} 3\n', text)
+        self.assertIn('# TYPE zmaninstaposter_stage_seconds histogram\n', text)
+        self.assertIn('zmaninstaposter_stage_seconds_bucket{stage="post \\"x\\"",le="0.1"} 0\n', text)
+        self.assertIn('zmaninstaposter_stage_seconds_bucket{stage="post \\"x\\"",le="+Inf"} 1\n', text)
+        self.assertIn('zmaninstaposter_stage_seconds_count{stage="post \\"x\\""} 1\n', text)
+
+    def test_events_are_written_as_json_lines(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.registry.event_log = EventLog(os.path.join(tmpdir, 'logs', 'events.jsonl'))
+
+        with self.registry.timed('post', account='gallery'):
+            self.clock.now += 0.25
+        try:
+            with self.registry.timed('post', account='gallery'):
+                raise ValueError('bad caption')
+        except ValueError:
+            pass
+        self.registry.event_log.close()
+
+        with open(os.path.join(tmpdir, 'logs', 'events.jsonl')) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([(e["stage"], e["outcome"], e["account"]) for e in events],
+                         [('post', 'ok', 'gallery'), ('post', 'error', 'gallery')])
+        self.assertEqual(events[0]["duration_ms"], 250.0)
+        self.assertEqual((events[1]["error"], events[1]["message"]), ('ValueError', 'bad caption'))
+
+
+class TestMetricsServer(unittest.TestCase):
+    """
+    Test suite for the local /metrics endpoint.
+    """
+
+    def test_serves_metrics(self):
+        registry = MetricsRegistry()
+        registry.inc('posts_total', account='gallery', outcome='success')
+        server = MetricsServer(registry, port=0).start()
+        self.addCleanup(server.stop)
+
+        with urllib.request.urlopen(f"{server.url}/metrics", timeout=5) as response:
+            body = response.read().decode()
+            content_type = response.headers['Content-Type']
+        with self.assertRaises(urllib.error.HTTPError) as missing:
+            urllib.request.urlopen(f"{server.url}/other", timeout=5)
+
+        self.assertIn('zmaninstaposter_posts_total{account="gallery",outcome="success"} 1', body)
+        self.assertTrue(content_type.startswith('text/plain; version=0.0.4'))
+        self.assertEqual(missing.exception.code, 404)
+
+    def test_reset_components_frees_the_port_for_a_rebuilt_server(self):
+        probe = MetricsServer(MetricsRegistry(), port=0).start()
+        port = probe.port
+        probe.close()
+        config = {"metrics": {"enabled": True, "port": port}}
+        with patch.object(main, 'get_config', return_value=config):
+            first = main.get_metrics_server()
+            main.reset_components()
+            second = main.get_metrics_server()
+            self.addCleanup(main.reset_components)
+
+        self.assertIsNot(first, second)
+        self.assertEqual(second.port, port)
+        with urllib.request.urlopen(f"{second.url}/healthz", timeout=5) as response:
+            self.assertEqual(response.read(), b'ok\n')
+
+
+class TestJobMetrics(unittest.TestCase):
+    """
+    Test suite for job outcome metrics.
+    """
+
+    def test_job_outcomes_are_counted(self):
+        def flaky(job):
+            if job.attempts == 1:
+                raise ConnectionError('reset')
+
+        before = {outcome: REGISTRY.value('jobs_total', kind='metrics-test', outcome=outcome)
+                  for outcome in ('completed', 'retried')}
+        queue = JobQueue(':memory:', base_delay=0)
+        queue.enqueue('metrics-test')
+
+        JobRunner(queue, {'metrics-test': flaky}).run_pending()
+
+        self.assertEqual(REGISTRY.value('jobs_total', kind='metrics-test', outcome='retried'),
+                         before['retried'] + 1)
+        self.assertEqual(REGISTRY.value('jobs_total', kind='metrics-test', outcome='completed'),
+                         before['completed'] + 1)
+        self.assertEqual(REGISTRY.value('stage_errors_total', stage='job.metrics-test',
+                                        error='ConnectionError'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
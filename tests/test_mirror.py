@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from src.manifest import record_from_blob
+from src.mirror import BucketMirror
+from tests.fakes import FakeBucket, Faults
+
+
+class TestBucketMirror(unittest.TestCase):
+    """
+    Test suite for the parallel, resumable bucket mirror.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bucket = FakeBucket()
+        for i in range(6):
+            self.bucket.add_blob(f'scans/{i}.png', f'scan {i}'.encode() * 10)
+        self.large = self.bucket.add_blob('scans/large.tif', bytes(range(256)) * 40)
+        self.mirror = BucketMirror(self.bucket, self.tmpdir, max_workers=4,
+                                   chunk_size=1000, ranged_threshold=5000)
+
+    def tearDown(self):
+        self.mirror.close()
+        shutil.rmtree(self.tmpdir)
+
+    def records(self):
+        return [record_from_blob(b) for b in self.bucket.blobs.values()]
+
+    def test_mirror_downloads_and_skips_unchanged(self):
+        first = self.mirror.mirror(self.records())
+        self.bucket.download_calls.clear()
+        second = self.mirror.mirror(self.records())
+
+        self.assertEqual(first["downloaded"], 7)
+        self.assertEqual(first["bytes"], sum(b.size for b in self.bucket.blobs.values()))
+        self.assertEqual(second["skipped"], 7)
+        self.assertEqual(self.bucket.download_calls, [])
+        with open(self.mirror.path_for('scans/large.tif'), 'rb') as f:
+            self.assertEqual(f.read(), self.large.data)
+
+    def test_large_blobs_are_downloaded_in_ranges(self):
+        self.mirror.mirror([record_from_blob(self.large)])
+
+        ranges = [(c["start"], c["end"]) for c in self.bucket.download_calls]
+        self.assertEqual(len(ranges), 11)
+        self.assertEqual(ranges[:2], [(0, 999), (1000, 1999)])
+        self.assertEqual(ranges[-1], (10000, 10239))
+
+    def test_interrupted_download_resumes(self):
+        self.bucket.interrupt_download['scans/large.tif'] = 3
+
+        failed = self.mirror.mirror([record_from_blob(self.large)])
+        self.bucket.download_calls.clear()
+        resumed = self.mirror.mirror([record_from_blob(self.large)])
+
+        self.assertEqual(failed["failed"], 1)
+        self.assertEqual(resumed["downloaded"], 1)
+        self.assertEqual(self.bucket.download_calls[0]["start"], 3000)
+        with open(self.mirror.path_for('scans/large.tif'), 'rb') as f:
+            self.assertEqual(f.read(), self.large.data)
+
+    def test_concurrent_fetches_of_one_blob_download_it_once(self):
+        self.bucket.faults = Faults(latency=0.005)
+        record = record_from_blob(self.large)
+        paths = []
+        threads = [threading.Thread(target=lambda: paths.append(self.mirror.fetch_record(record)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(paths)), 1)
+        self.assertIsNotNone(paths[0])
+        self.assertEqual(len(self.bucket.download_calls), 11)
+        self.assertEqual(self.mirror._downloads, {})
+
+    def test_changed_generation_is_downloaded_again(self):
+        self.mirror.mirror(self.records())
+        self.bucket.add_blob('scans/0.png', b'new bytes')
+
+        stats = self.mirror.mirror(self.records())
+
+        self.assertEqual(stats["downloaded"], 1)
+        with open(self.mirror.fetch('scans/0.png'), 'rb') as f:
+            self.assertEqual(f.read(), b'new bytes')
+
+    def test_copy_of_an_overwritten_blob_is_of_its_new_generation(self):
+        self.mirror.mirror(self.records())
+        record = record_from_blob(self.bucket.add_blob('scans/0.png', b'new bytes'))
+        copy = os.path.join(self.tmpdir, 'copy.png')
+
+        self.assertTrue(self.mirror.copy_to('scans/0.png', copy, record))
+
+        with open(copy, 'rb') as f:
+            self.assertEqual(f.read(), b'new bytes')
+
+    def test_corrupt_download_is_rejected(self):
+        record = record_from_blob(self.bucket.blobs['scans/1.png'])._replace(md5_hash='AAAAAAAAAAAAAAAAAAAAAA==')
+
+        self.assertIsNone(self.mirror.fetch_record(record))
+        self.assertIsNone(self.mirror.path_for('scans/1.png'))
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'partial')), [])
+
+    def test_composite_objects_are_verified_by_crc32c(self):
+        record = record_from_blob(self.bucket.blobs['scans/2.png'])._replace(md5_hash='')
+
+        path = self.mirror.fetch_record(record)
+
+        self.assertIsNotNone(path)
+
+    def test_identical_content_is_stored_once(self):
+        self.bucket.add_blob('copies/3.png', self.bucket.blobs['scans/3.png'].data)
+        self.mirror.mirror([record_from_blob(self.bucket.blobs['scans/3.png'])])
+        self.bucket.download_calls.clear()
+
+        path = self.mirror.fetch('copies/3.png')
+
+        self.assertEqual(path, self.mirror.path_for('scans/3.png'))
+        self.assertEqual(self.bucket.download_calls, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
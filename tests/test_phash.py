@@ -0,0 +1,134 @@
+import io
+import random
+import unittest
+
+from PIL import Image, ImageEnhance
+
+from src.history import PostedHistory
+from src.manifest import BlobRecord
+from src.phash import (MultiIndexHash, NearDuplicateFilter, PerceptualHashStore, dhash,
+                       hamming_distance, phash, to_signed, to_unsigned)
+from src.rotation import InMemorySource, SelectionEngine
+
+
+def encode(image, size=None, quality=90):
+    if size:
+        image = image.resize(size)
+    output = io.BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=quality)
+    return output.getvalue()
+
+
+def artwork():
+    return Image.effect_mandelbrot((512, 384), (-1.5, -0.2, 0.0, 1.0), 64)
+
+
+def rescan():
+    """The same artwork, brighter, slightly cropped, smaller and recompressed."""
+    image = ImageEnhance.Brightness(artwork()).enhance(1.1).crop((6, 4, 506, 380))
+    return encode(image, size=(400, 300), quality=60)
+
+
+def other_artwork():
+    return encode(Image.radial_gradient('L').resize((512, 384)))
+
+
+def make_record(name, generation=1, updated=0.0):
+    return BlobRecord(name, generation, 10, f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', updated)
+
+
+class TestPerceptualHashes(unittest.TestCase):
+    """
+    Test suite for perceptual hashing and the multi-index hash table.
+    """
+
+    def test_rescans_hash_close_and_other_images_far(self):
+        for algorithm in (phash, dhash):
+            original = algorithm(encode(artwork()))
+
+            self.assertLessEqual(hamming_distance(original, algorithm(rescan())), 6)
+            self.assertGreater(hamming_distance(original, algorithm(other_artwork())), 16)
+
+    def test_hashes_round_trip_through_signed_storage(self):
+        for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+            signed = to_signed(value)
+            self.assertTrue(-(1 << 63) <= signed < 1 << 63)
+            self.assertEqual(to_unsigned(signed), value)
+
+    def test_multi_index_query_matches_brute_force(self):
+        rng = random.Random(7)
+        index = MultiIndexHash(max_distance=7)
+        hashes = {}
+        for i in range(2000):
+            base = rng.getrandbits(64) if i % 4 == 0 else hashes[i - i % 4]
+            for _ in range(rng.randrange(8)):
+                base ^= 1 << rng.randrange(64)
+            hashes[i] = base
+            index.add(i, base)
+
+        for probe in rng.sample(list(hashes.values()), 50):
+            expected = sorted(k for k, v in hashes.items() if hamming_distance(probe, v) <= 7)
+            self.assertEqual(sorted(k for k, _ in index.query(probe)), expected)
+
+        index.remove(0)
+        self.assertNotIn(0, [k for k, _ in index.query(hashes[0], 0)])
+
+
+class TestNearDuplicates(unittest.TestCase):
+    """
+    Test suite for the hash store and rejecting look-alikes of recent posts.
+    """
+
+    def setUp(self):
+        self.images = {'https://example.com/scans/a.jpg': encode(artwork()),
+                       'https://example.com/scans/a-rescan.jpg': rescan(),
+                       'https://example.com/scans/b.jpg': other_artwork()}
+        self.fetched = []
+
+        def thumbnail(record):
+            self.fetched.append(record.public_url)
+            return self.images[record.public_url]
+
+        self.store = PerceptualHashStore(':memory:', thumbnail, max_workers=2)
+
+    def test_store_hashes_incrementally(self):
+        records = [make_record('scans/a.jpg'), make_record('scans/b.jpg')]
+
+        first = self.store.update(records)
+        second = self.store.update(records)
+        third = self.store.update([make_record('scans/a.jpg', generation=2)])
+
+        self.assertEqual(first, {"hashed": 2, "skipped": 0, "failed": 0})
+        self.assertEqual(second, {"hashed": 0, "skipped": 2, "failed": 0})
+        self.assertEqual(third["hashed"], 1)
+        self.assertEqual(len(self.fetched), 3)
+
+    def test_selection_skips_lookalikes_of_recent_posts(self):
+        history = PostedHistory(':memory:')
+        engine = SelectionEngine(history, near_duplicates=NearDuplicateFilter(self.store, history))
+        source = InMemorySource([make_record('scans/a.jpg', updated=1),
+                                 make_record('scans/a-rescan.jpg', updated=2),
+                                 make_record('scans/b.jpg', updated=3)])
+
+        first = engine.select(source)
+        engine.mark_posted(first, source)
+        second = engine.select(source)
+
+        self.assertEqual(first.name, 'scans/a.jpg')
+        self.assertEqual(second.name, 'scans/b.jpg')
+
+    def test_lookalikes_are_allowed_again_after_the_window(self):
+        now = [1000.0]
+        history = PostedHistory(':memory:', clock=lambda: now[0])
+        history.record_post('scans/a.jpg', None)
+        self.store.hash_of(make_record('scans/a.jpg'))
+        lookalikes = NearDuplicateFilter(self.store, history, window=86400)
+
+        self.assertTrue(lookalikes.is_near_duplicate(make_record('scans/a-rescan.jpg')))
+        now[0] += 86401
+        self.assertFalse(lookalikes.is_near_duplicate(make_record('scans/a-rescan.jpg')))
+
+
+if __name__ == '__main__':
+    unittest.main()
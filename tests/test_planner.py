@@ -0,0 +1,201 @@
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from src import main
+from src.accounts import Account, AccountContext, AccountDispatcher
+from src.history import PostedHistory
+from src.instagram_client import InstagramClient
+from src.jobs import JobQueue, PENDING
+from src.planner import (EngagementRecord, EngagementStore, HourOfWeekModel, PostingPlanner,
+                         hour_of_week, parse_time)
+from src.rotation import SelectionEngine
+from tests.fakes import GraphAPIStub
+
+MONDAY = datetime(2024, 1, 1)
+
+
+def at(days, hour):
+    """Local timestamp ``days`` after Monday 2024-01-01 at ``hour``:00."""
+    return (MONDAY + timedelta(days=days, hours=hour)).timestamp()
+
+
+def history(peak_hour, weeks=8, start=-56):
+    """One post a day for ``weeks`` weeks, alternating between peak_hour (busy) and 06:00 (quiet)."""
+    records = []
+    for day in range(weeks * 7):
+        hour, engagement = (peak_hour, 500) if day % 2 else (6, 20)
+        records.append(EngagementRecord(f'm{day}', at(start + day, hour), engagement))
+    return records
+
+
+class TestPostingPlanner(unittest.TestCase):
+    """
+    Test suite for the hour-of-week engagement model and posting plans.
+    """
+
+    def setUp(self):
+        self.store = EngagementStore(':memory:')
+        self.planner = PostingPlanner(self.store, default_time='09:00')
+
+    def test_model_follows_updates_incrementally(self):
+        self.planner.record('gallery', history(peak_hour=18))
+        scores = self.planner.hour_scores('gallery')
+        best = max(range(168), key=scores.__getitem__) % 24
+
+        # Engagement keeps growing after posting; only changed rows count
+        changed = self.planner.record('gallery', [EngagementRecord('m0', at(-56, 6), 5000),
+                                                  EngagementRecord('m1', at(-55, 18), 500)])
+        rebuilt = PostingPlanner(self.store)
+
+        self.assertIn(best, (17, 18, 19))
+        self.assertEqual(changed, 1)
+        self.assertEqual(self.store.count(), 56)
+        for mine, fresh in zip(self.planner.hour_scores('gallery'), rebuilt.hour_scores('gallery')):
+            self.assertAlmostEqual(mine, fresh)
+
+    def test_one_lucky_post_does_not_outrank_a_proven_hour(self):
+        model = HourOfWeekModel(prior_posts=3)
+        for week in range(10):
+            model.add(at(week * 7, 12), 400)
+            model.add(at(week * 7 + 3, 12), 100)
+        model.add(at(1, 3), 1000)
+
+        scores = model.scores()
+
+        self.assertGreater(scores[hour_of_week(at(0, 12))], scores[hour_of_week(at(1, 3))])
+
+    def test_plan_respects_daily_gap_and_hourly_limits(self):
+        self.planner = PostingPlanner(self.store, posts_per_day=2, min_gap_hours=4, max_posts_per_hour=1)
+        for account in ('gallery', 'prints'):
+            self.planner.record(account, history(peak_hour=18))
+
+        plan = self.planner.plan(['gallery', 'prints'], start=at(0, 0), days=2,
+                                 recent={'prints': [at(0, 17)]})
+
+        by_account = {}
+        for post in plan:
+            by_account.setdefault(post.account, []).append(post.at)
+        self.assertEqual(len(by_account['gallery']), 4)
+        self.assertEqual(len(by_account['prints']), 4)
+        self.assertEqual(len({post.at for post in plan}), len(plan))
+        for times in by_account.values():
+            self.assertTrue(all(b - a >= 4 * 3600 for a, b in zip(times, times[1:])))
+        self.assertTrue(all(abs(t - at(0, 17)) >= 4 * 3600 for t in by_account['prints']))
+        self.assertEqual(plan, sorted(plan, key=lambda post: post.at))
+
+    def test_plan_never_exceeds_publishing_limit(self):
+        self.planner = PostingPlanner(self.store, posts_per_day=24, min_gap_hours=0, publishing_limit=5)
+
+        plan = self.planner.plan(['gallery'], start=at(0, 0), days=1,
+                                 recent={'gallery': [at(-1, 20), at(-1, 21)]})
+
+        times = sorted([at(-1, 20), at(-1, 21)] + [post.at for post in plan])
+        self.assertEqual(len(plan), 5)
+        for start in times:
+            self.assertLessEqual(sum(1 for t in times if start <= t < start + 86400), 5)
+
+    def test_accounts_without_data_post_at_the_default_time(self):
+        plan = self.planner.plan(['new'], start=at(0, 10), days=2)
+
+        self.assertEqual([post.key for post in plan], ['2024-01-02T09', '2024-01-03T09'])
+
+    def test_imports_csv_and_json_exports(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        csv_path = os.path.join(directory, 'insights.csv')
+        with open(csv_path, 'w') as f:
+            f.write("account,media_id,posted_at,likes,comments\n"
+                    "gallery,1,2024-01-01T18:00:00,120,4\n"
+                    f"prints,2,{at(1, 8)},30,1\n")
+        json_path = os.path.join(directory, 'insights.json')
+        with open(json_path, 'w') as f:
+            json.dump([{"account": "gallery", "id": "3", "timestamp": "2024-01-02T18:00:00+0000",
+                        "engagement": 80}], f)
+
+        self.assertEqual(self.planner.import_file(csv_path), 2)
+        self.assertEqual(self.planner.import_file(json_path), 1)
+        self.assertEqual(self.planner.import_file(csv_path), 0)
+        records = {record.media_id: record for _, record in self.store.iter_records()}
+        self.assertEqual(records['1'].engagement, 124)
+        self.assertEqual(records['3'].posted_at, parse_time('2024-01-02T18:00:00Z'))
+
+    def test_year_of_history_for_many_accounts_plans_within_a_second(self):
+        rng = random.Random(3)
+        rows = [(f'account-{a}', f'{a}-{n}', at(-365, 0) + rng.random() * 365 * 86400, rng.randint(0, 900))
+                for a in range(50) for n in range(3 * 365)]
+        self.store.conn.executemany("INSERT INTO engagement VALUES (?, ?, ?, ?)", rows)
+        accounts = [f'account-{a}' for a in range(50)]
+
+        started = time.perf_counter()
+        plan = self.planner.plan(accounts, start=at(0, 0), days=7)
+        elapsed = time.perf_counter() - started
+
+        self.assertEqual(len(plan), 50 * 7)
+        self.assertLess(elapsed, 1.0)
+
+
+class TestPlannedRounds(unittest.TestCase):
+    """
+    Test suite for queueing posting rounds from the planner.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.addCleanup(self.stub.stop)
+        self.queue = JobQueue(':memory:', clock=lambda: at(0, 9))
+        self.planner = PostingPlanner(EngagementStore(':memory:'))
+        contexts = []
+        for name in ('gallery', 'prints'):
+            client = InstagramClient('token', name, base_url=self.stub.base_url)
+            engine = SelectionEngine(PostedHistory(':memory:', account=name))
+            contexts.append(AccountContext(Account(name, name, 'token'), engine,
+                                           lambda client=client: client))
+        self.dispatcher = AccountDispatcher(contexts)
+        for p in (patch.object(main, 'get_job_queue', return_value=self.queue),
+                  patch.object(main, 'get_account_dispatcher', return_value=self.dispatcher),
+                  patch.object(main, 'get_posting_planner', return_value=self.planner),
+                  patch.object(main, 'get_config', return_value={"schedule": {"time": "09:00"}})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def select_job(self, account, key):
+        # Enqueueing with an existing dedup key returns that job
+        return self.queue.get(self.queue.enqueue(main.SELECT_JOB, dedup_key=f"{main.SELECT_JOB}:{account}:{key}"))
+
+    def test_round_syncs_engagement_and_queues_posts_at_planned_hours(self):
+        media = [{"id": f"g{day}", "timestamp": datetime.fromtimestamp(at(day - 14, 20 if day % 2 else 7)).isoformat(),
+                  "like_count": 300 if day % 2 else 3, "comments_count": 12} for day in range(14)]
+        self.stub.script('/gallery/media', payload={"data": media})
+        job = main.Job(1, main.ROUND_JOB, {"round": "2024-01-01"}, 1, 5, None, at(0, 9))
+
+        result = main.run_round_job(job)
+
+        self.assertEqual(self.planner.store.count(), 14)
+        self.assertEqual(result["planned"], [{"account": "prints", "at": "2024-01-01T09"},
+                                             {"account": "gallery", "at": "2024-01-01T20"}])
+        gallery = self.select_job('gallery', '2024-01-01T20')
+        self.assertEqual((gallery["status"], gallery["run_at"]), (PENDING, at(0, 20)))
+        self.assertEqual(gallery["payload"], {"account": "gallery", "round": "2024-01-01T20"})
+        self.assertEqual(self.select_job('prints', '2024-01-01T09')["run_at"], at(0, 9))
+        self.assertEqual(self.queue.counts(), {'pending': 3})
+
+    def test_round_counts_posts_queued_by_an_earlier_plan(self):
+        self.queue.enqueue(main.SELECT_JOB, {"account": "gallery", "round": "2024-01-01T11"}, run_at=at(0, 11),
+                           dedup_key=f"{main.SELECT_JOB}:gallery:2024-01-01T11")
+
+        planned = main.plan_round(self.queue, self.planner, '2024-01-01')
+
+        # The default 09:00 is within the minimum gap of the queued 11:00 post
+        self.assertEqual(planned, [{"account": "prints", "at": "2024-01-01T09"},
+                                   {"account": "gallery", "at": "2024-01-02T08"}])
+        self.assertEqual(self.queue.counts(), {'pending': 3})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from src.manifest import BlobRecord
+from src.preprocess import ImagePreprocessor, fit_aspect_box, prepare_image_bytes
+
+
+def encode(image, fmt='PNG', **kwargs):
+    output = io.BytesIO()
+    image.save(output, fmt, **kwargs)
+    return output.getvalue()
+
+
+def decode(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+
+class TestPrepareImage(unittest.TestCase):
+    """
+    Test suite for the Instagram resize/recompress transform.
+    """
+
+    def test_fit_aspect_box(self):
+        self.assertEqual(fit_aspect_box(1000, 1000), (0, 0, 1000, 1000))
+        self.assertEqual(fit_aspect_box(800, 2000), (0, 500, 800, 1500))
+        left, top, right, bottom = fit_aspect_box(4000, 1000)
+        self.assertAlmostEqual((right - left) / (bottom - top), 1.91, places=2)
+
+    def test_tall_transparent_png_becomes_4_by_5_jpeg(self):
+        original = Image.new('RGBA', (2000, 6000), (255, 0, 0, 128))
+
+        result = decode(prepare_image_bytes(encode(original)))
+
+        self.assertEqual(result.format, 'JPEG')
+        self.assertEqual(result.mode, 'RGB')
+        self.assertEqual(result.size, (1080, 1350))
+
+    def test_small_images_are_not_upscaled(self):
+        result = decode(prepare_image_bytes(encode(Image.new('RGB', (600, 600)))))
+
+        self.assertEqual(result.size, (600, 600))
+
+    def test_exif_orientation_is_applied(self):
+        original = Image.new('RGB', (200, 100), (0, 128, 0))
+        exif = original.getexif()
+        exif[0x0112] = 6  # rotate 90 degrees clockwise on display
+
+        result = decode(prepare_image_bytes(encode(original, 'JPEG', exif=exif)))
+
+        self.assertEqual(result.size, (100, 125))
+
+
+class TestImagePreprocessor(unittest.TestCase):
+    """
+    Test suite for the cached derivative pipeline.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.originals = {f'scans/{i}.png': encode(Image.new('RGB', (2400, 1600), (i, 0, 0)))
+                          for i in range(3)}
+        self.uploaded = {}
+        self.downloads = []
+        self.preprocessor = ImagePreprocessor(
+            self.download, self.upload, os.path.join(self.tmpdir, 'derived.sqlite3'),
+            max_workers=2
+        )
+
+    def tearDown(self):
+        self.preprocessor.close()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, record, local_path):
+        blob_name = record.name
+        self.downloads.append(blob_name)
+        with open(local_path, 'wb') as f:
+            f.write(self.originals[blob_name])
+        return True
+
+    def upload(self, local_path, remote_name):
+        with open(local_path, 'rb') as f:
+            self.uploaded[remote_name] = f.read()
+        return f'https://example.com/{remote_name}'
+
+    def records(self):
+        return [BlobRecord(name, 1, len(data), '', 'image/png', f'https://example.com/{name}', 0.0)
+                for name, data in self.originals.items()]
+
+    def test_batch_is_processed_once_and_cached(self):
+        first = self.preprocessor.prepare_batch(self.records())
+        second = self.preprocessor.prepare_batch(self.records())
+
+        self.assertEqual(len(first), 3)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.uploaded), 3)
+        name, data = next(iter(self.uploaded.items()))
+        self.assertTrue(name.startswith('derived/') and name.endswith('-w1080-q85.jpg'))
+        self.assertEqual(decode(data).size, (1080, 720))
+
+    def test_known_md5_skips_the_download(self):
+        record = BlobRecord('scans/0.png', 1, 1, 'kX5hbMTqBrgl0DJrW0y+Iw==', 'image/png',
+                            'https://example.com/scans/0.png', 0.0)
+        self.preprocessor.prepare(record)
+        self.downloads.clear()
+
+        url = self.preprocessor.prepare(record)
+
+        self.assertTrue(url.startswith('https://example.com/derived/'))
+        self.assertEqual(self.downloads, [])
+
+    def test_existing_bucket_derivative_is_reused(self):
+        self.preprocessor.exists = lambda name: f'https://bucket/{name}'
+        record = BlobRecord('scans/0.png', 1, 1, 'kX5hbMTqBrgl0DJrW0y+Iw==', 'image/png',
+                            'https://example.com/scans/0.png', 0.0)
+
+        url = self.preprocessor.prepare(record)
+
+        self.assertTrue(url.startswith('https://bucket/derived/'))
+        self.assertEqual(self.downloads, [])
+        self.assertEqual(self.uploaded, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
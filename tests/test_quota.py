@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from src import main
+from src.accounts import Account, AccountContext, AccountDispatcher
+from src.history import PostedHistory
+from src.instagram_client import InstagramClient
+from src.jobs import JobQueue, JobRunner
+from src.manifest import BlobRecord
+from src.quota import PublishQuota
+from src.rotation import InMemorySource, SelectionEngine
+from tests.fakes import FakeClock, GraphAPIStub
+
+
+def make_record(name):
+    return BlobRecord(name, 1, 10, f'md5-{name}', 'image/jpeg', f'https://example.com/{name}', 0.0)
+
+
+class FakeStorageManager:
+    def candidate_source(self):
+        return InMemorySource([])
+
+
+class TestPublishQuota(unittest.TestCase):
+    """
+    Test suite for the sliding-window publishing quota.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.quota = PublishQuota(':memory:', limit=3, window=100, clock=self.clock)
+
+    def test_window_admits_until_full_and_frees_the_oldest_slot(self):
+        for key in ('a', 'b', 'c'):
+            self.assertTrue(self.quota.admit('gallery', key).admitted)
+            self.clock.now += 10
+
+        refused = self.quota.admit('gallery', 'd')
+
+        self.assertEqual(refused, (False, 3, 3, 70.0))
+        self.assertTrue(self.quota.admit('gallery', 'b').admitted)
+        self.assertTrue(self.quota.admit('prints', 'd').admitted)
+        self.quota.release('gallery', 'c')
+        self.assertTrue(self.quota.admit('gallery', 'd').admitted)
+        self.clock.now = 1000 + 100
+        self.assertEqual(self.quota.usage('gallery'), 2)
+        self.assertEqual(self.quota.retry_after('gallery'), 0)
+
+    def test_publishes_survive_a_restart(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'quota.sqlite3')
+        quota = PublishQuota(path, limit=2, clock=self.clock)
+        quota.admit('gallery', 'a')
+        quota.record_publish('gallery', 'a', 'media-1')
+        quota.record_publish('gallery', 'posted-directly', 'media-2')
+        quota.close()
+
+        reopened = PublishQuota(path, limit=2, clock=self.clock)
+
+        self.assertEqual(reopened.usage('gallery'), 2)
+        self.assertFalse(reopened.admit('gallery', 'b').admitted)
+
+    def test_sync_counts_posts_made_elsewhere(self):
+        stub = GraphAPIStub().start()
+        self.addCleanup(stub.stop)
+        stub.published['gallery'] = 48
+        client = InstagramClient('token', 'gallery', base_url=stub.base_url)
+        quota = PublishQuota(':memory:', sync_interval=900, clock=self.clock)
+
+        synced = [quota.sync('gallery', client), quota.sync('gallery', client)]
+        admitted = [quota.admit('gallery', key) for key in ('a', 'b', 'c')]
+
+        self.assertEqual(synced, [True, False])
+        self.assertEqual(len(stub.calls('/gallery/content_publishing_limit')), 1)
+        self.assertEqual([a.admitted for a in admitted], [True, True, False])
+        self.assertEqual(admitted[-1].retry_after, 900)
+
+
+class TestQuotaAdmission(unittest.TestCase):
+    """
+    Test suite for deferring posts while an account's quota is used up.
+    """
+
+    def setUp(self):
+        self.stub = GraphAPIStub().start()
+        self.addCleanup(self.stub.stop)
+        self.stub.publishing_limit = 1
+        self.clock = FakeClock(datetime(2024, 1, 1, 9, 0).timestamp())
+        self.queue = JobQueue(':memory:', clock=self.clock)
+        self.quota = PublishQuota(':memory:', sync_interval=900, clock=self.clock)
+        self.client = InstagramClient('token', 'gallery', base_url=self.stub.base_url)
+        engine = SelectionEngine(PostedHistory(':memory:', account='gallery', clock=self.clock))
+        context = AccountContext(Account('gallery', 'gallery', 'token'), engine, lambda: self.client)
+        dispatcher = AccountDispatcher([context])
+        for p in (patch.object(main, 'get_job_queue', return_value=self.queue),
+                  patch.object(main, 'get_account_dispatcher', return_value=dispatcher),
+                  patch.object(main, 'get_publish_quota', return_value=self.quota),
+                  patch.object(main, 'get_storage_manager', return_value=FakeStorageManager()),
+                  patch.object(main, 'instagram_url_for', side_effect=lambda record: record.public_url),
+                  patch.object(main, 'get_config', return_value={})):
+            p.start()
+            self.addCleanup(p.stop)
+        self.runner = JobRunner(self.queue, main.JOB_HANDLERS)
+
+    def container_job(self, round_key, name):
+        return self.queue.enqueue(main.CONTAINER_JOB, {"account": "gallery", "round": round_key,
+                                                       "record": make_record(name)._asdict(),
+                                                       "caption": "caption"})
+
+    def test_post_over_quota_is_deferred_before_its_container(self):
+        self.container_job('2024-01-01T09', 'a.jpg')
+        second = self.container_job('2024-01-01T15', 'b.jpg')
+
+        self.runner.run_pending()
+
+        job = self.queue.get(second)
+        self.assertEqual((job["status"], job["attempts"]), ('pending', 0))
+        self.assertEqual(job["run_at"], self.clock.now + 86400)
+        self.assertEqual(len(self.stub.calls('/gallery/media')), 1)
+        self.assertEqual(len(self.stub.calls('/gallery/media_publish')), 1)
+        self.assertEqual(self.quota.usage('gallery'), 1)
+
+    def test_refused_publish_waits_for_the_quota(self):
+        self.container_job('2024-01-01T09', 'a.jpg')
+        # Another tool posts after the quota was synced
+        self.quota.sync('gallery', self.client)
+        self.stub.published['gallery'] = 1
+
+        self.runner.run_pending()
+
+        publish = self.queue.get(self.queue.enqueue(main.PUBLISH_JOB, dedup_key='publish:gallery:2024-01-01T09'))
+        self.assertEqual((publish["status"], publish["attempts"]), ('pending', 0))
+        self.assertEqual(publish["run_at"], self.clock.now + 900)
+        self.assertFalse(self.quota.admit('gallery', 'other').admitted)
+
+        self.stub.published['gallery'] = 0
+        self.clock.now = publish["run_at"]
+        self.runner.run_pending()
+
+        self.assertEqual(self.queue.get(publish["id"])["status"], 'done')
+        self.assertEqual(len(self.stub.calls('/gallery/media')), 1)
+
+    def test_publish_without_a_media_id_keeps_its_slot(self):
+        self.stub.script('/gallery/media_publish', payload={})
+        self.container_job('2024-01-01T09', 'a.jpg')
+
+        self.runner.run_pending()
+
+        publish = self.queue.get(self.queue.enqueue(main.PUBLISH_JOB, dedup_key='publish:gallery:2024-01-01T09'))
+        self.assertIn('No media ID', publish["last_error"])
+        self.assertEqual(self.quota.usage('gallery'), 1)
+
+    def test_direct_post_over_quota_is_deferred(self):
+        first = main.publish_image(self.client, 'https://example.com/a.jpg', 'caption', account='gallery')
+        second = main.publish_image(self.client, 'https://example.com/b.jpg', 'caption', account='gallery')
+
+        self.assertTrue(first["success"])
+        self.assertEqual((second["deferred"], second["retry_after"]), (True, 86400))
+        self.assertEqual(len(self.stub.calls('/gallery/media')), 1)
+
+    def test_failed_direct_post_gives_its_slot_back(self):
+        with patch.object(self.client, 'wait_for_containers', side_effect=RuntimeError('boom')):
+            failed = main.publish_image(self.client, 'https://example.com/a.jpg', 'caption', account='gallery')
+
+        self.assertEqual(failed["error"], "Unexpected error: boom")
+        self.assertEqual(self.quota.usage('gallery'), 0)
+        self.assertTrue(main.publish_image(self.client, 'https://example.com/a.jpg', 'caption',
+                                           account='gallery')["success"])
+
+    def test_carousels_count_against_the_quota(self):
+        urls = ['https://example.com/a.jpg', 'https://example.com/b.jpg']
+        with patch.object(main, 'get_instagram_client', return_value=self.client):
+            first = main.post_carousel_to_instagram(urls, 'caption')
+            second = main.post_carousel_to_instagram(urls, 'caption')
+
+        self.assertTrue(first["success"])
+        self.assertTrue(second["deferred"])
+        self.assertEqual(self.quota.usage(main.DEFAULT_ACCOUNT), 1)
+        self.assertEqual(len(self.stub.calls('/media_publish')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+
+import requests
+
+from src import main
+from src.instagram_client import InstagramClient
+from src.replay import RECORD, Cassette, CassetteMiss, VirtualClock, _run_round, simulate
+from src.settings import build_settings
+from tests.fakes import FakeBucket, FakeGenerativeModel, GraphAPIStub
+
+
+class TestReplay(unittest.TestCase):
+    """
+    Test suite for recording, replaying and simulating against cassettes.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'cassette.jsonl')
+        self.stub = GraphAPIStub().start()
+        self.addCleanup(self.stub.stop)
+        self.bucket = FakeBucket('photos')
+
+    def test_replays_every_service_offline(self):
+        self.bucket.add_blob('a/one.jpg', b'one')
+        self.bucket.add_blob('b/two.jpg', b'two')
+        recorder = Cassette(self.path, RECORD)
+        bucket = recorder.bucket(self.bucket)
+        listed = [blob.name for blob in bucket.list_blobs(page_size=1)]
+        data = bucket.blob('a/one.jpg').download_as_bytes()
+        caption = recorder.model(FakeGenerativeModel()).generate_content(['Describe', {"data": b'one'}]).text
+        self.stub.statuses['container-1'] = ['IN_PROGRESS', 'FINISHED']
+        client = InstagramClient('secret-token', '1234', base_url=self.stub.base_url, session=recorder.session())
+        container = client.create_media_container('https://example.com/one.jpg', 'caption')
+        statuses = [client.get_container_statuses([container]) for _ in range(2)]
+        recorder.close()
+
+        player = Cassette(self.path)
+        bucket = player.bucket(name='photos')
+        client = InstagramClient('other-token', '1234', session=player.session())
+
+        self.assertNotIn('secret-token', open(self.path).read())
+        self.assertEqual([blob.name for blob in bucket.list_blobs(page_size=1)], listed)
+        self.assertEqual(bucket.blob('a/one.jpg').download_as_bytes(), data)
+        self.assertEqual(player.model().generate_content(['Describe', {"data": b'one'}]).text, caption)
+        self.assertEqual([client.get_container_statuses([container]) for _ in range(3)],
+                         statuses + statuses[-1:])
+        # Unrecorded requests fall back to what was recorded for the same route
+        self.assertEqual(client.create_media_container('https://example.com/new.jpg', 'other'), container)
+        self.assertEqual(player.stats()['instagram'], {'exact': 3, 'fallback': 1})
+        with self.assertRaises(CassetteMiss):
+            Cassette(self.path, strict=True).model().generate_content(['Describe', {"data": b'new'}])
+
+    def test_failed_requests_are_recorded_without_the_token(self):
+        # Nothing listens on a port the stub has given up
+        closed = GraphAPIStub()
+        base_url = closed.base_url
+        closed.server.server_close()
+        recorder = Cassette(self.path, RECORD)
+        client = InstagramClient('secret-token', '1234', base_url=base_url, max_retries=0,
+                                 session=recorder.session())
+        with self.assertRaises(requests.ConnectionError) as live:
+            client.recent_media()
+        recorder.close()
+
+        client = InstagramClient('other-token', '1234', max_retries=0, session=Cassette(self.path).session())
+
+        self.assertIn('secret-token', str(live.exception))
+        self.assertNotIn('secret-token', open(self.path).read())
+        with self.assertRaises(requests.ConnectionError):
+            client.recent_media()
+
+    def test_virtual_clock_stands_in_for_time(self):
+        clock = VirtualClock(start=1000.0)
+        real_sleep = time.sleep
+
+        with clock.installed(monotonic=True):
+            time.sleep(3600)
+            now, monotonic = time.time(), time.monotonic()
+
+        self.assertEqual((now, monotonic), (4600.0, 4600.0))
+        self.assertIs(time.sleep, real_sleep)
+
+    def test_simulates_weeks_of_rounds_from_one_recorded_round(self):
+        for i in range(10):
+            self.bucket.add_blob(f'art/{i:02d}.jpg', b'image %d' % i)
+        config = {"cloud_storage": {"bucket_name": "photos"},
+                  "gemini": {"api_key": "key", "thumbnails": {"enabled": False}},
+                  "instagram": {"access_token": "token", "user_id": "1234"},
+                  "preprocess": {"enabled": False},
+                  "schedule": {"time": "09:00"},
+                  "history": {"path": os.path.join(self.directory, 'history.sqlite3')},
+                  "jobs": {"path": os.path.join(self.directory, 'jobs.sqlite3')},
+                  "caption_cache": {"path": os.path.join(self.directory, 'captions.sqlite3')}}
+        main.use_settings(build_settings(config, {}))
+        self.addCleanup(main.use_settings, None)
+        recorder = Cassette(self.path, RECORD)
+        main.use_cassette(recorder)
+        self.addCleanup(main.use_cassette, None)
+        main.get_storage_manager().bucket = recorder.bucket(self.bucket)
+        main.get_caption_generator().model = recorder.model(FakeGenerativeModel())
+        main._instagram_client = InstagramClient('token', '1234', base_url=self.stub.base_url,
+                                                 session=recorder.session())
+        _run_round()
+        recorder.close()
+        main.use_cassette(None)
+
+        report = simulate(Cassette(self.path), days=14, start=datetime(2024, 1, 1, 8, 0).timestamp())
+
+        self.assertEqual(len(self.stub.calls('/media_publish')), 1)
+        self.assertEqual(report["posts"], 10)
+        self.assertEqual(report["posts_per_day"], [1] * 10 + [0] * 4)
+        self.assertEqual(report["days_without_posts"], 4)
+        self.assertNotIn('missed', report["calls"].get('instagram', {}))
+        self.assertGreater(report["calls"]["gemini"]["fallback"], 0)
+        self.assertLess(report["wall_seconds"], 10)
+        # The simulation's state never reached the recording run's files
+        self.assertEqual(main.PostedHistory(config["history"]["path"]).count(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from src import main
+from src.instagram_client import InstagramClient
+from src.jobs import RetryLater
+from src.resilience import (CLOSED, HALF_OPEN, OPEN, AdaptiveLimiter, CircuitBreaker,
+                            CircuitOpenError, ConcurrencyLimitExceeded, Endpoint, is_failure)
+from src.settings import build_settings
+from tests.fakes import FakeClock, GraphAPIStub
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class OverloadedModel:
+    """Gemini stand-in answering every request with a 503."""
+
+    def __init__(self):
+        self.requests = 0
+
+    def generate_content(self, contents, **kwargs):
+        self.requests += 1
+        raise HTTPError(503)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    """
+    Test suite for the circuit breaker and the adaptive concurrency limit.
+    """
+
+    def test_opens_after_consecutive_failures_and_probes_after_timeout(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=10, clock=clock)
+        for _ in range(3):
+            breaker.allow()
+            breaker.record(True)
+
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError) as raised:
+            breaker.allow()
+        self.assertEqual(raised.exception.retry_after, 10)
+
+        clock.now = 11
+        breaker.allow()
+        self.assertEqual(breaker.state, HALF_OPEN)
+        # Only one probe at a time
+        with self.assertRaises(CircuitOpenError):
+            breaker.allow()
+        breaker.record(True)
+        self.assertEqual(breaker.state, OPEN)
+
+        clock.now = 22
+        breaker.allow()
+        breaker.record(False)
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_opens_on_failure_rate(self):
+        breaker = CircuitBreaker('test', failure_threshold=100, failure_rate=0.5, window=10)
+        for k in range(10):
+            breaker.allow()
+            breaker.record(k % 2 == 1)
+
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_limiter_grows_on_success_and_halves_on_overload(self):
+        limiter = AdaptiveLimiter('test', initial=4, max_limit=6)
+        for _ in range(40):
+            self.assertTrue(limiter.acquire(0))
+            limiter.release(0.01)
+        self.assertEqual(limiter.limit, 6)
+
+        limiter.acquire(0)
+        limiter.release(overloaded=True)
+        self.assertEqual(limiter.limit, 3)
+
+        for _ in range(3):
+            self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0))
+
+
+class TestEndpoint(unittest.TestCase):
+    """
+    Test suite for retries, shedding and hedging of endpoint calls.
+    """
+
+    def test_client_errors_are_not_failures(self):
+        self.assertFalse(is_failure(HTTPError(404)))
+        self.assertTrue(is_failure(HTTPError(503)))
+        self.assertTrue(is_failure(TimeoutError()))
+        self.assertFalse(is_failure(ValueError('bad input')))
+
+    def test_retries_idempotent_calls_within_budget(self):
+        endpoint = Endpoint('test', retries=2, base_delay=0, max_delay=0)
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionError('reset')
+            return 'ok'
+
+        self.assertEqual(endpoint.call(flaky), 'ok')
+        self.assertEqual(len(calls), 3)
+
+        calls.clear()
+        with self.assertRaises(ConnectionError):
+            endpoint.call(flaky, idempotent=False)
+        self.assertEqual(len(calls), 1)
+
+    def test_retry_budget_limits_retries(self):
+        endpoint = Endpoint('test', failure_threshold=1000, window=1000, retries=5, retry_budget=0,
+                            base_delay=0, max_delay=0)
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise ConnectionError('down')
+
+        for _ in range(5):
+            with self.assertRaises(ConnectionError):
+                endpoint.call(failing)
+
+        # Ten starting tokens, then every call is made only once
+        self.assertEqual(len(calls), 15)
+
+    def test_open_circuit_fails_fast(self):
+        endpoint = Endpoint('test', failure_threshold=2, retries=0)
+        calls = []
+
+        def failing():
+            calls.append(1)
+            raise HTTPError(503)
+
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                endpoint.call(failing)
+        with self.assertRaises(CircuitOpenError):
+            endpoint.call(failing)
+
+        self.assertEqual(len(calls), 2)
+
+    def test_sheds_calls_without_a_free_slot(self):
+        endpoint = Endpoint('test', initial_concurrency=1, max_concurrency=1, max_wait=0.05)
+        release = threading.Event()
+        worker = threading.Thread(target=endpoint.call, args=(lambda: release.wait(5),))
+        worker.start()
+        time.sleep(0.05)
+
+        with self.assertRaises(ConcurrencyLimitExceeded):
+            endpoint.call(lambda: 'second')
+        release.set()
+        worker.join()
+        self.assertEqual(endpoint.breaker.state, CLOSED)
+
+    def test_hedges_slow_calls(self):
+        endpoint = Endpoint('test', hedge=True, min_hedge_delay=0.01)
+        for _ in range(20):
+            endpoint.call(lambda: None)
+        calls = []
+
+        def sometimes_slow():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(1)
+                return 'slow'
+            return 'fast'
+
+        started = time.monotonic()
+        self.assertEqual(endpoint.call(sometimes_slow), 'fast')
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(endpoint.call(sometimes_slow, hedge=False), 'fast')
+
+    def test_close_stops_the_hedging_threads(self):
+        endpoint = Endpoint('test', hedge=True, min_hedge_delay=0.01)
+        for _ in range(25):
+            endpoint.call(lambda: None)
+        executor = endpoint._executor
+
+        endpoint.close()
+
+        self.assertIsNotNone(executor)
+        self.assertTrue(executor._shutdown)
+        self.assertEqual(endpoint.call(lambda: 'unhedged'), 'unhedged')
+        self.assertIsNone(endpoint._executor)
+
+    def test_reload_and_reset_close_the_endpoints_they_replace(self):
+        config = {'resilience': {'storage': {'retries': 1}}}
+        with patch.object(main, 'get_config', return_value=config):
+            manager = main.get_storage_manager()
+            generator = main.get_caption_generator()
+            replaced = [manager.resilience, generator.resilience]
+            main.apply_settings(build_settings({}, {}), build_settings(config, {}))
+            current = [manager.resilience, generator.resilience]
+            main.reset_components()
+
+        self.assertTrue(all(endpoint._closed for endpoint in replaced + current))
+        self.assertFalse(any(old is new for old, new in zip(replaced, current)))
+
+
+class TestResilienceIntegration(unittest.TestCase):
+    """
+    Test suite for the breakers guarding Gemini and the Graph API.
+    """
+
+    def test_gemini_outage_gives_no_caption_and_defers_the_job(self):
+        config = {'gemini': {'api_key': 'key'},
+                  'resilience': {'gemini': {'failure_threshold': 2, 'retries': 0}}}
+        with patch.object(main, 'get_config', return_value=config):
+            generator = main.GeminiCaptionGenerator()
+        generator.model = OverloadedModel()
+
+        for _ in range(2):
+            generator.generate_caption('https://example.com/a.jpg')
+        self.assertEqual(generator.resilience.breaker.state, OPEN)
+        self.assertEqual(generator.generate_caption('https://example.com/a.jpg'), '')
+        self.assertEqual(generator.model.requests, 2)
+
+        job = main.Job(id=1, kind=main.CAPTION_JOB,
+                       payload={"record": {"name": 'a.jpg', "generation": 1, "size": 10, "md5_hash": 'x',
+                                           "content_type": 'image/jpeg', "public_url": 'u', "updated": 0.0}},
+                       attempts=0, max_attempts=3, dedup_key=None, run_at=0.0)
+        with patch.object(main, 'get_caption_generator', return_value=generator), \
+                patch.object(main, 'caption_for_record', return_value=''):
+            with self.assertRaises(RetryLater):
+                main.JOB_HANDLERS[main.CAPTION_JOB](job)
+
+    def test_graph_api_errors_open_the_shared_circuit(self):
+        stub = GraphAPIStub().start()
+        self.addCleanup(stub.stop)
+        endpoint = Endpoint('instagram', failure_threshold=2, retries=0)
+        client = InstagramClient('token', 'user', base_url=stub.base_url, max_retries=0,
+                                 resilience=endpoint)
+        self.addCleanup(client.close)
+        for _ in range(2):
+            stub.script('media', status=503, payload={"error": {"message": "down"}})
+            with self.assertRaises(Exception):
+                client.create_media_container('https://example.com/a.jpg', 'caption')
+
+        with self.assertRaises(CircuitOpenError):
+            client.create_media_container('https://example.com/a.jpg', 'caption')
+        self.assertEqual(len(stub.calls('/media')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
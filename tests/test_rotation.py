@@ -0,0 +1,164 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from src.history import PostedHistory
+from src.manifest import BucketManifest, BlobRecord
+from src.rotation import (InMemorySource, SelectionEngine, OldestUnpostedFirst,
+                          WeightedRandom, RoundRobinByFolder, build_strategy)
+from tests.fakes import FakeBucket, FakeClock
+
+
+def make_record(name, updated, md5=None):
+    return BlobRecord(name, 1, 10, md5 or f'md5-{name}', 'image/jpeg',
+                      f'https://example.com/{name}', updated)
+
+
+class TestPostedHistory(unittest.TestCase):
+    """
+    Test suite for the posted-history ledger.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock(1_000_000.0)
+        self.history = PostedHistory(':memory:', clock=self.clock)
+
+    def test_lookup_by_name_and_content_hash(self):
+        self.history.record_post('a.jpg', 'hash-a', media_id='1')
+
+        self.assertTrue(self.history.is_posted('a.jpg'))
+        self.assertTrue(self.history.is_posted('copy-of-a.jpg', 'hash-a'))
+        self.assertFalse(self.history.is_posted('b.jpg', 'hash-b'))
+
+    def test_no_repeat_window(self):
+        self.history.record_post('a.jpg')
+        self.clock.now += 3600
+
+        self.assertTrue(self.history.is_posted('a.jpg', within=7200))
+        self.assertFalse(self.history.is_posted('a.jpg', within=1800))
+
+    def test_accounts_are_isolated(self):
+        other = PostedHistory(':memory:', account='other')
+        other._conn = self.history.conn
+        self.history.record_post('a.jpg')
+
+        self.assertFalse(other.is_posted('a.jpg'))
+
+
+class TestSelectionEngine(unittest.TestCase):
+    """
+    Test suite for the rotation strategies.
+    """
+
+    def setUp(self):
+        self.clock = FakeClock(1_000_000.0)
+        self.history = PostedHistory(':memory:', clock=self.clock)
+        self.source = InMemorySource([
+            make_record('cats/1.jpg', 30),
+            make_record('cats/2.jpg', 10),
+            make_record('dogs/1.jpg', 20),
+            make_record('dogs/2.jpg', 40),
+            make_record('birds/1.jpg', 50),
+        ])
+
+    def post_next(self, engine):
+        record = engine.select(self.source)
+        engine.mark_posted(record, self.source, media_id='m')
+        return record.name
+
+    def test_oldest_unposted_first_never_repeats(self):
+        engine = SelectionEngine(self.history, OldestUnpostedFirst())
+
+        posted = [self.post_next(engine) for _ in range(5)]
+
+        self.assertEqual(posted, ['cats/2.jpg', 'dogs/1.jpg', 'cats/1.jpg',
+                                  'dogs/2.jpg', 'birds/1.jpg'])
+        self.assertIsNone(engine.select(self.source))
+
+    def test_no_repeat_window_wraps_around(self):
+        engine = SelectionEngine(self.history, OldestUnpostedFirst(), no_repeat_window=100)
+        for _ in range(5):
+            self.post_next(engine)
+            self.clock.now += 30
+
+        # Only the first two posts have aged out of the 100s window
+        self.assertEqual(engine.peek(self.source, 5)[0].name, 'cats/2.jpg')
+        self.assertEqual(len(engine.peek(self.source, 5)), 2)
+
+    def test_content_hash_duplicates_are_skipped(self):
+        source = InMemorySource([make_record('a.jpg', 1, 'same'), make_record('b.jpg', 2, 'same'),
+                                 make_record('c.jpg', 3)])
+        engine = SelectionEngine(self.history)
+
+        engine.mark_posted(engine.select(source), source)
+
+        self.assertEqual(engine.select(source).name, 'c.jpg')
+
+    def test_round_robin_by_folder(self):
+        engine = SelectionEngine(self.history, RoundRobinByFolder())
+
+        posted = [self.post_next(engine) for _ in range(5)]
+
+        self.assertEqual(posted, ['birds/1.jpg', 'cats/2.jpg', 'dogs/1.jpg',
+                                  'cats/1.jpg', 'dogs/2.jpg'])
+
+    def test_weighted_random_respects_weights(self):
+        strategy = WeightedRandom(weights={'dogs/': 0}, rng=random.Random(7))
+        engine = SelectionEngine(self.history, strategy)
+
+        picks = {engine.select(self.source).name for _ in range(20)}
+
+        self.assertTrue(picks)
+        self.assertFalse(any(name.startswith('dogs/') for name in picks))
+
+    def test_weighted_random_finds_the_last_unposted_image(self):
+        source = InMemorySource([make_record(f'art/{i:03d}.jpg', i) for i in range(500)])
+        for i in range(499):
+            self.history.record_post(f'art/{i:03d}.jpg', f'md5-art/{i:03d}.jpg')
+        engine = SelectionEngine(self.history, WeightedRandom(sample_size=4, max_rounds=2,
+                                                              rng=random.Random(7)))
+
+        self.assertEqual(engine.select(source).name, 'art/499.jpg')
+
+    def test_build_strategy_rejects_unknown_names(self):
+        self.assertIsInstance(build_strategy('round_robin_folder'), RoundRobinByFolder)
+        with self.assertRaises(ValueError):
+            build_strategy('newest_first')
+
+
+class TestSelectionWithManifest(unittest.TestCase):
+    """
+    The engine should work directly on top of the SQLite manifest.
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        bucket = FakeBucket()
+        for i in range(50):
+            bucket.add_blob(f'folder{i % 3}/{i:03d}.jpg', f'image {i}'.encode())
+        self.manifest = BucketManifest(os.path.join(self.tmpdir, 'manifest.sqlite3'))
+        self.manifest.refresh(bucket)
+        self.history = PostedHistory(os.path.join(self.tmpdir, 'history.sqlite3'))
+
+    def tearDown(self):
+        self.manifest.close()
+        self.history.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_strategies_select_distinct_images(self):
+        for name in ('oldest_unposted', 'weighted_random', 'round_robin_folder'):
+            engine = SelectionEngine(self.history, build_strategy(name))
+            posted = set()
+            for _ in range(5):
+                record = engine.select(self.manifest)
+                self.assertNotIn(record.name, posted)
+                posted.add(record.name)
+                engine.mark_posted(record, self.manifest)
+
+        self.assertEqual(self.history.count(), 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
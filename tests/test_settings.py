@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from src import main
+from src.jobs import JobQueue
+from src.settings import Settings, SettingsError, SettingsStore, build_settings
+
+
+class TestSettings(unittest.TestCase):
+    """
+    Test suite for building, validating and hot-reloading settings.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.config_path = os.path.join(self.directory, 'config.yaml')
+        self.env_path = os.path.join(self.directory, '.env')
+        self.writes = 0
+        # The store exports .env values; restore the environment afterwards
+        environ = patch.dict(os.environ, {})
+        environ.start()
+        self.addCleanup(environ.stop)
+        for variable in ('GEMINI_API_KEY', 'INSTAGRAM_ACCESS_TOKEN', 'INSTAGRAM_USER_ID'):
+            os.environ.pop(variable, None)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+        # Make every write visible even on coarse file timestamps
+        self.writes += 1
+        os.utime(path, (self.writes, self.writes))
+
+    def test_environment_overrides_env_file_overrides_config(self):
+        self.write(self.config_path, "gemini:\n  api_key: from-config\n  model: gemini-pro\n"
+                                     "instagram:\n  user_id: 1234\n  access_token: from-config\n")
+        self.write(self.env_path, "GEMINI_API_KEY=from-dotenv\nINSTAGRAM_ACCESS_TOKEN=from-dotenv\n")
+        os.environ['INSTAGRAM_ACCESS_TOKEN'] = 'from-process'
+
+        settings = SettingsStore(self.config_path, self.env_path).current
+
+        self.assertEqual(settings.gemini.api_key, 'from-dotenv')
+        self.assertEqual(settings.gemini.model, 'gemini-pro')
+        self.assertEqual(settings.instagram.access_token, 'from-process')
+        self.assertEqual(settings.instagram.user_id, '1234')
+        self.assertEqual(settings.raw['gemini']['api_key'], 'from-dotenv')
+        self.assertEqual(os.environ['GEMINI_API_KEY'], 'from-dotenv')
+        with self.assertRaises(TypeError):
+            settings.raw['gemini']['model'] = 'changed'
+
+    def test_reports_every_invalid_value(self):
+        config = {"schedule": {"time": "25:00"}, "instagram": {"pool_size": 0, "read_timeout": "slow"},
+                  "accounts": [{"name": "a", "user_id": "1"}]}
+
+        with self.assertRaises(SettingsError) as raised:
+            build_settings(config, {})
+
+        self.assertEqual(len(raised.exception.problems), 4)
+        self.assertIn("schedule.time", str(raised.exception))
+
+    def test_reload_swaps_snapshots_and_keeps_them_when_invalid(self):
+        self.write(self.config_path, "schedule:\n  time: '09:00'\ngemini:\n  prompt_template: old\n")
+        store = SettingsStore(self.config_path, self.env_path)
+        changes = []
+        store.subscribe(lambda old, new: changes.append(new.changed_sections(old)))
+        first = store.current
+
+        self.assertFalse(store.reload())
+        self.write(self.config_path, "schedule:\n  time: '18:30'\ngemini:\n  prompt_template: new\n")
+        self.assertTrue(store.reload())
+        self.write(self.config_path, "schedule:\n  time: 'teatime'\n")
+        self.assertFalse(store.reload())
+
+        self.assertEqual(first.schedule_time, '09:00')
+        self.assertEqual(store.current.schedule_time, '18:30')
+        self.assertEqual(store.current.gemini.prompt_template, 'new')
+        self.assertEqual(changes, [{'schedule', 'gemini'}])
+
+    def test_rotated_account_token_in_env_file_is_a_change(self):
+        self.write(self.config_path, "accounts:\n  - name: gallery\n    user_id: 1\n"
+                                     "    access_token_env: GAL_TOK\n")
+        self.write(self.env_path, "GAL_TOK=old-token\nSTALE=gone-soon\n")
+        store = SettingsStore(self.config_path, self.env_path)
+        changes = []
+        store.subscribe(lambda old, new: changes.append(new.changed_sections(old)))
+        first = store.current
+
+        self.write(self.env_path, "GAL_TOK=new-token\n")
+        self.assertTrue(store.reload())
+
+        self.assertEqual(first.accounts[0].access_token, 'old-token')
+        self.assertEqual(store.current.accounts[0].access_token, 'new-token')
+        self.assertEqual(changes, [{'accounts'}])
+        self.assertNotIn('STALE', os.environ)
+        # Tokens come from the environment the settings are built with
+        built = build_settings({"accounts": [{"name": "a", "user_id": "1", "access_token_env": "A_TOK"}]},
+                               {"A_TOK": "given"})
+        self.assertEqual(built.accounts[0].access_token, 'given')
+
+    def test_apply_settings_updates_prompts_and_moves_the_round(self):
+        old = build_settings({"schedule": {"time": "09:00"}}, {})
+        new = build_settings({"schedule": {"time": "18:30"},
+                              "gemini": {"prompt_template": "Describe {image_url}"}}, {})
+        now = datetime(2024, 1, 1, 8, 0).timestamp()
+        queue = JobQueue(':memory:', clock=lambda: now)
+        generator = main.GeminiCaptionGenerator()
+        with patch.object(main, 'get_settings', return_value=old):
+            main.schedule_round(queue)
+
+        get_job_queue = MagicMock(return_value=queue)
+        get_job_queue.peek.return_value = queue
+        with patch.object(main, 'get_settings', return_value=new), \
+                patch.object(main, 'get_job_queue', get_job_queue), \
+                patch.object(main.get_caption_generator, 'peek', return_value=generator):
+            main.apply_settings(old, new)
+
+        self.assertEqual(generator.build_prompt('u'), 'Describe u')
+        self.assertEqual(queue.counts(), {'pending': 1})
+        self.assertEqual(queue.next_due_at(), datetime(2024, 1, 1, 18, 30).timestamp())
+
+    def test_apply_settings_rebuilds_what_a_section_feeds(self):
+        def config(name):
+            return {"history": {"path": os.path.join(self.directory, f'{name}-history.sqlite3')},
+                    "caption_cache": {"path": os.path.join(self.directory, f'{name}-captions.sqlite3')}}
+        old = build_settings(config('old'), {})
+        new = build_settings({**config('new'), "cloud_storage": {"bucket_name": "other"}}, {})
+        main.use_settings(old)
+        self.addCleanup(main.use_settings, None)
+        self.addCleanup(main.reset_components)
+        engine = main.get_selection_engine()
+        main.get_caption_cache()
+
+        main.use_settings(new)
+        with self.assertLogs('src.main', 'WARNING') as logs:
+            main.apply_settings(old, new)
+
+        self.assertIsNot(main.get_selection_engine(), engine)
+        self.assertEqual(main.get_posted_history().path, new.raw["history"]["path"])
+        self.assertEqual(main.get_caption_cache().path, new.raw["caption_cache"]["path"])
+        self.assertIn('cloud_storage take effect after a restart', logs.output[0])
+
+    def test_settings_default_to_an_empty_config(self):
+        settings = build_settings({}, {})
+
+        self.assertEqual(settings, Settings(loaded_at=settings.loaded_at))
+        self.assertEqual(settings.section('gemini'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from src import main
+from benchmarks.import_time import parse_importtime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, logging, sys
+import src.main
+print(json.dumps({
+    "modules": sorted(m for m in sys.modules
+                      if m.startswith(('google.cloud', 'google.generativeai', 'google.oauth2',
+                                       'requests', 'schedule', 'dotenv',
+                                       'PIL', 'google_crc32c'))),
+    "handlers": len(logging.getLogger().handlers),
+}))
+"""
+
+
+class TestStartup(unittest.TestCase):
+    """
+    Test suite for side-effect-free, lazy imports of src.main.
+    """
+
+    def test_import_loads_no_clients_and_touches_nothing(self):
+        with tempfile.TemporaryDirectory() as workdir:
+            env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+            result = subprocess.run([sys.executable, '-c', PROBE], cwd=workdir, env=env,
+                                    capture_output=True, text=True, check=True)
+            created = os.listdir(workdir)
+
+        probe = json.loads(result.stdout)
+        self.assertEqual(probe["modules"], [])
+        self.assertEqual(probe["handlers"], 0)
+        self.assertEqual(created, [])
+        self.assertEqual(result.stderr, '')
+
+    def test_shared_objects_are_built_once(self):
+        self.assertIs(main.get_storage_manager(), main.get_storage_manager())
+        self.assertIs(main.storage_manager, main.get_storage_manager())
+        self.assertIs(main.cached_captioner.generator, main.caption_generator)
+        with self.assertRaises(AttributeError):
+            main.no_such_attribute
+
+    def test_parse_importtime(self):
+        stderr = ("import time: self [us] | cumulative | imported package\n"
+                  "import time:       120 |        120 |   yaml.error\n"
+                  "import time:      1500 |       9000 | src.main\n")
+
+        self.assertEqual(parse_importtime(stderr), {"yaml.error": (120, 120), "src.main": (1500, 9000)})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from src.main import GoogleCloudStorageManager
+from src.uploads import CHUNK_ALIGNMENT, BulkUploader, file_md5, find_images
+from tests.fakes import FakeBlob, FakeBucket, Faults
+
+
+class TestBulkUpload(unittest.TestCase):
+    """
+    Test suite for hashing, deduplicating and uploading local images.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.bucket = FakeBucket()
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_finds_images_and_names_blobs_after_their_path(self):
+        self.write('a.jpg', b'a')
+        self.write('sub/b.PNG', b'b')
+        self.write('notes.txt', b'not an image')
+        single = self.write('other/c.webp', b'c')
+
+        tasks = find_images([os.path.join(self.directory, 'sub'), single], prefix='2024/')
+        everything = find_images([self.directory])
+
+        self.assertEqual([t.remote_name for t in tasks], ['2024/b.PNG', '2024/c.webp'])
+        self.assertEqual(sorted(t.remote_name for t in everything), ['a.jpg', 'other/c.webp', 'sub/b.PNG'])
+
+    def test_skips_known_and_repeated_content_and_never_overwrites(self):
+        existing = self.bucket.add_blob('old/a.jpg', b'already uploaded')
+        self.bucket.add_blob('taken.jpg', b'someone else')
+        self.write('a.jpg', b'already uploaded')
+        self.write('b.jpg', b'x' * (CHUNK_ALIGNMENT * 2 + 1))
+        self.write('copy/b.jpg', b'x' * (CHUNK_ALIGNMENT * 2 + 1))
+        self.write('taken.jpg', b'new content')
+
+        uploader = BulkUploader(self.bucket, known_hashes=[existing.md5_hash], chunk_size=CHUNK_ALIGNMENT,
+                                metadata={"batch": "spring"}, cache_control='public, max-age=86400')
+        report = uploader.run([self.directory])
+
+        self.assertEqual((report['uploaded'], report['duplicate'], report['exists'], report['failed']),
+                         (1, 2, 1, 0))
+        self.assertEqual(report['bytes'], CHUNK_ALIGNMENT * 2 + 1)
+        self.assertGreater(report['mb_per_second'], 0)
+        self.assertEqual(self.bucket.blobs['taken.jpg'].data, b'someone else')
+        # Hashing runs in parallel, so either copy of b.jpg may be the one uploaded
+        name = [r['name'] for r in report['results'] if r['status'] == 'uploaded'][0]
+        self.assertIn(name, ('b.jpg', 'copy/b.jpg'))
+        uploaded = self.bucket.blobs[name]
+        self.assertEqual(uploaded.md5_hash, file_md5(os.path.join(self.directory, 'b.jpg')))
+        self.assertEqual(uploaded.acl, 'publicRead')
+        self.assertEqual(uploaded.content_type, 'image/jpeg')
+        self.assertEqual(uploaded.metadata, {"batch": "spring", "source-file": 'b.jpg'})
+        self.assertEqual(uploaded.cache_control, 'public, max-age=86400')
+        call = [c for c in self.bucket.upload_calls if c["name"] == name][0]
+        self.assertEqual(call["requests"], 3)
+        self.assertEqual(call["if_generation_match"], 0)
+
+    def test_failed_uploads_are_reported(self):
+        for i in range(3):
+            self.write(f'{i}.jpg', f'image {i}'.encode())
+        self.bucket.faults = Faults(error_rate=1.0)
+
+        report = BulkUploader(self.bucket).run([self.directory])
+
+        self.assertEqual(report['failed'], 3)
+        self.assertIn('injected fault', report['results'][0]['error'])
+        self.assertEqual(self.bucket.blobs, {})
+
+    def test_copy_of_a_failed_upload_is_still_uploaded(self):
+        self.write('a.jpg', b'same content')
+        self.write('b.jpg', b'same content')
+        upload = FakeBlob.upload_from_filename
+        attempts = []
+
+        def fail_first(blob, filename, **kwargs):
+            attempts.append(blob.name)
+            if len(attempts) == 1:
+                raise ConnectionError('reset')
+            upload(blob, filename, **kwargs)
+
+        with patch.object(FakeBlob, 'upload_from_filename', fail_first):
+            report = BulkUploader(self.bucket).run([self.directory])
+
+        self.assertEqual(sorted(r['status'] for r in report['results']), ['failed', 'uploaded'])
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(list(self.bucket.blobs), [attempts[1]])
+
+    def test_storage_manager_dedups_against_bucket_listing(self):
+        self.bucket.add_blob('2023/a.jpg', b'a')
+        self.write('a.jpg', b'a')
+        self.write('b.jpg', b'b')
+        manager = GoogleCloudStorageManager()
+        manager.bucket = self.bucket
+        manager.manifest = None
+
+        report = manager.bulk_upload([self.directory], prefix='2024/')
+
+        self.assertEqual([r['status'] for r in report['results']], ['duplicate', 'uploaded'])
+        self.assertIn('2024/b.jpg', self.bucket.blobs)
+        self.assertNotIn('2024/a.jpg', self.bucket.blobs)
+
+
+if __name__ == '__main__':
+    unittest.main()